@@ -1,3 +1,11 @@
+import os.path
+import sys
+
+# The SANCdpd modules import each other by their plain names (e.g., "import
+# conf"), so this directory must be on the module search path.  That is
+# already true for "python3 sancdpd", but not for "python3 -m sancdpd".
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
 import cli
 
 if __name__ == '__main__':
@@ -5,4 +13,6 @@ if __name__ == '__main__':
     # In intial development, the default behavior of SANCdpd is to run the CLI.
     # If other UIs are implemented, implement a command line switch here, or
     # change the default function call to the new UI.
-    cli.startcli()
+    # With no arguments, the CLI runs its interactive menu; with a command,
+    # it runs that command and exits with its status.
+    sys.exit(cli.main(sys.argv[1:]))
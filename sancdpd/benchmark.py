@@ -0,0 +1,669 @@
+"""
+This module generates synthetic preservation repositories and runs a suite
+of benchmarks over them, so that the speed of SANCdpd's hot paths can be
+measured and compared between versions.
+
+A synthetic repository is a directory of BagIt bags laid out under a
+path_root as described by bagmgmt.DEFAULT_PATH_LAYOUT, plus a SANCdpd
+database created from the scripts in sql_ddl.  The number of files in a bag
+and the size of each file follow log-normal distributions, with medians and
+spreads given to generate_repository().  The bags are registered in the
+database as one storage location, some of them are linked as parents and
+children (in shared bag families), and any number of synthetic bag_event
+rows (millions, for realistic tables) are added, with event types, outcomes,
+and dates drawn at random from the reference tables.
+
+The benchmark suite in run_benchmarks() measures:
+    startup:  a complete run of the CLI ("agents list") in a new process
+    loadref:  loading the reference tables
+    registration:  bulk registration of every bag, in a new database
+    validation:  validation of every bag (hashing throughput)
+    lineage:  ancestors, descendants, and families of a sample of bags,
+        with each lineage backend
+    report:  an events-by-type-and-month summary, and a CSV export of every
+        bag event (with reports.export_events(), as the report command does)
+Each benchmark is run several times, and the median, minimum, and all run
+times are written, with details of the repository and the platform, to a
+JSON file.  compare_benchmarks() compares two such files and lists the
+benchmarks that have become slower by more than a tolerance.
+
+The benchmarks switch the SANCdpd database connection to the synthetic
+database (and back again at the end), so they can be run from a session
+working on any database.
+
+startup_benchmark() times only the startup of the CLI, with the current
+config file and database, and lists the slowest imports.
+
+This module contains the following functions:
+    generate_repository() :  Create a synthetic repository and database
+    run_benchmarks() :  Run the benchmark suite and write JSON results
+    startup_benchmark() :  Time CLI startup and write JSON results
+    compare_benchmarks() :  Compare two benchmark result files
+"""
+
+# Import modules from the Python standard library
+import contextlib            # for switching databases
+import datetime as dt        # for random event dates
+import hashlib               # for manifest digests
+import json                  # for the results files
+import math                  # for distribution parameters
+import os                    # for making directories
+import os.path               # for building paths
+import platform              # for describing the machine
+import random                # for the synthetic distributions
+import shutil                # for removing temporary directories
+import sqlite3 as sq         # for creating the synthetic database
+import statistics            # for medians
+import subprocess            # for timing CLI startup
+import sys                   # for the Python executable
+import tempfile              # for scratch databases and files
+import time                  # for timing
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+import dbops
+import refdata
+import operational.bagmgmt as bagmgmt
+import operational.bagval as bagval
+import operational.lineage as lineage
+import operational.reports as reports
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Directory of the SANCdpd package, and of the database scripts
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+DDL_DIR = os.path.join(os.path.dirname(PACKAGE_DIR), "sql_ddl")
+
+# Scripts run, in order, to create a database
+DDL_SCRIPTS = ["create_tables.sql", "create_views.sql",
+               "insert_event_types.sql"]
+
+# Largest synthetic file, in bytes
+MAX_FILE_BYTES = 256 * 1024 * 1024
+
+# Number of synthetic rows inserted per transaction
+INSERT_BATCH_SIZE = 100000
+
+# Number of bags whose lineage is looked up in the lineage benchmark
+LINEAGE_SAMPLE = 1000
+
+# Range of years of synthetic event dates
+EVENT_YEARS = (2015, 2025)
+
+# CLI arguments run by the startup benchmarks
+STARTUP_ARGS = ["agents", "list", "--json"]
+
+# Number of slowest imports listed by startup_benchmark()
+IMPORT_TOP = 15
+
+
+###############################################################################
+# function: _create_db
+###############################################################################
+def _create_db(dbfile):
+    """
+    Creates a new SANCdpd database at dbfile from the scripts in sql_ddl,
+    with the person agent named in the config file and the software agent
+    of this session.
+    """
+    if os.path.exists(dbfile):
+        raise Exception("Database file already exists: " + dbfile)
+    con = sq.connect(dbfile)
+    for name in DDL_SCRIPTS:
+        with open(os.path.join(DDL_DIR, name), "r") as fp:
+            con.executescript(fp.read())
+    now = dbops.timestamp()
+    con.executemany("""INSERT INTO agent
+                         (agent_type_code, is_active, agent_name, agent_code,
+                          created_time, agent_version)
+                       VALUES (?, 1, ?, ?, ?, ?)""",
+                    [("PERSN", "Benchmark person",
+                      conf.fconf["person_agent_code"], now, None),
+                     ("SOFTW", conf.sconf.get("softw_agent_name", "SANCdpd"),
+                      None, now, conf.sconf.get("softw_agent_version"))])
+    con.commit()
+    con.close()
+
+
+###############################################################################
+# function: _add_storage
+###############################################################################
+def _add_storage(path_root):
+    """
+    Adds a storage location for path_root to the current database.
+    Returns its storage_id.
+    """
+    with dbops.transaction() as cur:
+        cur.execute("""INSERT INTO storage
+                         (path_root, storage_name, storage_notes, in_use)
+                       VALUES (?, 'synthetic', 'Synthetic repository', 1)""",
+                    (path_root,))
+        storage_id = cur.lastrowid
+    refdata.invalidate()
+    return storage_id
+
+
+###############################################################################
+# function: _database
+###############################################################################
+@contextlib.contextmanager
+def _database(dbfile):
+    """
+    Context manager that points this thread's database connections (and the
+    caches that depend on them) at dbfile, and back at the configured
+    database at the end of the block.
+    """
+    saved = conf.fconf["dbfile"]
+
+    def switch(path):
+        dbops.close()
+        conf.fconf["dbfile"] = path
+        refdata.invalidate()
+        lineage.clear_index()
+
+    switch(dbfile)
+    try:
+        yield
+    finally:
+        switch(saved)
+
+
+###############################################################################
+# function: _make_bag
+###############################################################################
+def _make_bag(bagdir, index, sizes, rng):
+    """
+    Writes one synthetic bag, with payload files of the given sizes, at
+    bagdir.
+    Returns the total number of payload bytes.
+    """
+    datadir = os.path.join(bagdir, "data")
+    os.makedirs(datadir)
+    lines = []
+    for n, size in enumerate(sizes):
+        relpath = "data/" + ("sub" + str(n % 4) + "/" if n % 3 else "") + \
+                  "file_" + str(n).zfill(5) + ".bin"
+        path = os.path.join(bagdir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        h = hashlib.sha256()
+        with open(path, "wb") as fp:
+            left = size
+            while left > 0:
+                block = rng.randbytes(min(left, 1024 * 1024))
+                fp.write(block)
+                h.update(block)
+                left -= len(block)
+        lines.append(h.hexdigest() + "  " + relpath + "\n")
+
+    day = dt.date(EVENT_YEARS[0], 1, 1) + dt.timedelta(
+        days=rng.randrange(365 * (EVENT_YEARS[1] - EVENT_YEARS[0])))
+    tags = {
+        "bagit.txt": ("BagIt-Version: 1.0\n" +
+                      "Tag-File-Character-Encoding: UTF-8\n"),
+        "bag-info.txt": ("Bagging-Date: " + day.isoformat() + "\n" +
+                         "External-Identifier: synthetic_" + str(index) +
+                         "\n" +
+                         "SANC-Bib-Record-ID: b" +
+                         str(index // 100).zfill(7) + "\n" +
+                         "SANC-Item-No: " + str(index) + "\n" +
+                         "Payload-Oxum: " + str(sum(sizes)) + "." +
+                         str(len(sizes)) + "\n"),
+        "manifest-sha256.txt": "".join(lines)
+        }
+    tagmanifest = []
+    for name, text in tags.items():
+        with open(os.path.join(bagdir, name), "w") as fp:
+            fp.write(text)
+        tagmanifest.append(hashlib.sha256(text.encode()).hexdigest() +
+                           "  " + name + "\n")
+    with open(os.path.join(bagdir, "tagmanifest-sha256.txt"), "w") as fp:
+        fp.write("".join(tagmanifest))
+
+    return sum(sizes)
+
+
+###############################################################################
+# function: generate_repository
+###############################################################################
+def generate_repository(path_root, dbfile=None, bags=1000, files_per_bag=10,
+                        file_bytes=65536, size_spread=1.5, events=1000000,
+                        lineage_fraction=0.2, seed=1):
+    """
+    Creates a synthetic repository (see the module docstring) of bags under
+    path_root, and a database for it at dbfile (by default, path_root
+    without its final "/", plus ".db").  Neither may exist already.
+    The number of files in each bag has median files_per_bag, and the size
+    of each file has median file_bytes and a log-normal spread (sigma) of
+    size_spread.  The number of synthetic bag_event rows added is events.
+    The fraction of bags given a parent bag is lineage_fraction.
+    The same seed gives the same repository.
+    Returns a dictionary describing the repository.
+    """
+    path_root = os.path.join(os.path.abspath(path_root), "")
+    if dbfile is None:
+        dbfile = path_root.rstrip("/") + ".db"
+    if os.path.exists(path_root) and os.listdir(path_root):
+        raise Exception("Directory is not empty: " + path_root)
+    bags = int(bags)
+    events = int(events)
+    rng = random.Random(seed)
+    started = time.monotonic()
+
+    lg.log("generate_repository: Writing " + str(bags) + " bags under " +
+           path_root)
+    summary = {"path_root": path_root, "dbfile": dbfile, "bags": bags,
+               "files": 0, "bytes": 0}
+    for i in range(bags):
+        count = max(1, round(rng.lognormvariate(
+            math.log(max(float(files_per_bag), 1.0)), 0.75)))
+        sizes = [min(MAX_FILE_BYTES, int(rng.lognormvariate(
+                     math.log(max(float(file_bytes), 1.0)),
+                     float(size_spread))))
+                 for _ in range(count)]
+        bagdir = os.path.join(path_root, "OPEN", "PR",
+                              "RG" + str(i % 20).zfill(2),
+                              "ACC" + str(i // 50).zfill(5),
+                              "bag_" + str(i).zfill(7))
+        summary["bytes"] += _make_bag(bagdir, i, sizes, rng)
+        summary["files"] += count
+
+    _create_db(dbfile)
+    with _database(dbfile):
+        storage_id = _add_storage(path_root)
+        result = bagmgmt.register_storage(storage_id)
+        if result["errors"]:
+            raise Exception("Registration of synthetic bags failed: " +
+                            str(result["errors"][:5]))
+
+        con = dbops.connect()
+        bag_ids = [r[0] for r in con.execute(
+            "SELECT bag_id FROM bag ORDER BY bag_id")]
+
+        # Parent links, each child joining its parent's family
+        links = []
+        for n, bag_id in enumerate(bag_ids[1:], 1):
+            if rng.random() < float(lineage_fraction):
+                links.append((bag_id, bag_ids[rng.randrange(n)]))
+        with dbops.transaction() as cur:
+            cur.executemany("""INSERT INTO bag_has_parent_bag
+                                 (child_bag_id, parent_bag_id)
+                               VALUES (?, ?)""", links)
+            for child, parent in links:
+                cur.execute("""UPDATE bag SET bag_family_id =
+                                 (SELECT bag_family_id FROM bag
+                                  WHERE bag_id = ?)
+                               WHERE bag_id = ?""", (parent, child))
+        summary["parent_links"] = len(links)
+
+        # Synthetic events
+        outcomes = con.execute("""SELECT event_type_code, outcome_code
+                                  FROM event_type_outcome""").fetchall()
+        agents = dbops.agent_ids()
+        first = dt.datetime(EVENT_YEARS[0], 1, 1)
+        span = int((dt.datetime(EVENT_YEARS[1], 1, 1) - first
+                    ).total_seconds())
+        qstr = """INSERT INTO bag_event
+                    (bag_id, event_type_code, person_agent_id,
+                     software_agent_id, end_time, event_details,
+                     tools_used, outcome_code)
+                  VALUES (?, ?, ?, ?, ?, ?, 'SANCdpd benchmark', ?)"""
+        left = events
+        while left > 0:
+            rows = []
+            for _ in range(min(left, INSERT_BATCH_SIZE)):
+                etype, outcome = rng.choice(outcomes)
+                when = first + dt.timedelta(seconds=rng.randrange(span))
+                rows.append((rng.choice(bag_ids), etype, agents[0],
+                             agents[1], when.strftime("%Y-%m-%dT%H:%M:%S"),
+                             "Synthetic " + etype + " event", outcome))
+            with dbops.transaction() as cur:
+                cur.executemany(qstr, rows)
+            left -= len(rows)
+        con.execute("ANALYZE")
+        summary["events"] = con.execute(
+            "SELECT count(*) FROM bag_event").fetchone()[0]
+
+    summary["seconds"] = round(time.monotonic() - started, 3)
+    lg.log("generate_repository: Done. " + str(summary["files"]) +
+           " files, " + str(summary["bytes"]) + " bytes, " +
+           str(summary["events"]) + " events.")
+
+    return summary
+
+
+###############################################################################
+# function: _timed
+###############################################################################
+def _timed(func, repeat, setup=None):
+    """
+    Runs func repeat times, after running setup (untimed) before each run.
+    The value returned by setup, if any, is passed to func.
+    Returns a dictionary with the median and minimum times in seconds, all
+    the run times, and the value returned by the last run of func.
+    """
+    runs = []
+    value = None
+    for _ in range(int(repeat)):
+        arg = setup() if setup else None
+        t0 = time.perf_counter()
+        value = func(arg) if setup else func()
+        runs.append(round(time.perf_counter() - t0, 6))
+    return {"median": statistics.median(runs), "min": min(runs),
+            "runs": runs, "value": value}
+
+
+###############################################################################
+# function: _cli_command
+###############################################################################
+def _cli_command(configfile, args, python_options=()):
+    """
+    Returns the command line and environment for running the CLI in a new
+    process, with the given config file and CLI arguments.
+    """
+    cmd = [sys.executable] + list(python_options) + [PACKAGE_DIR] + list(args)
+    env = dict(os.environ)
+    env["SANCDPD_CONFIG"] = os.path.abspath(configfile)
+    return cmd, env
+
+
+###############################################################################
+# function: _time_cli
+###############################################################################
+def _time_cli(configfile, repeat):
+    """
+    Times complete runs of the CLI ("agents list") in new processes, with
+    the given config file.
+    """
+    cmd, env = _cli_command(configfile, STARTUP_ARGS)
+
+    def run():
+        subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+    return _timed(run, repeat)
+
+
+###############################################################################
+# function: _bench_startup
+###############################################################################
+def _bench_startup(dbfile, scratch, repeat):
+    """
+    Times complete runs of the CLI in new processes, with a config file
+    pointing at dbfile.
+    """
+    rundir = os.path.join(scratch, "startup")
+    os.makedirs(os.path.join(rundir, "logs"))
+    cfg = dict(conf.fconf)
+    cfg.update({"dbfile": dbfile,
+                "logdir": os.path.join(rundir, "logs", "")})
+    configfile = os.path.join(rundir, conf.CONFIG_FILENAME)
+    with open(configfile, "w") as fp:
+        json.dump(cfg, fp)
+    return _time_cli(configfile, repeat)
+
+
+###############################################################################
+# function: _import_times
+###############################################################################
+def _import_times(configfile):
+    """
+    Runs the CLI once with "python -X importtime", and returns the modules
+    that took longest to import (including their own imports), as a list of
+    dictionaries with the module name and microseconds.
+    """
+    cmd, env = _cli_command(configfile, STARTUP_ARGS, ["-X", "importtime"])
+    proc = subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True)
+    times = []
+    for line in proc.stderr.splitlines():
+        # Lines look like:  import time:  self [us] | cumulative | module
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            self_us = int(fields[0])
+            cumulative_us = int(fields[1])
+        except ValueError:
+            continue
+        times.append({"module": fields[2].strip(), "self_us": self_us,
+                      "cumulative_us": cumulative_us})
+    times.sort(key=lambda t: t["cumulative_us"], reverse=True)
+    return times[:IMPORT_TOP]
+
+
+###############################################################################
+# function: startup_benchmark
+###############################################################################
+def startup_benchmark(repeat=10, output=None, importtime=True):
+    """
+    Times complete runs of the CLI ("agents list") in new processes, with
+    the current config file and database, to track the fixed cost of every
+    command.  If importtime is True, the slowest imports of one more run
+    (measured with "python -X importtime") are listed too.
+    Writes the results as JSON, in the format of run_benchmarks(), to output
+    (by default, a file named with the current time in the log directory),
+    so that compare_benchmarks() can compare two runs.
+    Returns a dictionary with the median and minimum times, the slowest
+    imports, and the path of the results file.
+    """
+    if output is None:
+        output = os.path.join(conf.fconf["logdir"], "startup_" +
+                              time.strftime("%Y%m%d_%H%M%S") + ".json")
+    repeat = int(repeat)
+
+    lg.log("startup_benchmark: Timing " + str(repeat) + " runs of the CLI")
+    result = _time_cli(conf.configfile, repeat)
+    result.pop("value")
+    imports = _import_times(conf.configfile) if importtime else []
+
+    doc = {"time": dbops.timestamp(),
+           "software_version": conf.sconf.get("softw_agent_version"),
+           "python": platform.python_version(),
+           "sqlite": sq.sqlite_version,
+           "platform": platform.platform(),
+           "cpus": os.cpu_count(),
+           "repeat": repeat,
+           "command": STARTUP_ARGS,
+           "benchmarks": {"startup": result},
+           "slowest_imports": imports}
+    with open(output, "w") as fp:
+        json.dump(doc, fp, indent=1)
+
+    lg.log("startup_benchmark: Wrote results to " + output)
+
+    return {"output": output, "median_seconds": result["median"],
+            "min_seconds": result["min"], "slowest_imports": imports}
+
+
+###############################################################################
+# function: _bench_registration
+###############################################################################
+def _bench_registration(path_root, scratch, repeat):
+    """
+    Times bulk registration of every bag under path_root, each time in a
+    new database.  Returns the timings, and the path of the last database
+    (with every bag registered), for the validation benchmark.
+    """
+    made = []
+
+    def setup():
+        dbfile = os.path.join(scratch, "register_" + str(len(made)) + ".db")
+        _create_db(dbfile)
+        made.append(dbfile)
+        with _database(dbfile):
+            storage_id = _add_storage(path_root)
+        return storage_id
+
+    def run(storage_id):
+        with _database(made[-1]):
+            return bagmgmt.register_storage(storage_id)["registered"]
+
+    result = _timed(run, repeat, setup)
+    result["bags_per_sec"] = round(result["value"] / result["median"], 1)
+    return result, made[-1]
+
+
+###############################################################################
+# function: _report
+###############################################################################
+def _report(path):
+    """
+    Runs the report queries of the report benchmark:  counts of events by
+    type and month, and an export of every event to a CSV file at path with
+    reports.export_events().
+    Returns the number of events exported.
+    """
+    dbops.readonly().execute("""SELECT event_type_code,
+                                       substr(end_time, 1, 7),
+                                       outcome_code, count(*)
+                                FROM bag_event
+                                GROUP BY 1, 2, 3""").fetchall()
+    summary = reports.export_events(path, format="csv", overwrite=True,
+                                    progress=False)
+    return summary["events"]
+
+
+###############################################################################
+# function: run_benchmarks
+###############################################################################
+def run_benchmarks(path_root, dbfile=None, output=None, repeat=3,
+                   workers=None):
+    """
+    Runs the benchmark suite (see the module docstring) on the synthetic
+    repository under path_root, with its database at dbfile (by default,
+    as in generate_repository()).  Each benchmark is run repeat times.
+    The number of hashing processes for validation is given by workers, or
+    by the config file.
+    Writes the results as JSON to output (by default, a file named with the
+    current time in the log directory).
+    Returns a dictionary with the median time of each benchmark and the
+    path of the results file.
+    """
+    path_root = os.path.join(os.path.abspath(path_root), "")
+    if dbfile is None:
+        dbfile = path_root.rstrip("/") + ".db"
+    if not os.path.exists(dbfile):
+        raise Exception("No synthetic database at " + dbfile +
+                        ".  Run: python3 sancdpd bench generate")
+    if output is None:
+        output = os.path.join(conf.fconf["logdir"], "benchmark_" +
+                              time.strftime("%Y%m%d_%H%M%S") + ".json")
+    repeat = int(repeat)
+
+    results = {}
+    scratch = tempfile.mkdtemp(prefix="sancdpd_bench_")
+    lg.log("run_benchmarks: Running benchmarks on " + path_root)
+    try:
+        results["startup"] = _bench_startup(dbfile, scratch, repeat)
+
+        with _database(dbfile):
+            con = dbops.connect()
+            repo = {
+                "bags": con.execute("SELECT count(*) FROM bag").fetchone()[0],
+                "payload_files": con.execute(
+                    "SELECT sum(payload_files) FROM bag").fetchone()[0],
+                "payload_bytes": con.execute(
+                    "SELECT sum(payload_bytes) FROM bag").fetchone()[0],
+                "events": con.execute(
+                    "SELECT count(*) FROM bag_event").fetchone()[0],
+                "parent_links": con.execute(
+                    "SELECT count(*) FROM bag_has_parent_bag").fetchone()[0]
+                }
+            results["loadref"] = _timed(lambda arg: dbops.loadref(), repeat,
+                                        setup=refdata.invalidate)
+
+            # Lineage:  a sample of bags with parents, and their parents
+            sample = [r[0] for r in con.execute(
+                """SELECT child_bag_id FROM bag_has_parent_bag
+                   ORDER BY child_bag_id LIMIT ?""", (LINEAGE_SAMPLE,))]
+            parents = [r[0] for r in con.execute(
+                """SELECT DISTINCT parent_bag_id FROM bag_has_parent_bag
+                   ORDER BY parent_bag_id LIMIT ?""", (LINEAGE_SAMPLE,))]
+            for backend in ("cte", "index"):
+                def lookups():
+                    lineage.clear_index()
+                    lineage.lineage_many(sample, "ancestors", backend)
+                    lineage.lineage_many(parents, "descendants", backend)
+                    lineage.lineage_many(sample, "family", backend)
+                results["lineage_" + backend] = _timed(lookups, repeat)
+
+            report_path = os.path.join(scratch, "report.csv")
+            results["report"] = _timed(lambda: _report(report_path), repeat)
+            results["report"]["rows_per_sec"] = round(
+                results["report"]["value"] / results["report"]["median"])
+
+        results["registration"], regdb = _bench_registration(
+            path_root, scratch, repeat)
+
+        def validate():
+            with _database(regdb):
+                return bagval.validate_bags(workers=workers)
+        results["validation"] = _timed(validate, repeat)
+        v = results["validation"]["value"]
+        results["validation"]["bytes_per_sec"] = round(
+            v["bytes"] / results["validation"]["median"])
+        results["validation"]["value"] = dict(
+            (k, v[k]) for k in ("bags", "files", "bytes", "VAL", "NVAL",
+                                "ERR") if k in v)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    doc = {"time": dbops.timestamp(),
+           "software_version": conf.sconf.get("softw_agent_version"),
+           "python": platform.python_version(),
+           "sqlite": sq.sqlite_version,
+           "platform": platform.platform(),
+           "cpus": os.cpu_count(),
+           "repeat": repeat,
+           "path_root": path_root,
+           "repository": repo,
+           "benchmarks": results}
+    with open(output, "w") as fp:
+        json.dump(doc, fp, indent=1, default=str)
+
+    lg.log("run_benchmarks: Wrote results to " + output)
+
+    return {"output": output,
+            "median_seconds": dict((k, r["median"])
+                                   for k, r in results.items())}
+
+
+###############################################################################
+# function: compare_benchmarks
+###############################################################################
+def compare_benchmarks(baseline, current, tolerance=0.1):
+    """
+    Compares two results files written by run_benchmarks().  A benchmark
+    whose median time in current is more than (1 + tolerance) times its
+    median in baseline is a regression; one that is less than
+    1 / (1 + tolerance) times is an improvement.
+    Returns a dictionary listing regressions and improvements, each with
+    the ratio of the times, and the names of unchanged benchmarks.
+    """
+    with open(baseline, "r") as fp:
+        old = json.load(fp)["benchmarks"]
+    with open(current, "r") as fp:
+        new = json.load(fp)["benchmarks"]
+    limit = 1.0 + float(tolerance)
+
+    result = {"regressions": [], "improvements": [], "unchanged": [],
+              "not_compared": []}
+    for name in sorted(set(old) | set(new)):
+        a = old.get(name, {}).get("median")
+        b = new.get(name, {}).get("median")
+        if not a or not b:
+            result["not_compared"].append(name)
+            continue
+        ratio = round(b / a, 3)
+        entry = {"benchmark": name, "baseline": a, "current": b,
+                 "ratio": ratio}
+        if ratio > limit:
+            result["regressions"].append(entry)
+        elif ratio < 1.0 / limit:
+            result["improvements"].append(entry)
+        else:
+            result["unchanged"].append(name)
+    return result
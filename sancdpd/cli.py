@@ -1,28 +1,57 @@
 """
 This module runs the CLI for SANCdpd.
 
+The CLI has two modes:
+  - With no command line arguments, it runs the interactive menu system.
+  - With a command (like "validate --storage-id 2"), it runs that one
+    procedure without prompts, and exits with a status code.  This mode is
+    meant for scripts, cron, and job runners.  Commands can also be read from
+    a batch file, one per line, with the --batch option.  The --json option
+    prints results as JSON (one line per command) instead of as text.
+    The --metrics and --profile options turn on instrumentation and
+    profiling for the run (see the metrics module).
+
+The exit status of a command is:
+    0 :  the procedure ran and reported no failures
+    1 :  the procedure ran but reported failures (like invalid bags)
+    2 :  the command line was not valid
+    3 :  the procedure raised an exception, or SANCdpd could not start (for
+         instance, because of a bad config file or a missing database)
+
 This module includes these functions:
-    startcli() :  Starts the CLI by running other functions
+    main() :  Runs the CLI in the mode given by the command line arguments
+    startcli() :  Starts the interactive CLI by running other functions
+    startup() :  Reads config, starts logging, and checks the database
     welcome() :  Just prints a welcome message
     run_menu() :  Implements the CLI menu system
-    run_proc() :  Passes control to the procedure to be run
+    run_proc() :  Prompts for arguments and runs a procedure from the menu
+    run_command() :  Runs a procedure from command line arguments
+    procfunc() :  Returns the function of a procedure, importing its module
+    build_parser() :  Builds the argument parser for commands
 
-This module also defines a global data structure called menudefs, which defines
-the menus displayed by run_menu().
+This module also defines global data structures called menudefs, procdefs,
+and cmddefs, which define the menus displayed by run_menu(), the procedures
+the menus and commands run, and the commands themselves.
 
 """
 
 # Import modules from the Python standard library
-import time                  # for the sleep() function
+import argparse              # for parsing commands
+import importlib             # for importing procedure modules on first use
+import json                  # for JSON output
+import shlex                 # for splitting lines of batch files
+import sys                   # for writing errors to stderr
 
 # Import other SANCdpd modules
 import conf
 import logger as lg
 import dbops
+import metrics
+import schema
 
-# Import SANCdpd modules for running operational scenarios
-import operational.bagmgmt
-import operational.agentmgmt
+# The modules for running operational scenarios are imported only when one
+# of their procedures is run (see procfunc()), so that starting the CLI
+# does not pay for importing all of them.
 
 
 # The name of the software agent currently running, as known to the SANCdpd
@@ -78,25 +107,45 @@ def welcome():
 ###############################################################################
 menudefs = {\
 "main": ["MAIN MENU",
-    ("n", "Perform new ingest", "proc", "ingest"),
+    ("n", "Perform new ingest (register bags in storage)", "proc",
+        "register_storage"),
     ("e", "Record administrative events", "menu", "recevents"),
     ("l", "Evolve lineage", "menu", "lineage"),
     ("c", "Create or register access copies", "menu", "access"),
     ("r", "Generate reports", "menu", "reports"),
     ("a", "Manage agents", "menu", "agent"),
     ("s", "Manage storage", "menu", "storage"),
+    ("j", "Manage background jobs", "menu", "jobs"),
     ("q", "Quit SANCdpd CLI", "quit", "")
     ],
 "recevents": ["Event Recording",
+    ("v", "Validate bags (BGVAL)", "proc", "validate_bags"),
+    ("f", "Audit fixity (TGCMP)", "proc", "audit_fixity"),
+    ("t", "Compare tagmanifests with the database (TGCMP)", "proc",
+        "compare_tagmanifests"),
+    ("s", "Scan bags for viruses (VRSSC)", "proc", "scan_bags"),
+    ("r", "Record events for many bags from a CSV or JSON file", "proc",
+        "record_events"),
     ("b", "Go back", "back", "")
     ],
 "lineage": ["Lineage Evolution",
+    ("s", "Show ancestors, descendants, or family of bags", "proc",
+        "show_lineage"),
+    ("p", "Split a bag into new bags (BGSPL)", "proc", "split_bag"),
+    ("m", "Merge bags into a new bag (BGMRG)", "proc", "merge_bags"),
     ("b", "Go back", "back", "")
     ],
 "access": ["Access Copies",
+    ("c", "Create access copies (CRACC)", "proc", "create_access_copies"),
     ("b", "Go back", "back", "")
     ],
 "reports": ["Reports",
+    ("r", "Export bag events (CSV, JSON lines, or PREMIS XML)", "proc",
+        "export_events"),
+    ("s", "Search the text of bags", "proc", "search_bags"),
+    ("e", "Search the details of bag events", "proc", "search_events"),
+    ("i", "Index existing bags and events for search", "proc",
+        "backfill_search"),
     ("b", "Go back", "back", "")
     ],
 "agent": ["Agent Management",
@@ -105,9 +154,28 @@ menudefs = {\
     ("d", "Deactivate agent", "proc", "deactivate_agent"),
     ("b", "Go back", "back", "")
     ],
+"jobs": ["Background Jobs",
+    ("e", "Queue a procedure to run as a job", "proc", "enqueue_job"),
+    ("l", "List jobs", "proc", "list_jobs"),
+    ("s", "Show a job", "proc", "show_job"),
+    ("c", "Cancel a job", "proc", "cancel_job"),
+    ("r", "Retry a failed or cancelled job", "proc", "retry_job"),
+    ("b", "Go back", "back", "")
+    ],
 "storage": ["Storage Management",
     ("s", "Show active storage locations", "proc", "show_storage"),
+    ("c", "Show capacity by storage, collection, or status", "proc",
+        "capacity_report"),
+    ("v", "Verify the capacity summaries against the bag table", "proc",
+        "verify_capacity"),
     ("a", "Add new storage location", "proc", "add_storage"),
+    ("r", "Register all bags in storage location", "proc", "register_storage"),
+    ("i", "Reconcile the bag table with the bags on disk", "proc",
+        "reconcile_inventory"),
+    ("m", "Migrate bags to another storage location (STMIG)", "proc",
+        "migrate_storage"),
+    ("k", "Back up bags to a replica storage location (STBKP)", "proc",
+        "backup_storage"),
     ("d", "Deactivate storage", "proc", "deactivate_storage"),
     ("b", "Go back", "back", "")
     ]
@@ -115,6 +183,311 @@ menudefs = {\
 
 
 
+###############################################################################
+# Constants and converters used in procdefs
+###############################################################################
+
+# Default value marking a required argument
+REQUIRED = "(required)"
+
+def _ints(value):
+    """Converts a comma-separated string into a list of integers."""
+    return [int(v) for v in value.split(",") if v.strip()]
+
+def _bool(value):
+    """Converts a yes/no string into a boolean."""
+    return value.strip().lower() in ("y", "yes", "t", "true", "1")
+
+# Converters from strings, for each kind of argument
+converters = {"int": int, "float": float, "str": str, "ints": _ints,
+              "bool": _bool}
+
+
+###############################################################################
+# dictionary: procdefs
+###############################################################################
+# This dictionary defines the procedures run by the menus and the commands.
+# The dictionary key is the procname (used in menudefs and cmddefs).
+# Each value is a 3-tuple:
+#    - the name of the function that runs the procedure, with its module
+#      (imported when the procedure is first run)
+#    - a list of arguments, each a 4-tuple:
+#        - the function's keyword argument name (and the command's option)
+#        - the kind of value ("int", "float", "str", "ints" (comma-separated
+#          integers), or "bool")
+#        - the prompt or help text
+#        - the default value, or REQUIRED
+#    - a list of keys in the result dictionary whose non-zero (or non-empty)
+#      values mean that the procedure reported failures
+# The functions take only the listed keyword arguments, never prompt for
+# input, and return a dictionary or a list that summarizes the results.
+###############################################################################
+procdefs = {\
+"show_agents": ("operational.agentmgmt.list_agents", [
+    ("include_inactive", "bool", "Include inactive agents", False)
+    ], []),
+"show_storage": ("operational.capacity.list_storage", [
+    ("include_inactive", "bool", "Include storage locations not in use",
+        False)
+    ], []),
+"capacity_report": ("operational.capacity.capacity_report", [
+    ("by", "str", "Group by: storage, collection, or status", "storage")
+    ], []),
+"verify_capacity": ("operational.capacity.verify_capacity", [
+    ("repair", "bool", "Rebuild the summaries if they differ", False)
+    ], ["drift"]),
+"register_storage": ("operational.bagmgmt.register_storage", [
+    ("storage_id", "int", "Storage ID to register bags from", REQUIRED),
+    ("bib_record_id", "str", "Default SANC bib record ID", None),
+    ("item_no", "str", "Default SANC item number", None),
+    ("restart", "bool", "Ignore the checkpoint and walk everything", False)
+    ], ["errors"]),
+"reconcile_inventory": ("operational.inventory.reconcile_inventory", [
+    ("storage_id", "int", "Storage ID to reconcile (default all in use)",
+        None),
+    ("update", "bool", "Correct the bag table (MDUPD events)", False),
+    ("threads", "int", "Number of threads walking storage", None)
+    ], ["missing", "unexpected", "moved", "reappeared", "errors",
+        "skipped"]),
+"validate_bags": ("operational.bagval.validate_bags", [
+    ("storage_id", "int", "Storage ID to validate (default all)", None),
+    ("bag_ids", "ints", "Bag IDs to validate (default all)", None),
+    ("workers", "int", "Number of worker processes", None)
+    ], ["NVAL", "ERR"]),
+"audit_fixity": ("operational.fixity.audit_bags", [
+    ("storage_id", "int", "Storage ID to audit (default all)", None),
+    ("bag_ids", "ints", "Bag IDs to audit (default all)", None),
+    ("mode", "str", "Audit mode: incremental or full", "incremental"),
+    ("max_age_days", "float", "Maximum age of cached verifications", None),
+    ("workers", "int", "Number of worker processes", None)
+    ], ["NSAM", "ERR"]),
+"compare_tagmanifests": ("operational.fixity.compare_tagmanifests", [
+    ("storage_id", "int", "Storage ID to compare", REQUIRED),
+    ("record_events", "bool", "Record a TGCMP event for each bag", False)
+    ], ["changed", "missing", "errors"]),
+"record_events": ("operational.events.record_events", [
+    ("path", "str", "CSV, JSON, or JSON lines file of events (- for stdin)",
+        REQUIRED),
+    ("event_type_code", "str", "Event type for rows without one", None),
+    ("outcome_code", "str", "Outcome for rows without one", None),
+    ("event_details", "str", "Event details for rows without them", None),
+    ("tools_used", "str", "Tools used for rows without them", None),
+    ("chunk_size", "int", "Number of events inserted per transaction", None),
+    ("default_agents", "bool",
+        "Use the agents of this session for rows without agents", True),
+    ("dry_run", "bool", "Only check the rows; record nothing", False)
+    ], ["errors"]),
+"show_lineage": ("operational.lineage.show_lineage", [
+    ("bag_ids", "ints", "Bag IDs", REQUIRED),
+    ("relation", "str", "Relation: ancestors, descendants, or family",
+        "ancestors"),
+    ("backend", "str", "Backend: auto, cte, or index", "auto")
+    ], []),
+"split_bag": ("operational.splitmerge.split_bag", [
+    ("bag_id", "int", "Bag ID to split", REQUIRED),
+    ("paths", "str", "Payload paths for the new bags, comma-separated", None),
+    ("max_bytes", "int", "Maximum payload bytes of each new bag", None),
+    ("method", "str", "Method: auto, reflink, hardlink, or copy", "auto"),
+    ("remove_parent", "bool", "Remove the original bag afterward", False)
+    ], []),
+"merge_bags": ("operational.splitmerge.merge_bags", [
+    ("bag_ids", "ints", "Bag IDs to merge", REQUIRED),
+    ("name", "str", "Name of the new bag", None),
+    ("method", "str", "Method: auto, reflink, hardlink, or copy", "auto"),
+    ("remove_parents", "bool", "Remove the original bags afterward", False)
+    ], []),
+"migrate_storage": ("operational.stormig.migrate_storage", [
+    ("source_storage_id", "int", "Storage ID to migrate bags from", REQUIRED),
+    ("target_storage_id", "int", "Storage ID to migrate bags to", REQUIRED),
+    ("bag_ids", "ints", "Bag IDs to migrate (default all)", None),
+    ("path_prefix", "str", "Prefix for preservation paths in the target", ""),
+    ("method", "str", "Method: auto, reflink, hardlink, or copy", "auto"),
+    ("verify", "bool", "Verify files against manifests", True),
+    ("remove_source", "bool", "Remove the original bags afterward", False),
+    ("workers", "int", "Number of threads", None)
+    ], ["failed", "errors"]),
+"backup_storage": ("operational.backup.backup_storage", [
+    ("source_storage_id", "int", "Storage ID to back up bags from", REQUIRED),
+    ("replica_storage_id", "int", "Storage ID of the replica", REQUIRED),
+    ("bag_ids", "ints", "Bag IDs to back up (default all)", None),
+    ("max_bytes_per_sec", "int", "Limit on bytes copied per second", None),
+    ("restart", "bool", "Ignore the checkpoint of an interrupted run", False),
+    ("workers", "int", "Number of threads", None)
+    ], ["failed", "errors"]),
+"scan_bags": ("operational.virusscan.scan_bags", [
+    ("storage_id", "int", "Storage ID to scan (default all)", None),
+    ("bag_ids", "ints", "Bag IDs to scan (default all)", None),
+    ("mode", "str", "Scan mode: instream or multiscan", None),
+    ("connections", "int", "Number of connections to the scanner", None)
+    ], ["VIR", "ERR"]),
+"serve_scanner": ("operational.scanstub.serve", [
+    ("address", "str", "Address to listen on (host:port or socket path)",
+        "localhost:3310")
+    ], []),
+"create_access_copies": ("operational.access.create_access_copies", [
+    ("storage_id", "int", "Storage ID to process (default all)", None),
+    ("bag_ids", "ints", "Bag IDs to process (default all)", None),
+    ("force", "bool", "Remake access copies that are current", False),
+    ("workers", "int", "Number of threads", None)
+    ], ["CMER", "ERR"]),
+"search_bags": ("operational.search.search_bags", [
+    ("query", "str", "Search query (FTS5 syntax)", REQUIRED),
+    ("limit", "int", "Number of results per page", 20),
+    ("offset", "int", "Number of results to skip", 0),
+    ("include_removed", "bool", "Include bags that no longer exist", False)
+    ], []),
+"search_events": ("operational.search.search_events", [
+    ("query", "str", "Search query (FTS5 syntax)", REQUIRED),
+    ("event_type_code", "str", "Only events of this type", None),
+    ("limit", "int", "Number of results per page", 20),
+    ("offset", "int", "Number of results to skip", 0)
+    ], []),
+"backfill_search": ("operational.search.backfill_search", [
+    ("batch_size", "int", "Number of rows indexed per transaction", None),
+    ("restart", "bool", "Empty the index and index every row again", False)
+    ], []),
+"export_events": ("operational.reports.export_events", [
+    ("output", "str", "Report file (.csv, .jsonl, or .xml, optionally .gz)",
+        REQUIRED),
+    ("format", "str", "Format: csv, jsonl, or premis (default by extension)",
+        None),
+    ("storage_id", "int", "Only bags in this storage location", None),
+    ("start_date", "str", "Only events ending on or after this date", None),
+    ("end_date", "str", "Only events ending on or before this date", None),
+    ("event_type_code", "str", "Only events of this type", None),
+    ("bib_record_id", "str", "Only bags of this SANC bib record ID", None),
+    ("overwrite", "bool", "Replace the report file if it exists", False),
+    ("progress", "bool", "Print progress to standard error", True)
+    ], []),
+"migrate_schema": ("schema.migrate", [], []),
+"check_query_plans": ("schema.check_query_plans", [], ["failed"]),
+"generate_repository": ("benchmark.generate_repository", [
+    ("path_root", "str", "Directory for the synthetic bags", REQUIRED),
+    ("dbfile", "str", "Path of the synthetic database", None),
+    ("bags", "int", "Number of bags", 1000),
+    ("files_per_bag", "int", "Median number of files per bag", 10),
+    ("file_bytes", "int", "Median file size in bytes", 65536),
+    ("size_spread", "float", "Spread (sigma) of log-normal file sizes", 1.5),
+    ("events", "int", "Number of synthetic events", 1000000),
+    ("lineage_fraction", "float", "Fraction of bags with a parent", 0.2),
+    ("seed", "int", "Seed for the random generator", 1)
+    ], []),
+"run_benchmarks": ("benchmark.run_benchmarks", [
+    ("path_root", "str", "Directory of the synthetic bags", REQUIRED),
+    ("dbfile", "str", "Path of the synthetic database", None),
+    ("output", "str", "Path of the JSON results file", None),
+    ("repeat", "int", "Number of runs of each benchmark", 3),
+    ("workers", "int", "Number of hashing processes", None)
+    ], []),
+"compare_benchmarks": ("benchmark.compare_benchmarks", [
+    ("baseline", "str", "Results file of the baseline run", REQUIRED),
+    ("current", "str", "Results file of the current run", REQUIRED),
+    ("tolerance", "float", "Allowed slowdown (0.1 is 10%)", 0.1)
+    ], ["regressions"]),
+"enqueue_job": ("jobs.enqueue", [
+    ("procedure", "str", "Procedure to run (like validate_bags)", REQUIRED),
+    ("arguments", "str", "Arguments as a JSON object", "{}"),
+    ("priority", "int", "Priority (higher runs first)", 0),
+    ("max_attempts", "int", "Maximum number of attempts", None)
+    ], []),
+"list_jobs": ("jobs.list_jobs", [
+    ("status", "str", "Only jobs with this status", None),
+    ("limit", "int", "Number of jobs to list", 50)
+    ], []),
+"show_job": ("jobs.show_job", [
+    ("job_id", "int", "Job ID", REQUIRED)
+    ], []),
+"cancel_job": ("jobs.cancel_job", [
+    ("job_id", "int", "Job ID", REQUIRED)
+    ], []),
+"retry_job": ("jobs.retry_job", [
+    ("job_id", "int", "Job ID", REQUIRED)
+    ], []),
+"run_workers": ("jobs.run_workers", [
+    ("workers", "int", "Number of worker processes", None),
+    ("drain", "bool", "Stop when no jobs are left to run", False)
+    ], ["failed"]),
+"startup_benchmark": ("benchmark.startup_benchmark", [
+    ("repeat", "int", "Number of runs of the CLI", 10),
+    ("output", "str", "Path of the JSON results file", None),
+    ("importtime", "bool", "List the slowest imports", True)
+    ], [])
+}
+
+# Procedures that can run on a database whose schema version is out of date
+NO_SCHEMA_CHECK = ["migrate_schema"]
+
+# Procedures that do not use the configured database (and create their own)
+NO_DATABASE = ["generate_repository"]
+
+
+###############################################################################
+# list: cmddefs
+###############################################################################
+# This list defines the commands available from the command line.
+# Each command is a 3-tuple:
+#    - the command (one word, or two words for a command in a group)
+#    - the procname of the procedure it runs (a key in procdefs)
+#    - the help text for the command
+###############################################################################
+cmddefs = [\
+("ingest", "register_storage",
+    "Register all bags under a storage location (BGRGS)"),
+("inventory", "reconcile_inventory",
+    "Reconcile the bag table with the bags on disk (MDUPD)"),
+("validate", "validate_bags", "Validate bags (BGVAL)"),
+("audit", "audit_fixity", "Audit the fixity of bags (TGCMP)"),
+("compare", "compare_tagmanifests",
+    "Compare the tagmanifests of bags with the database (TGCMP)"),
+("record", "record_events",
+    "Record events for many bags from a CSV or JSON file"),
+("lineage", "show_lineage",
+    "Show the ancestors, descendants, or family of bags"),
+("split", "split_bag", "Split a bag into new bags (BGSPL)"),
+("merge", "merge_bags", "Merge bags into a new bag (BGMRG)"),
+("migrate", "migrate_storage",
+    "Migrate bags to another storage location (STMIG)"),
+("backup", "backup_storage",
+    "Back up bags to a replica storage location (STBKP)"),
+("scan", "scan_bags", "Scan bags for viruses (VRSSC)"),
+("scanner serve", "serve_scanner",
+    "Run the stand-in virus scanner (for trials and testing)"),
+("access", "create_access_copies", "Create access copies (CRACC)"),
+("report", "export_events",
+    "Export bag events as CSV, JSON lines, or PREMIS XML"),
+("search bags", "search_bags", "Search the text of bags"),
+("search events", "search_events", "Search the details of bag events"),
+("search backfill", "backfill_search",
+    "Index existing bags and events for search"),
+("agents list", "show_agents", "List agents"),
+("storage list", "show_storage",
+    "List storage locations with the bags and bytes in each"),
+("capacity show", "capacity_report",
+    "Show capacity by storage location, collection, or status"),
+("capacity verify", "verify_capacity",
+    "Compare the capacity summaries with the bag table"),
+("jobs enqueue", "enqueue_job", "Queue a procedure to run as a job"),
+("jobs list", "list_jobs", "List jobs"),
+("jobs show", "show_job", "Show a job, with the events it recorded"),
+("jobs cancel", "cancel_job", "Cancel a queued or running job"),
+("jobs retry", "retry_job", "Queue a failed or cancelled job again"),
+("jobs work", "run_workers", "Run the worker daemon that runs jobs"),
+("schema migrate", "migrate_schema",
+    "Bring the database schema up to the current version"),
+("schema check-plans", "check_query_plans",
+    "Check that core queries use their indexes"),
+("bench generate", "generate_repository",
+    "Generate a synthetic repository and database for benchmarks"),
+("bench run", "run_benchmarks",
+    "Run the benchmark suite on a synthetic repository"),
+("bench compare", "compare_benchmarks",
+    "Compare two benchmark results files"),
+("bench startup", "startup_benchmark",
+    "Time startup of the CLI with the current config and database")
+]
+
+
+
 ###############################################################################
 # function: run_menu
 ###############################################################################
@@ -130,90 +503,133 @@ def run_menu(branch):
     for this module).  All menu content is defined in menudefs.
     This function assumes that menudefs has a particular structure.
 
-    Note that this is a recursive function:  It can call itself, based on user
-    input, to generate the next level of menu.  When the "quit" command is
-    received, that is the base case of the recusion, in which it does not call
-    itself again.  It will return control to the function that called it, which
-    might be itself, or might the start_cli function.
+    The function loops, displaying one menu per pass, until it receives the
+    "quit" command.  Going to a submenu adds a level to the branch, and going
+    back removes one, so navigation never deepens the call stack.
     """
 
-    # Create very slight pause to make console interaction feel more intuitive
-    time.sleep(0.3)
-
-    # Create and print string of navigation breadcrumbs based on the branch
-    crumbs = ""
-    for menu in branch:
-        crumbs += (">> " + menudefs[menu][0] + "  ")
-    crumbs += ">>"
-    print("\n")
-    print("".join([">" for i in range(len(crumbs))]))
-    print(crumbs)
-    print("".join([">" for i in range(len(crumbs))]))
+    branch = list(branch)
 
+    while True:
 
-    # Display the options for the last level in this branch.
-    # We get the last menu in the branch, and iterate through through the
-    # option tuples in that menu.
-    for op in menudefs[branch[-1]][1:]:
-        print("   " + op[0] + "\t" + op[1])
+        # Create and print string of navigation breadcrumbs based on the branch
+        crumbs = ""
+        for menu in branch:
+            crumbs += (">> " + menudefs[menu][0] + "  ")
+        crumbs += ">>"
+        print("\n")
+        print("".join([">" for i in range(len(crumbs))]))
+        print(crumbs)
+        print("".join([">" for i in range(len(crumbs))]))
 
 
-    # Variables to capture the menu action
-    next_action = ""
-    action_spec = ""
+        # Display the options for the last level in this branch.
+        # We get the last menu in the branch, and iterate through through the
+        # option tuples in that menu.
+        for op in menudefs[branch[-1]][1:]:
+            print("   " + op[0] + "\t" + op[1])
 
-    # Loop input prompt until we get valid user input
-    while next_action == "":
-        # Get raw user input from prompt
-        rawin = input("?> ")
 
-        # Very short pause
-        time.sleep(0.1)
+        # Variables to capture the menu action
+        next_action = ""
+        action_spec = ""
 
-        # Take only the first three characters, and make letters lowercase
-        normin = rawin[:3].lower()
+        # Loop input prompt until we get valid user input
+        while next_action == "":
+            # Get raw user input from prompt
+            rawin = input("?> ")
 
-        # Check to see if input matches a valid option in the current menu
-        for op in menudefs[branch[-1]][1:]:
-            if normin == op[0]:
-                next_action = op[2]
-                action_spec = op[3]
+            # Take only the first three characters, and make letters lowercase
+            normin = rawin[:3].lower()
 
-        # If the we didn't manage to set the next action, the input was invalid
-        if next_action == "":
-            print("-- Invalid entry. --")
+            # Check to see if input matches a valid option in the current menu
+            for op in menudefs[branch[-1]][1:]:
+                if normin == op[0]:
+                    next_action = op[2]
+                    action_spec = op[3]
 
+            # If we didn't manage to set the next action, the input was
+            # invalid
+            if next_action == "":
+                print("-- Invalid entry. --")
 
-    # Take the appropriate action based on the type of next action
 
-    if next_action == "menu":
-        # Add a level to the branch and run the menu
-        run_menu(branch + [action_spec])
+        # Take the appropriate action based on the type of next action
 
-    elif next_action == "back":
-        # Run the menu without the last level of the branch
-        run_menu(branch[:-1])
+        if next_action == "menu":
+            # Add a level to the branch
+            branch.append(action_spec)
 
-    elif next_action == "proc":
-        # Run the procedure specified, by passing the option to run_proc
-        run_proc(action_spec)
+        elif next_action == "back":
+            # Remove the last level of the branch
+            branch.pop()
 
-        # After running the procedure, run menu from the same level
-        run_menu(branch)
+        elif next_action == "proc":
+            # Run the procedure specified, by passing the option to run_proc.
+            # After running the procedure, the menu runs from the same level.
+            run_proc(action_spec)
 
-    elif next_action == "quit":
-        # Note that this option does not directly call an exit function.
-        # It "quits" simply by not calling the run_menu function again.
-        # Thus, it is the base case of the recursion.
-        lg.log("run_menu: Received 'quit' command from menu.  Returning.")
-        print("\n   Exiting the SANCdpd CLI menu system now.  Goodbye.\n")
+        elif next_action == "quit":
+            lg.log("run_menu: Received 'quit' command from menu.  Returning.")
+            print("\n   Exiting the SANCdpd CLI menu system now.  Goodbye.\n")
+            break
 
-    # If control is returned to the menu with no further directive, then exit
-    # with normal status.
+    # When the loop ends, exit with normal status.
     return 0
 
 
 
+###############################################################################
+# function: show_result
+###############################################################################
+def show_result(result):
+    """
+    Prints the result of a procedure as text.
+    A dictionary is printed one key per line.  Long lists within it are
+    summarized by their length.  A list of dictionaries is printed as rows.
+    """
+    if isinstance(result, dict):
+        for k, v in result.items():
+            if isinstance(v, list) and len(v) > 10:
+                v = str(len(v)) + " items"
+            print("   " + str(k) + ": " + str(v))
+    elif isinstance(result, list):
+        for row in result:
+            if isinstance(row, dict):
+                row = "\t".join(str(v) for v in row.values())
+            print("   " + str(row))
+    elif result is not None:
+        print("   " + str(result))
+
+
+###############################################################################
+# function: _failed
+###############################################################################
+def _failed(procname, result):
+    """
+    Returns True if the result of a procedure reports failures, according to
+    the failure keys for the procedure in procdefs.
+    """
+    if not isinstance(result, dict):
+        return False
+    return any(result.get(k) for k in procdefs[procname][2])
+
+
+
+###############################################################################
+# function: procfunc
+###############################################################################
+def procfunc(funcname):
+    """
+    Returns the function named (with its module, like
+    "operational.bagval.validate_bags") in procdefs, importing its module if
+    it has not been imported yet.
+    """
+    modname, _, name = funcname.rpartition(".")
+    return getattr(importlib.import_module(modname), name)
+
+
+
 ###############################################################################
 # function: run_proc
 ###############################################################################
@@ -222,64 +638,298 @@ def run_proc(procname):
     This function take a procname, as specified in a menu option, and executes
     the relevant commands.
 
-    This function basically serves as a switch statement that takes a menu
-    command and then executes the relevant procedure.
-
-    There should be one "if" or "elif" clause for each procname used in the
-    menu system.
-
-    Typically, there will be only a few lines of code for each of the possible
-    menu comands, because control will quicly be handed off to a function in
-    the module for the relevant operational scenario.
+    The procedure and its arguments are looked up in the procdefs dictionary.
+    The user is prompted for each argument (a blank entry takes the default),
+    and then control is handed off to the function in the module for the
+    relevant operational scenario.  Its result is printed.
     """
 
     lg.log("Menu command: " + procname + ". Will attempt to execute.")
 
-    if procname == "ingest":
-        operational.bagmgmt.new_ingest()
-
-    elif procname == "show_agents":
-        operational.agentmgmt.show_agents()
-
-    else:
+    if procname not in procdefs:
         print("   Procedure '" + procname + "' not yet implemented.")
+        input("   Press Enter to continue.")
+        return
+
+    funcname, params, failkeys = procdefs[procname]
+
+    # Prompt for each argument, until a valid value is entered
+    kwargs = {}
+    for name, kind, prompt, default in params:
+        while name not in kwargs:
+            if default is REQUIRED:
+                rawin = input("   " + prompt + ": ")
+            else:
+                rawin = input("   " + prompt + " [" + str(default) + "]: ")
+            if rawin.strip() == "":
+                if default is not REQUIRED:
+                    kwargs[name] = default
+                continue
+            try:
+                kwargs[name] = converters[kind](rawin.strip())
+            except ValueError:
+                print("-- Invalid entry. --")
+
+    try:
+        with metrics.procedure(procname):
+            result = procfunc(funcname)(**kwargs)
+        show_result(result)
+    except Exception as e:
+        lg.log("run_proc: " + procname + " failed: " + str(e), "ERROR")
+        print("   Error: " + str(e))
 
     input("   Press Enter to continue.")
 
 
 
 ###############################################################################
-# function: start_cli
+# function: build_parser
 ###############################################################################
-def startcli():
+def build_parser():
     """
-    This is the first function that should be run for the CLI.
+    Builds the argparse parser for commands, from cmddefs and procdefs.
+    Each argument of a procedure becomes an option of its command, named
+    like the argument with "-" for "_" (for example, --storage-id).
+    A "bool" argument that defaults to True becomes a --no- option (for
+    example, --no-verify).
     """
+    parser = argparse.ArgumentParser(
+        prog="sancdpd",
+        description="Run a SANCdpd procedure.  With no command, run the " +
+                    "interactive menu.")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON lines")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="read commands from FILE, one per line " +
+                             "(- for standard input)")
+    parser.add_argument("--metrics", action="store_true", default=None,
+                        help="record timings and counters, and write the " +
+                             "metrics textfile (see metrics.py)")
+    parser.add_argument("--profile", choices=metrics.PROFILE_MODES,
+                        help="profile each procedure run")
+    sub = parser.add_subparsers(dest="command", metavar="command")
+
+    groups = {}
+    for command, procname, helptext in cmddefs:
+        words = command.split()
+        if len(words) == 1:
+            cp = sub.add_parser(words[0], help=helptext)
+        else:
+            if words[0] not in groups:
+                gp = sub.add_parser(words[0], help=words[0] + " commands")
+                groups[words[0]] = gp.add_subparsers(dest="subcommand",
+                                                     metavar="subcommand",
+                                                     required=True)
+            cp = groups[words[0]].add_parser(words[1], help=helptext)
+        cp.set_defaults(procname=procname)
+        cp.add_argument("--json", action="store_true",
+                        default=argparse.SUPPRESS,
+                        help="print results as JSON lines")
+
+        for name, kind, prompt, default in procdefs[procname][1]:
+            opt = "--" + name.replace("_", "-")
+            if kind == "bool" and default is True:
+                cp.add_argument("--no-" + name.replace("_", "-"), dest=name,
+                                action="store_false", help="do not: " + prompt)
+            elif kind == "bool":
+                cp.add_argument(opt, dest=name, action="store_true",
+                                help=prompt)
+            elif default is REQUIRED:
+                cp.add_argument(opt, dest=name, type=converters[kind],
+                                required=True, help=prompt)
+            else:
+                cp.add_argument(opt, dest=name, type=converters[kind],
+                                default=default, help=prompt)
+
+    return parser
 
-    # Print intial welcome message for SANCdpd CLI
-    welcome()
+
+
+###############################################################################
+# function: run_command
+###############################################################################
+def run_command(args, as_json, check_schema=False):
+    """
+    Runs the procedure for a parsed command, without prompts, and prints its
+    result as text or as one line of JSON.
+    If check_schema is True, the schema version of the database is checked
+    first, unless the procedure is in NO_SCHEMA_CHECK (as for the commands
+    of a batch, where startup cannot know which procedures will run).
+    Returns the exit status for the command (see the module docstring).
+    """
+    procname = args.procname
+    funcname, params, failkeys = procdefs[procname]
+    kwargs = dict((p[0], getattr(args, p[0])) for p in params)
+
+    lg.log("Command: " + procname + " " + str(kwargs) +
+           ". Will attempt to execute.")
+
+    try:
+        if check_schema and procname not in NO_SCHEMA_CHECK:
+            schema.check_version()
+        with metrics.procedure(procname):
+            result = procfunc(funcname)(**kwargs)
+    except Exception as e:
+        lg.log("run_command: " + procname + " failed: " + str(e), "ERROR")
+        if as_json:
+            print(json.dumps({"command": procname, "status": 3,
+                              "error": str(e)}))
+        else:
+            print("Error: " + str(e), file=sys.stderr)
+        return 3
+
+    status = 1 if _failed(procname, result) else 0
+    if as_json:
+        print(json.dumps({"command": procname, "status": status,
+                          "result": result}, default=str))
+    else:
+        show_result(result)
+    return status
+
+
+
+###############################################################################
+# function: run_batch
+###############################################################################
+def run_batch(parser, filename, as_json):
+    """
+    Runs every command in a batch file, one command per line.  Blank lines
+    and lines beginning with "#" are skipped.  A failing command does not
+    stop the batch.  The schema version is checked for each command, so
+    that a batch can migrate the schema and then use it.
+    Returns the highest exit status of any command.
+    """
+    fp = sys.stdin if filename == "-" else open(filename, "r")
+    worst = 0
+    for line in fp:
+        if line.strip() == "" or line.lstrip().startswith("#"):
+            continue
+        try:
+            args = parser.parse_args(shlex.split(line))
+        except SystemExit as e:
+            worst = max(worst, e.code or 0)
+            continue
+        if args.command is None:
+            continue
+        worst = max(worst, run_command(args, as_json, check_schema=True))
+    if fp is not sys.stdin:
+        fp.close()
+    return worst
+
+
+
+###############################################################################
+# function: startup
+###############################################################################
+def startup(quiet=False, check_schema=True, instrument=None, profile=None,
+            use_db=True):
+    """
+    Does the work needed before any procedure can run:  reads the config
+    file, begins logging, turns on instrumentation (as configured, or as
+    given by instrument and profile), checks the database, and loads
+    reference data.
+    If quiet is True, nothing is printed to the console.
+    If check_schema is False, an out-of-date schema version is allowed.
+    If use_db is False, the configured database is neither checked nor read,
+    so it need not exist.
+    """
 
     # Read SANCdpd config file and assign values in the fconf dictionary
     conf.readfile()
 
+    # Record the software agent for events recorded in this session
+    conf.sconf["softw_agent_name"] = SOFTW_AGENT_NAME
+    conf.sconf["softw_agent_version"] = VERSION
+
     # Begin logging to logfile (if logging is set on the config file).
     if conf.fconf["logging"]:
-        lg.begin()
+        lg.begin(quiet=quiet)
+
+    # Turn on instrumentation and profiling, if asked for
+    metrics.begin(instrument, profile)
+
+    if not use_db:
+        return
 
     # Check that we have access to a usable SANCdpd database
-    dbops.check_db()
+    dbops.check_db(check_schema=check_schema)
 
     # Load values from reference tables into global variables
     dbops.loadref()
 
+
+
+###############################################################################
+# function: start_cli
+###############################################################################
+def startcli():
+    """
+    This is the first function that should be run for the interactive CLI.
+    """
+
+    # Print intial welcome message for SANCdpd CLI
+    welcome()
+
+    # Read config, begin logging, and check the database
+    startup()
+
     # Run main menu for the CLI.
     run_menu(['main'])
 
+    # Close the database connections opened during the session
+    dbops.close()
+
     # When run_menu returns, we're done
     return 0
 
 
+
+###############################################################################
+# function: main
+###############################################################################
+def main(argv):
+    """
+    Runs the CLI.  With no arguments in argv, runs the interactive menu.
+    Otherwise, runs the command (or batch of commands) given, and returns
+    the exit status.
+    """
+    if not argv:
+        return startcli()
+
+    parser = build_parser()
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as e:
+        return e.code or 0
+    if args.command is None and args.batch is None:
+        parser.print_help()
+        return 2
+
+    # The schema of a batch is checked command by command (see run_batch())
+    procname = getattr(args, "procname", None)
+    try:
+        startup(quiet=True,
+                check_schema=(args.batch is None and
+                              procname not in NO_SCHEMA_CHECK),
+                instrument=args.metrics, profile=args.profile,
+                use_db=args.batch is not None or procname not in NO_DATABASE)
+    except Exception as e:
+        if args.json:
+            print(json.dumps({"command": procname, "status": 3,
+                              "error": "Startup failed: " + str(e)}))
+        else:
+            print("Error: Startup failed: " + str(e), file=sys.stderr)
+        dbops.close()
+        return 3
+    if args.batch is not None:
+        status = run_batch(parser, args.batch, args.json)
+    else:
+        status = run_command(args, args.json)
+    dbops.close()
+    return status
+
+
 ###############################################################################
 
 if __name__ == '__main__':
-    startcli()
+    sys.exit(main(sys.argv[1:]))
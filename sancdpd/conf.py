@@ -3,6 +3,7 @@ This module manages config information used by the rest of the SANCdpd package.
 
 This module exposes several global variables for use by this and other modules:
     fconf: a dictionary of config values from the config file
+    configfile: the path of the config file that fconf was read from
     sconf: a dictionary of config values set a runtime (if any)
     event_types:  a list of event types from the database
     event_type_outcomes: a dictionary of lists of outcomes for each event type
@@ -14,7 +15,11 @@ The event_types and event_type_outcomes variables are useful for, among other
 purposes, creating menus or select lists to allow the user to choose the
 appropraite event types and the valid outcomes for a given event type.
 
-This module depends on a valid SANCdpd config file.
+This module depends on a valid SANCdpd config file, SANCdpd_config.json.
+It is found at the path in the SANCDPD_CONFIG environment variable, if that
+is set, or else in the first of these directories that has one:  the current
+directory, the SANCdpd project directory, and the OS-specific config
+directory (see config_dirs()).
 
 It is expected that the config file is JSON with at least the following keys:
     logging: whether to enable logging ("true" or "false")
@@ -24,13 +29,58 @@ It is expected that the config file is JSON with at least the following keys:
     access_path_root: The path to the access storage location (ends with "/")
 (Note that these match the req_conf_keys list defined below.)
 
-This module contains the following function:
+The config file may also include the following optional keys:
+    log_level, log_flush_interval, log_format: logging settings (see the
+        logger module)
+    db_pragmas: dictionary of SQLite pragmas overriding the defaults set on
+        every database connection (see dbops.DEFAULT_PRAGMAS)
+    validation_workers: number of processes for hashing in bag validation
+    hash_threads: number of threads hashing files in each process (see
+        operational/hashing.py)
+    audit_workers: number of processes for fixity audits
+    fixity_max_age_days: maximum age of a cached verification in an
+        incremental fixity audit
+    lineage_backend: default backend for small lineage lookups ("cte" or
+        "index")
+    preservation_path_layout: list of bag table columns matching the
+        directories between a storage path_root and each bag
+    inventory_threads: number of threads walking storage in an inventory
+        reconciliation
+    migration_workers: number of threads for storage migrations
+    backup_workers: number of threads for backups
+    backup_max_bytes_per_sec: limit on the total rate of copying in backups
+    clamd_address: address of the virus scanner daemon, "host:port" or the
+        path of a Unix socket
+    scan_mode: "instream" or "multiscan", for virus scans
+    scan_connections: number of concurrent connections to the scanner
+    access_converters: converter commands for access copies, by file
+        extension (see operational/access.py)
+    access_workers: number of threads running converters
+    access_timeout: maximum seconds for one converter command
+    search_backfill_batch: number of rows indexed per transaction by the
+        full-text search backfill
+    event_chunk_size: number of events inserted per transaction when
+        recording events from a file
+    metrics: true to record timings and counters (see the metrics module)
+    metrics_textfile: path of the metrics textfile in Prometheus format
+    profile: "cprofile", "tracemalloc", or "both", to profile procedures
+    job_workers, job_lease_seconds, job_poll_seconds, job_max_attempts,
+        job_chunk_bags: settings of the job queue (see the jobs module)
+
+The sconf dictionary includes the following keys, set by the running UI:
+    softw_agent_name: the agent_name of the running software agent
+    softw_agent_version: the agent_version of the running software agent
+
+This module contains the following functions:
+    config_dirs() :  List the directories searched for the config file
     readfile() :  Read the configuration file and write global fconf variable
 """
 
 # Import modules from the Python standard library
 import json                  # for reading the config file
-import os.path               # for checking for the config file
+import os                    # for the environment and file status
+import os.path               # for building config file paths
+import sys                   # for the platform
 
 # Import other SANCdpd modules
 import logger as lg
@@ -49,10 +99,20 @@ req_conf_keys = ["logging",
                  "access_path_root"
                  ]
 
+# The name of the config file to look for
+CONFIG_FILENAME = "SANCdpd_config.json"
+
 # Dictionary for config info from config file
 # (This shouldn't change once readfile() has been run once.)
 fconf = {}
 
+# Path of the config file that fconf was read from
+configfile = None
+
+# Parsed config, keyed by (absolute path, mtime in ns, size) of the file it
+# was parsed from, so that reading an unchanged file again skips parsing
+_parsed = {}
+
 # Dictionary for config info generated during currently running session
 # (as needed; functionality that depends on this should be commented.)
 sconf = {}
@@ -70,46 +130,83 @@ etypes = []
 otypes = {}
 
 
+###############################################################################
+# function: config_dirs
+###############################################################################
+def config_dirs():
+    """
+    Returns the list of directories searched for the config file, in order:
+      - the current working directory
+      - the SANCdpd project directory (the parent of the sancdpd package)
+      - the OS-specific config directory:
+            Windows:  %LOCALAPPDATA%\\SANCdpd\\
+            macOS:  ~/Library/Application Support/SANCdpd/
+            others:  $XDG_CONFIG_HOME/SANCdpd/ (default ~/.config/SANCdpd/)
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    dirs = ["./", os.path.dirname(package_dir) + os.sep]
+
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.join(
+            os.path.expanduser("~"), "AppData", "Local")
+    elif sys.platform == "darwin":
+        base = os.path.join(os.path.expanduser("~"), "Library",
+                            "Application Support")
+    else:
+        base = os.environ.get("XDG_CONFIG_HOME") or os.path.join(
+            os.path.expanduser("~"), ".config")
+    dirs.append(os.path.join(base, "SANCdpd") + os.sep)
+
+    return dirs
+
+
 ###############################################################################
 # function: readfile
 ###############################################################################
 def readfile():
     """
     Read a config file to initialize global variables.
+    The file named by the SANCDPD_CONFIG environment variable is used if that
+    is set; otherwise the first SANCdpd_config.json found in config_dirs().
+    Each location is tried once, by opening the file.  If the file has not
+    changed since it was last parsed in this process, the parsed values are
+    reused.
     If a required config value is missing or invalid, raise an exception.
     """
-
-    # The name of the config file to look for
-    configfilename = "SANCdpd_config.json"
-
-    # The list of locations where we will look for the config file
-    trylocs = [
-        "./",
-        "../",
-        "./SANCdpd/",
-        "../SANCdpd/"
-        ]
-
-    # Search for the config file in the list of locations.  Stop when found
-    found = False
-    for loc in trylocs:
-        pathtofile = loc + configfilename
-        if os.path.exists(pathtofile):
-            found = True
+    global fconf, configfile
+
+    # The list of files to try, in order
+    if os.environ.get("SANCDPD_CONFIG"):
+        trypaths = [os.environ["SANCDPD_CONFIG"]]
+    else:
+        trypaths = [d + CONFIG_FILENAME for d in config_dirs()]
+
+    # Open the first one that exists
+    conffp = None
+    for pathtofile in trypaths:
+        try:
+            conffp = open(pathtofile, "r")
             break
+        except FileNotFoundError:
+            continue
 
     # Raise an exception and error out if we don't have a config file.
-    if not found:
-        raise Exception("SANCdpd config file not found.")
-
-    # create a global variable to store config information
-    global fconf
-    fconf = {}
-
-    # load the global conf dictionary from the JSON file
-    conffp = open(pathtofile, "r")
-    fconf = json.load(conffp)
-    conffp.close()
+    if conffp is None:
+        raise Exception("SANCdpd config file not found.  Looked for: " +
+                        ", ".join(trypaths))
+
+    # load the global conf dictionary from the JSON file, unless the same
+    # file is unchanged since it was last parsed
+    with conffp:
+        st = os.fstat(conffp.fileno())
+        key = (os.path.abspath(pathtofile), st.st_mtime_ns, st.st_size)
+        if key in _parsed:
+            fconf = dict(_parsed[key])
+        else:
+            fconf = json.load(conffp)
+            _parsed.clear()
+            _parsed[key] = dict(fconf)
+    configfile = pathtofile
 
     # check to make sure we have the required configuration keys
     for k in req_conf_keys:
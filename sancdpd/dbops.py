@@ -5,78 +5,325 @@ The SANCdpd database is structured according to the schema specified and
 described in the SANCdpd data dictionary.  The database itself is created in
 SQLite version 3.
 
+All database access in SANCdpd goes through the connection manager in this
+module, rather than through separate calls to sqlite3.connect().  Each
+thread gets one read-write connection (from connect()) and, if it asks, one
+read-only connection (from readonly()), which are opened once and reused.
+When a connection is opened, the pragmas in DEFAULT_PRAGMAS are set, as
+overridden by the optional "db_pragmas" key in the config file.  Connections
+cache prepared statements, keyed by SQL text, so that queries repeated in a
+loop are compiled only once.
+
+Connections are in autocommit mode.  Writes that belong together should be
+made inside a transaction() block, which commits at the end of the block or
+rolls back if an exception is raised.
+
+When instrumentation is on (see the metrics module), connections are opened
+as _TimedConnection objects, whose cursors record a "db_statement" span for
+every statement executed (labeled with its first keyword, such as SELECT or
+INSERT) and count the rows written by INSERT, UPDATE, and DELETE statements.
+
 This module contains the following functions:
-    checkdb(): Checks connection and does basic validation of the database
+    connect() : Returns this thread's shared read-write connection
+    readonly() : Returns this thread's shared read-only connection
+    transaction() : Context manager for a write transaction
+    close() : Closes this thread's connections
+    check_db(): Checks connection and does basic validation of the database
     loadref() : Read database reference tables and write global lists
+    timestamp() : Returns the current time as an ISO 8601 string
+    agent_ids() : Looks up the database IDs of the agents of this session
+    insert_bag_events() : Inserts a batch of rows into the bag_event table
+    insert_storage_event() : Inserts a storage_event row and its agents
+    set_job() : Sets the job whose events this process is inserting
 """
 
 # Import modules from the Python standard library
+import os                    # for opening new connections after a fork
 import os.path               # to make sure the database file exists
 import sqlite3 as sq         # for SQLite DB interaction
 import datetime as dt        # for getting and formatting timestamps
+import contextlib            # for the transaction context manager
+import threading             # for per-thread connections
 
 
 # Import other SANCdpd modules
 import conf
 import logger as lg
+import metrics
+import refdata
+import schema
+
+
+###############################################################################
+# Global (for this module) data structures
+###############################################################################
+
+# Pragmas set on every new connection, in this order.
+# Any of these can be overridden with the "db_pragmas" config key.
+# (journal_mode must be changed to "DELETE" if the database file is on a
+# network share, where WAL does not work.)
+DEFAULT_PRAGMAS = {"journal_mode": "WAL",
+                   "synchronous": "NORMAL",
+                   "cache_size": -65536,
+                   "mmap_size": 268435456,
+                   "busy_timeout": 5000,
+                   "foreign_keys": "ON"
+                   }
+
+# Number of prepared statements cached per connection
+CACHED_STATEMENTS = 256
+
+# Statements whose rows are counted as written, when instrumentation is on
+WRITE_OPS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+# Per-thread connections, with attributes "rw" and "ro"
+_local = threading.local()
+
+# Connections inherited from the parent process by a forked process.  They
+# are kept here, unused and never closed, since using or closing a
+# connection across a fork could disturb the parent's locks on the database.
+_inherited = []
+
+# ID of the job that this process is running (see the jobs module), if any.
+# Events inserted while it is set are linked to the job.
+_job_id = None
+
+
+###############################################################################
+# function: _after_fork
+###############################################################################
+def _after_fork():
+    """
+    Runs in each new forked process, so that it opens its own connections
+    instead of using its parent's.
+    """
+    global _local
+    _inherited.append(_local)
+    _local = threading.local()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+###############################################################################
+# class: _TimedCursor
+###############################################################################
+class _TimedCursor(sq.Cursor):
+    """
+    A cursor that records metrics for each statement it executes.
+    """
+
+    def _timed(self, method, sql, params):
+        words = sql.split(None, 1)
+        op = words[0].upper() if words else ""
+        try:
+            with metrics.span("db_statement", op=op):
+                return method(sql, params)
+        finally:
+            if op in WRITE_OPS and self.rowcount > 0:
+                metrics.count("db_rows_written_total", self.rowcount,
+                              op=op)
+
+    def execute(self, sql, params=()):
+        return self._timed(super().execute, sql, params)
+
+    def executemany(self, sql, params):
+        return self._timed(super().executemany, sql, params)
+
+
+###############################################################################
+# class: _TimedConnection
+###############################################################################
+class _TimedConnection(sq.Connection):
+    """
+    A connection whose cursors are _TimedCursor objects.  (The execute
+    methods of a connection do not call its cursor() method, so they are
+    overridden too.)
+    """
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
+
+
+###############################################################################
+# function: _open
+###############################################################################
+def _open(readonly):
+    """
+    Opens a new connection to the database file named in the config file, and
+    sets the configured pragmas on it.
+    """
+    pragmas = dict(DEFAULT_PRAGMAS)
+    pragmas.update(conf.fconf.get("db_pragmas", {}))
+    factory = _TimedConnection if metrics.enabled() else sq.Connection
+
+    if readonly:
+        uri = "file:" + os.path.abspath(conf.fconf["dbfile"]) + "?mode=ro"
+        con = sq.connect(uri, uri=True, isolation_level=None,
+                         cached_statements=CACHED_STATEMENTS,
+                         factory=factory)
+        # The journal mode is a property of the database file, which a
+        # read-only connection cannot change.
+        del pragmas["journal_mode"]
+        pragmas["query_only"] = "ON"
+    else:
+        con = sq.connect(conf.fconf["dbfile"], isolation_level=None,
+                         cached_statements=CACHED_STATEMENTS,
+                         factory=factory)
+
+    for name, value in pragmas.items():
+        con.execute("PRAGMA " + name + " = " + str(value))
+
+    lg.log("dbops: Opened " + ("read-only" if readonly else "read-write") +
+           " connection to " + conf.fconf["dbfile"])
+    return con
+
+
+###############################################################################
+# function: connect
+###############################################################################
+def connect():
+    """
+    Returns the read-write connection for the calling thread, opening it on
+    first use.
+    """
+    con = getattr(_local, "rw", None)
+    if con is None:
+        con = _open(False)
+        _local.rw = con
+    return con
+
+
+###############################################################################
+# function: readonly
+###############################################################################
+def readonly():
+    """
+    Returns the read-only connection for the calling thread, opening it on
+    first use.  This is meant for reports and other long reads, which then
+    cannot take write locks by accident.
+    """
+    con = getattr(_local, "ro", None)
+    if con is None:
+        con = _open(True)
+        _local.ro = con
+    return con
+
+
+###############################################################################
+# function: transaction
+###############################################################################
+@contextlib.contextmanager
+def transaction():
+    """
+    Context manager for a write transaction on this thread's read-write
+    connection.  Yields a cursor.  Commits when the block ends, or rolls back
+    if the block raises an exception.
+    The transaction begins IMMEDIATE, taking the write lock at the start, so
+    that it cannot fail halfway with a busy error.  If a transaction is
+    already open, the block becomes a savepoint within it instead.
+    """
+    con = connect()
+    cur = con.cursor()
+    if con.in_transaction:
+        name = "sp" + str(id(cur))
+        cur.execute("SAVEPOINT " + name)
+        try:
+            yield cur
+        except BaseException:
+            cur.execute("ROLLBACK TO " + name)
+            cur.execute("RELEASE " + name)
+            raise
+        else:
+            cur.execute("RELEASE " + name)
+        finally:
+            cur.close()
+    else:
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            yield cur
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        else:
+            cur.execute("COMMIT")
+        finally:
+            cur.close()
+
+
+###############################################################################
+# function: close
+###############################################################################
+def close():
+    """
+    Closes the connections of the calling thread, if any are open.
+    """
+    for attr in ("rw", "ro"):
+        con = getattr(_local, attr, None)
+        if con is not None:
+            con.close()
+            setattr(_local, attr, None)
 
 
 ###############################################################################
 # function: check_db
 ###############################################################################
-def check_db():
+def check_db(check_schema=True):
     """
     Tests whether there seems to be a valid SANCdpd database in the file
     specified by the config file.
     Fails with errors or exceptions if any of the following:
       - the file isn't found
+      - the database schema version is not the version this software expects
+        (unless check_schema is False, as when migrating the schema)
       - the database doesn't have basic event type reference tables
       - the person agent from config file is not in the agents table
     """
 
     # Check to see if the SANCdpd SQLite database exists
     if not os.path.exists(conf.fconf["dbfile"]):
-        print("No file found at location:", conf.fconf["dbfile"])
-        raise Exception("Database file not found.")
+        raise Exception("Database file not found: " + conf.fconf["dbfile"])
 
-    # Create db connection and cursor
-    con = sq.connect(conf.fconf["dbfile"])
+    # Create db connection (shared with the reference-data cache)
+    connect()
     lg.log("check_db: Successfully connected to SQLite database at:" +
            conf.fconf["dbfile"])
-    cur = con.cursor()
 
+    # Check the schema version
+    if check_schema:
+        schema.check_version()
 
-    # Now, do some basic queries to see if it looks like a real SANCdpd db
+    # Now, load the reference tables once, and use them to see if it looks
+    # like a real SANCdpd db
+    refdata.load()
 
-    # Query the event_type and event_type_outcome tables for diagnostics
-    evttypes = cur.execute("SELECT * FROM event_type").fetchall()
-    outtypes = cur.execute("SELECT * FROM event_type_outcome").fetchall()
+    # Count the event types and outcomes for diagnostics
+    evttypes = refdata.event_types()
+    outtypes = [o for et in evttypes for o in refdata.outcomes(et[0])]
 
     # If not much data in those tables, print warning (but no exception)
     if len(evttypes) < 3 or len(outtypes) < 2:
         print("Warning:  Little or no data in event reference tables.")
 
 
-    # Query the agents table to confirm the agent specified in the config file
-    # is an active person agent in the database
-    qstr = """SELECT agent_name, agent_code
-              FROM agent
-              WHERE agent_code = ?"""
-    qargs = (conf.fconf["person_agent_code"],)
-    agentrows = cur.execute(qstr, qargs).fetchall()
+    # Confirm the agent specified in the config file is in the agents table
+    # (agent_code is UNIQUE, so there is at most one)
+    agent = refdata.agent_by_code(conf.fconf["person_agent_code"])
 
-    if len(agentrows) != 1:
+    if agent is None:
         erstr = "Person agent from config file not uniquely in agents table."
         raise Exception(erstr)
 
     lg.log("Active person agent " +
-           agentrows[0][0] + " (" + agentrows[0][1] + ") " +
+           agent["agent_name"] + " (" + agent["agent_code"] + ") " +
            "found in database.")
 
-    # Close cursor and connection
-    cur.close()
-    con.close()
-
 
 ###############################################################################
 # function: loadref
@@ -87,36 +334,143 @@ def loadref():
     Create global variables with data structures capturing records from
         `event_type`
         `event_type_outcome`
+    The data comes from the reference-data cache in the refdata module, which
+    loads both tables with a single query.  (The cache also holds agents and
+    storage locations; new code should use its lookup functions directly.)
+    The cache is only reloaded if the tables have changed since check_db()
+    loaded it.
     """
 
-    # Create db connection and cursor
-    con = sq.connect(conf.fconf["dbfile"])
-    cur = con.cursor()
+    # Load the reference-data cache, or reload it if it is stale
+    refdata.refresh()
+
+    # Set global list of event types
+    conf.etypes = refdata.event_types()
+
+    # Set global dictionary of outcomes for each event type
+    conf.otypes = {}
+    for et in conf.etypes:
+        conf.otypes[et[0]] = refdata.outcomes(et[0])
 
+    lg.log("loadref: Loaded values from event_type and event_type_outcome")
 
-    # Query event_type and set global list
-    qstr = """SELECT event_type_code, event_name, event_category_code
-              FROM event_type"""
-    conf.etypes = cur.execute(qstr).fetchall()
 
-    lg.log("loadref: Loaded values from event_type table")
+###############################################################################
+# function: timestamp
+###############################################################################
+def timestamp():
+    """
+    Returns the current local time as an ISO 8601 string, to the second, as
+    specified by the SANCdpd data dictionary for DATETIME fields.
+    """
+    return dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 
 
-    # Create global dictionary of outcomes
+###############################################################################
+# function: agent_ids
+###############################################################################
+def agent_ids():
+    """
+    Looks up the agents responsible for events recorded during this session.
+    Returns a pair (person_agent_id, software_agent_id).
+    The person agent is the one whose agent_code is given in the config file.
+    The software agent is the active SOFTW agent whose name and version match
+    those set in conf.sconf by the running UI.  Either may be None if it is
+    not found in the agent table.
+    """
+    person = refdata.agent_by_code(conf.fconf["person_agent_code"])
+    person_id = person["agent_id"] if person else None
 
-    # First, writ the query string to get the otypes for a given etype
-    qstr = """SELECT outcome_code, outcome_name
-              FROM event_type_outcome
-              WHERE event_type_code = ?"""
+    softw_id = None
+    for agent in refdata.agents():
+        if (agent["agent_type_code"] == "SOFTW" and agent["is_active"] and
+                agent["agent_name"] == conf.sconf.get("softw_agent_name") and
+                agent["agent_version"] ==
+                conf.sconf.get("softw_agent_version")):
+            softw_id = agent["agent_id"]
 
-    # Loop through the etypes to set valid otypes for each
-    for et in conf.etypes:
-        qargs = (et[0],)
-        conf.otypes[et[0]] = cur.execute(qstr, qargs).fetchall()
+    return person_id, softw_id
+
+
+###############################################################################
+# function: insert_bag_events
+###############################################################################
+def insert_bag_events(cur, rows):
+    """
+    Inserts a batch of events into the bag_event table with one executemany
+    call.  Each row is a dictionary whose keys are bag_event column names.
+    Columns missing from a row are inserted as NULL.
+    Returns the list of new bag_event_id values, in the order of the rows.
+    (Rows inserted in one transaction get consecutive IDs.)
+    If this process is running a job (see set_job()), the events are linked
+    to it.
+    The cursor should belong to an open transaction().
+    """
+    cols = ("bag_id", "event_type_code",
+            "person_agent_id", "software_agent_id",
+            "hardware_agent_id", "organization_agent_id",
+            "start_time", "end_time",
+            "event_details", "tools_used",
+            "outcome_code", "outcome_details")
+    qstr = ("INSERT INTO bag_event (" + ", ".join(cols) + ") " +
+            "VALUES (" + ", ".join(["?"] * len(cols)) + ")")
+    cur.executemany(qstr, [tuple(r.get(c) for c in cols) for r in rows])
+    qstr = "SELECT max(bag_event_id) FROM bag_event"
+    lastid = cur.execute(qstr).fetchone()[0]
+    ids = list(range(lastid - len(rows) + 1, lastid + 1))
+    if _job_id is not None:
+        qstr = """INSERT INTO job_bag_event (job_id, bag_event_id)
+                  VALUES (?, ?)"""
+        cur.executemany(qstr, [(_job_id, i) for i in ids])
+    return ids
 
-    lg.log("loadref: Loaded values from event_type_outcome table")
 
+###############################################################################
+# function: insert_storage_event
+###############################################################################
+def insert_storage_event(cur, row, agents):
+    """
+    Inserts one event into the storage_event table, and one row into the
+    storage_event_by_agent table for each agent responsible for it.
+    The row is a dictionary whose keys are storage_event column names.
+    Columns missing from the row are inserted as NULL.
+    The agents argument is a list of (agent_id, role_notes) pairs.  Pairs
+    whose agent_id is None are skipped.
+    Returns the new storage_event_id.
+    If this process is running a job (see set_job()), the event is linked to
+    it.
+    The cursor should belong to an open transaction().
+    """
+    cols = ("storage_id", "event_type_code",
+            "start_time", "end_time",
+            "event_details", "tools_used",
+            "outcome_code", "outcome_details")
+    qstr = ("INSERT INTO storage_event (" + ", ".join(cols) + ") " +
+            "VALUES (" + ", ".join(["?"] * len(cols)) + ")")
+    cur.execute(qstr, tuple(row.get(c) for c in cols))
+    event_id = cur.lastrowid
 
-    # Close cursor and connection
-    cur.close()
-    con.close()
+    qstr = """INSERT INTO storage_event_by_agent
+                  (storage_event_id, agent_id, role_notes)
+              VALUES (?, ?, ?)"""
+    cur.executemany(qstr, [(event_id, agent_id, notes)
+                           for agent_id, notes in agents
+                           if agent_id is not None])
+    if _job_id is not None:
+        qstr = """INSERT INTO job_storage_event (job_id, storage_event_id)
+                  VALUES (?, ?)"""
+        cur.execute(qstr, (_job_id, event_id))
+    return event_id
+
+
+###############################################################################
+# function: set_job
+###############################################################################
+def set_job(job_id):
+    """
+    Sets the ID of the job that this process is running, so that the
+    bag_event and storage_event rows inserted by insert_bag_events() and
+    insert_storage_event() are linked to it.  None clears it.
+    """
+    global _job_id
+    _job_id = job_id
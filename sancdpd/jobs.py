@@ -0,0 +1,681 @@
+"""
+This module runs long preservation procedures (validation, fixity audits,
+virus scans, backups, migrations, access copies, and registration) as jobs
+in the background, so that they do not need a person at the menu.
+
+A job is a row in the job table:  the procname of a procedure in
+cli.procdefs, its arguments (as a JSON object), and its status, which is
+one of:
+    queued:  waiting for a worker (after run_after_time)
+    running:  leased by a worker
+    done:  finished; the summary returned by the procedure is in result
+    failed:  raised an exception on its last allowed attempt
+    cancelled:  cancelled before it finished
+
+Jobs are added with enqueue() and run by the worker daemon, run_workers(),
+which starts several worker processes.  Each worker repeatedly claims the
+queued job with the highest priority (the oldest first, among equals) and
+runs it.  Claiming a job leases it to the worker for job_lease_seconds; a
+heartbeat thread renews the lease while the job runs.  If a worker dies,
+its lease runs out, and another worker claims the job again.  A job that
+raises an exception is queued again after a delay that doubles with each
+attempt, until it has been tried max_attempts times, when it fails.
+
+Jobs checkpoint their progress, so that a job claimed again continues
+where it stopped instead of starting over:
+  - Procedures that work bag by bag (see CHUNKED_PROCEDURES) are run on
+    chunks of job_chunk_bags bags, in order of bag_id.  After each chunk,
+    the last bag_id done and the merged summary so far are saved in the
+    checkpoint column.  (A chunk interrupted partway is run again, so its
+    bags may get a second event.)
+  - Procedures that keep their own checkpoints (registration, backups, and
+    access copies) continue from those when they are run again.
+Every bag_event and storage_event row inserted by a job is linked to it in
+the job_bag_event and job_storage_event tables.
+
+A job is cancelled with cancel_job().  A queued job is cancelled at once.
+A running chunked job stops at its next checkpoint, when its worker finds
+that it no longer holds the lease; other running jobs run to the end, but
+their outcome is not recorded.
+
+These optional keys in the config file control jobs:
+    job_workers:  number of worker processes (default 2)
+    job_lease_seconds:  length of a lease (default 300)
+    job_poll_seconds:  seconds between looks for new jobs (default 5)
+    job_max_attempts:  default number of attempts of a job (default 3)
+    job_chunk_bags:  number of bags per chunk of a chunked job (default 100)
+
+This module contains the following functions:
+    enqueue() :  Adds a job to the queue
+    list_jobs() :  Lists jobs
+    show_job() :  Shows one job, with the events it recorded
+    cancel_job() :  Cancels a job
+    retry_job() :  Queues a failed or cancelled job again
+    claim() :  Leases the next job to a worker
+    run_job() :  Runs a claimed job
+    run_workers() :  Runs the worker daemon
+"""
+
+# Import modules from the Python standard library
+import datetime as dt        # for lease and retry times
+import json                  # for job arguments, checkpoints, and results
+import multiprocessing       # for worker processes
+import os                    # for the process ID
+import signal                # for stopping workers
+import socket                # for naming workers
+import sqlite3 as sq         # for busy errors
+import threading             # for heartbeats
+import traceback             # for logging job errors
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+import dbops
+import metrics
+import cli
+import operational.bagval as bagval
+
+
+###############################################################################
+# Global (for this module) data structures
+###############################################################################
+
+# Statuses of a job
+STATUSES = ["queued", "running", "done", "failed", "cancelled"]
+
+# Procedures that can be run as jobs
+JOB_PROCEDURES = ["register_storage", "validate_bags", "audit_fixity",
+                  "compare_tagmanifests", "migrate_storage",
+                  "backup_storage", "scan_bags", "create_access_copies",
+                  "reconcile_inventory", "backfill_search",
+                  "record_events", "export_events", "verify_capacity"]
+
+# Procedures run in chunks of bags, with the name of their storage location
+# argument.  (Each takes a bag_ids argument, and records events bag by bag.)
+CHUNKED_PROCEDURES = {"validate_bags": "storage_id",
+                      "audit_fixity": "storage_id",
+                      "scan_bags": "storage_id",
+                      "create_access_copies": "storage_id"}
+
+# Keys of procedure results that list event IDs.  These are not stored in
+# job results, since the job_bag_event and job_storage_event tables link
+# the events to the job.
+EVENT_ID_KEYS = ["bag_event_ids", "storage_event_ids"]
+
+# Defaults for the optional config keys
+DEFAULT_WORKERS = 2
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_POLL_SECONDS = 5
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_CHUNK_BAGS = 100
+
+# Delay before the second attempt of a failed job, in seconds.  The delay
+# doubles with each further attempt.
+RETRY_DELAY = 60
+
+# Columns of the job table shown by list_jobs()
+LIST_COLUMNS = ["job_id", "procname", "status", "priority", "attempts",
+                "enqueued_time", "finished_time", "worker"]
+
+
+###############################################################################
+# class: LeaseLost
+###############################################################################
+class LeaseLost(Exception):
+    """
+    Raised in a worker when the job it is running is no longer leased to it,
+    because the job was cancelled or its lease ran out.
+    """
+
+
+###############################################################################
+# function: _time
+###############################################################################
+def _time(offset=0):
+    """
+    Returns the local time offset seconds from now, in the format of
+    dbops.timestamp().
+    """
+    return (dt.datetime.now() + dt.timedelta(seconds=offset)
+            ).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+###############################################################################
+# function: _setting
+###############################################################################
+def _setting(key, default):
+    """
+    Returns the value of an optional config key for jobs, as a number.
+    """
+    return float(conf.fconf.get(key) or default)
+
+
+###############################################################################
+# function: _dumps
+###############################################################################
+def _dumps(value):
+    """
+    Returns value as JSON, for the job table.
+    """
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+###############################################################################
+# function: _row
+###############################################################################
+def _row(cur, job_id):
+    """
+    Returns a dictionary of the columns of a job, or raises an exception if
+    there is no such job.
+    """
+    cur.execute("SELECT * FROM job WHERE job_id = ?", (job_id,))
+    row = cur.fetchone()
+    if row is None:
+        raise Exception("No job with ID " + str(job_id))
+    return dict(zip([d[0] for d in cur.description], row))
+
+
+###############################################################################
+# function: _check_arguments
+###############################################################################
+def _check_arguments(procname, arguments):
+    """
+    Checks the arguments of a job against the procedure's entry in
+    cli.procdefs, converting strings to the kinds of value expected.
+    Returns the checked arguments, or raises an exception.
+    """
+    if procname not in JOB_PROCEDURES:
+        raise Exception("Procedure cannot be run as a job: " + procname +
+                        ".  Jobs can run: " + ", ".join(JOB_PROCEDURES))
+    if not isinstance(arguments, dict):
+        raise Exception("Job arguments must be a JSON object.")
+    params = dict((p[0], p) for p in cli.procdefs[procname][1])
+
+    checked = {}
+    for name, value in arguments.items():
+        if name not in params:
+            raise Exception("Unknown argument for " + procname + ": " + name)
+        kind = params[name][1]
+        if isinstance(value, str) and kind != "str":
+            value = cli.converters[kind](value)
+        checked[name] = value
+    for name, kind, prompt, default in params.values():
+        if default == cli.REQUIRED and checked.get(name) is None:
+            raise Exception("Missing argument for " + procname + ": " + name)
+    return checked
+
+
+###############################################################################
+# function: enqueue
+###############################################################################
+def enqueue(procedure, arguments=None, priority=0, max_attempts=None):
+    """
+    Adds a job to the queue, to run procedure (a procname, i.e., a key in
+    cli.procdefs) with arguments, a dictionary or a JSON object.  Jobs with
+    higher priority run first.  The job is tried at most max_attempts times
+    (by default, the job_max_attempts config key).
+    Returns a dictionary with the new job_id.
+    """
+    if arguments is None:
+        arguments = {}
+    elif isinstance(arguments, str):
+        arguments = json.loads(arguments)
+    arguments = _check_arguments(procedure, arguments)
+    if max_attempts is None:
+        max_attempts = _setting("job_max_attempts", DEFAULT_MAX_ATTEMPTS)
+
+    now = dbops.timestamp()
+    with dbops.transaction() as cur:
+        cur.execute("""INSERT INTO job
+                           (procname, arguments, status, priority, attempts,
+                            max_attempts, run_after_time, enqueued_time)
+                       VALUES (?, ?, 'queued', ?, 0, ?, ?, ?)""",
+                    (procedure, _dumps(arguments), int(priority),
+                     int(max_attempts), now, now))
+        job_id = cur.lastrowid
+
+    lg.log("enqueue: Queued job " + str(job_id) + ": " + procedure + " " +
+           _dumps(arguments))
+    return {"job_id": job_id, "procname": procedure, "arguments": arguments}
+
+
+###############################################################################
+# function: list_jobs
+###############################################################################
+def list_jobs(status=None, limit=50):
+    """
+    Returns a list of dictionaries describing the most recent jobs, newest
+    first, optionally only those with a given status.
+    """
+    qstr = "SELECT " + ", ".join(LIST_COLUMNS) + " FROM job"
+    qargs = []
+    if status is not None:
+        if status not in STATUSES:
+            raise Exception("Unknown job status: " + str(status))
+        qstr += " WHERE status = ?"
+        qargs.append(status)
+    qstr += " ORDER BY job_id DESC LIMIT ?"
+    qargs.append(int(limit))
+
+    cur = dbops.connect().cursor()
+    jobs = [dict(zip(LIST_COLUMNS, row)) for row in cur.execute(qstr, qargs)]
+    cur.close()
+    return jobs
+
+
+###############################################################################
+# function: show_job
+###############################################################################
+def show_job(job_id):
+    """
+    Returns a dictionary of the columns of a job (with its arguments,
+    checkpoint, and result decoded), and the IDs of the bag_event and
+    storage_event rows it recorded.
+    """
+    cur = dbops.connect().cursor()
+    job = _row(cur, job_id)
+    for key in ("arguments", "checkpoint", "result"):
+        if job[key] is not None:
+            job[key] = json.loads(job[key])
+    job["bag_event_ids"] = [r[0] for r in cur.execute(
+        """SELECT bag_event_id FROM job_bag_event WHERE job_id = ?
+           ORDER BY bag_event_id""", (job_id,))]
+    job["storage_event_ids"] = [r[0] for r in cur.execute(
+        """SELECT storage_event_id FROM job_storage_event WHERE job_id = ?
+           ORDER BY storage_event_id""", (job_id,))]
+    cur.close()
+    return job
+
+
+###############################################################################
+# function: cancel_job
+###############################################################################
+def cancel_job(job_id):
+    """
+    Cancels a queued or running job.  A running chunked job stops at its
+    next checkpoint (see the module docstring).
+    Returns a dictionary with the job's status before and after.
+    """
+    with dbops.transaction() as cur:
+        before = _row(cur, job_id)["status"]
+        if before not in ("queued", "running"):
+            raise Exception("Job " + str(job_id) + " is " + before +
+                            ", and cannot be cancelled.")
+        cur.execute("""UPDATE job
+                       SET status = 'cancelled', finished_time = ?,
+                           lease_expires_time = NULL
+                       WHERE job_id = ?""", (dbops.timestamp(), job_id))
+
+    lg.log("cancel_job: Cancelled job " + str(job_id) + " (was " + before +
+           ")")
+    return {"job_id": job_id, "status_before": before,
+            "status": "cancelled"}
+
+
+###############################################################################
+# function: retry_job
+###############################################################################
+def retry_job(job_id):
+    """
+    Queues a failed or cancelled job again, with its attempts reset.  It
+    continues from its checkpoint, if it has one.
+    Returns a dictionary with the job's status before and after.
+    """
+    with dbops.transaction() as cur:
+        before = _row(cur, job_id)["status"]
+        if before not in ("failed", "cancelled"):
+            raise Exception("Job " + str(job_id) + " is " + before +
+                            ", and cannot be retried.")
+        cur.execute("""UPDATE job
+                       SET status = 'queued', attempts = 0,
+                           run_after_time = ?, finished_time = NULL,
+                           worker = NULL, error = NULL
+                       WHERE job_id = ?""", (dbops.timestamp(), job_id))
+
+    lg.log("retry_job: Queued job " + str(job_id) + " again (was " + before +
+           ")")
+    return {"job_id": job_id, "status_before": before, "status": "queued"}
+
+
+###############################################################################
+# function: claim
+###############################################################################
+def claim(worker):
+    """
+    Leases the next job to the named worker:  the queued job with the
+    highest priority whose run_after_time has passed, or else a running job
+    whose lease has run out (whose worker has presumably died).  A job whose
+    lease ran out on its last allowed attempt fails instead.
+    Returns a dictionary of the columns of the job, or None if there is no
+    job to run.
+    """
+    lease = _setting("job_lease_seconds", DEFAULT_LEASE_SECONDS)
+    now = _time()
+    with dbops.transaction() as cur:
+        # Fail jobs whose lease ran out on their last attempt
+        cur.execute("""UPDATE job
+                       SET status = 'failed', finished_time = ?,
+                           error = 'Lease of worker ' || worker ||
+                                   ' ran out on the last attempt.'
+                       WHERE status = 'running' AND lease_expires_time < ?
+                         AND attempts >= max_attempts""", (now, now))
+
+        row = cur.execute(
+            """SELECT job_id FROM job
+               WHERE status = 'queued' AND run_after_time <= ?
+               ORDER BY priority DESC, job_id
+               LIMIT 1""", (now,)).fetchone()
+        if row is None:
+            row = cur.execute(
+                """SELECT job_id FROM job
+                   WHERE status = 'running' AND lease_expires_time < ?
+                   ORDER BY priority DESC, job_id
+                   LIMIT 1""", (now,)).fetchone()
+        if row is None:
+            return None
+
+        cur.execute("""UPDATE job
+                       SET status = 'running', worker = ?,
+                           attempts = attempts + 1,
+                           started_time = ifnull(started_time, ?),
+                           heartbeat_time = ?, lease_expires_time = ?
+                       WHERE job_id = ?""",
+                    (worker, now, now, _time(lease), row[0]))
+        return _row(cur, row[0])
+
+
+###############################################################################
+# function: _renew
+###############################################################################
+def _renew(job_id, worker, checkpoint=None):
+    """
+    Renews the lease of a job held by worker, and saves its checkpoint if
+    one is given.  Raises LeaseLost if the job is no longer leased to the
+    worker.
+    """
+    lease = _setting("job_lease_seconds", DEFAULT_LEASE_SECONDS)
+    qstr = """UPDATE job
+              SET heartbeat_time = ?, lease_expires_time = ?"""
+    qargs = [_time(), _time(lease)]
+    if checkpoint is not None:
+        qstr += ", checkpoint = ?"
+        qargs.append(_dumps(checkpoint))
+    qstr += " WHERE job_id = ? AND worker = ? AND status = 'running'"
+    qargs.extend([job_id, worker])
+    with dbops.transaction() as cur:
+        cur.execute(qstr, qargs)
+        if cur.rowcount != 1:
+            raise LeaseLost("Job " + str(job_id) + " is no longer leased " +
+                            "to worker " + worker + ".")
+
+
+###############################################################################
+# function: _heartbeat
+###############################################################################
+def _heartbeat(job_id, worker, stop, lost):
+    """
+    Runs in a thread while a job runs.  Renews the job's lease at a fifth of
+    the lease length, until stop is set.  Sets lost if the lease is lost.
+    """
+    interval = _setting("job_lease_seconds", DEFAULT_LEASE_SECONDS) / 5.0
+    try:
+        while not stop.wait(interval):
+            try:
+                _renew(job_id, worker)
+            except LeaseLost:
+                lost.set()
+                lg.log("jobs: " + worker + " lost the lease of job " +
+                       str(job_id) + ".", "WARNING")
+                return
+            except sq.OperationalError as e:
+                lg.log("jobs: Heartbeat of job " + str(job_id) +
+                       " failed: " + str(e), "WARNING")
+    finally:
+        dbops.close()
+
+
+###############################################################################
+# function: _merge
+###############################################################################
+def _merge(total, result):
+    """
+    Merges the summary returned by one chunk of a chunked job into the
+    summary of the chunks before it:  numbers are added, lists are joined,
+    and other values are replaced.  Rates (keys ending in "_per_sec") are
+    worked out again from the merged totals and seconds.
+    """
+    if not isinstance(result, dict):
+        return total
+    for key, value in result.items():
+        if key in EVENT_ID_KEYS or key.endswith("_per_sec"):
+            continue
+        old = total.get(key)
+        if (isinstance(value, (int, float)) and not isinstance(value, bool)
+                and isinstance(old, (int, float))):
+            total[key] = round(old + value, 6)
+        elif isinstance(value, list) and isinstance(old, list):
+            total[key] = old + value
+        else:
+            total[key] = value
+    for key in result:
+        base = key[:-len("_per_sec")]
+        if key.endswith("_per_sec") and base in total:
+            seconds = total.get("seconds") or 0
+            total[key] = round(total[base] / seconds) if seconds else 0
+    return total
+
+
+###############################################################################
+# function: _run_chunked
+###############################################################################
+def _run_chunked(job, func, arguments, worker, lost):
+    """
+    Runs a chunked job (see the module docstring), starting after the last
+    bag in its checkpoint.  Returns the merged summary of all chunks.
+    """
+    chunk = int(_setting("job_chunk_bags", DEFAULT_CHUNK_BAGS))
+    state = {"last_bag_id": 0, "result": {}}
+    if job["checkpoint"]:
+        state = json.loads(job["checkpoint"])
+        lg.log("jobs: Job " + str(job["job_id"]) + " continues after bag " +
+               str(state["last_bag_id"]))
+
+    cur = dbops.connect().cursor()
+    storage_key = CHUNKED_PROCEDURES[job["procname"]]
+    bag_ids = [bag_id for bag_id, bagdir in
+               bagval.select_bags(cur, arguments.get(storage_key),
+                                  arguments.get("bag_ids"))
+               if bag_id > state["last_bag_id"]]
+    cur.close()
+
+    for i in range(0, len(bag_ids), chunk):
+        if lost.is_set():
+            raise LeaseLost("Job " + str(job["job_id"]) + " lost its lease.")
+        kwargs = dict(arguments)
+        kwargs["bag_ids"] = bag_ids[i:i + chunk]
+        state["result"] = _merge(state["result"], func(**kwargs))
+        state["last_bag_id"] = kwargs["bag_ids"][-1]
+        _renew(job["job_id"], worker, state)
+
+    return state["result"]
+
+
+###############################################################################
+# function: _finish
+###############################################################################
+def _finish(job, worker, error=None, result=None):
+    """
+    Records the end of an attempt at a job:  done, or if there was an error,
+    queued again after a delay, or failed on its last attempt.
+    Returns the job's new status, or None if the job is no longer leased to
+    the worker.
+    """
+    if error is None:
+        status = "done"
+        run_after = job["run_after_time"]
+    elif job["attempts"] < job["max_attempts"]:
+        status = "queued"
+        run_after = _time(RETRY_DELAY * 2 ** (job["attempts"] - 1))
+    else:
+        status = "failed"
+        run_after = job["run_after_time"]
+
+    if isinstance(result, dict):
+        result = dict((k, v) for k, v in result.items()
+                      if k not in EVENT_ID_KEYS)
+    with dbops.transaction() as cur:
+        cur.execute("""UPDATE job
+                       SET status = ?, run_after_time = ?,
+                           finished_time = ?, lease_expires_time = NULL,
+                           result = ?, error = ?
+                       WHERE job_id = ? AND worker = ?
+                         AND status = 'running'""",
+                    (status, run_after,
+                     dbops.timestamp() if status != "queued" else None,
+                     _dumps(result) if result is not None else None,
+                     error, job["job_id"], worker))
+        if cur.rowcount != 1:
+            return None
+    return status
+
+
+###############################################################################
+# function: run_job
+###############################################################################
+def run_job(job, worker):
+    """
+    Runs a job claimed by the named worker (see claim()), with a heartbeat
+    thread renewing its lease, and records the outcome.
+    Returns the job's new status, or None if the job was cancelled or lost
+    its lease while it ran.
+    """
+    job_id = job["job_id"]
+    procname = job["procname"]
+    arguments = json.loads(job["arguments"])
+    func = cli.procfunc(cli.procdefs[procname][0])
+    lg.log("jobs: " + worker + " runs job " + str(job_id) + " (attempt " +
+           str(job["attempts"]) + " of " + str(job["max_attempts"]) + "): " +
+           procname + " " + job["arguments"])
+
+    stop = threading.Event()
+    lost = threading.Event()
+    beat = threading.Thread(target=_heartbeat,
+                            args=(job_id, worker, stop, lost),
+                            name="job heartbeat", daemon=True)
+    beat.start()
+    dbops.set_job(job_id)
+    try:
+        with metrics.procedure(procname):
+            if procname in CHUNKED_PROCEDURES:
+                result = _run_chunked(job, func, arguments, worker, lost)
+            else:
+                result = func(**arguments)
+        status = _finish(job, worker, result=result)
+    except LeaseLost as e:
+        lg.log("jobs: " + str(e) + "  Stopped.", "WARNING")
+        status = None
+    except Exception as e:
+        lg.log("jobs: Job " + str(job_id) + " raised an exception:\n" +
+               traceback.format_exc(), "ERROR")
+        status = _finish(job, worker, error=str(e) or type(e).__name__)
+    finally:
+        dbops.set_job(None)
+        stop.set()
+        beat.join()
+
+    lg.log("jobs: Job " + str(job_id) + " is " + str(status))
+    return status
+
+
+###############################################################################
+# function: _work
+###############################################################################
+def _work(worker, stop, drain):
+    """
+    Runs in a worker process.  Claims and runs jobs until stop is set, or,
+    if drain is True, until there are no jobs to run.
+    """
+    # The daemon handles interrupts, and sets stop; the worker finishes its
+    # current job first.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    poll = _setting("job_poll_seconds", DEFAULT_POLL_SECONDS)
+    lg.log("jobs: Worker " + worker + " started.")
+
+    while not stop.is_set():
+        try:
+            job = claim(worker)
+        except sq.OperationalError as e:
+            lg.log("jobs: " + worker + " could not claim a job: " + str(e),
+                   "WARNING")
+            job = None
+        if job is not None:
+            run_job(job, worker)
+        elif drain:
+            break
+        else:
+            stop.wait(poll)
+
+    lg.log("jobs: Worker " + worker + " stopped.")
+    lg.flush()
+
+
+###############################################################################
+# function: run_workers
+###############################################################################
+def run_workers(workers=None, drain=False):
+    """
+    Runs the worker daemon:  starts the given number of worker processes (by
+    default, the job_workers config key), which claim and run jobs until the
+    daemon is interrupted (with Ctrl-C or SIGTERM), or, if drain is True,
+    until there are no jobs left to run.  When interrupted, the workers
+    finish their current jobs first; a second interrupt stops them at once,
+    and their jobs are claimed again when their leases run out.
+    Returns a dictionary counting the jobs finished by the workers, by
+    status.
+    """
+    if workers is None:
+        workers = _setting("job_workers", DEFAULT_WORKERS)
+    workers = int(workers)
+    daemon = socket.gethostname() + ":" + str(os.getpid())
+    started = dbops.timestamp()
+
+    # Log messages queued so far are written before forking, so that the
+    # workers do not write them again
+    lg.flush()
+    stop = multiprocessing.Event()
+    procs = [multiprocessing.Process(target=_work,
+                                     args=(daemon + "/" + str(i), stop,
+                                           drain),
+                                     name="SANCdpd worker " + str(i))
+             for i in range(1, workers + 1)]
+    lg.log("run_workers: Starting " + str(workers) + " workers as " + daemon)
+
+    def interrupt(signum, frame):
+        if stop.is_set():
+            for p in procs:
+                p.terminate()
+        else:
+            print("   Stopping after the current jobs.  " +
+                  "Interrupt again to stop at once.")
+            stop.set()
+
+    previous = (signal.signal(signal.SIGINT, interrupt),
+                signal.signal(signal.SIGTERM, interrupt))
+    try:
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+    finally:
+        signal.signal(signal.SIGINT, previous[0])
+        signal.signal(signal.SIGTERM, previous[1])
+
+    qstr = """SELECT status, count(*) FROM job
+              WHERE worker LIKE ? AND finished_time >= ?
+              GROUP BY status"""
+    summary = {"workers": workers, "done": 0, "failed": 0, "cancelled": 0}
+    for status, n in dbops.connect().execute(qstr, (daemon + "/%", started)):
+        summary[status] = n
+    lg.log("run_workers: Workers stopped: " + _dumps(summary))
+    return summary
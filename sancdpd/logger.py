@@ -1,38 +1,95 @@
 """
 This module creates and manages the runtime log files for SANCdpd.
 It depends on a valid logfile directory being specified in the config file.
-This module contains only two functions:
+This module contains these functions:
     begin() :  Tell logger to begin logging this session.
     log(msg) : Tell logger to add msg to session log.
+    flush() :  Wait until every message logged so far is written to disk.
+    end() :  Write any remaining messages and stop logging.
 
 To use the logging functionality in other modules, some module must call the
 begin() function (and this function should be called only once).
 After that, logging occurs whenever the log() function is called.
+
+Calls to log() are cheap:  they only put the message on a queue, with the
+time it was logged.  A background writer thread takes messages off the queue
+in batches, formats them, and appends them to the logfile, which it keeps
+open.  Lines are written to the file, in a single write each time, at
+least every log_flush_interval seconds.  Remaining messages are written
+when the program exits, including when it exits because of an uncaught
+exception (which is logged too).  A forked worker process, which has no
+writer thread, appends its messages to the same logfile directly, in the
+same format, through an unbuffered append handle that it opens once, on its
+first message.  Each line is one write, and none is held in a buffer, so
+none is lost when the worker exits with os._exit().
+
+These optional keys in the config file control logging:
+    log_level: lowest level of message to write ("DEBUG", "INFO",
+        "WARNING", or "ERROR"; default "INFO")
+    log_flush_interval: maximum seconds between flushes (default 1.0)
+    log_format: "text" (default) for lines like the following,
+            [2022-05-04 10:11:12.123456] message
+        or "jsonl" for one JSON object per line, with keys "time", "level",
+        and "msg", for machine parsing.
 """
 
 # Import modules from the Python standard library
+import atexit                # for writing remaining messages at exit
 import datetime as dt        # for getting and formatting timestamps
+import json                  # for the JSON-lines log format
+import os                    # for the process ID
 import os.path               # to make sure the log directory exists
-import pprint                # for formatting the fconf dictionary for printing
+import queue                 # for passing messages to the writer thread
+import sys                   # for hooking uncaught exceptions
+import threading             # for the writer thread
+import time                  # for message times
+import traceback             # for logging uncaught exceptions
 
 # Import other SANCdpd modules
 import conf
 
 
 ###############################################################################
-# Global variable for the logfile filename.
+# Global variables for the logger.
 ###############################################################################
+
+# The logfile filename
 logfilename = ""
 
+# Numeric values of the levels, for filtering
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+# Lowest numeric level written to the logfile
+_min_level = LEVELS["INFO"]
+
+# Queue of (time, level, message) records for the writer thread.
+# A record of None tells the writer thread to finish.
+_queue = queue.SimpleQueue()
+
+# The writer thread, and the process that started it
+_writer = None
+_pid = None
+
+# The format of the logfile ("text" or "jsonl")
+_fmt = "text"
+
+# The logfile opened by a forked worker process, or None
+_child_fp = None
+
+# The last second formatted by _format_text(), and its formatted string
+_stamp_cache = [None, ""]
+
 
 ###############################################################################
 # function: begin
 ###############################################################################
-def begin():
+def begin(quiet=False):
     """
     Create a new timestamped log file for this session.
     (This should be run only once per SANCdpd session.)
-    Begin logging by writing the first lines to it.
+    Begin logging by writing the first lines to it, and start the writer
+    thread.
+    If quiet is True, the console message about logging is not printed.
     """
 
     # If the conf file has not been read, for some reason, read it now.
@@ -47,44 +104,72 @@ def begin():
     if not os.path.exists(conf.fconf["logdir"]):
         raise Exception("Directory for log files does not exist.")
 
+    # Read the optional logging settings
+    global _min_level, _fmt
+    level = conf.fconf.get("log_level", "INFO").upper()
+    if level not in LEVELS:
+        raise Exception("Unknown log_level in config file: " + level)
+    _min_level = LEVELS[level]
+    fmt = conf.fconf.get("log_format", "text")
+    if fmt not in ("text", "jsonl"):
+        raise Exception("Unknown log_format in config file: " + fmt)
+    interval = float(conf.fconf.get("log_flush_interval", 1.0))
+    _fmt = fmt
+
     # Create string with current timestamp.
     now = dt.datetime.now()
     strnow = now.strftime("%Y-%m-%d_%H-%M-%S_%f")
 
     # Construct a full filename.
-    filename = conf.fconf["logdir"] + "sdpd_" + strnow + ".log"
-
-    # Create, initialize, write actual logfile.
-    fp = open(filename, "w")
-    fp.write("SANCdpd logger activated at " +
-             now.strftime("%Y-%m-%d %H:%M:%S.%f") +
-             "\n")
-    fp.write("SANCdpd is using the following values from the config file:" +
-             "\n")
-    fp.write(pprint.pformat(conf.fconf) + "\n")
-    fp.close()
+    ext = ".jsonl" if fmt == "jsonl" else ".log"
+    filename = conf.fconf["logdir"] + "sdpd_" + strnow + ext
+
+    # Create, initialize, write actual logfile.  It is opened unbuffered,
+    # in append mode, so that each write of whole lines lands at the end of
+    # the file, after any lines appended by forked worker processes.
+    fp = open(filename, "ab", buffering=0)
+    header = ("SANCdpd logger activated at " +
+              now.strftime("%Y-%m-%d %H:%M:%S.%f") + "\n" +
+              "SANCdpd is using the config file: " + str(conf.configfile))
+    if fmt == "jsonl":
+        header = json.dumps({"time": now.isoformat(), "level": "INFO",
+                             "msg": header})
+    fp.write((header + "\n").encode("utf-8"))
 
     # If we got here without a problem, set the global logfile filename
     global logfilename
     logfilename = filename
 
+    # Start the writer thread, which takes over the open file
+    global _writer, _pid
+    _pid = os.getpid()
+    _writer = threading.Thread(target=_write_loop, args=(fp, fmt, interval),
+                               name="SANCdpd logger", daemon=True)
+    _writer.start()
+    atexit.register(end)
+    _hook_exceptions()
+
     # Output message to console informing user about logging.
-    print("")
-    print("   " + "Runtime logging activated.")
-    print("   " + logfilename)
+    if not quiet:
+        print("")
+        print("   " + "Runtime logging activated.")
+        print("   " + logfilename)
 
-    # Log first message.
+    # Log first message, and the config values for debugging.
     log("Logging begun successfully.")
+    log("Config values: " + json.dumps(conf.fconf, sort_keys=True), "DEBUG")
 
 
 ###############################################################################
 # function: log
 ###############################################################################
-def log( message ):
+def log( message, level="INFO" ):
     """
     Add a new line to the end of the logfile for this session.
     The line will include timestamp and the message.
-    Note that the file gets opened, written, and closed for every log event.
+    The level is one of the keys of LEVELS.  Messages below the log_level
+    set in the config file are dropped.
+    The message is queued for the writer thread, not written immediately.
     """
 
     # If logging is not enabled, simply exit with 1 status
@@ -95,13 +180,172 @@ def log( message ):
     if logfilename == "":
         raise Exception("Tried to log without a log file.")
 
-    # create string with current timestamp
-    now = dt.datetime.now()
-    timestamp = "[" + now.strftime("%Y-%m-%d %H:%M:%S.%f") + "]"
+    if LEVELS[level] < _min_level:
+        return 0
 
-    # append new line to the logfile and close logfile.
-    fp = open(logfilename, "a")
-    fp.write(timestamp + " " + message + "\n")
-    fp.close()
+    # A forked worker process has no writer thread, so it appends directly,
+    # in the format of the logfile, one write per line.
+    if os.getpid() != _pid:
+        global _child_fp
+        if _child_fp is None:
+            _child_fp = open(logfilename, "ab", buffering=0)
+        _child_fp.write((_format((time.time(), level, message), _fmt) +
+                         "\n").encode("utf-8"))
+        return 0
+
+    _queue.put((time.time(), level, message))
 
     return 0
+
+
+###############################################################################
+# function: flush
+###############################################################################
+def flush():
+    """
+    Waits until every message logged so far has been written and flushed to
+    the logfile.
+    """
+    if _writer is None or not _writer.is_alive():
+        return
+    done = threading.Event()
+    _queue.put(done)
+    done.wait()
+
+
+###############################################################################
+# function: end
+###############################################################################
+def end():
+    """
+    Writes any remaining messages, stops the writer thread, and closes the
+    logfile.  This runs automatically at exit.
+    """
+    global _writer
+    if _writer is None or os.getpid() != _pid:
+        return
+    _queue.put(None)
+    _writer.join()
+    _writer = None
+
+
+###############################################################################
+# function: _format_text
+###############################################################################
+def _format_text(t, level, message):
+    """
+    Formats one record as a line of the text log format.
+    The date and time to the second are cached, since consecutive messages
+    usually fall in the same second.
+    """
+    sec = int(t)
+    if _stamp_cache[0] != sec:
+        _stamp_cache[0] = sec
+        _stamp_cache[1] = time.strftime("%Y-%m-%d %H:%M:%S",
+                                        time.localtime(sec))
+    stamp = ("[" + _stamp_cache[1] + "." +
+             str(int((t - sec) * 1000000)).zfill(6) + "] ")
+    if level != "INFO":
+        stamp += level + ": "
+    return stamp + message
+
+
+###############################################################################
+# function: _format
+###############################################################################
+def _format(rec, fmt):
+    """
+    Formats one (time, level, message) record as a line of the logfile, in
+    the format fmt ("text" or "jsonl").
+    """
+    if fmt == "jsonl":
+        stamp = dt.datetime.fromtimestamp(rec[0]).isoformat()
+        return json.dumps({"time": stamp, "level": rec[1], "msg": rec[2]})
+    return _format_text(*rec)
+
+
+###############################################################################
+# function: _write_loop
+###############################################################################
+def _write_loop(fp, fmt, interval):
+    """
+    Runs in the writer thread.  Takes records off the queue in batches and
+    formats them.  The formatted lines are held in memory, and appended to
+    the logfile in one write when the queue is empty and at least every
+    interval seconds while it is busy.  (The file itself is unbuffered, so
+    that a write is never split between lines appended by forked workers.)
+    """
+    last_flush = time.monotonic()
+    pending = []
+    running = True
+    while running:
+        try:
+            batch = [_queue.get(timeout=interval)]
+        except queue.Empty:
+            continue
+        while len(batch) < 10000:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        lines = []
+        waiters = []
+        for rec in batch:
+            if rec is None:
+                running = False
+            elif isinstance(rec, threading.Event):
+                waiters.append(rec)
+            else:
+                lines.append(_format(rec, fmt))
+        pending.extend(lines)
+
+        now = time.monotonic()
+        if (waiters or not running or _queue.empty() or
+                now - last_flush >= interval):
+            if pending:
+                fp.write(("\n".join(pending) + "\n").encode("utf-8"))
+                pending = []
+            last_flush = now
+        for w in waiters:
+            w.set()
+
+    fp.close()
+
+
+###############################################################################
+# function: _after_fork
+###############################################################################
+def _after_fork():
+    """
+    Runs in a new child process after a fork.  Forgets the logfile handle of
+    the parent, if the parent was itself a forked worker, so that the child
+    opens its own.
+    """
+    global _child_fp
+    _child_fp = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+###############################################################################
+# function: _hook_exceptions
+###############################################################################
+def _hook_exceptions():
+    """
+    Wraps sys.excepthook so that an uncaught exception is logged, and the
+    remaining messages written, before the program exits.
+    """
+    previous = sys.excepthook
+
+    def hook(exctype, value, tb):
+        try:
+            log("Uncaught exception:\n" +
+                "".join(traceback.format_exception(exctype, value, tb)),
+                "ERROR")
+            end()
+        finally:
+            previous(exctype, value, tb)
+
+    sys.excepthook = hook
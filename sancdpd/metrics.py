@@ -0,0 +1,397 @@
+"""
+This module collects timings and counts of work done by SANCdpd, and
+optionally profiles procedures, so that the time spent in a slow procedure
+can be attributed to SQLite, hashing, or filesystem walks.
+
+Instrumentation is off unless it is turned on by the "metrics" config key
+(true or false) or the --metrics command line option.  While it is off,
+span(), timed() and count() do little more than check a flag.
+
+While it is on, the following are collected:
+  - spans:  for each name (and labels, such as the procedure name or the
+    kind of SQL statement), the number of times a block of code ran, the
+    total seconds, and the longest run.  Spans are recorded around each
+    procedure run from the CLI, each statement executed through a dbops
+    connection (prepare and first step; rows fetched later are not
+    included), and per-bag and per-file work in the operational modules.
+  - counters:  totals such as bytes hashed, database rows written, and
+    files walked.
+At the end of each procedure, the metrics are written to a textfile in the
+Prometheus exposition format (for the node_exporter textfile collector), at
+the path in the optional "metrics_textfile" config key (default
+"sancdpd.prom" in the log directory), and summarized in the session log.
+Metrics accumulate over the session, so the textfile always holds totals
+since the session began.
+
+Worker processes have their own copies of the metrics, which start empty.
+Functions run in worker processes should return metrics.take() with their
+results, and the main process should pass it to merge().
+
+Profiling is turned on by the "profile" config key or the --profile command
+line option, with one of these modes:
+    cprofile:  run each procedure under cProfile, write the statistics to a
+        .pstats file in the log directory, and log the top functions by
+        cumulative time.  (Only the thread that runs the procedure is
+        profiled, not worker threads or processes.)
+    tracemalloc:  trace memory allocations during each procedure, and log
+        the peak traced memory and the lines that allocated the most.
+    both:  both of the above.
+
+This module contains the following functions:
+    begin() :  Turn on instrumentation and profiling, as configured
+    enabled() :  Tell whether instrumentation is on
+    span() :  Context manager that times a block of code
+    timed() :  Decorator that times every call of a function
+    count() :  Add to a counter
+    take() :  Return and clear the metrics of this process
+    merge() :  Add metrics returned by take() in another process
+    procedure() :  Context manager for running one procedure
+    export() :  Write the metrics textfile and log a summary
+"""
+
+# Import modules from the Python standard library
+import contextlib            # for the span and procedure context managers
+import functools             # for the timed() decorator
+import importlib             # for importing the profilers only when used
+import os                    # for resetting metrics in worker processes
+import os.path               # for building paths
+import threading             # for the lock on the metrics
+import time                  # for timing
+import tracemalloc           # for the tracemalloc mode
+# (cProfile, io, and pstats, for the cprofile mode, are imported only when
+# it is used, since most sessions do not profile.)
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+
+
+###############################################################################
+# Global (for this module) data structures
+###############################################################################
+
+# Prefix of every metric name in the textfile
+PREFIX = "sancdpd_"
+
+# Profiling modes
+PROFILE_MODES = ["cprofile", "tracemalloc", "both"]
+
+# Number of functions or allocation sites logged by profiling
+PROFILE_TOP = 25
+
+# Whether instrumentation is on, and the profiling mode (or None)
+_enabled = False
+_profile = None
+
+# Spans:  (name, labels) -> [count, total seconds, max seconds]
+# Counters:  (name, labels) -> total
+# Labels are tuples of (label, value) pairs, sorted by label.
+_spans = {}
+_counters = {}
+_lock = threading.Lock()
+
+
+###############################################################################
+# function: _reset
+###############################################################################
+def _reset():
+    """
+    Clears all metrics.  This runs in each new worker process, so that it
+    does not report the metrics inherited from its parent again.
+    """
+    global _lock
+    _lock = threading.Lock()
+    _spans.clear()
+    _counters.clear()
+
+
+os.register_at_fork(after_in_child=_reset)
+
+
+###############################################################################
+# function: begin
+###############################################################################
+def begin(enable=None, profile=None):
+    """
+    Turns on instrumentation if enable is True, or if enable is None and the
+    "metrics" config key is true.  Sets the profiling mode to profile, or if
+    that is None, to the "profile" config key (if any).
+    """
+    global _enabled, _profile
+    if enable is None:
+        enable = bool(conf.fconf.get("metrics", False))
+    if profile is None:
+        profile = conf.fconf.get("profile")
+    if profile is not None and profile not in PROFILE_MODES:
+        raise Exception("Unknown profile mode: " + str(profile))
+    _enabled = bool(enable)
+    _profile = profile
+    if _enabled or _profile:
+        lg.log("metrics: Instrumentation " + ("on" if _enabled else "off") +
+               ", profiling " + (_profile or "off") + ".")
+
+
+###############################################################################
+# function: enabled
+###############################################################################
+def enabled():
+    """
+    Returns True if instrumentation is on.
+    """
+    return _enabled
+
+
+###############################################################################
+# function: _add_span
+###############################################################################
+def _add_span(key, seconds):
+    """
+    Adds one timing to a span.
+    """
+    with _lock:
+        s = _spans.get(key)
+        if s is None:
+            _spans[key] = [1, seconds, seconds]
+        else:
+            s[0] += 1
+            s[1] += seconds
+            if seconds > s[2]:
+                s[2] = seconds
+
+
+###############################################################################
+# function: span
+###############################################################################
+@contextlib.contextmanager
+def span(name, **labels):
+    """
+    Context manager that records the time taken by the block in the span
+    with the given name and labels.  The time is recorded even if the block
+    raises an exception.
+    """
+    if not _enabled:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_span((name, tuple(sorted(labels.items()))),
+                  time.perf_counter() - t0)
+
+
+###############################################################################
+# function: timed
+###############################################################################
+def timed(name):
+    """
+    Decorator that records the time taken by every call of the decorated
+    function in the span with the given name.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _add_span((name, ()), time.perf_counter() - t0)
+        return wrapper
+    return decorate
+
+
+###############################################################################
+# function: count
+###############################################################################
+def count(name, value=1, **labels):
+    """
+    Adds value to the counter with the given name and labels.
+    """
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+###############################################################################
+# function: take
+###############################################################################
+def take():
+    """
+    Returns the metrics of this process, as a pair of dictionaries (spans
+    and counters) that can be pickled, and clears them.  Returns None if
+    instrumentation is off.
+    """
+    if not _enabled:
+        return None
+    with _lock:
+        taken = (dict((k, list(v)) for k, v in _spans.items()),
+                 dict(_counters))
+        _spans.clear()
+        _counters.clear()
+    return taken
+
+
+###############################################################################
+# function: merge
+###############################################################################
+def merge(taken):
+    """
+    Adds metrics returned by take() (in a worker process) to the metrics of
+    this process.
+    """
+    if not _enabled or taken is None:
+        return
+    spans, counters = taken
+    with _lock:
+        for key, (n, total, longest) in spans.items():
+            s = _spans.setdefault(key, [0, 0.0, 0.0])
+            s[0] += n
+            s[1] += total
+            s[2] = max(s[2], longest)
+        for key, value in counters.items():
+            _counters[key] = _counters.get(key, 0) + value
+
+
+###############################################################################
+# function: procedure
+###############################################################################
+@contextlib.contextmanager
+def procedure(procname):
+    """
+    Context manager for running one procedure:  records the procedure span,
+    profiles the procedure if profiling is on, and exports the metrics at
+    the end.
+    """
+    profiler = None
+    if _profile in ("cprofile", "both"):
+        profiler = importlib.import_module("cProfile").Profile()
+    tracing = _profile in ("tracemalloc", "both")
+    if tracing:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with span("procedure", procedure=procname):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if tracing:
+            _report_memory(procname)
+            tracemalloc.stop()
+        if profiler is not None:
+            _report_profile(procname, profiler)
+        if _enabled:
+            export()
+
+
+###############################################################################
+# function: _report_profile
+###############################################################################
+def _report_profile(procname, profiler):
+    """
+    Writes the statistics of a cProfile run to a .pstats file in the log
+    directory, and logs the top functions by cumulative time.
+    """
+    path = os.path.join(conf.fconf["logdir"], "profile_" + procname + "_" +
+                        time.strftime("%Y%m%d_%H%M%S") + ".pstats")
+    profiler.dump_stats(path)
+    io = importlib.import_module("io")
+    pstats = importlib.import_module("pstats")
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats(
+        "cumulative").print_stats(PROFILE_TOP)
+    lg.log("metrics: Profile of " + procname + " written to " + path +
+           "\n" + out.getvalue())
+
+
+###############################################################################
+# function: _report_memory
+###############################################################################
+def _report_memory(procname):
+    """
+    Logs the peak memory traced by tracemalloc, and the source lines that
+    allocated the most memory still in use.
+    """
+    current, peak = tracemalloc.get_traced_memory()
+    top = tracemalloc.take_snapshot().statistics("lineno")[:PROFILE_TOP]
+    lg.log("metrics: Memory of " + procname + ": peak " + str(peak) +
+           " bytes, " + str(current) + " bytes still in use.  Top lines:\n" +
+           "\n".join(str(stat) for stat in top))
+
+
+###############################################################################
+# function: _labels
+###############################################################################
+def _labels(labels, extra=()):
+    """
+    Formats labels for the Prometheus exposition format.
+    """
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"')
+        .replace("\n", "\\n") + '"' for k, v in pairs) + "}"
+
+
+###############################################################################
+# function: export
+###############################################################################
+def export():
+    """
+    Writes all metrics to the metrics textfile (replacing it atomically, so
+    that a collector never reads half a file), and logs one line per span
+    and counter.
+    Returns the path of the textfile.
+    """
+    path = conf.fconf.get("metrics_textfile") or os.path.join(
+        conf.fconf["logdir"], "sancdpd.prom")
+    with _lock:
+        spans = sorted(_spans.items())
+        counters = sorted(_counters.items())
+
+    lines = []
+    logged = []
+    names = sorted(set(k[0] for k, v in spans))
+    for name in names:
+        metric = PREFIX + name + "_seconds"
+        lines.append("# HELP " + metric + " Time spent in " + name + ".")
+        lines.append("# TYPE " + metric + " summary")
+        for (n, labels), (calls, total, longest) in spans:
+            if n != name:
+                continue
+            lines.append(metric + "_count" + _labels(labels) + " " +
+                         str(calls))
+            lines.append(metric + "_sum" + _labels(labels) + " " +
+                         repr(round(total, 6)))
+            logged.append(name + _labels(labels) + ": " + str(calls) +
+                          " in " + str(round(total, 6)) + " s (longest " +
+                          str(round(longest, 6)) + " s)")
+        lines.append("# HELP " + metric + "_max Longest time spent in " +
+                     name + ".")
+        lines.append("# TYPE " + metric + "_max gauge")
+        for (n, labels), (calls, total, longest) in spans:
+            if n == name:
+                lines.append(metric + "_max" + _labels(labels) + " " +
+                             repr(round(longest, 6)))
+
+    for name in sorted(set(k[0] for k, v in counters)):
+        metric = PREFIX + name
+        lines.append("# TYPE " + metric + " counter")
+        for (n, labels), value in counters:
+            if n == name:
+                lines.append(metric + _labels(labels) + " " + str(value))
+                logged.append(name + _labels(labels) + ": " + str(value))
+
+    tmp = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp, "w") as fp:
+        fp.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+    lg.log("metrics: Wrote " + path + "\n" + "\n".join(logged))
+    return path
@@ -0,0 +1,417 @@
+"""
+This module creates access copies of the payload files of bags, under the
+access storage location (access_path_root in the config file), recorded in
+the SANCdpd database as "Create access copy" (CRACC) events.
+
+Access copies are made by converter commands, chosen by the extension of
+each payload file.  The converters are defined by the "access_converters"
+key in the config file, a dictionary whose keys are lowercase file
+extensions (without the dot, or "*" for any other extension) and whose
+values are dictionaries like this:
+    {"name": "ImageMagick",
+     "command": ["magick", "{input}", "-resize", "2000x2000>", "{output}"],
+     "output_ext": "jpg",
+     "version": "7.1.1",
+     "version_command": ["magick", "-version"]}
+The "{input}" and "{output}" placeholders in the command are replaced with
+the paths of the payload file and of the access copy.  The command "copy"
+(a string instead of a list) copies the file unchanged.  The converter
+version is the "version" value, or else the first line printed by the
+"version_command", which is run once per session.  Files with extensions
+that have no converter are skipped.
+
+The access copy of "data/dir/file.tif" in a bag is written to
+    <access_path_root><preservation_path><preservation_bag_name>/dir/file.jpg
+(with the output_ext of the converter).  If the copies of two payload files
+would have the same name, as for "file.tif" and "file.jp2", each keeps the
+extension of its payload file:  "file.tif.jpg" and "file.jp2.jpg".
+
+The state of every task (one payload file of one bag) is kept in the
+access_task table, along with the manifest digest of the payload file and
+the converter version used.  An access copy that was made from a payload
+file with the same digest, by a converter with the same version, and that
+still exists, is current, and is not made again (unless force is True).
+Tasks are marked pending before they start, and done or failed as they
+finish, so a run that is interrupted can simply be run again.
+
+Tasks are run by a pool of threads (each waits on its converter process).
+The number of threads can be given directly, or set with the optional
+"access_workers" key in the config file.  Otherwise, it defaults to the
+number of CPUs.  Converters that run longer than the optional
+"access_timeout" seconds (default 3600) are stopped.
+
+One CRACC event is written for each bag for which access copies were made
+or failed, with the outcome COMP (complete), CMER (complete with errors),
+or ERR (the bag could not be read).  Bags whose access copies were all
+current get no event.
+
+This module contains the following function:
+    create_access_copies() :  Create access copies and record CRACC events
+"""
+
+# Import modules from the Python standard library
+import concurrent.futures    # for the pool of converter threads
+import os                    # for the CPU count and renaming files
+import os.path               # for building paths
+import shutil                # for the "copy" converter
+import subprocess            # for running converter commands
+import time                  # for measuring throughput
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+import dbops
+import metrics
+import operational.bagit as bagit
+import operational.fixity as fixity
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Default seconds a converter may run
+DEFAULT_TIMEOUT = 3600
+
+# Number of tasks to keep queued per worker thread
+TASKS_PER_WORKER = 4
+
+# Number of task state updates written per transaction
+STATE_BATCH_SIZE = 500
+
+# Prefix of the temporary name of an access copy being made
+TEMP_PREFIX = ".cracc-"
+
+
+###############################################################################
+# function: _load_converters
+###############################################################################
+def _load_converters():
+    """
+    Reads the converters from the config file, and finds their versions.
+    Returns a dictionary of extension -> converter dictionary (with the
+    "version" always filled in).
+    """
+    defs = conf.fconf.get("access_converters")
+    if not defs:
+        raise Exception("No access_converters defined in config file.")
+
+    converters = {}
+    for ext, d in defs.items():
+        c = dict(d)
+        c.setdefault("name", c["command"] if isinstance(c["command"], str)
+                     else os.path.basename(c["command"][0]))
+        if not c.get("version"):
+            if c.get("version_command"):
+                out = subprocess.run(c["version_command"],
+                                     capture_output=True, text=True,
+                                     timeout=60).stdout.strip()
+                c["version"] = out.splitlines()[0] if out else "unknown"
+            else:
+                c["version"] = "unknown"
+        converters[ext.lower().lstrip(".")] = c
+    return converters
+
+
+###############################################################################
+# function: _output_relpath
+###############################################################################
+def _output_relpath(relpath, converter, keep_ext=False):
+    """
+    Returns the path of the access copy of a payload file, relative to the
+    bag's access directory.  If keep_ext is True, the output_ext of the
+    converter is added after the extension of the payload file, instead of
+    replacing it.
+    """
+    relpath = relpath[len(bagit.PAYLOAD_DIR) + 1:]
+    if converter.get("output_ext"):
+        if not keep_ext:
+            relpath = os.path.splitext(relpath)[0]
+        relpath += "." + converter["output_ext"]
+    return relpath
+
+
+###############################################################################
+# function: _convert
+###############################################################################
+@metrics.timed("convert_file")
+def _convert(task, converter, timeout):
+    """
+    Runs in a worker thread.  Makes one access copy, under a temporary name,
+    and renames it into place if the converter succeeds.
+    Returns a pair:  the task, and an error message (or None).
+    """
+    src, dst = task["abspath"], task["outpath"]
+    tmp = os.path.join(os.path.dirname(dst),
+                       TEMP_PREFIX + os.path.basename(dst))
+    try:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if converter["command"] == "copy":
+            shutil.copyfile(src, tmp)
+        else:
+            args = [a.replace("{input}", src).replace("{output}", tmp)
+                    for a in converter["command"]]
+            proc = subprocess.run(args, capture_output=True, text=True,
+                                  timeout=timeout)
+            if proc.returncode != 0:
+                raise Exception("exit status " + str(proc.returncode) +
+                                ": " + proc.stderr.strip()[-500:])
+            if not os.path.exists(tmp):
+                raise Exception("converter made no output")
+        os.replace(tmp, dst)
+        return task, None
+    except Exception as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return task, str(e)
+
+
+###############################################################################
+# function: _plan_bag
+###############################################################################
+@metrics.timed("plan_access_bag")
+def _plan_bag(cur, bag_id, bagdir, accessdir, converters, force):
+    """
+    Compares the payload manifests of a bag with its task state.
+    Returns a pair:  the list of tasks to run (as dictionaries), and the
+    number of access copies that are already current.
+    """
+    digests = {}
+    for alg, path in bagit.manifest_paths(bagdir).items():
+        for relpath, digest in bagit.read_manifest(path).items():
+            digests.setdefault(relpath, {})[alg] = digest
+    if not digests:
+        raise Exception("No payload manifest found in bag: " + bagdir)
+
+    qstr = """SELECT source_path, source_digest, converter_version,
+                     output_path, status
+              FROM access_task
+              WHERE bag_id = ?"""
+    state = dict((r[0], r[1:]) for r in cur.execute(qstr, (bag_id,)))
+
+    # Choose the access copy of each payload file.  Files whose copies
+    # would have the same name (like scan.tif and scan.jp2, both made into
+    # scan.jpg) keep their own extension in the name (scan.tif.jpg and
+    # scan.jp2.jpg), unless the copy has the payload file's own name.
+    planned = []
+    names = {}
+    for relpath in sorted(digests):
+        ext = os.path.splitext(relpath)[1].lower().lstrip(".")
+        converter = converters.get(ext, converters.get("*"))
+        if converter is None:
+            continue
+        outrel = _output_relpath(relpath, converter)
+        planned.append((relpath, converter, outrel))
+        names[outrel.lower()] = names.get(outrel.lower(), 0) + 1
+
+    tasks = []
+    current = 0
+    for relpath, converter, outrel in planned:
+        if (names[outrel.lower()] > 1 and
+                outrel != relpath[len(bagit.PAYLOAD_DIR) + 1:]):
+            outrel = _output_relpath(relpath, converter, keep_ext=True)
+        alg = fixity._preferred_alg(digests[relpath])
+        digest = alg + ":" + digests[relpath][alg]
+        outpath = os.path.join(accessdir, outrel)
+        s = state.get(relpath)
+        if (not force and s is not None and
+                s == (digest, converter["version"], outrel, "done") and
+                os.path.exists(outpath)):
+            current += 1
+            continue
+        tasks.append({"bag_id": bag_id, "relpath": relpath,
+                      "abspath": os.path.join(bagdir, relpath),
+                      "outrel": outrel, "outpath": outpath,
+                      "digest": digest, "converter": converter})
+    return tasks, current
+
+
+###############################################################################
+# function: create_access_copies
+###############################################################################
+def create_access_copies(storage_id=None, bag_ids=None, force=False,
+                         workers=None):
+    """
+    Creates access copies of the payload files of bags, skipping copies that
+    are current, and records a CRACC event for each bag with work done.
+    Either storage_id or bag_ids (a list) may be given, to limit the bags
+    processed.
+    Returns a dictionary summarizing the run.
+    """
+    if workers is None:
+        workers = conf.fconf.get("access_workers") or os.cpu_count() or 1
+    workers = int(workers)
+    timeout = float(conf.fconf.get("access_timeout", DEFAULT_TIMEOUT))
+    converters = _load_converters()
+    access_root = conf.fconf["access_path_root"]
+    if not os.path.isdir(access_root):
+        raise Exception("Access path root not found: " + access_root)
+
+    cur = dbops.connect().cursor()
+    qstr = """SELECT b.bag_id, s.path_root,
+                     b.preservation_path, b.preservation_bag_name
+              FROM bag b
+              JOIN storage s ON s.storage_id = b.storage_id
+              WHERE b.still_exists"""
+    qargs = []
+    if storage_id is not None:
+        qstr += " AND b.storage_id = ?"
+        qargs.append(storage_id)
+    if bag_ids is not None:
+        qstr += (" AND b.bag_id IN (" +
+                 ", ".join(["?"] * len(bag_ids)) + ")")
+        qargs.extend(bag_ids)
+    qstr += " ORDER BY b.bag_id"
+    bags = []
+    for bag_id, root, ppath, bagname in cur.execute(qstr, qargs).fetchall():
+        bags.append((bag_id, bagit.bag_dir(root, ppath, bagname),
+                     bagit.bag_dir(access_root, ppath, bagname)))
+    agents = dbops.agent_ids()
+
+    lg.log("create_access_copies: Processing " + str(len(bags)) +
+           " bags with " + str(workers) + " threads.")
+
+    summary = {"bags": len(bags), "COMP": 0, "CMER": 0, "ERR": 0,
+               "current_bags": 0, "created": 0, "failed": 0, "current": 0,
+               "bag_event_ids": []}
+    states = {}
+    updates = []
+    rows = []
+    started = time.monotonic()
+
+    def flush():
+        if updates or rows:
+            with dbops.transaction() as tcur:
+                tcur.executemany("""UPDATE access_task
+                                    SET status = ?, message = ?,
+                                        updated_time = ?
+                                    WHERE bag_id = ? AND source_path = ?""",
+                                 updates)
+                if rows:
+                    ids = dbops.insert_bag_events(tcur, rows)
+                    summary["bag_event_ids"].extend(ids)
+            del updates[:]
+            del rows[:]
+
+    def finish(bag_id):
+        state = states.pop(bag_id)
+        if state["error"]:
+            outcome = "ERR"
+            details = [state["error"]]
+        elif state["failed"]:
+            outcome = "CMER"
+            details = state["failed"]
+        elif state["created"]:
+            outcome = "COMP"
+            details = []
+        else:
+            summary["current_bags"] += 1
+            return
+        summary[outcome] += 1
+        used = sorted(set(c["name"] + " " + c["version"]
+                          for c in state["converters"]))
+        rows.append({
+            "bag_id": bag_id,
+            "event_type_code": "CRACC",
+            "person_agent_id": agents[0],
+            "software_agent_id": agents[1],
+            "start_time": state["start_time"],
+            "end_time": dbops.timestamp(),
+            "event_details": ("Created " + str(state["created"]) +
+                              " access copies in " + state["accessdir"] +
+                              " (" + str(state["current"]) +
+                              " already current, " +
+                              str(len(state["failed"])) + " failed)."),
+            "tools_used": "; ".join(used) or None,
+            "outcome_code": outcome,
+            "outcome_details": "; ".join(details)[:2500] or None
+            })
+        lg.log("create_access_copies: Bag " + str(bag_id) + " " + outcome)
+
+    def collect(fut):
+        task, error = fut.result()
+        state = states[task["bag_id"]]
+        if error is None:
+            state["created"] += 1
+            summary["created"] += 1
+            updates.append(("done", None, dbops.timestamp(),
+                            task["bag_id"], task["relpath"]))
+        else:
+            state["failed"].append(task["relpath"] + ": " + error)
+            summary["failed"] += 1
+            updates.append(("failed", error[:500], dbops.timestamp(),
+                            task["bag_id"], task["relpath"]))
+        state["tasks"] -= 1
+        if state["tasks"] == 0:
+            finish(task["bag_id"])
+        if len(updates) >= STATE_BATCH_SIZE:
+            flush()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for bag_id, bagdir, accessdir in bags:
+            state = {"start_time": dbops.timestamp(), "accessdir": accessdir,
+                     "created": 0, "current": 0, "failed": [],
+                     "error": None, "tasks": 0, "converters": []}
+            states[bag_id] = state
+            try:
+                tasks, state["current"] = _plan_bag(cur, bag_id, bagdir,
+                                                    accessdir, converters,
+                                                    force)
+            except Exception as e:
+                state["error"] = str(e)
+                tasks = []
+            summary["current"] += state["current"]
+
+            # Mark the tasks pending before starting them
+            if tasks:
+                now = dbops.timestamp()
+                with dbops.transaction() as tcur:
+                    tcur.executemany(
+                        """INSERT INTO access_task
+                               (bag_id, source_path, source_digest,
+                                converter, converter_version, output_path,
+                                status, message, updated_time)
+                           VALUES (?, ?, ?, ?, ?, ?, 'pending', NULL, ?)
+                           ON CONFLICT (bag_id, source_path) DO UPDATE SET
+                               source_digest = excluded.source_digest,
+                               converter = excluded.converter,
+                               converter_version = excluded.converter_version,
+                               output_path = excluded.output_path,
+                               status = 'pending', message = NULL,
+                               updated_time = excluded.updated_time""",
+                        [(bag_id, t["relpath"], t["digest"],
+                          t["converter"]["name"], t["converter"]["version"],
+                          t["outrel"], now) for t in tasks])
+            state["tasks"] = len(tasks)
+            state["converters"] = [t["converter"] for t in tasks]
+            if not tasks:
+                finish(bag_id)
+
+            for task in tasks:
+                # Keep the queue of tasks bounded
+                while len(pending) >= workers * TASKS_PER_WORKER:
+                    done, _ = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for fut in done:
+                        pending.discard(fut)
+                        collect(fut)
+                pending.add(pool.submit(_convert, task, task["converter"],
+                                        timeout))
+
+        for fut in concurrent.futures.as_completed(pending):
+            collect(fut)
+
+    flush()
+    cur.close()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    summary["seconds"] = round(elapsed, 3)
+    summary["files_per_sec"] = round(summary["created"] / elapsed, 1)
+
+    lg.log("create_access_copies: Done. " + str(summary["created"]) +
+           " created, " + str(summary["current"]) + " current, " +
+           str(summary["failed"]) + " failed.")
+
+    return summary
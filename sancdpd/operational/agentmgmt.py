@@ -2,26 +2,33 @@
 This module supplies functions for managing agents recorded in the SANCdpd
 agent table.
 
-So far, this module is basically a stub.  It need to be implemented.
-"""
+So far, only listing agents is implemented.  Adding and deactivating agents
+still need to be implemented.
 
-# Import modules from the Python standard library
-import sqlite3 as sq         # for SQLite DB interaction
-import datetime as dt        # for getting and formatting timestamps
+This module contains the following function:
+    list_agents() :  Return the agents in the agent table
+"""
 
 # Import other SANCdpd modules
-import conf
-import logger as lg
+import refdata
+
+
+# Columns of the agent table included when listing agents
+LIST_COLUMNS = ["agent_id", "agent_type_code", "agent_name", "agent_code",
+                "agent_version"]
 
 
 ###############################################################################
-# function: show_agents
+# function: list_agents
 ###############################################################################
-def show_agents():
+def list_agents(include_inactive=False):
     """
-    This function ...
+    Returns a list of agents, each as a dictionary of the columns named in
+    LIST_COLUMNS, ordered by agent_id.  Only active agents are included,
+    unless include_inactive is True.
     """
-    print("   ... Showing agents ...")
-    print("   (Not yet implemented)")
-
-    pass
+    rows = []
+    for agent in sorted(refdata.agents(), key=lambda a: a["agent_id"]):
+        if agent["is_active"] or include_inactive:
+            rows.append(dict((c, agent[c]) for c in LIST_COLUMNS))
+    return rows
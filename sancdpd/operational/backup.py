@@ -0,0 +1,423 @@
+"""
+This module implements backup replication of bags from one storage location
+to a replica storage location (another row of the storage table), recorded
+in the SANCdpd database as a "Perform backup" (STBKP) storage event.
+
+Each bag is copied to the same preservation_path and preservation_bag_name
+under the path_root of the replica.  Only new and changed files are copied:
+  - A bag is unchanged, and nothing is read beyond directory listings and
+    its tagmanifests, if its tagmanifests are identical in both places and
+    every file has the same size and mtime in both places.
+  - Otherwise, a file is copied if it is missing from the replica, if its
+    size or mtime differs, or if its digest in the bag's manifests differs
+    from its digest in the replica's manifests.  Files in the replica bag
+    that are no longer in the source bag are removed.
+Files listed in the source manifests are checked against their digests as
+they are copied, so a damaged source file is never copied over a good
+replica.  Payload files are copied first, then tag files, and tagmanifests
+last, so that an interrupted copy never looks complete.  Each file is
+written under a temporary name, and renamed into place.
+
+Bags are copied by a pool of threads.  The number of threads can be given
+directly, or set with the optional "backup_workers" key in the config file
+(default 4).  The total rate of copying can be limited with the optional
+"backup_max_bytes_per_sec" key (or the max_bytes_per_sec argument), which
+is shared by all threads.
+
+A run is resumable.  As each bag is finished, a row is written to the
+backup_checkpoint table.  If a run is interrupted, the next run for the
+same replica skips the bags it was asked for that are already finished,
+unless restart is True.  The checkpoint rows of the bags in a run are
+removed when it finishes and its event is recorded.
+
+This module contains the following function:
+    backup_storage() :  Replicate bags to a replica storage location
+"""
+
+# Import modules from the Python standard library
+import concurrent.futures    # for the pool of copying threads
+import os                    # for copying files and stat calls
+import os.path               # for building paths
+import threading             # for the lock of the rate limiter
+import time                  # for rate limiting and measuring throughput
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+import dbops
+import metrics
+import refdata
+import operational.bagit as bagit
+import operational.hashing as hashing
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Default number of threads copying bags at once
+DEFAULT_WORKERS = 4
+
+# Suffix of the temporary name a file is copied to
+TEMP_SUFFIX = ".stbkp-tmp"
+
+
+###############################################################################
+# class: _RateLimiter
+###############################################################################
+class _RateLimiter:
+    """
+    A token bucket shared by the copying threads.  Tokens are bytes.  The
+    bucket refills at rate bytes per second, and holds at most one second
+    of tokens.  A thread that takes more tokens than the bucket holds goes
+    into debt, and sleeps until the debt is paid.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+###############################################################################
+# function: _stat_files
+###############################################################################
+def _stat_files(bagdir):
+    """
+    Lists every file in the bag at bagdir.
+    Returns a dictionary whose keys are file paths relative to the bag
+    directory (with "/" separators) and whose values are (size, mtime_ns)
+    pairs.  Returns an empty dictionary if the bag directory does not exist.
+    """
+    found = {}
+    if not os.path.isdir(bagdir):
+        return found
+    stack = [""]
+    while stack:
+        reldir = stack.pop()
+        with os.scandir(os.path.join(bagdir, reldir)) as it:
+            for entry in it:
+                relpath = reldir + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relpath + "/")
+                elif not entry.name.endswith(TEMP_SUFFIX):
+                    st = entry.stat(follow_symlinks=False)
+                    found[relpath] = (st.st_size, st.st_mtime_ns)
+    metrics.count("files_walked_total", len(found))
+    return found
+
+
+###############################################################################
+# function: _read_digests
+###############################################################################
+def _read_digests(bagdir, tag=False):
+    """
+    Reads all manifests (or tagmanifests, if tag is True) of the bag at
+    bagdir.  Returns a dictionary of relpath -> {alg: digest}.
+    """
+    digests = {}
+    if os.path.isdir(bagdir):
+        for alg, path in bagit.manifest_paths(bagdir, tag).items():
+            for relpath, digest in bagit.read_manifest(path).items():
+                digests.setdefault(relpath, {})[alg] = digest
+    return digests
+
+
+###############################################################################
+# function: _tagmanifest_digests
+###############################################################################
+def _tagmanifest_digests(bagdir):
+    """
+    Returns a dictionary of tagmanifest filenames and their SHA-256 digests,
+    for the bag at bagdir.
+    """
+    found = {}
+    if os.path.isdir(bagdir):
+        for alg, path in bagit.manifest_paths(bagdir, tag=True).items():
+            digests, nbytes = hashing.hash_file(path, ["sha256"])
+            found[os.path.basename(path)] = digests["sha256"]
+    return found
+
+
+###############################################################################
+# function: _copy_file
+###############################################################################
+def _copy_file(src, dst, algs, limiter):
+    """
+    Copies src to a temporary file next to dst, hashing it with each
+    algorithm in algs as it is copied, and taking tokens from the limiter
+    (if any) for each block.  The temporary file is given the mtime of src.
+    The caller checks the digests, and then either renames the temporary
+    file to dst or removes it.
+    Returns a triple:  the dictionary of digests, the number of bytes
+    copied, and the path of the temporary file.
+    """
+    tmp = dst + TEMP_SUFFIX
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    digests, nbytes = hashing.copy_file(
+        src, tmp, algs, limiter.take if limiter is not None else None)
+    st = os.stat(src)
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return digests, nbytes, tmp
+
+
+###############################################################################
+# function: _backup_bag
+###############################################################################
+@metrics.timed("backup_bag")
+def _backup_bag(bag_id, srcdir, repdir, limiter):
+    """
+    Runs in a worker thread.  Brings the replica of one bag at repdir up to
+    date with the bag at srcdir.
+    Returns a dictionary of results for the bag.
+    """
+    result = {"bag_id": bag_id, "problems": [], "error": None,
+              "unchanged": False, "copied": 0, "bytes": 0, "removed": 0}
+    try:
+        if not os.path.isdir(srcdir):
+            raise Exception("Bag directory not found: " + srcdir)
+
+        src_files = _stat_files(srcdir)
+        rep_files = _stat_files(repdir)
+
+        # Fast path:  identical tagmanifests, and identical stat metadata
+        src_tags = _tagmanifest_digests(srcdir)
+        if (src_tags and src_tags == _tagmanifest_digests(repdir) and
+                src_files == rep_files):
+            result["unchanged"] = True
+            return result
+
+        # Files whose stat metadata differ, or that are missing
+        changed = set(r for r in src_files
+                      if rep_files.get(r) != src_files[r])
+
+        # Files whose manifest digests differ
+        src_digests = _read_digests(srcdir)
+        src_digests.update(_read_digests(srcdir, tag=True))
+        rep_digests = _read_digests(repdir)
+        rep_digests.update(_read_digests(repdir, tag=True))
+        for relpath, digests in src_digests.items():
+            if relpath in src_files and rep_digests.get(relpath) != digests:
+                changed.add(relpath)
+
+        # Copy the payload first, then tag files, then tagmanifests
+        def order(relpath):
+            name = relpath.rsplit("/", 1)[-1]
+            if "/" not in relpath and name.startswith("tagmanifest-"):
+                return (2, relpath)
+            if relpath.startswith(bagit.PAYLOAD_DIR + "/"):
+                return (0, relpath)
+            return (1, relpath)
+
+        for relpath in sorted(changed, key=order):
+            digests = src_digests.get(relpath, {})
+            dst = os.path.join(repdir, relpath)
+            actual, nbytes, tmp = _copy_file(os.path.join(srcdir, relpath),
+                                             dst, digests, limiter)
+            bad = [a for a in digests if actual[a] != digests[a]]
+            if bad:
+                os.remove(tmp)
+                result["problems"].append("source " + "/".join(bad) +
+                                          " mismatch: " + relpath)
+                continue
+            os.replace(tmp, dst)
+            result["copied"] += 1
+            result["bytes"] += nbytes
+
+        # Remove files that are no longer in the source bag
+        for relpath in sorted(set(rep_files) - set(src_files)):
+            os.remove(os.path.join(repdir, relpath))
+            result["removed"] += 1
+
+    except Exception as e:
+        result["error"] = str(e)
+
+    return result
+
+
+###############################################################################
+# function: backup_storage
+###############################################################################
+def backup_storage(source_storage_id, replica_storage_id, bag_ids=None,
+                   max_bytes_per_sec=None, restart=False, workers=None):
+    """
+    Replicates bags from a storage location to a replica storage location,
+    copying only new and changed files, and records one STBKP storage event
+    for the replica.
+    All bags in the source location that still exist are replicated, unless
+    bag_ids (a list) is given.  Bags finished by an interrupted run are
+    skipped, unless restart is True.
+    Returns a dictionary summarizing the run.
+    """
+    if source_storage_id == replica_storage_id:
+        raise Exception("Source and replica storage locations are the same.")
+    if workers is None:
+        workers = conf.fconf.get("backup_workers", DEFAULT_WORKERS)
+    workers = int(workers)
+    if max_bytes_per_sec is None:
+        max_bytes_per_sec = conf.fconf.get("backup_max_bytes_per_sec")
+    limiter = _RateLimiter(max_bytes_per_sec) if max_bytes_per_sec else None
+
+    source = refdata.storage(source_storage_id)
+    replica = refdata.storage(replica_storage_id)
+    if source is None or replica is None:
+        raise Exception("Unknown storage location.")
+    if not replica["in_use"]:
+        raise Exception("Replica storage location is not in use.")
+    if not os.path.isdir(replica["path_root"]):
+        raise Exception("Replica path_root not found: " +
+                        replica["path_root"])
+
+    con = dbops.connect()
+    agents = dbops.agent_ids()
+
+    # Pick up the checkpoint of an interrupted run, if any
+    if restart:
+        with dbops.transaction() as cur:
+            cur.execute("DELETE FROM backup_checkpoint WHERE storage_id = ?",
+                        (replica_storage_id,))
+    qstr = """SELECT bag_id, run_start_time
+              FROM backup_checkpoint
+              WHERE storage_id = ?"""
+    checkpoint = dict(con.execute(qstr, (replica_storage_id,)).fetchall())
+
+    qstr = """SELECT bag_id, preservation_path, preservation_bag_name
+              FROM bag
+              WHERE still_exists AND storage_id = ?"""
+    qargs = [source_storage_id]
+    if bag_ids is not None:
+        qstr += (" AND bag_id IN (" + ", ".join(["?"] * len(bag_ids)) + ")")
+        qargs.extend(bag_ids)
+    qstr += " ORDER BY bag_id"
+    requested = con.execute(qstr, qargs).fetchall()
+
+    # Only the requested bags count as finished, since the checkpoint may
+    # be from an interrupted run for other bags
+    finished = dict((b[0], checkpoint[b[0]]) for b in requested
+                    if b[0] in checkpoint)
+    bags = [b for b in requested if b[0] not in finished]
+    start_time = min(finished.values()) if finished else dbops.timestamp()
+
+    lg.log("backup_storage: Replicating " + str(len(bags)) + " bags from " +
+           "storage " + str(source_storage_id) + " to storage " +
+           str(replica_storage_id) + " with " + str(workers) + " threads" +
+           (", resuming after " + str(len(finished)) + " bags" if finished
+            else "") + ".")
+
+    started = time.monotonic()
+    summary = {"bags": len(bags) + len(finished), "resumed": len(finished),
+               "unchanged": 0, "updated": 0, "failed": 0, "errors": 0,
+               "files_copied": 0, "bytes_copied": 0, "files_removed": 0,
+               "storage_event_id": None}
+    details = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for bag_id, ppath, bagname in bags:
+            futures.append(pool.submit(
+                _backup_bag, bag_id,
+                bagit.bag_dir(source["path_root"], ppath, bagname),
+                bagit.bag_dir(replica["path_root"], ppath, bagname),
+                limiter))
+
+        for fut in concurrent.futures.as_completed(futures):
+            result = fut.result()
+            bag_id = result["bag_id"]
+            summary["files_copied"] += result["copied"]
+            summary["bytes_copied"] += result["bytes"]
+            summary["files_removed"] += result["removed"]
+            if result["error"] is not None:
+                summary["errors"] += 1
+                details.append("bag " + str(bag_id) + ": " + result["error"])
+                lg.log("backup_storage: Bag " + str(bag_id) + " error: " +
+                       result["error"], "ERROR")
+                continue
+            if result["problems"]:
+                summary["failed"] += 1
+                details.append("bag " + str(bag_id) + ": " +
+                               "; ".join(result["problems"]))
+                lg.log("backup_storage: Bag " + str(bag_id) + " not fully " +
+                       "replicated: " + "; ".join(result["problems"]),
+                       "WARNING")
+                continue
+            if result["unchanged"]:
+                summary["unchanged"] += 1
+            else:
+                summary["updated"] += 1
+                lg.log("backup_storage: Bag " + str(bag_id) + " updated: " +
+                       str(result["copied"]) + " files copied, " +
+                       str(result["removed"]) + " removed.")
+            with dbops.transaction() as cur:
+                cur.execute("""INSERT INTO backup_checkpoint
+                                   (storage_id, bag_id, run_start_time,
+                                    completed_time)
+                               VALUES (?, ?, ?, ?)""",
+                            (replica_storage_id, bag_id, start_time,
+                             dbops.timestamp()))
+
+    # Choose the outcome of the event
+    good = summary["bags"] - summary["failed"] - summary["errors"]
+    if good == summary["bags"]:
+        outcome = "SUCC"
+    elif good:
+        outcome = "PSUC"
+    elif summary["errors"]:
+        outcome = "ERR"
+    else:
+        outcome = "FAIL"
+
+    # Record the event, and clear the checkpoint of this run
+    with dbops.transaction() as cur:
+        summary["storage_event_id"] = dbops.insert_storage_event(cur, {
+            "storage_id": replica_storage_id,
+            "event_type_code": "STBKP",
+            "start_time": start_time,
+            "end_time": dbops.timestamp(),
+            "event_details": ("Replicated " + str(good) + " of " +
+                              str(summary["bags"]) + " bags from storage " +
+                              str(source_storage_id) + " (" +
+                              source["path_root"] + "): " +
+                              str(summary["unchanged"]) + " unchanged, " +
+                              str(summary["updated"]) + " updated, " +
+                              str(summary["files_copied"]) + " files (" +
+                              str(summary["bytes_copied"]) + " bytes) " +
+                              "copied, " + str(summary["files_removed"]) +
+                              " files removed."),
+            "tools_used": ("SANCdpd backup with " + str(workers) +
+                           " threads" +
+                           (", limited to " + str(max_bytes_per_sec) +
+                            " bytes/s" if max_bytes_per_sec else "")),
+            "outcome_code": outcome,
+            "outcome_details": "; ".join(details)[:2500] or None
+            }, [(agents[0], "Person running the backup"),
+                (agents[1], "Software performing the backup")])
+        if bag_ids is None:
+            cur.execute("DELETE FROM backup_checkpoint WHERE storage_id = ?",
+                        (replica_storage_id,))
+        else:
+            cur.executemany("""DELETE FROM backup_checkpoint
+                               WHERE storage_id = ? AND bag_id = ?""",
+                            [(replica_storage_id, b[0]) for b in requested])
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    summary["seconds"] = round(elapsed, 3)
+    summary["bytes_per_sec"] = round(summary["bytes_copied"] / elapsed)
+
+    lg.log("backup_storage: Done. " + str(summary["unchanged"]) +
+           " unchanged, " + str(summary["updated"]) + " updated, " +
+           str(summary["failed"]) + " failed, " + str(summary["errors"]) +
+           " errors.  Outcome " + outcome + ".")
+
+    return summary
@@ -0,0 +1,285 @@
+"""
+This module supplies helper functions for reading BagIt bags on disk.
+
+These functions only read files in bags.  (Files are hashed by the hashing
+module.)  They do not interact with the
+SANCdpd database, so they can be used from worker processes as well as from
+the main SANCdpd process.
+
+This module contains the following functions:
+    bag_dir() :  Build the full filesystem path of a bag
+    read_tag_file() :  Parse a BagIt tag file into a list of (label, value)
+    read_baginfo() :  Read bag-info.txt as a dictionary plus raw text
+    parse_payload_oxum() :  Split a Payload-Oxum value into bytes and files
+    manifest_paths() :  Find the manifest or tagmanifest files of a bag
+    supported_algorithm() :  Check that a manifest algorithm can be computed
+    read_manifest() :  Parse a manifest file into a dictionary
+    walk_payload() :  List the files in the payload directory with sizes
+    strongest_tagmanifest() :  Find the tagmanifest with the strongest digests
+    canonical_manifest() :  Put the text of a manifest in canonical form
+    manifest_digest() :  Compute the digest of the canonical form of a manifest
+    diff_manifests() :  List the differences between two manifest texts
+"""
+
+# Import modules from the Python standard library
+import hashlib               # for computing file digests
+import os                    # for walking directories and stat calls
+import os.path               # for building paths
+
+# Import other SANCdpd modules
+import metrics
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Name of the payload directory within a bag
+PAYLOAD_DIR = "data"
+
+# Digest algorithms in order of preference, for choosing a tagmanifest
+ALG_PREFERENCE = ["sha512", "sha256", "sha1", "md5"]
+
+
+###############################################################################
+# function: bag_dir
+###############################################################################
+def bag_dir(path_root, preservation_path, preservation_bag_name):
+    """
+    Returns the full path of a bag directory, built from the path_root of the
+    storage location and the preservation_path and preservation_bag_name of
+    the bag, as recorded in the SANCdpd database.
+    """
+    return os.path.join(path_root, preservation_path, preservation_bag_name)
+
+
+###############################################################################
+# function: read_tag_file
+###############################################################################
+def read_tag_file(path):
+    """
+    Parses a BagIt tag file (like bagit.txt or bag-info.txt).
+    Returns a list of (label, value) pairs, in the order found in the file.
+    Lines beginning with whitespace are continuations of the previous value.
+    """
+    pairs = []
+    with open(path, "r", encoding="utf-8-sig") as fp:
+        for line in fp:
+            line = line.rstrip("\r\n")
+            if line.strip() == "":
+                continue
+            if line[0] in " \t" and pairs:
+                label, value = pairs[-1]
+                pairs[-1] = (label, value + " " + line.strip())
+            elif ":" in line:
+                label, value = line.split(":", 1)
+                pairs.append((label.strip(), value.strip()))
+    return pairs
+
+
+###############################################################################
+# function: read_baginfo
+###############################################################################
+def read_baginfo(bagdir):
+    """
+    Reads the bag-info.txt file of the bag at bagdir.
+    Returns a pair: a dictionary of labels and values (the first value wins
+    if a label is repeated), and the raw text of the file.
+    If the bag has no bag-info.txt file, returns an empty dictionary and an
+    empty string.
+    """
+    path = os.path.join(bagdir, "bag-info.txt")
+    if not os.path.exists(path):
+        return {}, ""
+
+    info = {}
+    for label, value in read_tag_file(path):
+        if label not in info:
+            info[label] = value
+
+    with open(path, "r", encoding="utf-8-sig") as fp:
+        raw = fp.read()
+
+    return info, raw
+
+
+###############################################################################
+# function: parse_payload_oxum
+###############################################################################
+def parse_payload_oxum(value):
+    """
+    Splits a Payload-Oxum value ("<octetcount>.<streamcount>") into a pair of
+    integers (payload_bytes, payload_files).
+    Raises an exception if the value is malformed.
+    """
+    parts = value.strip().split(".")
+    if len(parts) != 2 or not parts[0].isdigit() or not parts[1].isdigit():
+        raise Exception("Malformed Payload-Oxum: '" + value + "'")
+    return int(parts[0]), int(parts[1])
+
+
+###############################################################################
+# function: manifest_paths
+###############################################################################
+def manifest_paths(bagdir, tag=False):
+    """
+    Finds the manifest files of the bag at bagdir.
+    Returns a dictionary whose keys are algorithm names (like "md5") and whose
+    values are the paths of the manifest files.
+    If tag is True, finds tagmanifest files instead of payload manifests.
+    """
+    prefix = "tagmanifest-" if tag else "manifest-"
+    found = {}
+    for name in os.listdir(bagdir):
+        if name.startswith(prefix) and name.endswith(".txt"):
+            alg = name[len(prefix):-len(".txt")].lower()
+            found[alg] = os.path.join(bagdir, name)
+    return found
+
+
+###############################################################################
+# function: supported_algorithm
+###############################################################################
+def supported_algorithm(alg):
+    """
+    Returns True if digests can be computed with the algorithm named alg (as
+    in the name of a manifest file), and False if hashlib does not provide
+    it (as for "blake3").
+    """
+    try:
+        hashlib.new(alg)
+    except (ValueError, TypeError):
+        return False
+    return True
+
+
+###############################################################################
+# function: read_manifest
+###############################################################################
+def read_manifest(path):
+    """
+    Parses a BagIt manifest or tagmanifest file.
+    Returns a dictionary whose keys are file paths relative to the bag
+    directory (always with "/" separators) and whose values are lowercase
+    digests.
+    Percent-encoded line breaks and percent signs in paths are decoded, as
+    specified by BagIt version 1.0.
+    """
+    entries = {}
+    with open(path, "r", encoding="utf-8-sig") as fp:
+        for line in fp:
+            line = line.rstrip("\r\n")
+            if line.strip() == "":
+                continue
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                raise Exception("Malformed manifest line in " + path)
+            digest, relpath = parts
+            # Only the line ending is removed, since spaces at either end
+            # may be part of the file name
+            relpath = relpath.lstrip("*")
+            relpath = relpath.replace("%0A", "\n").replace("%0D", "\r")
+            relpath = relpath.replace("%25", "%")
+            entries[relpath] = digest.lower()
+    return entries
+
+
+###############################################################################
+# function: walk_payload
+###############################################################################
+def walk_payload(bagdir):
+    """
+    Walks the payload directory of the bag at bagdir.
+    Returns a dictionary whose keys are file paths relative to the bag
+    directory (with "/" separators) and whose values are file sizes in bytes.
+    """
+    found = {}
+    stack = [PAYLOAD_DIR]
+    while stack:
+        reldir = stack.pop()
+        with os.scandir(os.path.join(bagdir, reldir)) as it:
+            for entry in it:
+                relpath = reldir + "/" + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relpath)
+                else:
+                    found[relpath] = entry.stat(follow_symlinks=False).st_size
+    metrics.count("files_walked_total", len(found))
+    return found
+
+
+###############################################################################
+# function: strongest_tagmanifest
+###############################################################################
+def strongest_tagmanifest(bagdir):
+    """
+    Finds the tagmanifest of the bag at bagdir with the strongest digest
+    algorithm (by ALG_PREFERENCE, then by name).
+    Returns the path of the tagmanifest file, or None if there is none.
+    """
+    tagmanifests = manifest_paths(bagdir, tag=True)
+    for alg in ALG_PREFERENCE + sorted(tagmanifests):
+        if alg in tagmanifests:
+            return tagmanifests[alg]
+    return None
+
+
+###############################################################################
+# function: _manifest_entries
+###############################################################################
+def _manifest_entries(text):
+    """
+    Parses the text of a manifest into a dictionary of paths (exactly as
+    written, without decoding) and lowercase digests.
+    """
+    entries = {}
+    for line in text.lstrip("\ufeff").splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2:
+            entries[parts[1].strip().lstrip("*")] = parts[0].lower()
+    return entries
+
+
+###############################################################################
+# function: canonical_manifest
+###############################################################################
+def canonical_manifest(text):
+    """
+    Returns the canonical form of the text of a manifest or tagmanifest:
+    one "<digest> <path>" line per file, with lowercase digests and single
+    spaces, sorted by path, with "\n" line endings.  Manifests that list the
+    same digests for the same files have the same canonical form, whatever
+    their line order, line endings, or spacing.
+    """
+    entries = _manifest_entries(text)
+    return "".join(entries[p] + " " + p + "\n" for p in sorted(entries))
+
+
+###############################################################################
+# function: manifest_digest
+###############################################################################
+def manifest_digest(text):
+    """
+    Returns the SHA-256 digest (64 hex characters) of the canonical form of
+    the text of a manifest or tagmanifest.
+    """
+    return hashlib.sha256(
+        canonical_manifest(text).encode("utf-8")).hexdigest()
+
+
+###############################################################################
+# function: diff_manifests
+###############################################################################
+def diff_manifests(old_text, new_text):
+    """
+    Compares the texts of two manifests, line by line.
+    Returns a dictionary with sorted lists of the paths "added" (only in
+    new_text), "removed" (only in old_text), and "changed" (in both, with
+    different digests).
+    """
+    old = _manifest_entries(old_text)
+    new = _manifest_entries(new_text)
+    return {"added": sorted(set(new) - set(old)),
+            "removed": sorted(set(old) - set(new)),
+            "changed": sorted(p for p in set(old) & set(new)
+                              if old[p] != new[p])}
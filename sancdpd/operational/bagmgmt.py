@@ -5,31 +5,417 @@ of bags.
 Some main functions in this module will be called by the CLI.  Other helper
 functions will be called only from within this module.
 
-So far, this module is basically a stub.  It need to be implemented.
+Bulk registration records every bag found under the path_root of a storage
+location as a new row in the bag table, each in its own new bag family, with
+a "Register bag" (BGRGS) event.  Values for the bag table come from three
+places:
+  - the location of the bag relative to path_root.  The directories above
+    the bag are matched, in order, to the columns named in the
+    "preservation_path_layout" config key (or DEFAULT_PATH_LAYOUT).
+  - the tags in bag-info.txt named in BAGINFO_TAGS.
+  - defaults passed to register_storage(), for values that neither of the
+    above supply.
+born_digital is set from the digitalOriginality tag when it holds one of
+the values in DIGITAL_ORIGINALITY, and from the born_digital argument of
+register_storage() otherwise.
+Bags are written in batches, each in one transaction that also advances the
+registration_checkpoint row for the storage location.  An interrupted run
+resumes after the last committed bag.  The checkpoint is deleted when the
+walk finishes, so that the next run walks the whole storage location again
+(and finds new bags, and bags skipped with errors, wherever they are).
+Bags already registered at the same location are skipped.  A bag whose
+tagmanifest has the same canonical digest (see bagit.manifest_digest()) as
+a registered bag is reported as an error, since it is a copy of that bag.
+
+This module contains the following functions:
+    walk_bags() :  Generate the relative paths of all bags under a root
+    read_bag() :  Read the bag table values for one bag on disk
+    register_storage() :  Register all bags under a storage location
 """
 
 # Import modules from the Python standard library
-import sqlite3 as sq         # for SQLite DB interaction
-import datetime as dt        # for getting and formatting timestamps
-import time                  # for the sleep() function
+import concurrent.futures    # for reading bags in parallel
+import itertools             # for taking batches from the bag walk
+import os                    # for scandir and stat calls
+import os.path               # for building paths
 
 # Import other SANCdpd modules
 import conf
 import logger as lg
+import dbops
+import metrics
+import operational.bagit as bagit
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Default meaning of the directories between path_root and a bag
+DEFAULT_PATH_LAYOUT = ["path_records_status",
+                       "path_collection_type",
+                       "path_records_group",
+                       "path_accession_no"
+                       ]
+
+# bag-info.txt tags read into values for the bag table and related tables
+BAGINFO_TAGS = {"SANC_container_id": "SANC-Container-ID",
+                "original_bag_name": "External-Identifier",
+                "SANC_bib_record_id": "SANC-Bib-Record-ID",
+                "SANC_item_no": "SANC-Item-No",
+                "bag-info_Bagging-Date": "Bagging-Date",
+                "bag-info_digitalContentStructure": "digitalContentStructure",
+                "bag-info_digitalOriginality": "digitalOriginality"
+                }
+
+# Values of the digitalOriginality tag (lowercased), and whether each means
+# the bag is born digital
+DIGITAL_ORIGINALITY = {"born digital": True,
+                       "born-digital": True,
+                       "digitized": False,
+                       "digitised": False,
+                       "reformatted digital": False
+                       }
+
+# Columns of the bag table written by bulk registration
+BAG_COLUMNS = ["bag_id", "bag_family_id", "storage_id",
+               "preservation_path", "preservation_bag_name",
+               "SANC_container_id", "original_bag_name",
+               "records_collection_id", "item_id",
+               "still_exists", "born_digital", "processing_status_code",
+               "path_records_status", "path_collection_type",
+               "path_records_group", "path_series_no", "path_item_no",
+               "path_accession_no", "path_accession_no_suffix",
+               "tagmanifest_filename", "tagmanifest_contents",
+               "tagmanifest_digest",
+               "bag-info_contents", "bag-info_Bagging-Date",
+               "bag-info_digitalContentStructure",
+               "bag-info_digitalOriginality",
+               "payload_files", "payload_bytes", "total_files", "total_bytes"
+               ]
+
+# Default number of bags registered per transaction
+DEFAULT_BATCH_SIZE = 1000
+
+# Number of threads reading bags from disk
+READ_THREADS = 8
+
+
+###############################################################################
+# function: walk_bags
+###############################################################################
+def walk_bags(path_root, after=None):
+    """
+    Generates the paths, relative to path_root and with "/" separators, of
+    all bags (directories containing bagit.txt) under path_root.
+    Directories are visited in sorted order, and the walk does not descend
+    into bags.  If after is given, only bags that come after that relative
+    path in the walk order are generated, and directories entirely before
+    it are not visited at all.
+    """
+    mark = tuple(after.split("/")) if after else None
+    stack = [()]
+    while stack:
+        parts = stack.pop()
+        absdir = os.path.join(path_root, *parts)
+        if parts and os.path.exists(os.path.join(absdir, "bagit.txt")):
+            if mark is None or parts > mark:
+                yield "/".join(parts)
+            continue
+        metrics.count("dirs_walked_total")
+        try:
+            with os.scandir(absdir) as it:
+                names = sorted(e.name for e in it
+                               if e.is_dir(follow_symlinks=False))
+        except OSError as e:
+            lg.log("walk_bags: Cannot read " + absdir + ": " + str(e))
+            continue
+        for name in reversed(names):
+            child = parts + (name,)
+            # Skip subtrees that lie wholly before the checkpoint
+            if mark is not None and child < mark[:len(child)]:
+                continue
+            stack.append(child)
 
 
 ###############################################################################
-# function: new_ingest
+# function: read_bag
 ###############################################################################
-def new_ingest():
+@metrics.timed("read_bag")
+def read_bag(path_root, relpath, layout):
     """
-    This function ... well, it needs some work.
+    Reads the bag at relpath under path_root, and returns a dictionary of
+    values for the bag table, plus the bag-info values named in BAGINFO_TAGS.
+    Payload counts come from the Payload-Oxum if there is one, or from a stat
+    walk of the payload otherwise.
+    Raises an exception if the bag cannot be read.
     """
-    print("   Setting up new ingest operation...")
-    time.sleep(2)
-    print("   Standby...")
-    time.sleep(3)
-    print("   Preparing for ingest...\n")
-    time.sleep(3)
-    print("   Just kidding.  lol\n")
-    time.sleep(5)
+    bagdir = os.path.join(path_root, relpath)
+    parts = relpath.split("/")
+    # A bag directly under path_root has an empty preservation_path, so that
+    # bagit.bag_dir() and the "known" paths of register_storage() match it
+    rec = {"preservation_path": relpath[:relpath.rfind("/") + 1],
+           "preservation_bag_name": parts[-1]}
+
+    # Values from the directories above the bag
+    for col, value in zip(layout, parts[:-1]):
+        rec[col] = value
+
+    # Values from bag-info.txt
+    info, rec["bag-info_contents"] = bagit.read_baginfo(bagdir)
+    for col, tag in BAGINFO_TAGS.items():
+        if tag in info:
+            rec[col] = info[tag]
+
+    # The strongest tagmanifest, if any, and its canonical digest
+    path = bagit.strongest_tagmanifest(bagdir)
+    if path is not None:
+        rec["tagmanifest_filename"] = os.path.basename(path)
+        with open(path, "r", encoding="utf-8-sig") as fp:
+            rec["tagmanifest_contents"] = fp.read()
+        rec["tagmanifest_digest"] = bagit.manifest_digest(
+            rec["tagmanifest_contents"])
+
+    # Payload counts, from the Payload-Oxum or a stat walk
+    if "Payload-Oxum" in info:
+        rec["payload_bytes"], rec["payload_files"] = \
+            bagit.parse_payload_oxum(info["Payload-Oxum"])
+    else:
+        sizes = bagit.walk_payload(bagdir)
+        rec["payload_bytes"] = sum(sizes.values())
+        rec["payload_files"] = len(sizes)
+
+    # Totals add the tag files (everything outside the payload directory)
+    tagfiles = 0
+    tagbytes = 0
+    stack = [bagdir]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path != os.path.join(bagdir, bagit.PAYLOAD_DIR):
+                        stack.append(entry.path)
+                else:
+                    tagfiles += 1
+                    tagbytes += entry.stat(follow_symlinks=False).st_size
+    rec["total_files"] = rec["payload_files"] + tagfiles
+    rec["total_bytes"] = rec["payload_bytes"] + tagbytes
+
+    return rec
+
+
+###############################################################################
+# function: _lookup_ids
+###############################################################################
+def _lookup_ids(cur, table, idcol, keycol):
+    """
+    Returns a dictionary of key values to IDs for a reference table (such as
+    accession), for get-or-create lookups during bulk registration.
+    """
+    qstr = "SELECT " + keycol + ", " + idcol + " FROM " + table
+    return dict(cur.execute(qstr).fetchall())
+
+
+###############################################################################
+# function: _get_or_create
+###############################################################################
+def _get_or_create(cur, ids, table, keycol, key):
+    """
+    Returns the ID for key in a reference table, inserting a new row if there
+    is none.  The ids dictionary comes from _lookup_ids() and is updated.
+    """
+    if key not in ids:
+        cur.execute("INSERT INTO " + table + " (" + keycol + ") VALUES (?)",
+                    (key,))
+        ids[key] = cur.lastrowid
+    return ids[key]
+
+
+###############################################################################
+# function: _next_id
+###############################################################################
+def _next_id(cur, table, idcol):
+    """
+    Returns the next unused value of an AUTOINCREMENT primary key.
+    Must be called inside the write transaction that uses the value.
+    """
+    qstr = "SELECT seq FROM sqlite_sequence WHERE name = ?"
+    row = cur.execute(qstr, (table,)).fetchone()
+    seq = row[0] if row else 0
+    top = cur.execute("SELECT max(" + idcol + ") FROM " + table).fetchone()[0]
+    return max(seq, top or 0) + 1
+
+
+###############################################################################
+# function: register_storage
+###############################################################################
+def register_storage(storage_id, bib_record_id=None, item_no=None,
+                     processing_status_code="UNPRC", born_digital=True,
+                     batch_size=None, restart=False):
+    """
+    Registers all bags found under the path_root of a storage location, with
+    one BGRGS event for each.  See the module docstring for where values come
+    from.  The bib_record_id and item_no arguments are defaults for bags whose
+    bag-info.txt does not name a records collection or item.
+    If restart is True, the checkpoint is ignored and the whole storage
+    location is walked again (bags already registered are still skipped).
+    The checkpoint is deleted when the walk finishes.
+    Returns a dictionary summarizing the run.
+    """
+    batch_size = int(batch_size or DEFAULT_BATCH_SIZE)
+    layout = conf.fconf.get("preservation_path_layout", DEFAULT_PATH_LAYOUT)
+
+    cur = dbops.connect().cursor()
+
+    qstr = "SELECT path_root FROM storage WHERE storage_id = ?"
+    row = cur.execute(qstr, (storage_id,)).fetchone()
+    if row is None:
+        raise Exception("No storage location with ID " + str(storage_id))
+    path_root = row[0]
+
+    qstr = """SELECT last_bag_path FROM registration_checkpoint
+              WHERE storage_id = ?"""
+    row = cur.execute(qstr, (storage_id,)).fetchone()
+    after = row[0] if row and not restart else None
+
+    # Bags already registered at this storage location
+    qstr = """SELECT preservation_path || preservation_bag_name
+              FROM bag
+              WHERE storage_id = ?"""
+    known = set(r[0] for r in cur.execute(qstr, (storage_id,)))
+
+    # Reference tables, for get-or-create lookups
+    collections = _lookup_ids(cur, "records_collection",
+                              "records_collection_id", "SANC_bib_record_id")
+    items = _lookup_ids(cur, "item", "item_id", "SANC_item_no")
+    accessions = _lookup_ids(cur, "accession", "accession_id",
+                             "SANC_accession_no")
+    agents = dbops.agent_ids()
+    cur.close()
+
+    lg.log("register_storage: Registering bags under " + path_root +
+           (" after " + after if after else ""))
+
+    summary = {"registered": 0, "skipped": 0, "errors": [],
+               "bag_event_ids": []}
+    bag_insert = ("INSERT INTO bag (" +
+                  ", ".join('"' + c + '"' for c in BAG_COLUMNS) +
+                  ") VALUES (" + ", ".join(["?"] * len(BAG_COLUMNS)) + ")")
+    dup_query = "SELECT bag_id FROM bag WHERE tagmanifest_digest = ?"
+
+    def unregistered():
+        for relpath in walk_bags(path_root, after):
+            if relpath in known:
+                summary["skipped"] += 1
+            else:
+                yield relpath
+    walk = unregistered()
+
+    with concurrent.futures.ThreadPoolExecutor(READ_THREADS) as pool:
+        while True:
+            batch = list(itertools.islice(walk, batch_size))
+            if not batch:
+                break
+
+            def read_one(relpath):
+                try:
+                    return relpath, read_bag(path_root, relpath, layout), None
+                except Exception as e:
+                    return relpath, None, str(e)
+            results = list(pool.map(read_one, batch))
+
+            with dbops.transaction() as cur:
+                bag_id = _next_id(cur, "bag", "bag_id")
+                family_id = _next_id(cur, "bag_family", "bag_family_id")
+                now = dbops.timestamp()
+                bagrows = []
+                accrows = []
+                eventrows = []
+                digests = set()
+
+                for relpath, rec, error in results:
+                    if rec is not None:
+                        bib = rec.get("SANC_bib_record_id", bib_record_id)
+                        itm = rec.get("SANC_item_no", item_no)
+                        acc = rec.get("path_accession_no")
+                        digest = rec.get("tagmanifest_digest")
+                        if bib is None or itm is None or acc is None:
+                            error = ("no records collection, item, or " +
+                                     "accession number")
+                        elif digest is not None and (digest in digests or
+                                cur.execute(dup_query, (digest,)).fetchone()):
+                            error = ("same tagmanifest as a bag already " +
+                                     "registered")
+                        else:
+                            digests.add(digest)
+                    if error is not None:
+                        summary["errors"].append((relpath, error))
+                        lg.log("register_storage: Skipping " + relpath +
+                               ": " + error)
+                        continue
+
+                    orig = rec.get("bag-info_digitalOriginality")
+                    rec.update({
+                        "bag_id": bag_id,
+                        "bag_family_id": family_id,
+                        "storage_id": storage_id,
+                        "records_collection_id": _get_or_create(
+                            cur, collections, "records_collection",
+                            "SANC_bib_record_id", bib),
+                        "item_id": _get_or_create(
+                            cur, items, "item", "SANC_item_no", itm),
+                        "still_exists": True,
+                        "born_digital": DIGITAL_ORIGINALITY.get(
+                            (orig or "").strip().lower(), born_digital),
+                        "processing_status_code": processing_status_code
+                        })
+                    rec.setdefault("SANC_container_id",
+                                   rec["preservation_bag_name"])
+                    rec.setdefault("original_bag_name",
+                                   rec["preservation_bag_name"])
+                    bagrows.append(tuple(rec.get(c) for c in BAG_COLUMNS))
+                    accrows.append((bag_id, _get_or_create(
+                        cur, accessions, "accession", "SANC_accession_no",
+                        acc)))
+                    eventrows.append({
+                        "bag_id": bag_id,
+                        "event_type_code": "BGRGS",
+                        "person_agent_id": agents[0],
+                        "software_agent_id": agents[1],
+                        "end_time": now,
+                        "event_details": ("Bulk registration of bag at " +
+                                          path_root + relpath),
+                        "tools_used": "SANCdpd bulk registration",
+                        "outcome_code": "SUCC"
+                        })
+                    bag_id += 1
+                    family_id += 1
+
+                cur.executemany("INSERT INTO bag_family (bag_family_id) " +
+                                "VALUES (?)", [(r[1],) for r in bagrows])
+                cur.executemany(bag_insert, bagrows)
+                cur.executemany("INSERT INTO bag_from_accession " +
+                                "(bag_id, accession_id) VALUES (?, ?)",
+                                accrows)
+                if eventrows:
+                    summary["bag_event_ids"].extend(
+                        dbops.insert_bag_events(cur, eventrows))
+                cur.execute("""INSERT OR REPLACE INTO registration_checkpoint
+                                 (storage_id, last_bag_path, updated_time)
+                               VALUES (?, ?, ?)""",
+                            (storage_id, batch[-1], now))
+
+            summary["registered"] += len(bagrows)
+            lg.log("register_storage: Committed " + str(len(bagrows)) +
+                   " bags through " + batch[-1])
+
+    # The walk is complete, so the next run starts from the beginning
+    with dbops.transaction() as cur:
+        cur.execute("DELETE FROM registration_checkpoint WHERE storage_id = ?",
+                    (storage_id,))
+
+    lg.log("register_storage: Done. Registered " +
+           str(summary["registered"]) + " bags, with " +
+           str(len(summary["errors"])) + " errors.")
+
+    return summary
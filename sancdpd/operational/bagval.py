@@ -0,0 +1,355 @@
+"""
+This module implements bag validation, recorded in the SANCdpd database as
+"Bag validation" (BGVAL) events.
+
+Validation checks each bag against its own BagIt metadata:
+  - the bag has a bagit.txt file and at least one payload manifest
+  - every payload file is listed in the manifests, and every file listed in
+    the manifests exists
+  - the Payload-Oxum in bag-info.txt (if any) matches the payload on disk
+  - every digest in every manifest and tagmanifest matches the file
+A bag with a manifest whose algorithm cannot be computed here (such as
+blake3) is recorded as not valid, rather than stopping the validation of
+the other bags.
+
+The reading of manifests and walking of payload directories happens in the
+main process.  The hashing of files is spread across a pool of worker
+processes, in chunks of files, so that large bags and many small bags both
+keep all the workers busy.  One bag_event row is written per bag.
+
+The number of worker processes can be given directly, or set with the
+optional "validation_workers" key in the config file.  Otherwise, it
+defaults to the number of CPUs.
+
+This module contains the following functions:
+    validate_bags() :  Validate bags and record BGVAL events
+    select_bags() :  Query the database for the bags to be validated
+"""
+
+# Import modules from the Python standard library
+import concurrent.futures    # for the pool of hashing processes
+import os                    # for the CPU count
+import os.path               # for checking paths
+import time                  # for measuring throughput
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+import dbops
+import metrics
+import operational.bagit as bagit
+import operational.hashing as hashing
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Upper limits on the size of one chunk of files sent to a worker process
+CHUNK_MAX_FILES = 64
+CHUNK_MAX_BYTES = 64 * 1024 * 1024
+
+# Number of chunks to keep queued per worker process
+CHUNKS_PER_WORKER = 4
+
+# Number of bag_event rows to insert per transaction
+EVENT_BATCH_SIZE = 500
+
+
+###############################################################################
+# function: select_bags
+###############################################################################
+def select_bags(cur, storage_id=None, bag_ids=None):
+    """
+    Queries the database for bags to process.
+    Either storage_id or bag_ids (a list) may be given, to limit the bags
+    selected.  Only bags marked as still existing are selected.
+    Returns a list of (bag_id, bagdir) pairs, where bagdir is the full path of
+    the bag on disk.
+    """
+    qstr = """SELECT b.bag_id, s.path_root,
+                     b.preservation_path, b.preservation_bag_name
+              FROM bag b
+              JOIN storage s ON s.storage_id = b.storage_id
+              WHERE b.still_exists"""
+    qargs = []
+    if storage_id is not None:
+        qstr += " AND b.storage_id = ?"
+        qargs.append(storage_id)
+    if bag_ids is not None:
+        qstr += (" AND b.bag_id IN (" +
+                 ", ".join(["?"] * len(bag_ids)) + ")")
+        qargs.extend(bag_ids)
+    qstr += " ORDER BY b.bag_id"
+
+    bags = []
+    for row in cur.execute(qstr, qargs):
+        bags.append((row[0], bagit.bag_dir(row[1], row[2], row[3])))
+    return bags
+
+
+###############################################################################
+# function: _hash_chunk
+###############################################################################
+def _hash_chunk(bagkey, chunk):
+    """
+    Runs in a worker process.  Hashes each file in a chunk.
+    The chunk is a list of (relpath, abspath, algs) triples.
+    Returns a 3-tuple: the bagkey passed in, a list of
+    (relpath, digests, nbytes, error) tuples, where error is None unless the
+    file could not be read, and the worker's metrics (see metrics.take()).
+    """
+    hashed = hashing.hash_files([(abspath, algs)
+                                 for relpath, abspath, algs in chunk])
+    results = [(relpath, digests, nbytes, error)
+               for (relpath, abspath, algs), (digests, nbytes, error)
+               in zip(chunk, hashed)]
+    return bagkey, results, metrics.take()
+
+
+###############################################################################
+# function: _plan_bag
+###############################################################################
+@metrics.timed("plan_bag")
+def _plan_bag(bagdir):
+    """
+    Reads the metadata of the bag at bagdir and compares it with the files on
+    disk, without hashing anything.
+    Returns a triple:
+      - expected: dictionary of relpath -> {alg: digest} for files to hash
+      - problems: list of strings describing invalid features of the bag
+      - chunks: list of chunks of files to hash (see _hash_chunk)
+    Raises an exception if the bag cannot be read at all.
+    """
+    if not os.path.isdir(bagdir):
+        raise Exception("Bag directory not found: " + bagdir)
+
+    problems = []
+    expected = {}
+
+    if not os.path.exists(os.path.join(bagdir, "bagit.txt")):
+        problems.append("bagit.txt missing")
+
+    # Read all payload manifests
+    manifests = bagit.manifest_paths(bagdir)
+    if not manifests:
+        problems.append("no payload manifest")
+    listed = set()
+    for alg, path in manifests.items():
+        # The files listed in a manifest that cannot be checked still count
+        # as listed, but their digests are not compared
+        supported = bagit.supported_algorithm(alg)
+        if not supported:
+            problems.append("unsupported manifest algorithm: " + alg)
+        for relpath, digest in bagit.read_manifest(path).items():
+            if supported:
+                expected.setdefault(relpath, {})[alg] = digest
+            listed.add(relpath)
+
+    # Compare the manifests with the payload on disk
+    if os.path.isdir(os.path.join(bagdir, bagit.PAYLOAD_DIR)):
+        payload = bagit.walk_payload(bagdir)
+    else:
+        problems.append("payload directory missing")
+        payload = {}
+
+    for relpath in sorted(set(payload) - listed):
+        problems.append("not in manifest: " + relpath)
+    for relpath in sorted(listed - set(payload)):
+        problems.append("missing from payload: " + relpath)
+        expected.pop(relpath, None)
+
+    # Check the Payload-Oxum, if there is one
+    info, raw = bagit.read_baginfo(bagdir)
+    if "Payload-Oxum" in info:
+        try:
+            oxbytes, oxfiles = bagit.parse_payload_oxum(info["Payload-Oxum"])
+            if (oxbytes, oxfiles) != (sum(payload.values()), len(payload)):
+                problems.append("Payload-Oxum " + info["Payload-Oxum"] +
+                                " does not match payload " +
+                                str(sum(payload.values())) + "." +
+                                str(len(payload)))
+        except Exception as e:
+            problems.append(str(e))
+
+    # Read all tagmanifests
+    for alg, path in bagit.manifest_paths(bagdir, tag=True).items():
+        if not bagit.supported_algorithm(alg):
+            problems.append("unsupported tagmanifest algorithm: " + alg)
+            continue
+        for relpath, digest in bagit.read_manifest(path).items():
+            if os.path.isfile(os.path.join(bagdir, relpath)):
+                expected.setdefault(relpath, {})[alg] = digest
+            else:
+                problems.append("tag file missing: " + relpath)
+
+    # Group the files to be hashed into chunks
+    chunks = []
+    chunk = []
+    chunkbytes = 0
+    for relpath in sorted(expected):
+        abspath = os.path.join(bagdir, relpath)
+        chunk.append((relpath, abspath, tuple(sorted(expected[relpath]))))
+        chunkbytes += payload.get(relpath, 0)
+        if len(chunk) >= CHUNK_MAX_FILES or chunkbytes >= CHUNK_MAX_BYTES:
+            chunks.append(chunk)
+            chunk = []
+            chunkbytes = 0
+    if chunk:
+        chunks.append(chunk)
+
+    return expected, problems, chunks
+
+
+###############################################################################
+# function: _finish_bag
+###############################################################################
+def _finish_bag(state, agents, workers):
+    """
+    Builds the bag_event row for a bag whose hashing is complete.
+    The state is the dictionary kept for the bag by validate_bags().
+    """
+    if state["errors"]:
+        outcome = "ERR"
+        details = state["errors"] + state["problems"]
+    elif state["problems"]:
+        outcome = "NVAL"
+        details = state["problems"]
+    else:
+        outcome = "VAL"
+        details = []
+
+    return {
+        "bag_id": state["bag_id"],
+        "event_type_code": "BGVAL",
+        "person_agent_id": agents[0],
+        "software_agent_id": agents[1],
+        "start_time": state["start_time"],
+        "end_time": dbops.timestamp(),
+        "event_details": ("Validated " + str(state["files"]) + " files (" +
+                          str(state["bytes"]) + " bytes) against " +
+                          "manifests and tagmanifests."),
+        "tools_used": ("SANCdpd bagval with " + str(workers) +
+                       " worker processes"),
+        "outcome_code": outcome,
+        "outcome_details": "; ".join(details)[:2500] or None
+        }
+
+
+###############################################################################
+# function: validate_bags
+###############################################################################
+def validate_bags(storage_id=None, bag_ids=None, workers=None):
+    """
+    Validates bags and records one BGVAL event per bag.
+    Either storage_id or bag_ids (a list) may be given, to limit the bags
+    validated.  The number of hashing processes is given by workers, or by
+    the config file.
+    Returns a dictionary summarizing the run, including the count of bags for
+    each outcome and the throughput in bytes and files per second.
+    """
+    if workers is None:
+        workers = conf.fconf.get("validation_workers") or os.cpu_count() or 1
+    workers = int(workers)
+
+    cur = dbops.connect().cursor()
+    bags = select_bags(cur, storage_id, bag_ids)
+    agents = dbops.agent_ids()
+    cur.close()
+
+    lg.log("validate_bags: Validating " + str(len(bags)) + " bags with " +
+           str(workers) + " worker processes.")
+
+    summary = {"bags": len(bags), "VAL": 0, "NVAL": 0, "ERR": 0,
+               "files": 0, "bytes": 0, "bag_event_ids": []}
+    states = {}
+    pending = set()
+    rows = []
+    started = time.monotonic()
+    bagiter = iter(bags)
+
+    def flush_events():
+        if rows:
+            with dbops.transaction() as tcur:
+                ids = dbops.insert_bag_events(tcur, rows)
+            summary["bag_event_ids"].extend(ids)
+            del rows[:]
+
+    def finish(key):
+        state = states.pop(key)
+        row = _finish_bag(state, agents, workers)
+        summary[row["outcome_code"]] += 1
+        summary["files"] += state["files"]
+        summary["bytes"] += state["bytes"]
+        rows.append(row)
+        lg.log("validate_bags: Bag " + str(state["bag_id"]) + " " +
+               row["outcome_code"])
+        if len(rows) >= EVENT_BATCH_SIZE:
+            flush_events()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        exhausted = False
+        while not exhausted or pending:
+
+            # Keep the pool fed with chunks from the next bags
+            while not exhausted and len(pending) < workers * CHUNKS_PER_WORKER:
+                try:
+                    bag_id, bagdir = next(bagiter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                state = {"bag_id": bag_id, "start_time": dbops.timestamp(),
+                         "problems": [], "errors": [],
+                         "files": 0, "bytes": 0, "chunks": 0}
+                states[bag_id] = state
+                try:
+                    state["expected"], state["problems"], chunks = \
+                        _plan_bag(bagdir)
+                except Exception as e:
+                    state["errors"].append(str(e))
+                    chunks = []
+                state["chunks"] = len(chunks)
+                for chunk in chunks:
+                    pending.add(pool.submit(_hash_chunk, bag_id, chunk))
+                if not chunks:
+                    finish(bag_id)
+
+            if not pending:
+                continue
+
+            # Collect finished chunks and compare digests
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                pending.discard(fut)
+                bag_id, results, taken = fut.result()
+                metrics.merge(taken)
+                state = states[bag_id]
+                for relpath, digests, nbytes, error in results:
+                    if error is not None:
+                        state["errors"].append("cannot read " + relpath +
+                                               ": " + error)
+                        continue
+                    state["files"] += 1
+                    state["bytes"] += nbytes
+                    for alg, digest in state["expected"][relpath].items():
+                        if digests[alg] != digest:
+                            state["problems"].append(
+                                alg + " mismatch: " + relpath)
+                state["chunks"] -= 1
+                if state["chunks"] == 0:
+                    finish(bag_id)
+
+    flush_events()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    summary["seconds"] = round(elapsed, 3)
+    summary["bytes_per_sec"] = round(summary["bytes"] / elapsed)
+    summary["files_per_sec"] = round(summary["files"] / elapsed, 1)
+
+    lg.log("validate_bags: Done. " + str(summary["VAL"]) + " valid, " +
+           str(summary["NVAL"]) + " not valid, " + str(summary["ERR"]) +
+           " errors.  Throughput: " + str(summary["bytes_per_sec"]) +
+           " bytes/s, " + str(summary["files_per_sec"]) + " files/s.")
+
+    return summary
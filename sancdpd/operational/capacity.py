@@ -0,0 +1,140 @@
+"""
+This module reports the capacity used by bags:  the number of bags, files,
+and bytes in each storage location, records collection, and processing
+status.
+
+The totals are read from the bag_capacity table, through the views in
+sql_ddl/create_views.sql, rather than by aggregating the bag table.
+bag_capacity holds one row of sums for each combination of storage_id,
+records_collection_id, processing_status_code, and still_exists, and it is
+kept current by triggers on the bag table (see schema.CAPACITY_TABLES), so
+that a report reads a few hundred rows at most, however many bags there
+are.  The reports cover only the bags that still exist.
+
+Because the summaries are maintained separately from the bags, they could
+drift from the bag table if the triggers were ever bypassed (for instance,
+by restoring the bag table from an older copy).  verify_capacity()
+recomputes the summaries from the bag table, lists any differences, and,
+with repair, rebuilds bag_capacity in one transaction.
+
+This module contains the following functions:
+    list_storage() :  List storage locations with their capacity
+    capacity_report() :  Report capacity by storage, collection, or status
+    verify_capacity() :  Compare bag_capacity with the bag table
+"""
+
+# Import modules from the Python standard library
+import time                  # for measuring throughput
+
+# Import other SANCdpd modules
+import logger as lg
+import dbops
+import schema
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Views of each capacity report, with the column they are ordered by
+VIEWS = {"storage": ("storage_capacity", "storage_id"),
+         "collection": ("collection_capacity", "SANC_bib_record_id"),
+         "status": ("processing_status_capacity", "processing_status_code")}
+
+
+###############################################################################
+# function: _rows
+###############################################################################
+def _rows(qstr, args=()):
+    """
+    Runs a query on the read-only connection, and returns its rows as
+    dictionaries keyed by column name.
+    """
+    cur = dbops.readonly().execute(qstr, args)
+    cols = [d[0] for d in cur.description]
+    return [dict(zip(cols, r)) for r in cur.fetchall()]
+
+
+###############################################################################
+# function: list_storage
+###############################################################################
+def list_storage(include_inactive=False):
+    """
+    Returns a list of storage locations, ordered by storage_id, each as a
+    dictionary with its ID, name, and path_root, and the number of bags,
+    payload bytes, and total bytes stored there.  Only storage locations in
+    use are included, unless include_inactive is True.
+    """
+    qstr = """SELECT storage_id, storage_name, path_root, bags,
+                     payload_bytes, total_bytes
+              FROM storage_capacity"""
+    if not include_inactive:
+        qstr += " WHERE in_use"
+    return _rows(qstr + " ORDER BY storage_id")
+
+
+###############################################################################
+# function: capacity_report
+###############################################################################
+def capacity_report(by="storage"):
+    """
+    Returns the capacity used by the bags that still exist, grouped by
+    "storage" (location), "collection" (records collection), or "status"
+    (processing status), as a list of dictionaries with the number of bags,
+    payload files and bytes, and total files and bytes of each group.
+    """
+    if by not in VIEWS:
+        raise Exception("Unknown capacity grouping: " + str(by) + ".  Use " +
+                        ", ".join(VIEWS))
+    view, order = VIEWS[by]
+    return _rows("SELECT * FROM " + view + " ORDER BY " + order)
+
+
+###############################################################################
+# function: verify_capacity
+###############################################################################
+def verify_capacity(repair=False):
+    """
+    Recomputes the capacity summaries from the bag table, and compares them
+    with the bag_capacity table.  If repair is True and they differ,
+    bag_capacity is rebuilt from the bag table in one transaction.
+    Returns a dictionary with the number of summary rows, a list of the
+    rows that differ (with the recorded and the recomputed sums), and
+    whether the table was rebuilt.
+    """
+    start = time.perf_counter()
+    keys = [c for c, e in schema.CAPACITY_KEYS]
+    sums = [c for c, e in schema.CAPACITY_SUMS]
+    nkeys = len(keys)
+
+    def summaries(qstr):
+        return dict((tuple(r[:nkeys]), tuple(r[nkeys:]))
+                    for r in dbops.readonly().execute(qstr))
+
+    expected = summaries(schema.CAPACITY_QUERY)
+    recorded = summaries("SELECT " + ", ".join(keys + sums) +
+                         " FROM bag_capacity")
+
+    drift = []
+    for key in sorted(set(expected) | set(recorded), key=repr):
+        if expected.get(key) != recorded.get(key):
+            row = dict(zip(keys, key))
+            row["recorded"] = dict(zip(sums, recorded[key])) \
+                if key in recorded else None
+            row["expected"] = dict(zip(sums, expected[key])) \
+                if key in expected else None
+            drift.append(row)
+
+    rebuilt = False
+    if repair and drift:
+        with dbops.transaction() as cur:
+            cur.execute("DELETE FROM bag_capacity")
+            cur.execute("INSERT INTO bag_capacity " + schema.CAPACITY_QUERY)
+        rebuilt = True
+
+    summary = {"groups": len(expected), "drift": drift, "rebuilt": rebuilt,
+               "seconds": round(time.perf_counter() - start, 3)}
+    lg.log("verify_capacity: " + str(len(drift)) + " of " +
+           str(len(expected)) + " capacity summaries differ from the bag " +
+           "table" + ("; rebuilt bag_capacity." if rebuilt else "."))
+    return summary
@@ -0,0 +1,456 @@
+"""
+This module records administrative events for many bags at once, such as a
+virus scan (VRSSC) or a processing run (PRCSS) that was done outside of
+SANCdpd.
+
+The events are read as a stream from a CSV file (with a header row), a JSON
+lines file (one object per line), or a JSON file holding an array of
+objects.  The format is recognized from the first character of the file.
+Every format is read a row at a time:  a JSON array is decoded one element
+at a time with json.JSONDecoder.raw_decode(), READ_CHARS characters at a
+time, rather than loaded whole.
+Each row (or object) describes one event, with these fields:
+    bag_id (required)
+    event_type_code, outcome_code
+    start_time, end_time (ISO 8601; end_time defaults to the current time)
+    event_details, tools_used, outcome_details
+    person_agent_code, software_agent_code, hardware_agent_code,
+        organization_agent_code (or the same with _agent_id, to give the
+        agent_id instead of the agent_code)
+The event type, outcome, details, and tools can also be given once for the
+whole file, and are used for rows that leave them blank.  A row that names
+no agent at all is recorded with the agents of this session (the person in
+the config file and the SANCdpd software agent), unless default_agents is
+False.
+
+The file is read, checked, and recorded one chunk of rows at a time, so
+that a file of any size is recorded in little memory.  Each row of a chunk
+is checked in memory:  the event type and outcome against the
+reference-data cache (see the refdata module), the agents against the
+cached agent table (each must exist and be of the type for its role), and
+the agent CHECK constraint of the bag_event table (at least one agent).
+The bag IDs of the chunk are then checked with one query.  Rows that fail
+are reported with their row numbers, and do not stop the other rows.
+Because the chunks are recorded as they are read, a failing row does not
+stop the chunks before it from being recorded either; use dry_run to check
+the whole file first.
+
+The rows that pass are inserted with one executemany call per chunk, each
+chunk in its own transaction.  If a chunk still fails in the database (for
+instance, because a bag was deleted in the meantime), it is inserted again
+one row at a time, each in a savepoint, so that only the failing rows are
+left out.
+
+The number of rows per chunk can be given directly, or set with the
+optional "event_chunk_size" key in the config file (default CHUNK_SIZE).
+
+This module contains the following functions:
+    read_event_rows() :  Read the rows of an events file as a stream
+    record_events() :  Check and record the events in an events file
+"""
+
+# Import modules from the Python standard library
+import csv                   # for reading CSV files
+import datetime as dt        # for checking and formatting timestamps
+import json                  # for reading JSON files
+import sqlite3 as sq         # for recognizing constraint failures
+import sys                   # for reading standard input
+import time                  # for measuring throughput
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+import dbops
+import refdata
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Default number of events inserted per transaction
+CHUNK_SIZE = 1000
+
+# Roles of the agents of an event (the prefixes of the bag_event columns)
+AGENT_ROLES = ("person", "software", "hardware", "organization")
+
+# The agent_type_code an agent must have for each role
+AGENT_TYPES = {"person": "PERSN", "software": "SOFTW", "hardware": "HARDW",
+               "organization": "ORGZN"}
+
+# Text fields copied from a row as they are
+TEXT_FIELDS = ("event_details", "tools_used", "outcome_details")
+
+# Number of characters of a JSON array file read at a time
+READ_CHARS = 65536
+
+
+###############################################################################
+# function: read_event_rows
+###############################################################################
+def read_event_rows(fp):
+    """
+    Reads the rows of an open events file (see the module docstring), one at
+    a time, recognizing CSV, JSON lines, or a JSON array from the first
+    character that is not white space.
+    Yields (row number, row) pairs, where row is a dictionary, or an error
+    message if the row could not be read.  Rows are numbered from 1 (the row
+    after the header, in a CSV file).
+    """
+    first = ""
+    while True:
+        first = fp.read(1)
+        if first == "" or not first.isspace():
+            break
+
+    if first == "[":
+        yield from _json_array(fp)
+
+    elif first == "{":
+        for n, line in enumerate(fp, 1):
+            if n == 1:
+                line = first + line
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield n, "Invalid JSON: " + str(e)
+                continue
+            yield n, row if isinstance(row, dict) else "Not a JSON object"
+
+    elif first:
+        lines = iter(fp)
+        head = first + next(lines, "")
+        reader = csv.DictReader(_chain(head, lines))
+        for n, row in enumerate(reader, 1):
+            if None in row:
+                yield n, "More fields than the header"
+                continue
+            yield n, dict((k.strip(), v) for k, v in row.items() if k)
+
+
+###############################################################################
+# function: _json_array
+###############################################################################
+def _json_array(fp):
+    """
+    Reads the elements of a JSON array from an open file, just after its
+    "[", one at a time, reading READ_CHARS characters at a time, so that the
+    whole array is never held in memory.
+    Yields (row number, row) pairs as read_event_rows() does.  The array
+    cannot be read past invalid JSON, so that is the last row yielded.
+    """
+    decoder = json.JSONDecoder()
+    state = {"buf": "", "pos": 0, "eof": False}
+
+    def more():
+        # Keeps the unread part of the buffer, and reads more after it
+        text = fp.read(READ_CHARS)
+        state["eof"] = text == ""
+        state["buf"] = state["buf"][state["pos"]:] + text
+        state["pos"] = 0
+
+    def peek():
+        # Skips white space, and returns the next character ("" at the end)
+        while True:
+            buf, pos = state["buf"], state["pos"]
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            state["pos"] = pos
+            if pos < len(buf) or state["eof"]:
+                return buf[pos:pos + 1]
+            more()
+
+    n = 0
+    while True:
+        c = peek()
+        if c == "]":
+            return
+        if n > 0:
+            if c != ",":
+                yield n + 1, ("Invalid JSON: expected ',' or ']' after row " +
+                              str(n))
+                return
+            state["pos"] += 1
+            peek()
+
+        # Decode the next element, reading more until it is complete.  An
+        # element that ends just at the end of the buffer (like a number)
+        # might go on, so more is read for it too.
+        while True:
+            try:
+                row, end = decoder.raw_decode(state["buf"], state["pos"])
+                if end < len(state["buf"]) or state["eof"]:
+                    break
+            except ValueError as e:
+                if state["eof"]:
+                    yield n + 1, "Invalid JSON: " + str(e)
+                    return
+            more()
+        state["pos"] = end
+        n += 1
+        yield n, row if isinstance(row, dict) else "Not a JSON object"
+
+
+###############################################################################
+# function: _chain
+###############################################################################
+def _chain(head, lines):
+    """
+    Yields head, and then the lines from an iterator.
+    """
+    yield head
+    yield from lines
+
+
+###############################################################################
+# function: _value
+###############################################################################
+def _value(row, key):
+    """
+    Returns the value of a field of a row, with surrounding white space
+    removed, or None if it is missing or blank.
+    """
+    value = row.get(key)
+    if isinstance(value, str):
+        value = value.strip()
+        if value == "":
+            return None
+    return value
+
+
+###############################################################################
+# function: _time
+###############################################################################
+def _time(value, field):
+    """
+    Checks an ISO 8601 timestamp, and returns it in the format used in the
+    database (local time, to the second).
+    """
+    try:
+        t = dt.datetime.fromisoformat(str(value))
+    except ValueError:
+        raise Exception("Invalid " + field + ": " + str(value))
+    if t.tzinfo is not None:
+        t = t.astimezone().replace(tzinfo=None)
+    return t.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+###############################################################################
+# function: _agent
+###############################################################################
+def _agent(row, role):
+    """
+    Returns the agent_id given for a role in a row, by agent_code or by
+    agent_id, or None if none is given.  Raises an exception if the agent
+    is not in the agent table, or is not of the type for the role (e.g., a
+    software agent given as the person agent).
+    """
+    code = _value(row, role + "_agent_code")
+    agent_id = _value(row, role + "_agent_id")
+    if code is not None:
+        agent = refdata.agent_by_code(str(code))
+        if agent is None:
+            raise Exception("Unknown " + role + " agent code: " + str(code))
+        if agent_id is not None and str(agent["agent_id"]) != str(agent_id):
+            raise Exception("The " + role + " agent code and ID do not match")
+    elif agent_id is not None:
+        try:
+            agent = refdata.agent_by_id(int(agent_id))
+        except ValueError:
+            agent = None
+        if agent is None:
+            raise Exception("Unknown " + role + " agent ID: " + str(agent_id))
+    else:
+        return None
+    if agent["agent_type_code"] != AGENT_TYPES[role]:
+        raise Exception("Agent " + str(agent["agent_id"]) + " is a " +
+                        agent["agent_type_code"] + " agent, not a " +
+                        AGENT_TYPES[role] + " (" + role + ") agent")
+    return agent["agent_id"]
+
+
+###############################################################################
+# function: _check_row
+###############################################################################
+def _check_row(row, defaults, session_agents, now):
+    """
+    Checks one row of an events file in memory, filling in blank fields from
+    defaults.
+    Returns a dictionary of bag_event columns, or raises an exception that
+    says what is wrong with the row.
+    """
+    bag_id = _value(row, "bag_id")
+    if bag_id is None:
+        raise Exception("Missing bag_id")
+    try:
+        bag_id = int(bag_id)
+    except (TypeError, ValueError):
+        raise Exception("Invalid bag_id: " + str(bag_id))
+
+    event = {"bag_id": bag_id}
+    for key in ("event_type_code", "outcome_code") + TEXT_FIELDS:
+        value = _value(row, key)
+        event[key] = str(value) if value is not None else defaults.get(key)
+
+    if event["event_type_code"] is None:
+        raise Exception("Missing event_type_code")
+    if refdata.event_type(event["event_type_code"]) is None:
+        raise Exception("Unknown event type: " + event["event_type_code"])
+    if event["outcome_code"] is None:
+        raise Exception("Missing outcome_code")
+    if not refdata.is_valid_outcome(event["event_type_code"],
+                                    event["outcome_code"]):
+        raise Exception("Outcome " + event["outcome_code"] +
+                        " is not valid for " + event["event_type_code"] +
+                        " events.  Valid outcomes: " +
+                        ", ".join(o[0] for o in
+                                  refdata.outcomes(event["event_type_code"])))
+
+    start = _value(row, "start_time")
+    end = _value(row, "end_time")
+    event["start_time"] = _time(start, "start_time") if start else None
+    event["end_time"] = _time(end, "end_time") if end else now
+    if event["start_time"] and event["start_time"] > event["end_time"]:
+        raise Exception("start_time is after end_time")
+
+    for role in AGENT_ROLES:
+        event[role + "_agent_id"] = _agent(row, role)
+    if not any(event[role + "_agent_id"] for role in AGENT_ROLES):
+        event["person_agent_id"], event["software_agent_id"] = \
+            session_agents
+        if not any(session_agents):
+            raise Exception("No agent given for the event")
+    return event
+
+
+###############################################################################
+# function: _existing
+###############################################################################
+def _existing(cur, chunk, summary):
+    """
+    Checks, with one query, that the bags of a chunk of (row number, event)
+    pairs exist.  Adds an error to the summary for each row whose bag does
+    not.
+    Returns the list of pairs whose bags exist.
+    """
+    bag_ids = sorted(set(e["bag_id"] for n, e in chunk))
+    qstr = ("SELECT bag_id FROM bag WHERE bag_id IN (" +
+            ", ".join(["?"] * len(bag_ids)) + ")")
+    found = set(r[0] for r in cur.execute(qstr, bag_ids))
+    good = []
+    for n, event in chunk:
+        if event["bag_id"] in found:
+            good.append((n, event))
+        else:
+            summary["errors"].append({"row": n, "error": "No bag with ID " +
+                                      str(event["bag_id"])})
+    summary["checked"] += len(good)
+    return good
+
+
+###############################################################################
+# function: _record_chunk
+###############################################################################
+def _record_chunk(chunk, summary, dry_run):
+    """
+    Records the events of a chunk of (row number, event) pairs whose bags
+    exist, in one transaction, and adds the new IDs and the errors to the
+    summary.  If the batch insert fails, inserts the events one at a time
+    instead.  If dry_run is True, only checks the bags.
+    """
+    if dry_run:
+        _existing(dbops.readonly(), chunk, summary)
+        return
+
+    with dbops.transaction() as cur:
+        good = _existing(cur, chunk, summary)
+        if not good:
+            return
+        try:
+            with dbops.transaction() as sp:
+                ids = dbops.insert_bag_events(sp, [e for n, e in good])
+            summary["bag_event_ids"].extend(ids)
+            return
+        except sq.IntegrityError as e:
+            lg.log("record_events: Batch insert failed (" + str(e) +
+                   "); inserting rows " + str(good[0][0]) + " to " +
+                   str(good[-1][0]) + " one at a time.", "DEBUG")
+
+        for n, event in good:
+            try:
+                with dbops.transaction() as sp:
+                    ids = dbops.insert_bag_events(sp, [event])
+                summary["bag_event_ids"].extend(ids)
+            except sq.IntegrityError as e:
+                summary["errors"].append({"row": n, "error": str(e)})
+
+
+###############################################################################
+# function: record_events
+###############################################################################
+def record_events(path, event_type_code=None, outcome_code=None,
+                  event_details=None, tools_used=None, chunk_size=None,
+                  default_agents=True, dry_run=False):
+    """
+    Reads the events file at path ("-" for standard input), and checks and
+    records the events of the rows that pass, in chunks of chunk_size rows
+    (see the module docstring).  The event type, outcome,
+    details, and tools given here are used for rows that leave them blank.
+    If dry_run is True, the rows are only checked (the bags too), and
+    nothing is recorded.
+    Returns a dictionary summarizing the run, with a list of the rows that
+    were not recorded and why.
+    """
+    chunk_size = max(1, int(chunk_size or conf.fconf.get("event_chunk_size")
+                            or CHUNK_SIZE))
+    start = time.perf_counter()
+    refdata.refresh()
+    defaults = {"event_type_code": event_type_code,
+                "outcome_code": outcome_code,
+                "event_details": event_details, "tools_used": tools_used}
+    session_agents = dbops.agent_ids() if default_agents else (None, None)
+    now = dbops.timestamp()
+
+    summary = {"rows": 0, "checked": 0, "recorded": 0, "errors": [],
+               "bag_event_ids": []}
+    fp = sys.stdin if path == "-" else open(path, "r", encoding="utf-8-sig",
+                                            newline="")
+    try:
+        chunk = []
+        for n, row in read_event_rows(fp):
+            summary["rows"] += 1
+            if isinstance(row, str):
+                summary["errors"].append({"row": n, "error": row})
+                continue
+            try:
+                chunk.append((n, _check_row(row, defaults, session_agents,
+                                            now)))
+            except Exception as e:
+                summary["errors"].append({"row": n, "error": str(e)})
+                continue
+            if len(chunk) >= chunk_size:
+                _record_chunk(chunk, summary, dry_run)
+                chunk = []
+                lg.log("record_events: " + str(summary["rows"]) +
+                       " rows read.", "DEBUG")
+        if chunk:
+            _record_chunk(chunk, summary, dry_run)
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+
+    summary["errors"].sort(key=lambda e: e["row"])
+    summary["recorded"] = len(summary["bag_event_ids"])
+    seconds = time.perf_counter() - start
+    summary["seconds"] = round(seconds, 3)
+    summary["rows_per_sec"] = round(summary["rows"] / seconds, 1) \
+        if seconds else 0
+
+    lg.log("record_events: " + ("Checked " if dry_run else "Recorded ") +
+           str(summary["checked"] if dry_run else summary["recorded"]) +
+           " of " + str(summary["rows"]) + " events from " + path +
+           ", with " + str(len(summary["errors"])) + " errors, in " +
+           str(summary["seconds"]) + " s.")
+    return summary
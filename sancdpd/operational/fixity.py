@@ -0,0 +1,506 @@
+"""
+This module implements fixity audits of bags, recorded in the SANCdpd
+database as "Tagmanifest comparison" (TGCMP) events.
+
+An audit compares every file listed in the manifests and tagmanifests of a
+bag with the digests recorded there.  One bag_event row is written per bag,
+with the outcome SAME (all files match), NSAM (some file is missing, extra,
+changed, or cannot be read), or ERR (the bag could not be audited at all,
+for instance because it has no manifests).
+
+Audits run in one of two modes:
+  - "full" mode re-hashes every file.
+  - "incremental" mode consults the fixity_cache table, which records the
+    size, mtime_ns and inode of each file when its digest was last verified.
+    A file is re-hashed only if its stat values have changed, if its
+    manifest digest no longer matches the cached digest, or if its last
+    verification is older than the maximum age.
+
+In both modes, the fixity_cache table is updated for every file hashed.
+
+The maximum age can be given directly, or set with the optional
+"fixity_max_age_days" key in the config file (default 90 days).  The number
+of worker processes can be given directly, or set with the optional
+"audit_workers" key in the config file.  Otherwise, it defaults to the
+number of CPUs.
+
+A tagmanifest comparison is a much quicker check of a whole storage
+location.  It reads only the strongest tagmanifest of each bag on disk,
+computes its canonical digest (see bagit.manifest_digest()), and joins the
+digests with the tagmanifest_digest column of the bag table, which is
+indexed.  Only for bags whose digests differ are the tagmanifests compared
+line by line.  Since a tagmanifest lists the digests of the other tag files
+(including the payload manifests), a changed digest means that some tag
+file or manifest of the bag has changed.
+
+This module contains the following functions:
+    audit_bags() :  Audit bags and record TGCMP events
+    compare_tagmanifests() :  Compare tagmanifests on disk with the database
+"""
+
+# Import modules from the Python standard library
+import concurrent.futures    # for the pool of auditing processes
+import datetime as dt        # for computing the maximum age cutoff
+import itertools             # for taking batches from the bag walk
+import os                    # for stat calls and the CPU count
+import os.path               # for building paths
+import time                  # for measuring throughput
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+import dbops
+import metrics
+import operational.bagit as bagit
+import operational.hashing as hashing
+import operational.bagmgmt as bagmgmt
+import operational.bagval as bagval
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Digest algorithms in order of preference for the fixity cache
+ALG_PREFERENCE = ["sha512", "sha256", "sha1", "md5"]
+
+# Default maximum age, in days, of a cached verification
+DEFAULT_MAX_AGE_DAYS = 90
+
+# Number of bags to keep queued per worker process
+BAGS_PER_WORKER = 4
+
+# Number of bags whose results are written per transaction
+BAG_BATCH_SIZE = 200
+
+# Number of bags read per batch in a tagmanifest comparison
+SCAN_BATCH_SIZE = 1000
+
+
+###############################################################################
+# function: _preferred_alg
+###############################################################################
+def _preferred_alg(algs):
+    """
+    Returns the strongest digest algorithm in algs, for use in the cache.
+    """
+    for alg in ALG_PREFERENCE:
+        if alg in algs:
+            return alg
+    return sorted(algs)[0]
+
+
+###############################################################################
+# function: _audit_bag
+###############################################################################
+def _audit_bag(bag_id, bagdir, cached, cutoff, full):
+    """
+    Runs in a worker process.  Audits one bag.
+    The cached argument is a dictionary of the bag's fixity_cache rows,
+    keyed by relative path, as (size, mtime_ns, inode, alg, digest,
+    verified_time) tuples.  Cached verifications older than the cutoff
+    timestamp are not trusted.  If full is True, the cache is ignored.
+    Returns a dictionary of results for the bag, including the worker's
+    metrics (see metrics.take()).
+    """
+    result = {"bag_id": bag_id, "problems": [], "error": None,
+              "hashed": 0, "skipped": 0, "bytes": 0,
+              "cache_rows": [], "paths": [], "invalid": []}
+    try:
+        if not os.path.isdir(bagdir):
+            raise Exception("Bag directory not found: " + bagdir)
+
+        # Collect expected digests from all manifests and tagmanifests
+        expected = {}
+        for tag in (False, True):
+            for alg, path in bagit.manifest_paths(bagdir, tag=tag).items():
+                for relpath, digest in bagit.read_manifest(path).items():
+                    expected.setdefault(relpath, {})[alg] = digest
+        if not expected:
+            raise Exception("No manifests found in bag: " + bagdir)
+        result["paths"] = sorted(expected)
+
+        # Payload files not listed in any manifest
+        if os.path.isdir(os.path.join(bagdir, bagit.PAYLOAD_DIR)):
+            for relpath in sorted(set(bagit.walk_payload(bagdir)) -
+                                  set(expected)):
+                result["problems"].append("not in manifest: " + relpath)
+
+        now = dbops.timestamp()
+        tohash = []
+        for relpath in result["paths"]:
+            digests = expected[relpath]
+            alg = _preferred_alg(digests)
+            try:
+                st = os.stat(os.path.join(bagdir, relpath))
+            except FileNotFoundError:
+                result["problems"].append("missing: " + relpath)
+                result["invalid"].append(relpath)
+                continue
+            statkey = (st.st_size, st.st_mtime_ns, st.st_ino)
+
+            # Skip the file if the cache vouches for it
+            c = cached.get(relpath)
+            if (not full and c is not None and c[:3] == statkey and
+                    c[3] == alg and c[4] == digests[alg] and c[5] >= cutoff):
+                result["skipped"] += 1
+                continue
+            tohash.append((relpath, digests, alg, statkey))
+
+        # Hash the files the cache does not vouch for, in one batch
+        hashed = hashing.hash_files([(os.path.join(bagdir, relpath), digests)
+                                     for relpath, digests, alg, statkey
+                                     in tohash])
+        for (relpath, digests, alg, statkey), (actual, nbytes, error) in \
+                zip(tohash, hashed):
+            if error is not None:
+                result["problems"].append("cannot read " + relpath + ": " +
+                                          error)
+                result["invalid"].append(relpath)
+                continue
+            result["hashed"] += 1
+            result["bytes"] += nbytes
+            bad = [a for a in digests if actual[a] != digests[a]]
+            if bad:
+                result["problems"].append("/".join(bad) + " mismatch: " +
+                                          relpath)
+                result["invalid"].append(relpath)
+            else:
+                result["cache_rows"].append(
+                    (bag_id, relpath) + statkey + (alg, actual[alg], now))
+
+    except Exception as e:
+        result["error"] = str(e)
+
+    result["metrics"] = metrics.take()
+    return result
+
+
+###############################################################################
+# function: _write_results
+###############################################################################
+def _write_results(cur, results, agents, mode):
+    """
+    Writes a batch of bag audit results to the database: updates to the
+    fixity_cache table and one TGCMP bag_event row per bag.
+    Returns the list of new bag_event_id values.
+    """
+    rows = []
+    for r in results:
+
+        # Forget cached verifications for files that failed or are gone
+        qstr = """DELETE FROM fixity_cache
+                  WHERE bag_id = ? AND relative_path = ?"""
+        if r["error"] is None:
+            paths = set(r["paths"])
+            stale = cur.execute("SELECT relative_path FROM fixity_cache " +
+                                "WHERE bag_id = ?", (r["bag_id"],)).fetchall()
+            cur.executemany(qstr, [(r["bag_id"], p) for (p,) in stale
+                                   if p not in paths])
+            cur.executemany(qstr, [(r["bag_id"], p) for p in r["invalid"]])
+
+        qstr = """INSERT OR REPLACE INTO fixity_cache
+                    (bag_id, relative_path, file_size, mtime_ns, inode,
+                     algorithm, digest, verified_time)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+        cur.executemany(qstr, r["cache_rows"])
+
+        if r["error"] is not None:
+            outcome = "ERR"
+            details = r["error"]
+        elif r["problems"]:
+            outcome = "NSAM"
+            details = "; ".join(r["problems"])[:2500]
+        else:
+            outcome = "SAME"
+            details = None
+
+        rows.append({
+            "bag_id": r["bag_id"],
+            "event_type_code": "TGCMP",
+            "person_agent_id": agents[0],
+            "software_agent_id": agents[1],
+            "start_time": r["start_time"],
+            "end_time": r["end_time"],
+            "event_details": (mode.capitalize() + " fixity audit: " +
+                              str(r["hashed"]) + " files hashed (" +
+                              str(r["bytes"]) + " bytes), " +
+                              str(r["skipped"]) + " files verified " +
+                              "from the fixity cache."),
+            "tools_used": "SANCdpd fixity audit",
+            "outcome_code": outcome,
+            "outcome_details": details
+            })
+
+    return dbops.insert_bag_events(cur, rows)
+
+
+###############################################################################
+# function: audit_bags
+###############################################################################
+def audit_bags(storage_id=None, bag_ids=None, mode="incremental",
+               max_age_days=None, workers=None):
+    """
+    Audits the fixity of bags and records one TGCMP event per bag.
+    Either storage_id or bag_ids (a list) may be given, to limit the bags
+    audited.  The mode is "incremental" or "full" (see the module
+    docstring).
+    Returns a dictionary summarizing the run.
+    """
+    if mode not in ("incremental", "full"):
+        raise Exception("Unknown fixity audit mode: " + str(mode))
+    if max_age_days is None:
+        max_age_days = conf.fconf.get("fixity_max_age_days",
+                                      DEFAULT_MAX_AGE_DAYS)
+    if workers is None:
+        workers = conf.fconf.get("audit_workers") or os.cpu_count() or 1
+    workers = int(workers)
+
+    cutoff = (dt.datetime.now() - dt.timedelta(days=float(max_age_days))
+              ).strftime("%Y-%m-%dT%H:%M:%S")
+
+    cur = dbops.connect().cursor()
+
+    qstr = """SELECT name FROM sqlite_master
+              WHERE type = 'table' AND name = 'fixity_cache'"""
+    if cur.execute(qstr).fetchone() is None:
+        raise Exception("Database has no fixity_cache table.")
+
+    bags = bagval.select_bags(cur, storage_id, bag_ids)
+    agents = dbops.agent_ids()
+
+    lg.log("audit_bags: " + mode.capitalize() + " audit of " +
+           str(len(bags)) + " bags with " + str(workers) +
+           " worker processes.")
+
+    summary = {"bags": len(bags), "SAME": 0, "NSAM": 0, "ERR": 0,
+               "hashed": 0, "skipped": 0, "bytes": 0, "bag_event_ids": []}
+    qstr = """SELECT relative_path, file_size, mtime_ns, inode,
+                     algorithm, digest, verified_time
+              FROM fixity_cache
+              WHERE bag_id = ?"""
+    started = time.monotonic()
+    done_results = []
+    pending = {}
+    bagiter = iter(bags)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        exhausted = False
+        while not exhausted or pending:
+
+            # Keep the pool fed with the next bags
+            while not exhausted and len(pending) < workers * BAGS_PER_WORKER:
+                try:
+                    bag_id, bagdir = next(bagiter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                cached = {}
+                if mode == "incremental":
+                    for row in cur.execute(qstr, (bag_id,)):
+                        cached[row[0]] = tuple(row[1:])
+                fut = pool.submit(_audit_bag, bag_id, bagdir, cached,
+                                  cutoff, mode == "full")
+                pending[fut] = dbops.timestamp()
+
+            if not pending:
+                continue
+
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                r = fut.result()
+                metrics.merge(r.pop("metrics"))
+                r["start_time"] = pending.pop(fut)
+                r["end_time"] = dbops.timestamp()
+                done_results.append(r)
+                for k in ("hashed", "skipped", "bytes"):
+                    summary[k] += r[k]
+
+            if len(done_results) >= BAG_BATCH_SIZE or not pending:
+                with dbops.transaction() as tcur:
+                    ids = _write_results(tcur, done_results, agents, mode)
+                summary["bag_event_ids"].extend(ids)
+                for r in done_results:
+                    outcome = ("ERR" if r["error"] is not None else
+                               "NSAM" if r["problems"] else "SAME")
+                    summary[outcome] += 1
+                    lg.log("audit_bags: Bag " + str(r["bag_id"]) + " " +
+                           outcome)
+                done_results = []
+
+    cur.close()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    summary["seconds"] = round(elapsed, 3)
+    summary["bytes_per_sec"] = round(summary["bytes"] / elapsed)
+
+    lg.log("audit_bags: Done. " + str(summary["SAME"]) + " same, " +
+           str(summary["NSAM"]) + " not same, " + str(summary["ERR"]) +
+           " errors.  " + str(summary["hashed"]) + " files hashed, " +
+           str(summary["skipped"]) + " skipped using the fixity cache.")
+
+    return summary
+
+
+###############################################################################
+# function: _scan_tagmanifest
+###############################################################################
+@metrics.timed("scan_tagmanifest")
+def _scan_tagmanifest(path_root, relpath):
+    """
+    Reads the strongest tagmanifest of the bag at relpath under path_root.
+    Returns a 3-tuple:  relpath, the canonical digest of the tagmanifest
+    (None if the bag has none), and an error message (or None).
+    """
+    try:
+        path = bagit.strongest_tagmanifest(os.path.join(path_root, relpath))
+        if path is None:
+            return relpath, None, None
+        with open(path, "r", encoding="utf-8-sig") as fp:
+            return relpath, bagit.manifest_digest(fp.read()), None
+    except Exception as e:
+        return relpath, None, str(e)
+
+
+###############################################################################
+# function: compare_tagmanifests
+###############################################################################
+def compare_tagmanifests(storage_id, record_events=False):
+    """
+    Compares the tagmanifest of every bag under the path_root of a storage
+    location with the tagmanifest recorded for it in the database (see the
+    module docstring).
+    Reports bags that are the same, bags that have changed (with the paths
+    added, removed, and changed in the tagmanifest), registered bags that
+    are missing from disk, and bags on disk that are not registered at this
+    storage location (with the ID of any bag registered with the same
+    tagmanifest elsewhere).
+    If record_events is True, records one TGCMP event for each registered
+    bag:  SAME, NSAM (changed), or ERR (missing or unreadable).
+    Returns a dictionary summarizing the run.
+    """
+    con = dbops.connect()
+    row = con.execute("SELECT path_root FROM storage WHERE storage_id = ?",
+                      (storage_id,)).fetchone()
+    if row is None:
+        raise Exception("No storage location with ID " + str(storage_id))
+    path_root = row[0]
+
+    lg.log("compare_tagmanifests: Scanning bags under " + path_root)
+
+    # Digests of the bags on disk go into a temporary table, for joining
+    con.execute("DROP TABLE IF EXISTS temp.tagmanifest_scan")
+    con.execute("""CREATE TEMP TABLE tagmanifest_scan (
+                     bag_path VARCHAR(255) PRIMARY KEY,
+                     tagmanifest_digest VARCHAR(64),
+                     error VARCHAR(500)
+                   )""")
+    walk = bagmgmt.walk_bags(path_root)
+    with concurrent.futures.ThreadPoolExecutor(bagmgmt.READ_THREADS) as pool:
+        while True:
+            batch = list(itertools.islice(walk, SCAN_BATCH_SIZE))
+            if not batch:
+                break
+            rows = list(pool.map(lambda p: _scan_tagmanifest(path_root, p),
+                                 batch))
+            with dbops.transaction() as cur:
+                cur.executemany("INSERT INTO temp.tagmanifest_scan " +
+                                "VALUES (?, ?, ?)", rows)
+
+    summary = {"bags": 0, "same": 0, "changed": [], "missing": [],
+               "unregistered": [], "errors": [], "bag_event_ids": []}
+    outcomes = []
+
+    # Registered bags at this storage location, joined with the scan
+    qstr = """SELECT b.bag_id,
+                     b.preservation_path || b.preservation_bag_name,
+                     b.tagmanifest_filename, b.tagmanifest_contents,
+                     b.tagmanifest_digest IS s.tagmanifest_digest,
+                     s.bag_path IS NOT NULL, s.error
+              FROM bag b
+              LEFT JOIN temp.tagmanifest_scan s
+                ON s.bag_path = b.preservation_path || b.preservation_bag_name
+              WHERE b.still_exists AND b.storage_id = ?
+              ORDER BY b.bag_id"""
+    for (bag_id, relpath, filename, old_text,
+         same, found, error) in con.execute(qstr, (storage_id,)).fetchall():
+        summary["bags"] += 1
+        if not found:
+            summary["missing"].append({"bag_id": bag_id, "path": relpath})
+            outcomes.append((bag_id, "ERR", "Bag not found on disk."))
+        elif error is not None:
+            summary["errors"].append({"bag_id": bag_id, "path": relpath,
+                                      "error": error})
+            outcomes.append((bag_id, "ERR", error))
+        elif same:
+            summary["same"] += 1
+            outcomes.append((bag_id, "SAME", None))
+        else:
+            # Only now read the tagmanifest again, for a line by line diff
+            try:
+                path = bagit.strongest_tagmanifest(
+                    os.path.join(path_root, relpath))
+                if path is None:
+                    raise Exception("tagmanifest missing")
+                with open(path, "r", encoding="utf-8-sig") as fp:
+                    diff = bagit.diff_manifests(old_text or "", fp.read())
+            except Exception as e:
+                summary["errors"].append({"bag_id": bag_id, "path": relpath,
+                                          "error": str(e)})
+                outcomes.append((bag_id, "ERR", str(e)))
+                continue
+            details = "; ".join(k + ": " + ", ".join(diff[k])
+                                for k in ("added", "removed", "changed")
+                                if diff[k])
+            if os.path.basename(path) != filename:
+                details = ("tagmanifest is now " + os.path.basename(path) +
+                           "; " + details)
+            diff.update({"bag_id": bag_id, "path": relpath})
+            summary["changed"].append(diff)
+            outcomes.append((bag_id, "NSAM", details[:2500]))
+
+    # Bags on disk not registered here, and any bag with the same digest
+    qstr = """SELECT s.bag_path, s.error, b.bag_id
+              FROM temp.tagmanifest_scan s
+              LEFT JOIN bag b ON b.tagmanifest_digest = s.tagmanifest_digest
+              WHERE s.bag_path NOT IN
+                  (SELECT preservation_path || preservation_bag_name
+                   FROM bag
+                   WHERE still_exists AND storage_id = ?)
+              ORDER BY s.bag_path"""
+    for relpath, error, same_as in con.execute(qstr, (storage_id,)):
+        if error is not None:
+            summary["errors"].append({"bag_id": None, "path": relpath,
+                                      "error": error})
+        else:
+            summary["unregistered"].append({"path": relpath,
+                                            "same_as_bag_id": same_as})
+    con.execute("DROP TABLE temp.tagmanifest_scan")
+
+    if record_events:
+        agents = dbops.agent_ids()
+        now = dbops.timestamp()
+        rows = [{"bag_id": bag_id,
+                 "event_type_code": "TGCMP",
+                 "person_agent_id": agents[0],
+                 "software_agent_id": agents[1],
+                 "end_time": now,
+                 "event_details": ("Comparison of the tagmanifest at " +
+                                   path_root + " with the database."),
+                 "tools_used": "SANCdpd tagmanifest comparison",
+                 "outcome_code": outcome,
+                 "outcome_details": details}
+                for bag_id, outcome, details in outcomes]
+        for i in range(0, len(rows), BAG_BATCH_SIZE):
+            with dbops.transaction() as cur:
+                summary["bag_event_ids"].extend(dbops.insert_bag_events(
+                    cur, rows[i:i + BAG_BATCH_SIZE]))
+
+    lg.log("compare_tagmanifests: Done. " + str(summary["same"]) +
+           " same, " + str(len(summary["changed"])) + " changed, " +
+           str(len(summary["missing"])) + " missing, " +
+           str(len(summary["unregistered"])) + " not registered, " +
+           str(len(summary["errors"])) + " errors.")
+
+    return summary
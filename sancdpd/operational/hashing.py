@@ -0,0 +1,266 @@
+"""
+This module is the one I/O path for computing file digests in SANCdpd.
+Validation, fixity audits, storage migrations, and backups all hash files
+through it.
+
+Every file is read only once, however many digest algorithms are wanted
+(bags often carry both md5 and sha256 manifests), and each block read is
+fed to every hasher.  How a file is read depends on its size:
+  - Small files (up to SMALL_FILE_BYTES) are read with one read call.
+  - Large files (from MMAP_MIN_BYTES) are memory-mapped, and hashed in
+    slices of BUFSIZE bytes, so that no data is copied into Python.
+  - Other files are read into a reusable buffer of BUFSIZE bytes.  When
+    only one algorithm is wanted, hashlib.file_digest() is used instead,
+    where it is available (Python 3.11 and later).
+The hashlib functions release the GIL while they hash a block, so several
+threads can hash files at once, and keep a fast disk busy.  hash_files()
+hashes a list of files with a pool of threads.  Small files are handed to
+the threads in batches, so that the cost of scheduling them does not
+outweigh the cost of hashing them.
+
+The number of threads used by hash_files() can be given directly, or set
+with the optional "hash_threads" key in the config file (default 1, which
+hashes in the calling thread).  Validation and fixity audits already hash
+in several processes; more threads per process help mainly on storage that
+one reader per CPU cannot keep busy, such as NVMe drives or network shares
+with high latency.
+
+These functions only read files.  They do not interact with the SANCdpd
+database, so they can be used from worker processes.
+
+This module contains the following functions:
+    hash_file() :  Compute one or more digests of a file in a single pass
+    hash_files() :  Hash many files with a pool of threads
+    copy_file() :  Copy a file, computing its digests in the same pass
+"""
+
+# Import modules from the Python standard library
+import concurrent.futures    # for the pool of hashing threads
+import hashlib               # for computing file digests
+import mmap                  # for hashing large files
+import os                    # for file sizes
+import threading             # for per-thread buffers
+
+# Import other SANCdpd modules
+import conf
+import metrics
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Size of the blocks read and hashed (a multiple of the page size)
+BUFSIZE = 4 * 1024 * 1024
+
+# Files up to this size are read with one read call
+SMALL_FILE_BYTES = 256 * 1024
+
+# Files of at least this size are memory-mapped
+MMAP_MIN_BYTES = 64 * 1024 * 1024
+
+# Upper limits on a batch of small files handed to one thread
+BATCH_MAX_FILES = 64
+BATCH_MAX_BYTES = 16 * 1024 * 1024
+
+# Per-thread read buffers
+_local = threading.local()
+
+
+###############################################################################
+# function: _buffer
+###############################################################################
+def _buffer():
+    """
+    Returns this thread's read buffer of BUFSIZE bytes, and a memoryview of
+    it.
+    """
+    buf = getattr(_local, "buf", None)
+    if buf is None:
+        buf = bytearray(BUFSIZE)
+        _local.buf = buf
+        _local.view = memoryview(buf)
+    return buf, _local.view
+
+
+###############################################################################
+# function: _hash_mmap
+###############################################################################
+def _hash_mmap(fp, size, hashers):
+    """
+    Hashes an open file of the given size by memory-mapping it, in slices of
+    BUFSIZE bytes.
+    """
+    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mm)
+        try:
+            for start in range(0, size, BUFSIZE):
+                block = view[start:start + BUFSIZE]
+                for h in hashers:
+                    h.update(block)
+                block.release()
+        finally:
+            view.release()
+    return size
+
+
+###############################################################################
+# function: _hash_buffered
+###############################################################################
+def _hash_buffered(fp, hashers):
+    """
+    Hashes an open file by reading it into this thread's buffer.
+    Returns the number of bytes read.
+    """
+    buf, view = _buffer()
+    nbytes = 0
+    while True:
+        n = fp.readinto(buf)
+        if not n:
+            break
+        block = view[:n]
+        for h in hashers:
+            h.update(block)
+        nbytes += n
+    return nbytes
+
+
+###############################################################################
+# function: hash_file
+###############################################################################
+@metrics.timed("hash_file")
+def hash_file(path, algs):
+    """
+    Computes digests of the file at path for every algorithm name in algs,
+    reading the file only once.
+    Returns a pair: a dictionary of algorithm names and lowercase hex digests,
+    and the number of bytes read.
+    """
+    algs = list(algs)
+    with open(path, "rb", buffering=0) as fp:
+        size = os.fstat(fp.fileno()).st_size
+
+        if size <= SMALL_FILE_BYTES:
+            data = fp.read()
+            hashers = [hashlib.new(alg, data) for alg in algs]
+            nbytes = len(data)
+        elif size >= MMAP_MIN_BYTES:
+            hashers = [hashlib.new(alg) for alg in algs]
+            nbytes = _hash_mmap(fp, size, hashers)
+        elif len(algs) == 1 and hasattr(hashlib, "file_digest"):
+            hashers = [hashlib.file_digest(fp, algs[0])]
+            nbytes = size
+        else:
+            hashers = [hashlib.new(alg) for alg in algs]
+            nbytes = _hash_buffered(fp, hashers)
+
+    metrics.count("files_hashed_total")
+    metrics.count("bytes_hashed_total", nbytes)
+    return dict(zip(algs, [h.hexdigest() for h in hashers])), nbytes
+
+
+###############################################################################
+# function: _hash_batch
+###############################################################################
+def _hash_batch(batch):
+    """
+    Runs in a hashing thread.  Hashes each file in a batch of (path, algs)
+    pairs.
+    Returns a list of (digests, nbytes, error) triples, where error is None
+    unless the file could not be read or an algorithm is not supported.
+    """
+    results = []
+    for path, algs in batch:
+        try:
+            digests, nbytes = hash_file(path, algs)
+            results.append((digests, nbytes, None))
+        except (OSError, ValueError) as e:
+            results.append(({}, 0, str(e)))
+    return results
+
+
+###############################################################################
+# function: hash_files
+###############################################################################
+def hash_files(files, threads=None):
+    """
+    Hashes many files.  The files argument is a list of (path, algs) pairs.
+    The number of threads is given by threads, or by the "hash_threads"
+    config key.  Small files are hashed in batches (see the module
+    docstring); larger files are hashed one per task.
+    Returns a list of (digests, nbytes, error) triples, in the order of the
+    files, where error is None unless the file could not be read or an
+    algorithm is not supported.
+    """
+    if threads is None:
+        threads = conf.fconf.get("hash_threads") or 1
+    threads = int(threads)
+    if threads <= 1 or len(files) <= 1:
+        return _hash_batch(files)
+
+    # Group the positions of the files into batches of small files and
+    # single large files
+    batches = []
+    batch = []
+    batchbytes = 0
+    for i, (path, algs) in enumerate(files):
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            size = 0
+        if size > SMALL_FILE_BYTES:
+            batches.append([i])
+            continue
+        batch.append(i)
+        batchbytes += size
+        if len(batch) >= BATCH_MAX_FILES or batchbytes >= BATCH_MAX_BYTES:
+            batches.append(batch)
+            batch = []
+            batchbytes = 0
+    if batch:
+        batches.append(batch)
+
+    # Hash the batches, and put the results back in the order of the files
+    results = [None] * len(files)
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        hashed = pool.map(_hash_batch,
+                          [[files[i] for i in batch] for batch in batches])
+        for batch, batch_results in zip(batches, hashed):
+            for i, r in zip(batch, batch_results):
+                results[i] = r
+    return results
+
+
+###############################################################################
+# function: copy_file
+###############################################################################
+def copy_file(src, dst, algs, throttle=None):
+    """
+    Copies the file at src to dst in user space, computing its digests for
+    every algorithm name in algs from the blocks as they are copied, so that
+    every byte is read only once.  If throttle is given, it is called with
+    the size of each block before the block is written (to limit the rate
+    of copying).
+    Returns a pair: a dictionary of algorithm names and lowercase hex digests,
+    and the number of bytes copied.
+    """
+    algs = list(algs)
+    hashers = [hashlib.new(alg) for alg in algs]
+    buf, view = _buffer()
+    nbytes = 0
+    with open(src, "rb", buffering=0) as sfp, open(dst, "wb") as dfp:
+        while True:
+            n = sfp.readinto(buf)
+            if not n:
+                break
+            if throttle is not None:
+                throttle(n)
+            block = view[:n]
+            for h in hashers:
+                h.update(block)
+            dfp.write(block)
+            nbytes += n
+    metrics.count("bytes_hashed_total", nbytes)
+    return dict(zip(algs, [h.hexdigest() for h in hashers])), nbytes
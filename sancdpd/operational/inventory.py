@@ -0,0 +1,374 @@
+"""
+This module reconciles the bag table with the bags actually found on disk,
+for every storage location in use (or for one storage location).
+
+The inventory walks each storage path_root with os.scandir, which reads the
+file type of each entry from the directory itself, so that only one stat
+call (for bagit.txt) is needed per directory.  A directory is a bag if it
+contains a bagit.txt file, and the walk does not list or descend into bags.
+The walk runs in a pool of threads:  the top levels of the tree are listed
+one directory per task, until there are at least SPLIT_FACTOR subtrees per
+thread, and then each thread walks whole subtrees.  (The system calls
+release the GIL, so the threads keep a network share or a large disk array
+busy.)
+
+The bags found are then joined with the bag table as sets of
+(storage_id, preservation_path || preservation_bag_name) keys, read from
+the database in one query.  Each bag falls into one of these groups:
+    present:  recorded as still existing, and found where it is recorded
+    missing:  recorded as still existing, but not found
+    unexpected:  found, but not recorded at that location
+    moved:  a missing bag whose preservation_bag_name is found at exactly
+        one unexpected location, with the same tagmanifest digest (if one
+        is recorded)
+    reappeared:  recorded as no longer existing, but found where it was
+A storage location whose path_root cannot be read is reported as an error,
+and its bags are not reported as missing.  Likewise, a directory under it
+that cannot be listed is reported as skipped, and the bags recorded in that
+subtree are left out of the missing and moved bags (and so are not changed
+by an update), since the walk cannot tell whether they are there.
+
+If update is True, the bag table is corrected in one transaction:
+still_exists is set to false for missing bags and to true for bags that
+reappeared, and moved bags get their new storage_id and preservation_path.
+A "Metadata update" (MDUPD) event is recorded for each bag changed.
+
+The number of threads can be given directly, or set with the optional
+"inventory_threads" key in the config file (default INVENTORY_THREADS).
+
+This module contains the following functions:
+    walk_storage() :  Find all bags under a path_root with a pool of threads
+    reconcile_inventory() :  Compare the bag table with the bags on disk
+"""
+
+# Import modules from the Python standard library
+import concurrent.futures    # for the pool of walking threads
+import os                    # for scandir calls
+import os.path               # for building paths
+import time                  # for measuring throughput
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+import dbops
+import metrics
+import operational.bagit as bagit
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Default number of threads walking a storage location
+INVENTORY_THREADS = 16
+
+# Number of subtrees per thread to split the top of the tree into
+SPLIT_FACTOR = 4
+
+
+###############################################################################
+# function: _list_dir
+###############################################################################
+def _list_dir(path_root, parts):
+    """
+    Lists the directory at parts (a tuple of names) under path_root, unless
+    it is a bag.
+    Returns a triple:  whether the directory is a bag, the names of its
+    subdirectories (empty for a bag), and an error message or None.
+    """
+    absdir = os.path.join(path_root, *parts)
+    if parts and os.path.exists(os.path.join(absdir, "bagit.txt")):
+        return True, [], None
+    try:
+        with os.scandir(absdir) as it:
+            names = [e.name for e in it if e.is_dir(follow_symlinks=False)]
+    except OSError as e:
+        return False, [], "Cannot read " + absdir + ": " + str(e)
+    metrics.count("dirs_walked_total")
+    return False, names, None
+
+
+###############################################################################
+# function: _walk_subtree
+###############################################################################
+def _walk_subtree(path_root, top):
+    """
+    Runs in a walking thread.  Walks the subtree at top (a tuple of names)
+    under path_root.
+    Returns a triple:  the relative paths of the bags found, the number of
+    directories listed, and a list of (relative path, error message) pairs
+    for the directories that could not be listed.
+    """
+    bags = []
+    skipped = []
+    ndirs = 0
+    stack = [top]
+    while stack:
+        parts = stack.pop()
+        is_bag, names, error = _list_dir(path_root, parts)
+        ndirs += 1
+        if error is not None:
+            skipped.append(("/".join(parts), error))
+        elif is_bag:
+            bags.append("/".join(parts))
+        else:
+            stack.extend(parts + (name,) for name in names)
+    return bags, ndirs, skipped
+
+
+###############################################################################
+# function: walk_storage
+###############################################################################
+@metrics.timed("walk_storage")
+def walk_storage(path_root, threads=None):
+    """
+    Finds all bags under path_root, with a pool of threads (see the module
+    docstring).  The number of threads is given by threads, or by the
+    "inventory_threads" config key.
+    Returns a triple:  a set of the relative paths of the bags (with "/"
+    separators), the number of directories listed, and a list of (relative
+    path, error message) pairs for the directories that could not be read,
+    whose subtrees were skipped ("" for path_root itself).
+    """
+    if threads is None:
+        threads = conf.fconf.get("inventory_threads") or INVENTORY_THREADS
+    threads = max(1, int(threads))
+
+    bags = set()
+    skipped = []
+    ndirs = 0
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        # List the top levels one directory per task, until there are
+        # enough subtrees to keep every thread busy
+        frontier = [()]
+        while frontier and len(frontier) < threads * SPLIT_FACTOR:
+            listed = pool.map(lambda p: _list_dir(path_root, p), frontier)
+            children = []
+            for parts, (is_bag, names, error) in zip(frontier, listed):
+                ndirs += 1
+                if error is not None:
+                    skipped.append(("/".join(parts), error))
+                elif is_bag:
+                    bags.add("/".join(parts))
+                else:
+                    children.extend(parts + (name,) for name in names)
+            frontier = children
+
+        # Then walk whole subtrees, one per task
+        for found, n, skips in pool.map(
+                lambda p: _walk_subtree(path_root, p), frontier):
+            bags.update(found)
+            ndirs += n
+            skipped.extend(skips)
+
+    return bags, ndirs, skipped
+
+
+###############################################################################
+# function: _under
+###############################################################################
+def _under(relpath, prefixes):
+    """
+    Tells whether relpath lies in the subtree of any of the relative paths
+    in prefixes ("" is the whole storage location).
+    """
+    return any(p == "" or relpath == p or relpath.startswith(p + "/")
+               for p in prefixes)
+
+
+###############################################################################
+# function: _same_bag
+###############################################################################
+def _same_bag(bagdir, digest):
+    """
+    Tells whether the bag at bagdir has a tagmanifest with the given
+    canonical digest.  A bag with no recorded digest matches any bag.
+    """
+    if digest is None:
+        return True
+    try:
+        path = bagit.strongest_tagmanifest(bagdir)
+        if path is None:
+            return False
+        with open(path, "r", encoding="utf-8-sig") as fp:
+            return bagit.manifest_digest(fp.read()) == digest
+    except OSError:
+        return False
+
+
+###############################################################################
+# function: reconcile_inventory
+###############################################################################
+def reconcile_inventory(storage_id=None, update=False, threads=None):
+    """
+    Walks every storage location in use (or only the one with storage_id),
+    and compares the bags found with the bag table (see the module
+    docstring).
+    If update is True, corrects still_exists for missing bags and bags that
+    reappeared, and the location of moved bags, in one transaction, with
+    an MDUPD event for each bag changed.  Bags recorded in subtrees that
+    could not be read are listed under "skipped", and are not changed.
+    Returns a dictionary summarizing the run.
+    """
+    start = time.perf_counter()
+    con = dbops.connect()
+
+    if storage_id is None:
+        qstr = """SELECT storage_id, path_root FROM storage WHERE in_use
+                  ORDER BY storage_id"""
+        storages = con.execute(qstr).fetchall()
+    else:
+        qstr = "SELECT storage_id, path_root FROM storage WHERE storage_id = ?"
+        storages = con.execute(qstr, (storage_id,)).fetchall()
+        if not storages:
+            raise Exception("No storage location with ID " + str(storage_id))
+    roots = dict(storages)
+
+    summary = {"storages": len(storages), "dirs": 0, "bags_found": 0,
+               "bags_recorded": 0, "present": 0, "missing": [],
+               "unexpected": [], "moved": [], "reappeared": [], "errors": [],
+               "skipped": [], "updated": 0, "bag_event_ids": []}
+
+    # Walk each storage location
+    found = set()
+    walked = []
+    unread = {}
+    for sid, path_root in storages:
+        if not os.path.isdir(path_root):
+            summary["errors"].append({"storage_id": sid,
+                                      "error": "Cannot read " + path_root})
+            lg.log("reconcile_inventory: Skipping storage " + str(sid) +
+                   ": cannot read " + path_root)
+            continue
+        bags, ndirs, skipped = walk_storage(path_root, threads)
+        lg.log("reconcile_inventory: Found " + str(len(bags)) + " bags in " +
+               str(ndirs) + " directories under " + path_root)
+        for relpath, error in skipped:
+            lg.log("reconcile_inventory: Skipping " + path_root + relpath +
+                   ": " + error)
+        found.update((sid, relpath) for relpath in bags)
+        summary["dirs"] += ndirs
+        summary["skipped"].extend({"storage_id": sid, "path": relpath,
+                                   "error": error}
+                                  for relpath, error in skipped)
+        unread[sid] = [relpath for relpath, error in skipped]
+        walked.append(sid)
+    summary["bags_found"] = len(found)
+
+    # Bags recorded at the storage locations walked
+    recorded = {}
+    if walked:
+        qstr = ("""SELECT storage_id,
+                          preservation_path || preservation_bag_name,
+                          bag_id, still_exists, preservation_bag_name,
+                          tagmanifest_digest
+                   FROM bag
+                   WHERE storage_id IN (""" +
+                ", ".join(["?"] * len(walked)) + ")")
+        for sid, relpath, bag_id, exists, name, digest in con.execute(
+                qstr, walked):
+            recorded[(sid, relpath)] = (bag_id, bool(exists), name, digest)
+    summary["bags_recorded"] = len(recorded)
+
+    # Join the two sets
+    existing = set(k for k, v in recorded.items() if v[1])
+    summary["present"] = len(existing & found)
+    # Bags in subtrees that could not be read are neither found nor missing
+    missing = sorted(k for k in existing - found
+                     if not _under(k[1], unread[k[0]]))
+    unexpected = sorted(found - set(recorded))
+    reappeared = sorted(k for k in found & set(recorded)
+                        if not recorded[k][1])
+
+    # A missing bag has moved if its name is found at exactly one
+    # unexpected location, with the same tagmanifest
+    by_name = {}
+    for key in unexpected:
+        by_name.setdefault(key[1].rsplit("/", 1)[-1], []).append(key)
+    moved = {}
+    for key in missing:
+        bag_id, exists, name, digest = recorded[key]
+        candidates = by_name.get(name, [])
+        if len(candidates) == 1 and candidates[0] not in moved.values() \
+                and _same_bag(os.path.join(roots[candidates[0][0]],
+                                           candidates[0][1]), digest):
+            moved[key] = candidates[0]
+
+    for key in missing:
+        if key in moved:
+            new = moved[key]
+            summary["moved"].append({"bag_id": recorded[key][0],
+                                     "from_storage_id": key[0],
+                                     "from_path": key[1],
+                                     "storage_id": new[0], "path": new[1]})
+        else:
+            summary["missing"].append({"bag_id": recorded[key][0],
+                                       "storage_id": key[0], "path": key[1]})
+    claimed = set(moved.values())
+    summary["unexpected"] = [{"storage_id": k[0], "path": k[1]}
+                             for k in unexpected if k not in claimed]
+    summary["reappeared"] = [{"bag_id": recorded[k][0], "storage_id": k[0],
+                              "path": k[1]} for k in reappeared]
+
+    # Correct the bag table in one transaction
+    if update and (summary["missing"] or summary["moved"] or
+                   summary["reappeared"]):
+        agents = dbops.agent_ids()
+        now = dbops.timestamp()
+        eventrows = []
+
+        def event(bag_id, details):
+            eventrows.append({"bag_id": bag_id,
+                              "event_type_code": "MDUPD",
+                              "person_agent_id": agents[0],
+                              "software_agent_id": agents[1],
+                              "end_time": now,
+                              "event_details": details,
+                              "tools_used": "SANCdpd inventory",
+                              "outcome_code": "SUCC"})
+
+        existsrows = []
+        for b in summary["missing"]:
+            existsrows.append((False, b["bag_id"]))
+            event(b["bag_id"], "Inventory reconciliation: bag not found at " +
+                  roots[b["storage_id"]] + b["path"] +
+                  "; still_exists set to false.")
+        for b in summary["reappeared"]:
+            existsrows.append((True, b["bag_id"]))
+            event(b["bag_id"], "Inventory reconciliation: bag found at " +
+                  roots[b["storage_id"]] + b["path"] +
+                  "; still_exists set to true.")
+        moverows = []
+        for b in summary["moved"]:
+            moverows.append((b["storage_id"],
+                             b["path"][:b["path"].rfind("/") + 1],
+                             b["bag_id"]))
+            event(b["bag_id"], "Inventory reconciliation: bag moved from " +
+                  roots[b["from_storage_id"]] + b["from_path"] + " to " +
+                  roots[b["storage_id"]] + b["path"] +
+                  "; storage_id and preservation_path updated.")
+
+        with dbops.transaction() as cur:
+            cur.executemany("UPDATE bag SET still_exists = ? " +
+                            "WHERE bag_id = ?", existsrows)
+            cur.executemany("UPDATE bag SET storage_id = ?, " +
+                            "preservation_path = ? WHERE bag_id = ?",
+                            moverows)
+            summary["bag_event_ids"] = dbops.insert_bag_events(cur, eventrows)
+        summary["updated"] = len(eventrows)
+
+    seconds = time.perf_counter() - start
+    summary["seconds"] = round(seconds, 3)
+    summary["dirs_per_sec"] = round(summary["dirs"] / seconds, 1) \
+        if seconds else 0
+
+    lg.log("reconcile_inventory: Done. " + str(summary["present"]) +
+           " present, " + str(len(summary["missing"])) + " missing, " +
+           str(len(summary["unexpected"])) + " unexpected, " +
+           str(len(summary["moved"])) + " moved, " +
+           str(len(summary["reappeared"])) + " reappeared, " +
+           str(len(summary["skipped"])) + " directories skipped; " +
+           str(summary["updated"]) + " bags updated, in " +
+           str(summary["seconds"]) + " s.")
+
+    return summary
@@ -0,0 +1,300 @@
+"""
+This module answers lineage questions about bags:  the ancestors of a bag
+(its parents, their parents, and so on, through bag_has_parent_bag), its
+descendants, and the other members of its bag family.
+
+Lineage lookups have two backends:
+  - "cte":  recursive common table expressions, run by SQLite.  These rely
+    on the primary key of bag_has_parent_bag (for child-to-parent steps) and
+    on the idx_bag_has_parent_bag_parent index (for parent-to-child steps).
+    Batch lookups pass all the starting bags to one query as a JSON array.
+  - "index":  an in-memory adjacency index of the whole lineage graph and of
+    the family-to-members map, loaded with two table scans.  The index is
+    reloaded automatically when bag_has_parent_bag, or the bag_id or
+    bag_family_id of the bag table, has changed since it was loaded, by any
+    connection.  (Triggers raise the versions of those tables in the
+    table_version table; see schema.LINEAGE_VERSIONED.)  Other writes, such
+    as recording events, do not cause a reload.
+With the default backend, "auto", single lookups and small batches use the
+CTE backend (unless the index is already loaded), and batches of more than
+INDEX_THRESHOLD bags use the index.
+
+Every lookup returns sets of bag_id values.  A bag is never its own ancestor
+or descendant, and cycles in bad data do not cause infinite loops.
+
+This module contains the following functions:
+    ancestors() :  Ancestors of one bag
+    descendants() :  Descendants of one bag
+    family() :  Members of the family of one bag
+    lineage_many() :  Ancestors, descendants, or family of many bags at once
+    load_index() :  Load (or reload) the in-memory adjacency index
+    clear_index() :  Discard the in-memory adjacency index
+    show_lineage() :  Look up lineage of bags, with results for the CLI
+"""
+
+# Import modules from the Python standard library
+import json                  # for passing bag IDs to batch queries
+import sqlite3 as sq         # for recognizing an older schema
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+import dbops
+
+
+###############################################################################
+# Global (for this module) data structures
+###############################################################################
+
+# Batches larger than this use the in-memory index with the "auto" backend
+INDEX_THRESHOLD = 100
+
+# The in-memory adjacency index:
+#    _parents:  child bag_id -> list of parent bag_ids
+#    _children:  parent bag_id -> list of child bag_ids
+#    _family_of:  bag_id -> bag_family_id
+#    _members:  bag_family_id -> list of bag_ids
+_parents = {}
+_children = {}
+_family_of = {}
+_members = {}
+
+# The versions of the lineage tables when the index was loaded, or None if
+# it is not loaded
+_index_state = None
+
+# Query returning the versions of the tables in the index.  Versions only
+# increase, so their sum changes whenever either table changes.
+VERSION_QUERY = """
+    SELECT sum(version) FROM table_version
+    WHERE table_name IN ('bag_has_parent_bag', 'bag')"""
+
+# Recursive queries for the CTE backend.  Each takes a JSON array of starting
+# bag IDs and returns (start bag_id, related bag_id) pairs.
+CTE_QUERIES = {
+"ancestors": """
+    WITH RECURSIVE seed(root) AS (SELECT value FROM json_each(?)),
+    walk(root, bag_id) AS (
+        SELECT s.root, p.parent_bag_id
+        FROM seed s
+        JOIN bag_has_parent_bag p ON p.child_bag_id = s.root
+        UNION
+        SELECT w.root, p.parent_bag_id
+        FROM walk w
+        JOIN bag_has_parent_bag p ON p.child_bag_id = w.bag_id)
+    SELECT root, bag_id FROM walk WHERE bag_id != root""",
+"descendants": """
+    WITH RECURSIVE seed(root) AS (SELECT value FROM json_each(?)),
+    walk(root, bag_id) AS (
+        SELECT s.root, p.child_bag_id
+        FROM seed s
+        JOIN bag_has_parent_bag p ON p.parent_bag_id = s.root
+        UNION
+        SELECT w.root, p.child_bag_id
+        FROM walk w
+        JOIN bag_has_parent_bag p ON p.parent_bag_id = w.bag_id)
+    SELECT root, bag_id FROM walk WHERE bag_id != root""",
+"family": """
+    WITH seed(root) AS (SELECT value FROM json_each(?))
+    SELECT s.root, m.bag_id
+    FROM seed s
+    JOIN bag b ON b.bag_id = s.root
+    JOIN bag m ON m.bag_family_id = b.bag_family_id"""
+}
+
+
+###############################################################################
+# function: _lineage_version
+###############################################################################
+def _lineage_version(con):
+    """
+    Returns a value that changes whenever the lineage of bags has been
+    changed, by this connection or any other, or None if the database has
+    no table_version table (before schema version 10).
+    """
+    try:
+        return con.execute(VERSION_QUERY).fetchone()[0]
+    except sq.OperationalError:
+        return None
+
+
+###############################################################################
+# function: load_index
+###############################################################################
+def load_index():
+    """
+    Loads the in-memory adjacency index and family map from the database,
+    replacing any index already loaded.
+    """
+    global _index_state
+
+    con = dbops.connect()
+    # Read the version first, so that a change made while loading is seen
+    # by the next lookup
+    version = _lineage_version(con)
+    _parents.clear()
+    _children.clear()
+    _family_of.clear()
+    _members.clear()
+
+    qstr = "SELECT child_bag_id, parent_bag_id FROM bag_has_parent_bag"
+    for child, parent in con.execute(qstr):
+        _parents.setdefault(child, []).append(parent)
+        _children.setdefault(parent, []).append(child)
+
+    qstr = "SELECT bag_id, bag_family_id FROM bag"
+    for bag_id, family_id in con.execute(qstr):
+        _family_of[bag_id] = family_id
+        _members.setdefault(family_id, []).append(bag_id)
+
+    _index_state = version
+
+    lg.log("lineage: Loaded index of " + str(len(_family_of)) + " bags, " +
+           str(sum(len(v) for v in _parents.values())) + " parent links, " +
+           str(len(_members)) + " families.")
+
+
+###############################################################################
+# function: clear_index
+###############################################################################
+def clear_index():
+    """
+    Discards the in-memory index, so that the next index lookup loads it
+    again.  This is needed when the connection is closed and reopened on
+    another database file, since the versions of its lineage tables could
+    happen to match the old one's.
+    """
+    global _index_state
+
+    _parents.clear()
+    _children.clear()
+    _family_of.clear()
+    _members.clear()
+    _index_state = None
+
+
+###############################################################################
+# function: _ensure_index
+###############################################################################
+def _ensure_index():
+    """
+    Loads the index if it is not loaded or the lineage tables have changed.
+    """
+    version = _lineage_version(dbops.connect())
+    if version is None or version != _index_state:
+        load_index()
+
+
+###############################################################################
+# function: _walk
+###############################################################################
+def _walk(adjacency, bag_id):
+    """
+    Returns the set of bags reachable from bag_id in the adjacency map,
+    not including bag_id itself.
+    """
+    found = set()
+    stack = list(adjacency.get(bag_id, ()))
+    while stack:
+        b = stack.pop()
+        if b not in found and b != bag_id:
+            found.add(b)
+            stack.extend(adjacency.get(b, ()))
+    return found
+
+
+###############################################################################
+# function: _index_lookup
+###############################################################################
+def _index_lookup(relation, bag_id):
+    """
+    Looks up one relation ("ancestors", "descendants", or "family") of a bag
+    in the in-memory index.
+    """
+    if relation == "ancestors":
+        return _walk(_parents, bag_id)
+    if relation == "descendants":
+        return _walk(_children, bag_id)
+    if bag_id not in _family_of:
+        return set()
+    return set(_members[_family_of[bag_id]])
+
+
+###############################################################################
+# function: lineage_many
+###############################################################################
+def lineage_many(bag_ids, relation, backend="auto"):
+    """
+    Looks up one relation ("ancestors", "descendants", or "family") for many
+    bags in one pass.
+    Returns a dictionary whose keys are the given bag IDs and whose values
+    are sets of related bag IDs.
+    The backend is "cte", "index", or "auto" (see the module docstring).
+    """
+    if relation not in CTE_QUERIES:
+        raise Exception("Unknown lineage relation: " + str(relation))
+    bag_ids = [int(b) for b in bag_ids]
+
+    if backend == "auto":
+        if len(bag_ids) > INDEX_THRESHOLD or _index_state is not None:
+            backend = "index"
+        else:
+            backend = conf.fconf.get("lineage_backend", "cte")
+
+    result = dict((b, set()) for b in bag_ids)
+    if backend == "index":
+        _ensure_index()
+        for b in bag_ids:
+            result[b] = _index_lookup(relation, b)
+    elif backend == "cte":
+        con = dbops.connect()
+        for root, bag_id in con.execute(CTE_QUERIES[relation],
+                                        (json.dumps(bag_ids),)):
+            result[root].add(bag_id)
+    else:
+        raise Exception("Unknown lineage backend: " + str(backend))
+
+    return result
+
+
+###############################################################################
+# function: ancestors
+###############################################################################
+def ancestors(bag_id, backend="auto"):
+    """
+    Returns the set of IDs of all ancestors of a bag.
+    """
+    return lineage_many([bag_id], "ancestors", backend)[int(bag_id)]
+
+
+###############################################################################
+# function: descendants
+###############################################################################
+def descendants(bag_id, backend="auto"):
+    """
+    Returns the set of IDs of all descendants of a bag.
+    """
+    return lineage_many([bag_id], "descendants", backend)[int(bag_id)]
+
+
+###############################################################################
+# function: family
+###############################################################################
+def family(bag_id, backend="auto"):
+    """
+    Returns the set of IDs of all bags in the same family as a bag
+    (including the bag itself).
+    """
+    return lineage_many([bag_id], "family", backend)[int(bag_id)]
+
+
+###############################################################################
+# function: show_lineage
+###############################################################################
+def show_lineage(bag_ids, relation="ancestors", backend="auto"):
+    """
+    Looks up a relation for a list of bags, for the CLI.
+    Returns a dictionary of bag IDs to sorted lists of related bag IDs.
+    """
+    found = lineage_many(bag_ids, relation, backend)
+    return dict((b, sorted(found[b])) for b in found)
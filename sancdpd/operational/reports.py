@@ -0,0 +1,430 @@
+"""
+This module exports reports of bag events, for audits, as CSV, JSON lines,
+or PREMIS XML files, optionally compressed with gzip.
+
+A report can cover millions of bag_event rows.  The rows are streamed:
+they are read from the read-only connection with fetchmany, FETCH_ROWS at a
+time, and each row is written out before the next batch is read, so memory
+use does not grow with the size of the report.  The events are joined in
+SQL with their bags, collections, event types, and outcomes; their agents
+are looked up in the reference-data cache (see the refdata module).
+
+The format is given by the extension of the output file (".csv", ".jsonl",
+or ".xml", each optionally followed by ".gz" for gzip compression), or by
+the format argument.  The file is written under a temporary name, and
+renamed when it is complete, so that an interrupted export never leaves a
+partial report behind.
+
+A PREMIS report holds one representation object for each bag with events
+in the report, then the events, then the agents linked to them, as the
+PREMIS schema requires.  The objects are written by a first pass over the
+matching events, and the events by a second; only the IDs of the agents are
+kept in memory between them.  Both passes run in one read transaction, so
+that they see the same snapshot of the database:  every event written
+links to an object written, even if events are recorded meanwhile.  The
+XML is written element by element with xml.sax.saxutils.XMLGenerator.
+
+Events can be filtered by storage location, by a range of end times, by
+event type, and by records collection (its SANC bib record ID).  Progress
+is printed to standard error (so that it does not mix with --json output)
+and logged every PROGRESS_SECONDS seconds.
+
+This module contains the following functions:
+    export_events() :  Export the events matching the filters to a file
+"""
+
+# Import modules from the Python standard library
+import csv                   # for writing CSV reports
+import datetime as dt        # for checking the date range
+import gzip                  # for compressed reports
+import json                  # for writing JSON lines reports
+import os                    # for renaming complete reports
+import os.path               # for checking the output file
+import sys                   # for progress output
+import time                  # for progress and throughput
+import xml.sax.saxutils      # for writing PREMIS XML incrementally
+
+# Import other SANCdpd modules
+import logger as lg
+import dbops
+import refdata
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Number of rows read from the database at a time
+FETCH_ROWS = 5000
+
+# Minimum number of seconds between progress reports
+PROGRESS_SECONDS = 5.0
+
+# Compression level of gzip files (lower is faster)
+GZIP_LEVEL = 6
+
+# Report formats, by file extension
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".xml": "premis"}
+
+# Columns of the CSV and JSON lines reports
+COLUMNS = ("bag_event_id", "bag_id", "preservation_bag_name", "storage_id",
+           "SANC_bib_record_id", "event_type_code", "event_name",
+           "start_time", "end_time", "outcome_code", "outcome_name",
+           "person_agent", "software_agent", "hardware_agent",
+           "organization_agent", "event_details", "tools_used",
+           "outcome_details")
+
+# Roles of the agents of an event, and their PREMIS linkingAgentRole terms
+AGENT_ROLES = (("person", "implementer"),
+               ("software", "executing program"),
+               ("hardware", "executing hardware"),
+               ("organization", "responsible organization"))
+
+# PREMIS agentType terms, by agent_type_code
+AGENT_TYPES = {"PERSN": "person", "SOFTW": "software",
+               "HARDW": "hardware", "ORGZN": "organization"}
+
+# PREMIS namespaces
+PREMIS_NS = "http://www.loc.gov/premis/v3"
+XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
+PREMIS_XSD = "https://www.loc.gov/standards/premis/premis.xsd"
+
+
+###############################################################################
+# function: _bound
+###############################################################################
+def _bound(value, field, end):
+    """
+    Checks a date or timestamp given as a filter, and returns it as a
+    timestamp in the database format.  A date alone means the start of the
+    day, or the end of the day if end is True.
+    """
+    try:
+        t = dt.datetime.fromisoformat(value)
+    except ValueError:
+        raise Exception("Invalid " + field + ": " + value)
+    if len(value) == 10 and end:
+        t = t.replace(hour=23, minute=59, second=59)
+    return t.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+###############################################################################
+# function: _filters
+###############################################################################
+def _filters(storage_id, start_date, end_date, event_type_code,
+             bib_record_id):
+    """
+    Builds the WHERE clause and its arguments for the filters of a report,
+    on bag_event e and bag b.
+    """
+    where = []
+    args = []
+    if storage_id is not None:
+        where.append("b.storage_id = ?")
+        args.append(int(storage_id))
+    if start_date:
+        where.append("e.end_time >= ?")
+        args.append(_bound(start_date, "start_date", False))
+    if end_date:
+        where.append("e.end_time <= ?")
+        args.append(_bound(end_date, "end_date", True))
+    if event_type_code:
+        if refdata.event_type(event_type_code) is None:
+            raise Exception("Unknown event type: " + event_type_code)
+        where.append("e.event_type_code = ?")
+        args.append(event_type_code)
+    if bib_record_id:
+        qstr = """SELECT records_collection_id FROM records_collection
+                  WHERE SANC_bib_record_id = ?"""
+        row = dbops.readonly().execute(qstr, (bib_record_id,)).fetchone()
+        if row is None:
+            raise Exception("No records collection with bib record ID " +
+                            bib_record_id)
+        where.append("b.records_collection_id = ?")
+        args.append(row[0])
+    return (" WHERE " + " AND ".join(where) if where else ""), args
+
+
+###############################################################################
+# function: _stream
+###############################################################################
+def _stream(qstr, args):
+    """
+    Runs a query on the read-only connection, and yields its rows, reading
+    FETCH_ROWS rows at a time.
+    """
+    cur = dbops.readonly().cursor()
+    try:
+        cur.arraysize = FETCH_ROWS
+        cur.execute(qstr, args)
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cur.close()
+
+
+###############################################################################
+# function: _events
+###############################################################################
+def _events(where, args, agent_ids):
+    """
+    Yields the events matching a WHERE clause, in the order of their IDs,
+    as dictionaries with the keys of COLUMNS, plus the agent IDs and the
+    event type's LC term.  Adds the IDs of their agents to agent_ids.
+    """
+    qstr = """SELECT e.bag_event_id, e.bag_id, b.preservation_bag_name,
+                     b.storage_id, rc.SANC_bib_record_id,
+                     e.event_type_code, t.event_name, t.LC_event_term,
+                     e.start_time, e.end_time,
+                     e.outcome_code, o.outcome_name,
+                     e.person_agent_id, e.software_agent_id,
+                     e.hardware_agent_id, e.organization_agent_id,
+                     e.event_details, e.tools_used, e.outcome_details
+              FROM bag_event e
+              JOIN bag b ON b.bag_id = e.bag_id
+              JOIN records_collection rc
+                ON rc.records_collection_id = b.records_collection_id
+              JOIN event_type t ON t.event_type_code = e.event_type_code
+              JOIN event_type_outcome o
+                ON o.event_type_code = e.event_type_code
+               AND o.outcome_code = e.outcome_code""" + where + """
+              ORDER BY e.bag_event_id"""
+    for r in _stream(qstr, args):
+        event = {"bag_event_id": r[0], "bag_id": r[1],
+                 "preservation_bag_name": r[2], "storage_id": r[3],
+                 "SANC_bib_record_id": r[4], "event_type_code": r[5],
+                 "event_name": r[6], "LC_event_term": r[7],
+                 "start_time": r[8], "end_time": r[9],
+                 "outcome_code": r[10], "outcome_name": r[11],
+                 "event_details": r[16], "tools_used": r[17],
+                 "outcome_details": r[18]}
+        for (role, term), agent_id in zip(AGENT_ROLES, r[12:16]):
+            event[role + "_agent_id"] = agent_id
+            agent = refdata.agent_by_id(agent_id) if agent_id else None
+            event[role + "_agent"] = agent["agent_name"] if agent else None
+            if agent_id:
+                agent_ids.add(agent_id)
+        yield event
+
+
+###############################################################################
+# function: _write_csv
+###############################################################################
+def _write_csv(fp, where, args, progress):
+    """
+    Writes the events matching a WHERE clause to an open file as CSV, with a
+    header row.
+    """
+    writer = csv.writer(fp)
+    writer.writerow(COLUMNS)
+    for event in _events(where, args, set()):
+        writer.writerow([event[c] for c in COLUMNS])
+        progress()
+
+
+###############################################################################
+# function: _write_jsonl
+###############################################################################
+def _write_jsonl(fp, where, args, progress):
+    """
+    Writes the events matching a WHERE clause to an open file as JSON lines,
+    one object per event.
+    """
+    for event in _events(where, args, set()):
+        fp.write(json.dumps(dict((c, event[c]) for c in COLUMNS)) + "\n")
+        progress()
+
+
+###############################################################################
+# function: _element
+###############################################################################
+def _element(xg, name, children=None, text=None, attrs=None):
+    """
+    Writes a PREMIS element with the XMLGenerator xg:  either text, or child
+    elements given as a list of (name, children, text) triples.  Child
+    elements whose text is None are left out.
+    """
+    xg.startElement("premis:" + name, attrs or {})
+    if text is not None:
+        xg.characters(str(text))
+    for child in children or []:
+        if child[1] is None and child[2] is None:
+            continue
+        _element(xg, *child)
+    xg.endElement("premis:" + name)
+
+
+###############################################################################
+# function: _write_premis
+###############################################################################
+def _write_premis(fp, where, args, progress):
+    """
+    Writes the events matching a WHERE clause to an open file as a PREMIS
+    document (see the module docstring).
+    """
+    # One snapshot for the object pass and the event pass
+    con = dbops.readonly()
+    con.execute("BEGIN")
+    try:
+        _write_premis_passes(fp, where, args, progress)
+    finally:
+        con.execute("COMMIT")
+
+
+###############################################################################
+# function: _write_premis_passes
+###############################################################################
+def _write_premis_passes(fp, where, args, progress):
+    """
+    Writes the PREMIS document for _write_premis(), inside its read
+    transaction.
+    """
+    xg = xml.sax.saxutils.XMLGenerator(fp, "utf-8", short_empty_elements=True)
+    xg.startDocument()
+    xg.startElement("premis:premis", {
+        "xmlns:premis": PREMIS_NS, "xmlns:xsi": XSI_NS,
+        "xsi:schemaLocation": PREMIS_NS + " " + PREMIS_XSD,
+        "version": "3.0"})
+    fp.write("\n")
+
+    # Objects:  the bags with events in the report
+    qstr = """SELECT b.bag_id, b.preservation_bag_name FROM bag b
+              WHERE b.bag_id IN (SELECT e.bag_id FROM bag_event e
+                                 JOIN bag b ON b.bag_id = e.bag_id""" + \
+        where + """)
+              ORDER BY b.bag_id"""
+    for bag_id, name in _stream(qstr, args):
+        _element(xg, "object", [
+            ("objectIdentifier", [
+                ("objectIdentifierType", None, "SANCdpd bag_id"),
+                ("objectIdentifierValue", None, bag_id)], None),
+            ("originalName", None, name)],
+            attrs={"xsi:type": "premis:representation"})
+        fp.write("\n")
+
+    # Events
+    agent_ids = set()
+    for e in _events(where, args, agent_ids):
+        children = [
+            ("eventIdentifier", [
+                ("eventIdentifierType", None, "SANCdpd bag_event_id"),
+                ("eventIdentifierValue", None, e["bag_event_id"])], None),
+            ("eventType", None, e["LC_event_term"] or e["event_name"]),
+            ("eventDateTime", None, e["end_time"])]
+        for label, key in (("", "event_details"),
+                           ("Tools used: ", "tools_used")):
+            if e[key]:
+                children.append(("eventDetailInformation", [
+                    ("eventDetail", None, label + e[key])], None))
+        outcome = [("eventOutcome", None, e["outcome_name"])]
+        if e["outcome_details"]:
+            outcome.append(("eventOutcomeDetail", [
+                ("eventOutcomeDetailNote", None, e["outcome_details"])],
+                None))
+        children.append(("eventOutcomeInformation", outcome, None))
+        for role, term in AGENT_ROLES:
+            if e[role + "_agent_id"]:
+                children.append(("linkingAgentIdentifier", [
+                    ("linkingAgentIdentifierType", None, "SANCdpd agent_id"),
+                    ("linkingAgentIdentifierValue", None,
+                     e[role + "_agent_id"]),
+                    ("linkingAgentRole", None, term)], None))
+        children.append(("linkingObjectIdentifier", [
+            ("linkingObjectIdentifierType", None, "SANCdpd bag_id"),
+            ("linkingObjectIdentifierValue", None, e["bag_id"])], None))
+        _element(xg, "event", children)
+        fp.write("\n")
+        progress()
+
+    # Agents linked to the events
+    for agent_id in sorted(agent_ids):
+        agent = refdata.agent_by_id(agent_id)
+        _element(xg, "agent", [
+            ("agentIdentifier", [
+                ("agentIdentifierType", None, "SANCdpd agent_id"),
+                ("agentIdentifierValue", None, agent_id)], None),
+            ("agentName", None, agent["agent_name"]),
+            ("agentType", None, AGENT_TYPES.get(agent["agent_type_code"],
+                                                agent["agent_type_code"])),
+            ("agentVersion", None, agent["agent_version"])])
+        fp.write("\n")
+
+    xg.endElement("premis:premis")
+    xg.endDocument()
+
+
+###############################################################################
+# function: export_events
+###############################################################################
+def export_events(output, format=None, storage_id=None, start_date=None,
+                  end_date=None, event_type_code=None, bib_record_id=None,
+                  overwrite=False, progress=True):
+    """
+    Exports the bag events matching the filters to the file at output, as
+    CSV, JSON lines, or PREMIS XML ("csv", "jsonl", or "premis"), streaming
+    the rows (see the module docstring).  The format is taken from the
+    extension of output unless it is given, and the file is compressed with
+    gzip if output ends with ".gz".  The date range (start_date to end_date,
+    inclusive) applies to the end times of the events.
+    If progress is True, the number of events written so far is printed to
+    standard error every PROGRESS_SECONDS seconds.
+    Returns a dictionary summarizing the export.
+    """
+    compress = output.endswith(".gz")
+    ext = os.path.splitext(output[:-3] if compress else output)[1].lower()
+    format = format or FORMATS.get(ext)
+    writers = {"csv": _write_csv, "jsonl": _write_jsonl,
+               "premis": _write_premis}
+    if format not in writers:
+        raise Exception("Unknown report format for " + output + ".  Use " +
+                        ", ".join(FORMATS) + " (optionally with .gz), or " +
+                        "give the format: " + ", ".join(writers))
+    if os.path.exists(output) and not overwrite:
+        raise Exception("Report file already exists: " + output)
+
+    refdata.refresh()
+    where, args = _filters(storage_id, start_date, end_date, event_type_code,
+                           bib_record_id)
+
+    start = time.perf_counter()
+    state = {"events": 0, "next": start + PROGRESS_SECONDS}
+
+    def count():
+        state["events"] += 1
+        if state["events"] % 1000 == 0 and time.perf_counter() >= \
+                state["next"]:
+            state["next"] = time.perf_counter() + PROGRESS_SECONDS
+            message = ("export_events: " + str(state["events"]) +
+                       " events written to " + output + ".")
+            lg.log(message)
+            if progress:
+                sys.stderr.write("   " + message + "\n")
+                sys.stderr.flush()
+
+    partial = output + ".partial"
+    if compress:
+        fp = gzip.open(partial, "wt", compresslevel=GZIP_LEVEL,
+                       encoding="utf-8", newline="")
+    else:
+        fp = open(partial, "w", encoding="utf-8", newline="")
+    try:
+        with fp:
+            writers[format](fp, where, args, count)
+        os.replace(partial, output)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    seconds = time.perf_counter() - start
+    summary = {"output": output, "format": format, "compressed": compress,
+               "events": state["events"], "bytes": os.path.getsize(output),
+               "seconds": round(seconds, 3),
+               "events_per_sec": round(state["events"] / seconds, 1)
+               if seconds else 0}
+    lg.log("export_events: Wrote " + str(summary["events"]) + " events to " +
+           output + " in " + str(summary["seconds"]) + " s.")
+    return summary
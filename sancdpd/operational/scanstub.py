@@ -0,0 +1,243 @@
+"""
+This module is a stand-in for the ClamAV daemon (clamd), for trying out and
+testing virus scanning in SANCdpd without installing ClamAV.
+
+It listens on a TCP port or a Unix socket and answers the parts of the
+clamd protocol that SANCdpd uses:
+    PING, VERSION, IDSESSION, END, INSTREAM, SCAN, CONTSCAN, MULTISCAN
+with commands prefixed by "z" (null-terminated) or "n" (newline-terminated),
+as described in the clamd manual page.
+
+Instead of virus signatures, it looks for byte strings given in a
+dictionary of signature names and strings.  By default it knows only the
+EICAR anti-virus test file, so any file containing the EICAR test string is
+reported as "Eicar-Test-Signature FOUND".
+
+This module contains the following functions:
+    serve() :  Run the stand-in scanner until interrupted
+    scan_bytes() :  Look for signatures in a stream of blocks
+"""
+
+# Import modules from the Python standard library
+import os                    # for walking directories
+import os.path               # for checking paths
+import socket                # for the address family
+import socketserver          # for the threaded server
+import struct                # for INSTREAM chunk lengths
+
+# Import other SANCdpd modules
+import logger as lg
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Version string reported by the VERSION command
+VERSION = "SANCdpd scanstub 0.1"
+
+# The EICAR anti-virus test string (in two parts, so that this source file
+# is not itself detected by virus scanners)
+EICAR = (b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$" +
+         b"EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*")
+
+# Default signatures:  name -> byte string
+DEFAULT_SIGNATURES = {"Eicar-Test-Signature": EICAR}
+
+# Largest INSTREAM stream accepted, like clamd's StreamMaxLength
+STREAM_MAX_LENGTH = 1024 * 1024 * 1024
+
+# Size of blocks read from files
+READ_SIZE = 1024 * 1024
+
+
+###############################################################################
+# function: scan_bytes
+###############################################################################
+def scan_bytes(blocks, signatures):
+    """
+    Looks for any of the signatures (a dictionary of names and byte strings)
+    in the concatenation of an iterable of byte blocks, including matches
+    that span block boundaries.
+    Returns the name of the first signature found, or None.
+    """
+    overlap = max(len(s) for s in signatures.values()) - 1
+    tail = b""
+    for block in blocks:
+        data = tail + bytes(block)
+        for name, sig in signatures.items():
+            if sig in data:
+                return name
+        tail = data[-overlap:] if overlap > 0 else b""
+    return None
+
+
+###############################################################################
+# function: _file_blocks
+###############################################################################
+def _file_blocks(path):
+    """
+    Yields the contents of a file in blocks.
+    """
+    with open(path, "rb") as fp:
+        while True:
+            block = fp.read(READ_SIZE)
+            if not block:
+                break
+            yield block
+
+
+###############################################################################
+# class: _Handler
+###############################################################################
+class _Handler(socketserver.BaseRequestHandler):
+    """
+    Handles one client connection:  one command, or a session of commands
+    begun with IDSESSION and ended with END.
+    """
+
+    def setup(self):
+        self.buf = b""
+        self.closing = False
+
+    def recv_exact(self, n):
+        while len(self.buf) < n:
+            data = self.request.recv(65536)
+            if not data:
+                raise EOFError()
+            self.buf += data
+        out, self.buf = self.buf[:n], self.buf[n:]
+        return out
+
+    def recv_command(self):
+        first = self.recv_exact(1)
+        delim = b"\0" if first == b"z" else b"\n"
+        if first not in (b"z", b"n"):
+            self.buf = first + self.buf
+        while delim not in self.buf:
+            data = self.request.recv(65536)
+            if not data:
+                raise EOFError()
+            self.buf += data
+        line, self.buf = self.buf.split(delim, 1)
+        return line.decode("utf-8", "replace"), delim
+
+    def instream_blocks(self):
+        total = 0
+        while True:
+            n = struct.unpack("!L", self.recv_exact(4))[0]
+            if n == 0:
+                return
+            total += n
+            if total > STREAM_MAX_LENGTH:
+                raise OverflowError()
+            yield self.recv_exact(n)
+
+    def scan_path(self, path):
+        sigs = self.server.signatures
+        if not os.path.exists(path):
+            return [path + ": No such file or directory. ERROR"]
+        files = [path]
+        if os.path.isdir(path):
+            files = []
+            for dirpath, dirnames, filenames in os.walk(path):
+                for name in sorted(filenames):
+                    files.append(os.path.join(dirpath, name))
+        replies = []
+        for f in files:
+            try:
+                found = scan_bytes(_file_blocks(f), sigs)
+            except OSError as e:
+                replies.append(f + ": " + e.strerror + ". ERROR")
+                continue
+            if found:
+                replies.append(f + ": " + found + " FOUND")
+        self.server.scanned += len(files)
+        return replies or [path + ": OK"]
+
+    def run_command(self, cmd):
+        name, _, arg = cmd.partition(" ")
+        if name == "PING":
+            return ["PONG"]
+        if name == "VERSION":
+            return [VERSION]
+        if name == "INSTREAM":
+            try:
+                blocks = list(self.instream_blocks())
+            except OverflowError:
+                # Like clamd, give up on the rest of the connection
+                self.closing = True
+                return ["INSTREAM size limit exceeded. ERROR"]
+            self.server.scanned += 1
+            found = scan_bytes(blocks, self.server.signatures)
+            return ["stream: " + found + " FOUND" if found else "stream: OK"]
+        if name in ("SCAN", "CONTSCAN", "MULTISCAN"):
+            return self.scan_path(arg)
+        return ["UNKNOWN COMMAND"]
+
+    def handle(self):
+        try:
+            cmd, delim = self.recv_command()
+            if cmd != "IDSESSION":
+                for reply in self.run_command(cmd):
+                    self.request.sendall(reply.encode() + delim)
+                return
+            reqid = 0
+            while True:
+                cmd, delim = self.recv_command()
+                if cmd == "END":
+                    return
+                reqid += 1
+                for reply in self.run_command(cmd):
+                    self.request.sendall(str(reqid).encode() + b": " +
+                                         reply.encode() + delim)
+                if self.closing:
+                    return
+        except (EOFError, ConnectionError):
+            return
+
+
+###############################################################################
+# function: serve
+###############################################################################
+def serve(address="localhost:3310", signatures=None):
+    """
+    Runs the stand-in scanner on address, which is "host:port" for TCP or
+    the path of a Unix socket, until interrupted (for example, with Ctrl-C).
+    The signatures are a dictionary of names and byte strings (default:
+    the EICAR test string).
+    Returns a dictionary with the number of files and streams scanned.
+    """
+    if ":" in address and not os.path.isabs(address):
+        host, port = address.rsplit(":", 1)
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+        server = Server((host, int(port)), _Handler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+
+        class Server(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+            pass
+        server = Server(address, _Handler)
+    server.daemon_threads = True
+    server.signatures = signatures or DEFAULT_SIGNATURES
+    server.scanned = 0
+
+    lg.log("scanstub: Listening on " + address + ".")
+    print("   Stand-in scanner listening on " + address +
+          ".  Press Ctrl-C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server.address_family == getattr(socket, "AF_UNIX", None):
+            os.remove(address)
+
+    lg.log("scanstub: Stopped after scanning " + str(server.scanned) +
+           " files and streams.")
+    return {"scanned": server.scanned}
@@ -0,0 +1,225 @@
+"""
+This module implements full-text search of the SANCdpd database:  of the
+bag-info.txt contents, general notes, and processing notes of bags, and of
+the details of bag events.
+
+The text is indexed in two FTS5 tables, bag_fts and bag_event_fts (see
+schema.SEARCH_TABLES).  They are external-content tables:  they hold only
+the index, and read the text itself from the bag and bag_event tables.
+Triggers on those tables keep the index up to date as rows are inserted,
+updated, and deleted.
+
+Rows that existed before the index was added to a database are indexed by
+backfill_search(), in batches of rowids, each in its own transaction, so
+that other work can go on while it runs.  Its progress is kept in the
+search_backfill table, so an interrupted backfill continues where it
+stopped.  It can be run as a job (see the jobs module).  Until a row has
+been backfilled, it is not found by searches.
+
+Queries use the FTS5 query syntax:  words (all must match), "quoted
+phrases", OR, NOT, NEAR(), prefixes like "accessi*", and column filters
+like "general_notes: water".  Results are ranked by BM25 (best first), and
+are returned a page at a time.
+
+The batch size of the backfill can be given directly, or set with the
+optional "search_backfill_batch" key in the config file (default
+BACKFILL_BATCH).
+
+This module contains the following functions:
+    search_bags() :  Search the text of bags
+    search_events() :  Search the details of bag events
+    backfill_search() :  Index the rows that existed before the index
+"""
+
+# Import modules from the Python standard library
+import sqlite3 as sq         # for recognizing query syntax errors
+import time                  # for measuring throughput
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+import dbops
+import schema
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Default number of rows indexed per transaction by backfill_search()
+BACKFILL_BATCH = 5000
+
+# Default number of results per page
+PAGE_SIZE = 20
+
+# Number of tokens in each snippet of matching text
+SNIPPET_TOKENS = 16
+
+
+###############################################################################
+# function: _run_query
+###############################################################################
+def _run_query(qstr, args):
+    """
+    Runs a search query on the read-only connection, and returns all rows.
+    Raises an exception with a plain message if the search query is not
+    valid FTS5 syntax.
+    """
+    try:
+        return dbops.readonly().execute(qstr, args).fetchall()
+    except sq.OperationalError as e:
+        if "fts5" in str(e) or "no such column" in str(e):
+            raise Exception("Invalid search query: " + str(e))
+        raise
+
+
+###############################################################################
+# function: search_bags
+###############################################################################
+def search_bags(query, limit=None, offset=0, include_removed=False):
+    """
+    Searches the bag-info.txt contents, general notes, and processing notes
+    of bags.  Bags that no longer exist are left out unless include_removed
+    is True.  Returns one page of results, of at most limit bags, starting
+    after offset results.
+    Returns a dictionary with the total number of matching bags and a list
+    of results, best first, each with the bag's ID, name, and location, a
+    snippet of the matching text, and its rank (lower is better).
+    """
+    limit = int(limit or PAGE_SIZE)
+    where = "bag_fts MATCH ?" + ("" if include_removed
+                                 else " AND b.still_exists")
+    qstr = """SELECT b.bag_id, b.preservation_bag_name, b.storage_id,
+                     b.preservation_path, b.still_exists,
+                     snippet(bag_fts, -1, '[', ']', '...', ?),
+                     bag_fts.rank
+              FROM bag_fts
+              JOIN bag b ON b.bag_id = bag_fts.rowid
+              WHERE """ + where + """
+              ORDER BY bag_fts.rank
+              LIMIT ? OFFSET ?"""
+    rows = _run_query(qstr, (SNIPPET_TOKENS, query, limit, int(offset)))
+    total = _run_query("""SELECT count(*) FROM bag_fts
+                          JOIN bag b ON b.bag_id = bag_fts.rowid
+                          WHERE """ + where, (query,))[0][0]
+
+    results = [{"bag_id": r[0], "bag_name": r[1], "storage_id": r[2],
+                "path": r[3] + r[1], "still_exists": bool(r[4]),
+                "snippet": r[5], "rank": round(r[6], 6)} for r in rows]
+    lg.log("search_bags: '" + query + "' matched " + str(total) + " bags.")
+    return {"total": total, "offset": int(offset), "results": results}
+
+
+###############################################################################
+# function: search_events
+###############################################################################
+def search_events(query, event_type_code=None, limit=None, offset=0):
+    """
+    Searches the details of bag events, optionally only of one event type.
+    Returns one page of results, of at most limit events, starting after
+    offset results.
+    Returns a dictionary with the total number of matching events and a
+    list of results, best first, each with the event's ID, bag, type, end
+    time, and outcome, a snippet of the matching text, and its rank (lower
+    is better).
+    """
+    limit = int(limit or PAGE_SIZE)
+    where = "bag_event_fts MATCH ?"
+    args = [query]
+    if event_type_code:
+        where += " AND e.event_type_code = ?"
+        args.append(event_type_code)
+    qstr = """SELECT e.bag_event_id, e.bag_id, e.event_type_code,
+                     e.end_time, e.outcome_code,
+                     snippet(bag_event_fts, 0, '[', ']', '...', ?),
+                     bag_event_fts.rank
+              FROM bag_event_fts
+              JOIN bag_event e ON e.bag_event_id = bag_event_fts.rowid
+              WHERE """ + where + """
+              ORDER BY bag_event_fts.rank
+              LIMIT ? OFFSET ?"""
+    rows = _run_query(qstr, [SNIPPET_TOKENS] + args + [limit, int(offset)])
+    total = _run_query("""SELECT count(*) FROM bag_event_fts
+                          JOIN bag_event e
+                            ON e.bag_event_id = bag_event_fts.rowid
+                          WHERE """ + where, args)[0][0]
+
+    results = [{"bag_event_id": r[0], "bag_id": r[1],
+                "event_type_code": r[2], "end_time": r[3],
+                "outcome_code": r[4], "snippet": r[5],
+                "rank": round(r[6], 6)} for r in rows]
+    lg.log("search_events: '" + query + "' matched " + str(total) +
+           " events.")
+    return {"total": total, "offset": int(offset), "results": results}
+
+
+###############################################################################
+# function: backfill_search
+###############################################################################
+def backfill_search(batch_size=None, restart=False):
+    """
+    Indexes, for full-text search, the rows of each table in
+    schema.SEARCH_INDEXES that existed when the index was added and have
+    not been indexed yet, in batches of batch_size rows (see the module
+    docstring).  If restart is True, the whole index is emptied first, and
+    every existing row is indexed again.
+    Returns a dictionary with the number of rows indexed in each table.
+    """
+    batch_size = int(batch_size or conf.fconf.get("search_backfill_batch") or
+                     BACKFILL_BATCH)
+    started = time.monotonic()
+    summary = {}
+
+    for fts, table, rowid, cols in schema.SEARCH_INDEXES:
+        collist = ", ".join(cols)
+        if restart:
+            with dbops.transaction() as cur:
+                cur.execute("INSERT INTO " + fts + " (" + fts + ") " +
+                            "VALUES ('delete-all')")
+                top = cur.execute("SELECT max(" + rowid + ") FROM " +
+                                  table).fetchone()[0]
+                cur.execute("""INSERT OR REPLACE INTO search_backfill
+                                 (table_name, last_rowid, max_rowid,
+                                  updated_time)
+                               VALUES (?, 0, ?, ?)""",
+                            (table, top or 0, dbops.timestamp()))
+            lg.log("backfill_search: Emptied " + fts + ".")
+
+        indexed = 0
+        while True:
+            with dbops.transaction() as cur:
+                row = cur.execute("""SELECT last_rowid, max_rowid
+                                     FROM search_backfill
+                                     WHERE table_name = ?""",
+                                  (table,)).fetchone()
+                if row is None or row[0] >= row[1]:
+                    break
+                last, top = row
+                qstr = ("SELECT max(" + rowid + ") FROM (SELECT " + rowid +
+                        " FROM " + table + " WHERE " + rowid + " > ? AND " +
+                        rowid + " <= ? ORDER BY " + rowid + " LIMIT ?)")
+                upto = cur.execute(qstr, (last, top, batch_size)
+                                   ).fetchone()[0] or top
+                cur.execute("INSERT INTO " + fts + " (rowid, " + collist +
+                            ") SELECT " + rowid + ", " + collist + " FROM " +
+                            table + " WHERE " + rowid + " > ? AND " + rowid +
+                            " <= ?", (last, upto))
+                indexed += cur.rowcount
+                cur.execute("""UPDATE search_backfill
+                               SET last_rowid = ?, updated_time = ?
+                               WHERE table_name = ?""",
+                            (upto, dbops.timestamp(), table))
+            lg.log("backfill_search: Indexed " + table + " rows through " +
+                   str(upto) + " of " + str(top) + ".", "DEBUG")
+
+        # Merge the index segments written by the batches
+        if indexed:
+            with dbops.transaction() as cur:
+                cur.execute("INSERT INTO " + fts + " (" + fts + ") " +
+                            "VALUES ('optimize')")
+        summary[table] = indexed
+        lg.log("backfill_search: Indexed " + str(indexed) + " rows of " +
+               table + ".")
+
+    summary["seconds"] = round(time.monotonic() - started, 3)
+    return summary
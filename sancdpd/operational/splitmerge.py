@@ -0,0 +1,589 @@
+"""
+This module implements splitting a bag into several new bags, and merging
+several bags into one new bag, recorded in the SANCdpd database as "Split
+bag" (BGSPL) and "Merge bags" (BGMRG) events.
+
+Neither operation copies or reads payload data.  The payload files of the
+new bags are hardlinks to (or copy-on-write clones of) the files of the
+original bags, which lie on the same filesystem, since the new bags are
+made next to the originals.  The copy methods are tried as in storage
+migration (see the stormig module):  with the default method, "auto",
+reflinks first, then hardlinks, then copies made by the kernel.
+
+The payload manifests of the new bags are written from the digests in the
+manifests of the original bags, for every algorithm that all of the
+originals have.  Only the tag files (bagit.txt, bag-info.txt, and the new
+manifests) are hashed, for the new tagmanifests.  The bag-info.txt of a new
+bag is that of its (first) original, with a new Payload-Oxum and
+Bagging-Date.  Since hardlinked files keep their inode and mtime, the
+fixity_cache rows of hardlinked files are copied to the new bags, so the
+next incremental fixity audit does not read them either.
+
+A bag is split in one of two ways:
+  - by paths:  each listed path in the payload (like "data/box1") becomes a
+    new bag, and the payload files under none of them become one more.
+  - by size:  the payload files, in order of their paths, are packed into
+    new bags of at most max_bytes bytes each.
+The new bags are named after the original, with a suffix "_01", "_02", and
+so on.  Merged bags must be in the same storage location, and must not
+hold different files at the same path.  The merged bag is named after the
+first original, with the suffix "_merged", unless a name is given.
+
+Each new bag is built in a temporary directory and renamed into place.  When
+all are built, the new bag rows (in the bag family of the first original),
+their accessions, the bag_has_parent_bag edges, the fixity_cache rows, and
+one event for each original and each new bag are written in a single
+transaction.  The original bags are removed only if asked, and only after
+that transaction commits.
+
+This module contains the following functions:
+    split_bag() :  Split a bag into new bags
+    merge_bags() :  Merge bags into a new bag
+"""
+
+# Import modules from the Python standard library
+import datetime as dt        # for the Bagging-Date of new bags
+import os                    # for linking files and stat calls
+import os.path               # for building paths
+import shutil                # for copying bagit.txt and removing directories
+import time                  # for measuring throughput
+
+# Import other SANCdpd modules
+import logger as lg
+import dbops
+import metrics
+import operational.bagit as bagit
+import operational.bagmgmt as bagmgmt
+import operational.hashing as hashing
+import operational.stormig as stormig
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Suffix of the temporary directory a new bag is built in
+PARTIAL_SUFFIX = ".splitmerge-partial"
+
+# bag-info.txt tags replaced in new bags
+REPLACED_TAGS = ["Payload-Oxum", "Bagging-Date", "Bag-Size"]
+
+# Columns of the bag table written for each new bag
+BAG_COLUMNS = bagmgmt.BAG_COLUMNS
+
+
+###############################################################################
+# function: _read_parent
+###############################################################################
+def _read_parent(cur, bag_id):
+    """
+    Reads the bag table row of an original bag, with the path_root of its
+    storage location, its bag directory, its payload manifests, and its
+    accessions.
+    Raises an exception if the bag is not found or has no manifests.
+    """
+    qstr = """SELECT b.*, s.path_root
+              FROM bag b JOIN storage s ON s.storage_id = b.storage_id
+              WHERE b.bag_id = ?"""
+    cur.execute(qstr, (bag_id,))
+    row = cur.fetchone()
+    if row is None:
+        raise Exception("No bag with ID " + str(bag_id))
+    rec = dict(zip([d[0] for d in cur.description], row))
+    if not rec["still_exists"]:
+        raise Exception("Bag " + str(bag_id) + " no longer exists.")
+    rec["bagdir"] = bagit.bag_dir(rec["path_root"], rec["preservation_path"],
+                                  rec["preservation_bag_name"])
+
+    # Digests of the payload files, by path and algorithm
+    rec["digests"] = {}
+    for alg, path in bagit.manifest_paths(rec["bagdir"]).items():
+        for relpath, digest in bagit.read_manifest(path).items():
+            rec["digests"].setdefault(relpath, {})[alg] = digest
+    if not rec["digests"]:
+        raise Exception("No payload manifests found in bag: " + rec["bagdir"])
+
+    qstr = "SELECT accession_id FROM bag_from_accession WHERE bag_id = ?"
+    rec["accessions"] = [r[0] for r in cur.execute(qstr, (bag_id,))]
+    return rec
+
+
+###############################################################################
+# function: _common_algs
+###############################################################################
+def _common_algs(parents):
+    """
+    Returns the sorted digest algorithms listed for every payload file of
+    every original bag.
+    Raises an exception if there are none.
+    """
+    algs = None
+    for parent in parents:
+        for digests in parent["digests"].values():
+            algs = set(digests) if algs is None else algs & set(digests)
+    if not algs:
+        raise Exception("The bags have no digest algorithm in common.")
+    return sorted(algs)
+
+
+###############################################################################
+# function: _encode_path
+###############################################################################
+def _encode_path(relpath):
+    """
+    Percent-encodes the line breaks and percent signs in a path, for a
+    manifest line (as specified by BagIt version 1.0).
+    """
+    return (relpath.replace("%", "%25").replace("\n", "%0A")
+            .replace("\r", "%0D"))
+
+
+###############################################################################
+# function: _baginfo_text
+###############################################################################
+def _baginfo_text(text, payload_bytes, payload_files):
+    """
+    Returns the text of bag-info.txt for a new bag:  the text of the
+    original, without the tags in REPLACED_TAGS (and their continuation
+    lines), followed by a new Payload-Oxum and Bagging-Date.
+    """
+    lines = []
+    skipping = False
+    for line in text.splitlines():
+        if line[:1] in (" ", "\t") and line.strip():
+            if not skipping:
+                lines.append(line)
+            continue
+        label = line.split(":", 1)[0].strip()
+        skipping = ":" in line and label in REPLACED_TAGS
+        if not skipping and line.strip():
+            lines.append(line)
+    lines.append("Bagging-Date: " + dt.date.today().isoformat())
+    lines.append("Payload-Oxum: " + str(payload_bytes) + "." +
+                 str(payload_files))
+    return "\n".join(lines) + "\n"
+
+
+###############################################################################
+# function: _link_file
+###############################################################################
+def _link_file(src, dst, methods):
+    """
+    Creates dst from src with the first copy method in methods that works,
+    dropping methods that are not supported from the front of the list.
+    Returns the method used.
+    """
+    while True:
+        method = methods[0]
+        try:
+            if method == "reflink":
+                stormig._reflink(src, dst)
+            elif method == "hardlink":
+                os.link(src, dst)
+            else:
+                stormig._copy_kernel(src, dst)
+                shutil.copystat(src, dst)
+            return method
+        except OSError as e:
+            if method == "copy" or e.errno not in stormig.UNSUPPORTED_ERRNOS:
+                raise
+            if len(methods) == 1:
+                raise Exception("Copy method " + method + " is not " +
+                                "supported on this filesystem (" +
+                                e.strerror + ")")
+            lg.log("splitmerge: " + method + " not supported for " + dst +
+                   "; trying " + methods[1], "DEBUG")
+            methods.pop(0)
+
+
+###############################################################################
+# function: _build_bag
+###############################################################################
+@metrics.timed("build_bag")
+def _build_bag(newdir, files, algs, first, methods):
+    """
+    Builds a new bag at newdir, from files, a list of (relpath, original)
+    pairs, where original is the record of the original bag holding the
+    file (see _read_parent()).  The first original supplies bagit.txt and
+    bag-info.txt.  Payload files are linked (see _link_file()), and only
+    the tag files are hashed.
+    Returns a dictionary of values for the bag table, plus the methods used
+    and the payload files that were hardlinked.
+    """
+    if os.path.exists(newdir):
+        raise Exception("Destination already exists: " + newdir)
+    partial = newdir.rstrip("/\\") + PARTIAL_SUFFIX
+    if os.path.exists(partial):
+        shutil.rmtree(partial)
+
+    result = {"methods": {}, "hardlinked": {}}
+    payload_bytes = 0
+    try:
+        # Link the payload files
+        for relpath, parent in files:
+            src = os.path.join(parent["bagdir"], *relpath.split("/"))
+            dst = os.path.join(partial, *relpath.split("/"))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            method = _link_file(src, dst, methods)
+            result["methods"][method] = result["methods"].get(method, 0) + 1
+            if method == "hardlink":
+                result["hardlinked"].setdefault(parent["bag_id"],
+                                                []).append(relpath)
+            payload_bytes += os.stat(dst).st_size
+
+        # Payload manifests, from the digests of the originals
+        tagfiles = ["bagit.txt", "bag-info.txt"]
+        for alg in algs:
+            name = "manifest-" + alg + ".txt"
+            with open(os.path.join(partial, name), "w", encoding="utf-8",
+                      newline="\n") as fp:
+                for relpath, parent in files:
+                    fp.write(parent["digests"][relpath][alg] + "  " +
+                             _encode_path(relpath) + "\n")
+            tagfiles.append(name)
+
+        # bagit.txt and bag-info.txt
+        shutil.copyfile(os.path.join(first["bagdir"], "bagit.txt"),
+                        os.path.join(partial, "bagit.txt"))
+        info, text = bagit.read_baginfo(first["bagdir"])
+        text = _baginfo_text(text, payload_bytes, len(files))
+        with open(os.path.join(partial, "bag-info.txt"), "w",
+                  encoding="utf-8", newline="\n") as fp:
+            fp.write(text)
+
+        # Tagmanifests, hashing only the tag files
+        hashed = hashing.hash_files([(os.path.join(partial, name), algs)
+                                     for name in tagfiles])
+        tagbytes = 0
+        for name, (digests, nbytes, error) in zip(tagfiles, hashed):
+            if error is not None:
+                raise Exception(error)
+            tagbytes += nbytes
+        for alg in algs:
+            with open(os.path.join(partial, "tagmanifest-" + alg + ".txt"),
+                      "w", encoding="utf-8", newline="\n") as fp:
+                for name, (digests, nbytes, error) in zip(tagfiles, hashed):
+                    fp.write(digests[alg] + "  " + name + "\n")
+        for alg in algs:
+            tagbytes += os.stat(os.path.join(
+                partial, "tagmanifest-" + alg + ".txt")).st_size
+
+        os.makedirs(os.path.dirname(newdir.rstrip("/\\")), exist_ok=True)
+        os.rename(partial, newdir)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+    path = bagit.strongest_tagmanifest(newdir)
+    with open(path, "r", encoding="utf-8-sig") as fp:
+        contents = fp.read()
+    result.update({
+        "tagmanifest_filename": os.path.basename(path),
+        "tagmanifest_contents": contents,
+        "tagmanifest_digest": bagit.manifest_digest(contents),
+        "bag-info_contents": text,
+        "bag-info_Bagging-Date": dt.date.today().isoformat(),
+        "payload_files": len(files),
+        "payload_bytes": payload_bytes,
+        "total_files": len(files) + len(tagfiles) + len(algs),
+        "total_bytes": payload_bytes + tagbytes
+        })
+    return result
+
+
+###############################################################################
+# function: _methods
+###############################################################################
+def _methods(method):
+    """
+    Returns the list of copy methods to try for a method argument.
+    """
+    if method == "auto":
+        return list(stormig.SAME_FS_METHODS)
+    if method not in stormig.SAME_FS_METHODS:
+        raise Exception("Unknown copy method: " + str(method))
+    return [method]
+
+
+###############################################################################
+# function: _create_bags
+###############################################################################
+def _create_bags(parents, children, event_type, method, remove_parents):
+    """
+    Builds the new bags and records them (see the module docstring).  The
+    parents are records from _read_parent(), and children is a list of
+    (preservation_bag_name, files) pairs, where files is as for
+    _build_bag().  The new bags go in the storage location, path, and bag
+    family of the first parent.
+    Returns a dictionary summarizing the run.
+    """
+    started = time.monotonic()
+    first = parents[0]
+    algs = _common_algs(parents)
+    methods = _methods(method)
+    agents = dbops.agent_ids()
+    start_time = dbops.timestamp()
+
+    # Build every new bag before touching the database
+    built = []
+    try:
+        for name, files in children:
+            newdir = bagit.bag_dir(first["path_root"],
+                                   first["preservation_path"], name)
+            built.append((name, newdir, _build_bag(newdir, files, algs,
+                                                   first, methods)))
+    except BaseException:
+        for name, newdir, result in built:
+            shutil.rmtree(newdir, ignore_errors=True)
+        raise
+
+    summary = {"parent_bag_ids": [p["bag_id"] for p in parents],
+               "bags": [], "files_linked": 0, "methods": {},
+               "bag_event_ids": []}
+    for name, newdir, result in built:
+        summary["files_linked"] += result["payload_files"]
+        for m, n in result["methods"].items():
+            summary["methods"][m] = summary["methods"].get(m, 0) + n
+    tools = ("SANCdpd splitmerge, methods " +
+             ", ".join(m + ": " + str(n)
+                       for m, n in sorted(summary["methods"].items())))
+    accessions = sorted(set(a for p in parents for a in p["accessions"]))
+    names = {p["bag_id"]: p["preservation_bag_name"] for p in parents}
+    verb = "Split" if event_type == "BGSPL" else "Merged"
+    now = dbops.timestamp()
+
+    try:
+        with dbops.transaction() as cur:
+            bag_id = bagmgmt._next_id(cur, "bag", "bag_id")
+            bagrows = []
+            accrows = []
+            edgerows = []
+            cacherows = []
+            eventrows = []
+
+            def event(target, details):
+                eventrows.append({
+                    "bag_id": target,
+                    "event_type_code": event_type,
+                    "person_agent_id": agents[0],
+                    "software_agent_id": agents[1],
+                    "start_time": start_time,
+                    "end_time": now,
+                    "event_details": details[:2500],
+                    "tools_used": tools,
+                    "outcome_code": "SUCC"
+                    })
+
+            for name, newdir, result in built:
+                rec = dict((c, first.get(c)) for c in BAG_COLUMNS)
+                rec.update(dict((c, result[c]) for c in BAG_COLUMNS
+                                if c in result))
+                rec.update({"bag_id": bag_id,
+                            "preservation_bag_name": name,
+                            "SANC_container_id": name,
+                            "original_bag_name": name,
+                            "still_exists": True})
+                bagrows.append(tuple(rec.get(c) for c in BAG_COLUMNS))
+
+                accrows.extend((bag_id, acc) for acc in accessions)
+                edgerows.extend((bag_id, p["bag_id"]) for p in parents)
+
+                # Cached verifications of hardlinked files still hold
+                for parent_id, relpaths in result["hardlinked"].items():
+                    qstr = """SELECT relative_path, file_size, mtime_ns,
+                                     inode, algorithm, digest, verified_time
+                              FROM fixity_cache WHERE bag_id = ?"""
+                    wanted = set(relpaths)
+                    cacherows.extend((bag_id,) + tuple(r) for r in
+                                     cur.execute(qstr, (parent_id,))
+                                     if r[0] in wanted)
+
+                event(bag_id, verb + " from bag" +
+                      ("s " if len(parents) > 1 else " ") +
+                      ", ".join(str(p["bag_id"]) + " (" +
+                                names[p["bag_id"]] + ")" for p in parents) +
+                      "; " + str(result["payload_files"]) +
+                      " payload files, " + str(result["payload_bytes"]) +
+                      " bytes.")
+                summary["bags"].append({
+                    "bag_id": bag_id, "path": newdir,
+                    "payload_files": result["payload_files"],
+                    "payload_bytes": result["payload_bytes"]})
+                bag_id += 1
+
+            children_text = ", ".join(str(b["bag_id"]) + " (" +
+                                      os.path.basename(b["path"]) + ")"
+                                      for b in summary["bags"])
+            for p in parents:
+                details = (verb + " into bag" +
+                           ("s " if len(built) > 1 else " ") + children_text)
+                others = [str(q["bag_id"]) for q in parents if q is not p]
+                if others:
+                    details += (" with bag" +
+                                ("s " if len(others) > 1 else " ") +
+                                ", ".join(others))
+                if remove_parents:
+                    details += ".  Original bag removed"
+                event(p["bag_id"], details + ".")
+
+            cur.executemany("INSERT INTO bag (" +
+                            ", ".join('"' + c + '"' for c in BAG_COLUMNS) +
+                            ") VALUES (" +
+                            ", ".join(["?"] * len(BAG_COLUMNS)) + ")",
+                            bagrows)
+            cur.executemany("INSERT INTO bag_from_accession " +
+                            "(bag_id, accession_id) VALUES (?, ?)", accrows)
+            cur.executemany("INSERT INTO bag_has_parent_bag " +
+                            "(child_bag_id, parent_bag_id) VALUES (?, ?)",
+                            edgerows)
+            cur.executemany("""INSERT INTO fixity_cache
+                                   (bag_id, relative_path, file_size,
+                                    mtime_ns, inode, algorithm, digest,
+                                    verified_time)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                            cacherows)
+            if remove_parents:
+                cur.executemany("UPDATE bag SET still_exists = ? " +
+                                "WHERE bag_id = ?",
+                                [(False, p["bag_id"]) for p in parents])
+            summary["bag_event_ids"] = dbops.insert_bag_events(cur,
+                                                               eventrows)
+    except BaseException:
+        for name, newdir, result in built:
+            shutil.rmtree(newdir, ignore_errors=True)
+        raise
+
+    # Remove the original bags, once the new bags are recorded
+    if remove_parents:
+        for p in parents:
+            shutil.rmtree(p["bagdir"])
+        lg.log("splitmerge: Removed " + str(len(parents)) +
+               " original bags.")
+
+    summary["child_bag_ids"] = [b["bag_id"] for b in summary["bags"]]
+    summary["seconds"] = round(time.monotonic() - started, 3)
+    lg.log("splitmerge: " + verb + " bags " +
+           ", ".join(str(i) for i in summary["parent_bag_ids"]) +
+           " into bags " +
+           ", ".join(str(i) for i in summary["child_bag_ids"]) + ", " +
+           str(summary["files_linked"]) + " files linked, in " +
+           str(summary["seconds"]) + " s.")
+    return summary
+
+
+###############################################################################
+# function: split_bag
+###############################################################################
+def split_bag(bag_id, paths=None, max_bytes=None, method="auto",
+              remove_parent=False):
+    """
+    Splits a bag into new bags, either by paths (a comma-separated string or
+    a list of paths in the payload) or by size (max_bytes), and records a
+    BGSPL event for the original bag and for each new bag (see the module
+    docstring).  The method is "auto", "reflink", "hardlink", or "copy".
+    If remove_parent is True, the original bag is removed afterward.
+    Returns a dictionary summarizing the run.
+    """
+    if (paths is None) == (max_bytes is None):
+        raise Exception("Give either paths or max_bytes to split a bag.")
+
+    cur = dbops.connect().cursor()
+    parent = _read_parent(cur, bag_id)
+    cur.close()
+    relpaths = sorted(parent["digests"])
+
+    groups = []
+    if paths is not None:
+        if isinstance(paths, str):
+            paths = paths.split(",")
+        prefixes = []
+        for path in paths:
+            path = path.strip().strip("/")
+            if not path:
+                continue
+            if not path.startswith(bagit.PAYLOAD_DIR + "/"):
+                path = bagit.PAYLOAD_DIR + "/" + path
+            prefixes.append(path)
+        groups = [[] for p in prefixes] + [[]]
+        for relpath in relpaths:
+            for i, prefix in enumerate(prefixes):
+                if relpath == prefix or relpath.startswith(prefix + "/"):
+                    groups[i].append(relpath)
+                    break
+            else:
+                groups[-1].append(relpath)
+        for prefix, group in zip(prefixes, groups):
+            if not group:
+                raise Exception("No payload files under " + prefix)
+        if not groups[-1]:
+            groups.pop()
+    else:
+        max_bytes = int(max_bytes)
+        group = []
+        size = 0
+        for relpath in relpaths:
+            n = os.stat(os.path.join(parent["bagdir"],
+                                     *relpath.split("/"))).st_size
+            if group and size + n > max_bytes:
+                groups.append(group)
+                group = []
+                size = 0
+            group.append(relpath)
+            size += n
+        if group:
+            groups.append(group)
+
+    if len(groups) < 2:
+        raise Exception("The split would make only one bag.")
+
+    width = max(2, len(str(len(groups))))
+    children = [(parent["preservation_bag_name"] + "_" +
+                 str(i + 1).zfill(width),
+                 [(relpath, parent) for relpath in group])
+                for i, group in enumerate(groups)]
+    lg.log("split_bag: Splitting bag " + str(bag_id) + " into " +
+           str(len(children)) + " bags.")
+    return _create_bags([parent], children, "BGSPL", method, remove_parent)
+
+
+###############################################################################
+# function: merge_bags
+###############################################################################
+def merge_bags(bag_ids, name=None, method="auto", remove_parents=False):
+    """
+    Merges bags into one new bag, named name (or after the first bag), and
+    records a BGMRG event for each original bag and for the new bag (see
+    the module docstring).  The method is "auto", "reflink", "hardlink", or
+    "copy".  If remove_parents is True, the original bags are removed
+    afterward.
+    Returns a dictionary summarizing the run.
+    """
+    bag_ids = list(bag_ids)
+    if len(set(bag_ids)) < 2:
+        raise Exception("Give at least two bags to merge.")
+
+    cur = dbops.connect().cursor()
+    parents = [_read_parent(cur, i) for i in bag_ids]
+    cur.close()
+    if len(set(p["storage_id"] for p in parents)) > 1:
+        raise Exception("Bags to merge must be in the same storage location.")
+
+    # The union of the payloads, with each path from the first bag with it
+    owner = {}
+    for parent in parents:
+        for relpath, digests in parent["digests"].items():
+            other = owner.get(relpath)
+            if other is None:
+                owner[relpath] = parent
+            elif any(other["digests"][relpath].get(a, d) != d
+                     for a, d in digests.items()):
+                raise Exception("Bags " + str(other["bag_id"]) + " and " +
+                                str(parent["bag_id"]) +
+                                " hold different files at " + relpath)
+
+    name = name or (parents[0]["preservation_bag_name"] + "_merged")
+    children = [(name, [(relpath, owner[relpath])
+                        for relpath in sorted(owner)])]
+    lg.log("merge_bags: Merging bags " + ", ".join(str(i) for i in bag_ids) +
+           " into " + name + ".")
+    return _create_bags(parents, children, "BGMRG", method, remove_parents)
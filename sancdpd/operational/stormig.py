@@ -0,0 +1,421 @@
+"""
+This module implements storage migration:  moving bags from one storage
+location (a row of the storage table) to another, recorded in the SANCdpd
+database as a "Storage migration" (STMIG) storage event.
+
+Each bag is copied into a temporary directory next to its new location, and
+renamed into place when every file has been copied.  Files are copied by the
+cheapest method available:
+  - "reflink":  a copy-on-write clone (on filesystems that support it, like
+    Btrfs and XFS), which shares the data blocks of the original
+  - "hardlink":  a second directory entry for the original file
+  - "copy":  a copy of the bytes.  When files are verified, the copy is made
+    in user space, and each block read is hashed as it is written, so that
+    every byte is read only once.  When files are not verified, the copy is
+    made by the kernel (with copy_file_range or sendfile).
+With the default method, "auto", reflinks are tried first, then hardlinks,
+when the bag and its new location are on the same filesystem.  Otherwise,
+files are copied.
+
+When verify is True (the default), every file listed in the bag's manifests
+and tagmanifests is checked against its digests in the same pass as the
+copy (or, for linked files, in one read of the new file).  A bag with a
+missing or mismatched file is not migrated.  The digests verified are also
+written to the fixity_cache table, so the next incremental fixity audit does
+not need to read the bags again.
+
+Bags are migrated in parallel, by a pool of threads (copying and hashing
+release the GIL).  The number of threads can be given directly, or set with
+the optional "migration_workers" key in the config file (default 4).
+
+When all bags have been copied, the storage_id and preservation_path of the
+migrated bags are updated in a single transaction, along with the fixity
+cache and the STMIG event.  The original bags are removed only if
+remove_source is True, and only after that transaction commits.
+
+This module contains the following function:
+    migrate_storage() :  Migrate bags to a new storage location
+"""
+
+# Import modules from the Python standard library
+import concurrent.futures    # for the pool of copying threads
+import errno                 # for recognizing unsupported copy methods
+import os                    # for copying, linking, and stat calls
+import os.path               # for building paths
+import shutil                # for removing directories
+import time                  # for measuring throughput
+try:
+    import fcntl             # for reflinks (not available on Windows)
+except ImportError:
+    fcntl = None
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+import dbops
+import metrics
+import refdata
+import operational.bagit as bagit
+import operational.hashing as hashing
+import operational.fixity as fixity
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Default number of threads migrating bags at once
+DEFAULT_WORKERS = 4
+
+# Copy methods tried in order by the "auto" method on one filesystem
+SAME_FS_METHODS = ["reflink", "hardlink", "copy"]
+
+# The Linux ioctl request number for cloning a file (FICLONE)
+FICLONE = 0x40049409
+
+# Errors meaning that a copy method is not supported for a pair of files
+UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                      errno.EINVAL, errno.ENOSYS, errno.EPERM)
+
+# Suffix of the temporary directory a bag is copied into
+PARTIAL_SUFFIX = ".stmig-partial"
+
+
+###############################################################################
+# function: _reflink
+###############################################################################
+def _reflink(src, dst):
+    """
+    Creates dst as a copy-on-write clone of src.
+    Raises OSError if the filesystem does not support it.
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflinks not supported")
+    with open(src, "rb") as sfp, open(dst, "wb") as dfp:
+        try:
+            fcntl.ioctl(dfp.fileno(), FICLONE, sfp.fileno())
+        except OSError:
+            dfp.close()
+            os.remove(dst)
+            raise
+
+
+###############################################################################
+# function: _copy_kernel
+###############################################################################
+def _copy_kernel(src, dst):
+    """
+    Copies src to dst inside the kernel, with copy_file_range (or sendfile,
+    where copy_file_range is not available).
+    Returns the number of bytes copied.
+    """
+    with open(src, "rb") as sfp, open(dst, "wb") as dfp:
+        size = os.fstat(sfp.fileno()).st_size
+        copy = getattr(os, "copy_file_range", None)
+        done = 0
+        while done < size:
+            try:
+                if copy is not None:
+                    n = copy(sfp.fileno(), dfp.fileno(), size - done)
+                else:
+                    n = os.sendfile(dfp.fileno(), sfp.fileno(), done,
+                                    size - done)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS or done > 0:
+                    raise
+                # Fall back to a plain copy
+                shutil.copyfileobj(sfp, dfp, hashing.BUFSIZE)
+                return size
+            if n == 0:
+                break
+            done += n
+    return done
+
+
+###############################################################################
+# function: _migrate_bag
+###############################################################################
+@metrics.timed("migrate_bag")
+def _migrate_bag(bag_id, srcdir, dstdir, methods, verify):
+    """
+    Runs in a worker thread.  Copies one bag from srcdir to dstdir, trying
+    the copy methods in order, and verifying files against the manifests if
+    verify is True.
+    Returns a dictionary of results for the bag.
+    """
+    result = {"bag_id": bag_id, "problems": [], "error": None,
+              "files": 0, "bytes_copied": 0, "bytes_verified": 0,
+              "methods": {}, "cache_rows": []}
+    partial = dstdir.rstrip("/\\") + PARTIAL_SUFFIX
+    try:
+        if not os.path.isdir(srcdir):
+            raise Exception("Bag directory not found: " + srcdir)
+        if os.path.exists(dstdir):
+            raise Exception("Destination already exists: " + dstdir)
+
+        # Collect expected digests from all manifests and tagmanifests
+        expected = {}
+        if verify:
+            for tag in (False, True):
+                for alg, path in bagit.manifest_paths(srcdir, tag).items():
+                    for relpath, digest in bagit.read_manifest(path).items():
+                        expected.setdefault(relpath, {})[alg] = digest
+            if not expected:
+                raise Exception("No manifests found in bag: " + srcdir)
+
+        # Remove what is left of an earlier, interrupted attempt
+        if os.path.exists(partial):
+            shutil.rmtree(partial)
+
+        methods = list(methods)
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(srcdir):
+            dirnames.sort()
+            reldir = os.path.relpath(dirpath, srcdir)
+            os.makedirs(os.path.join(partial, reldir), exist_ok=True)
+            for name in sorted(filenames):
+                src = os.path.join(dirpath, name)
+                dst = os.path.join(partial, reldir, name)
+                relpath = os.path.normpath(os.path.join(reldir, name))
+                relpath = relpath.replace(os.sep, "/")
+                digests = expected.get(relpath)
+                st = os.stat(src)
+
+                # Copy the file with the first method that works
+                actual = None
+                while True:
+                    method = methods[0]
+                    try:
+                        if method == "reflink":
+                            _reflink(src, dst)
+                        elif method == "hardlink":
+                            os.link(src, dst)
+                        elif digests:
+                            actual, n = hashing.copy_file(src, dst, digests)
+                            result["bytes_copied"] += n
+                            result["bytes_verified"] += n
+                        else:
+                            result["bytes_copied"] += _copy_kernel(src, dst)
+                        break
+                    except OSError as e:
+                        if (method == "copy" or
+                                e.errno not in UNSUPPORTED_ERRNOS):
+                            raise
+                        if len(methods) == 1:
+                            raise Exception("Copy method " + method +
+                                            " is not supported on this " +
+                                            "filesystem (" + e.strerror +
+                                            ")")
+                        lg.log("stormig: " + method + " not supported for " +
+                               dst + "; trying " + methods[1], "DEBUG")
+                        methods.pop(0)
+
+                result["methods"][method] = \
+                    result["methods"].get(method, 0) + 1
+                result["files"] += 1
+                if method != "hardlink":
+                    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+                # Verify the file against the manifests
+                if digests:
+                    seen.add(relpath)
+                    if actual is None:
+                        actual, n = hashing.hash_file(dst, digests)
+                        result["bytes_verified"] += n
+                    bad = [a for a in digests if actual[a] != digests[a]]
+                    if bad:
+                        result["problems"].append("/".join(bad) +
+                                                  " mismatch: " + relpath)
+                    else:
+                        alg = fixity._preferred_alg(digests)
+                        dst_st = os.stat(dst)
+                        result["cache_rows"].append(
+                            (relpath, dst_st.st_size, dst_st.st_mtime_ns,
+                             dst_st.st_ino, alg, actual[alg]))
+
+        for relpath in sorted(set(expected) - seen):
+            result["problems"].append("missing: " + relpath)
+
+        if result["problems"]:
+            shutil.rmtree(partial)
+        else:
+            os.makedirs(os.path.dirname(dstdir.rstrip("/\\")), exist_ok=True)
+            os.rename(partial, dstdir)
+
+    except Exception as e:
+        result["error"] = str(e)
+        if os.path.exists(partial):
+            shutil.rmtree(partial, ignore_errors=True)
+
+    return result
+
+
+###############################################################################
+# function: migrate_storage
+###############################################################################
+def migrate_storage(source_storage_id, target_storage_id, bag_ids=None,
+                    path_prefix="", method="auto", verify=True,
+                    remove_source=False, workers=None):
+    """
+    Migrates bags from one storage location to another, and records one
+    STMIG storage event for the target storage location.
+    All bags in the source location that still exist are migrated, unless
+    bag_ids (a list) is given.  The path_prefix, if given, is put in front of
+    the preservation_path of each bag in its new location.  The method is
+    "auto", "reflink", "hardlink", or "copy" (see the module docstring).
+    Returns a dictionary summarizing the run.
+    """
+    if method not in ["auto"] + SAME_FS_METHODS:
+        raise Exception("Unknown migration method: " + str(method))
+    if source_storage_id == target_storage_id:
+        raise Exception("Source and target storage locations are the same.")
+    if workers is None:
+        workers = conf.fconf.get("migration_workers", DEFAULT_WORKERS)
+    workers = int(workers)
+    path_prefix = path_prefix or ""
+    if path_prefix and not path_prefix.endswith("/"):
+        path_prefix += "/"
+
+    source = refdata.storage(source_storage_id)
+    target = refdata.storage(target_storage_id)
+    if source is None or target is None:
+        raise Exception("Unknown storage location.")
+    if not target["in_use"]:
+        raise Exception("Target storage location is not in use.")
+    if not os.path.isdir(target["path_root"]):
+        raise Exception("Target path_root not found: " + target["path_root"])
+
+    qstr = """SELECT bag_id, preservation_path, preservation_bag_name
+              FROM bag
+              WHERE still_exists AND storage_id = ?"""
+    qargs = [source_storage_id]
+    if bag_ids is not None:
+        qstr += (" AND bag_id IN (" + ", ".join(["?"] * len(bag_ids)) + ")")
+        qargs.extend(bag_ids)
+    qstr += " ORDER BY bag_id"
+    bags = dbops.connect().execute(qstr, qargs).fetchall()
+    agents = dbops.agent_ids()
+
+    # Choose the copy methods
+    if method == "auto":
+        same_fs = (os.path.isdir(source["path_root"]) and
+                   os.stat(source["path_root"]).st_dev ==
+                   os.stat(target["path_root"]).st_dev)
+        methods = SAME_FS_METHODS if same_fs else ["copy"]
+    else:
+        methods = [method]
+
+    lg.log("migrate_storage: Migrating " + str(len(bags)) + " bags from " +
+           "storage " + str(source_storage_id) + " to storage " +
+           str(target_storage_id) + " with " + str(workers) +
+           " threads, methods " + "/".join(methods) + ", verify " +
+           str(verify) + ".")
+
+    start_time = dbops.timestamp()
+    started = time.monotonic()
+    summary = {"bags": len(bags), "migrated": 0, "failed": 0, "errors": 0,
+               "files": 0, "bytes_copied": 0, "bytes_verified": 0,
+               "methods": {}, "storage_event_id": None}
+    done = []
+    details = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for bag_id, ppath, bagname in bags:
+            srcdir = bagit.bag_dir(source["path_root"], ppath, bagname)
+            dstdir = bagit.bag_dir(target["path_root"], path_prefix + ppath,
+                                   bagname)
+            fut = pool.submit(_migrate_bag, bag_id, srcdir, dstdir, methods,
+                              verify)
+            futures[fut] = (bag_id, path_prefix + ppath, srcdir)
+
+        for fut in concurrent.futures.as_completed(futures):
+            bag_id, newpath, srcdir = futures[fut]
+            result = fut.result()
+            summary["files"] += result["files"]
+            summary["bytes_copied"] += result["bytes_copied"]
+            summary["bytes_verified"] += result["bytes_verified"]
+            for m, n in result["methods"].items():
+                summary["methods"][m] = summary["methods"].get(m, 0) + n
+            if result["error"] is not None:
+                summary["errors"] += 1
+                details.append("bag " + str(bag_id) + ": " + result["error"])
+                lg.log("migrate_storage: Bag " + str(bag_id) + " error: " +
+                       result["error"], "ERROR")
+            elif result["problems"]:
+                summary["failed"] += 1
+                details.append("bag " + str(bag_id) + ": " +
+                               "; ".join(result["problems"]))
+                lg.log("migrate_storage: Bag " + str(bag_id) + " failed " +
+                       "verification: " + "; ".join(result["problems"]),
+                       "WARNING")
+            else:
+                summary["migrated"] += 1
+                done.append((bag_id, newpath, srcdir, result))
+                lg.log("migrate_storage: Bag " + str(bag_id) + " copied.")
+
+    # Choose the outcome of the event
+    if summary["migrated"] == len(bags):
+        outcome = "SUCC"
+    elif summary["migrated"]:
+        outcome = "PSUC"
+    elif summary["errors"]:
+        outcome = "ERR"
+    else:
+        outcome = "FAIL"
+
+    # Point the migrated bags at their new location, and record the event
+    now = dbops.timestamp()
+    with dbops.transaction() as cur:
+        qstr = """UPDATE bag SET storage_id = ?, preservation_path = ?
+                  WHERE bag_id = ?"""
+        cur.executemany(qstr, [(target_storage_id, newpath, bag_id)
+                               for bag_id, newpath, srcdir, result in done])
+        qstr = "DELETE FROM fixity_cache WHERE bag_id = ?"
+        cur.executemany(qstr, [(d[0],) for d in done])
+        qstr = """INSERT INTO fixity_cache
+                      (bag_id, relative_path, file_size, mtime_ns, inode,
+                       algorithm, digest, verified_time)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+        cur.executemany(qstr, [(bag_id,) + row + (now,)
+                               for bag_id, newpath, srcdir, result in done
+                               for row in result["cache_rows"]])
+        summary["storage_event_id"] = dbops.insert_storage_event(cur, {
+            "storage_id": target_storage_id,
+            "event_type_code": "STMIG",
+            "start_time": start_time,
+            "end_time": now,
+            "event_details": ("Migrated " + str(summary["migrated"]) +
+                              " of " + str(len(bags)) + " bags (" +
+                              str(summary["files"]) + " files) from " +
+                              "storage " + str(source_storage_id) + " (" +
+                              source["path_root"] + ")" +
+                              (", verified against manifests." if verify
+                               else ", without verification.")),
+            "tools_used": ("SANCdpd stormig, methods " +
+                           ", ".join(m + ": " + str(n) for m, n in
+                                     sorted(summary["methods"].items()))),
+            "outcome_code": outcome,
+            "outcome_details": "; ".join(details)[:2500] or None
+            }, [(agents[0], "Person running the migration"),
+                (agents[1], "Software performing the migration")])
+
+    # Remove the original bags, once the data is on disk
+    if remove_source and done:
+        if hasattr(os, "sync"):
+            os.sync()
+        for bag_id, newpath, srcdir, result in done:
+            shutil.rmtree(srcdir)
+        lg.log("migrate_storage: Removed " + str(len(done)) +
+               " original bags.")
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    summary["seconds"] = round(elapsed, 3)
+    summary["bytes_per_sec"] = round(
+        max(summary["bytes_copied"], summary["bytes_verified"]) / elapsed)
+
+    lg.log("migrate_storage: Done. " + str(summary["migrated"]) +
+           " migrated, " + str(summary["failed"]) + " failed, " +
+           str(summary["errors"]) + " errors.  Outcome " + outcome + ".")
+
+    return summary
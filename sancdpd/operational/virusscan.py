@@ -0,0 +1,460 @@
+"""
+This module implements virus scanning of bags, recorded in the SANCdpd
+database as "Scan for viruses" (VRSSC) events, with automatic "Enter
+quarantine" (QRNTN) and "Exit quarantine" (UNQRN) events.
+
+Scanning is done by a long-lived scanner daemon that speaks the clamd
+protocol:  the ClamAV daemon itself, or the stand-in in the scanstub module.
+The daemon keeps its signature database loaded, so SANCdpd never starts a
+scanner process.  Its address is set with the optional "clamd_address" key
+in the config file:  "host:port" for TCP, or the path of a Unix socket
+(default "localhost:3310").
+
+There are two scanning modes, set with the mode argument or the optional
+"scan_mode" key in the config file:
+  - "instream" (the default):  SANCdpd reads each payload file and streams
+    it to the daemon with the INSTREAM command.  Each connection is a clamd
+    session (IDSESSION), reused for many files.  This works even if the
+    daemon cannot see the storage location.
+  - "multiscan":  SANCdpd sends the path of each bag's payload directory
+    with the MULTISCAN command, and the daemon reads and scans the files
+    itself with its own threads.  The daemon must see the storage location
+    at the same paths.
+The number of concurrent connections to the daemon is set with the
+connections argument or the optional "scan_connections" key in the config
+file (default 4).
+
+One VRSSC event is written per bag, with the outcome NVIR (no virus found),
+VIR (virus found), or ERR (some file could not be scanned).  A bag with
+outcome VIR that is not already in quarantine also gets a QRNTN event.  A
+bag in quarantine (whose latest QRNTN event is later than its latest UNQRN
+event) with outcome NVIR gets an UNQRN event.  Events are written in
+batches.
+
+This module contains the following function:
+    scan_bags() :  Scan bags for viruses and record VRSSC events
+"""
+
+# Import modules from the Python standard library
+import concurrent.futures    # for the pool of scanning threads
+import json                  # for passing bag IDs to queries
+import os                    # for file sizes
+import os.path               # for building paths
+import socket                # for connecting to the scanner daemon
+import struct                # for INSTREAM chunk lengths
+import threading             # for per-thread scanner sessions
+import time                  # for measuring throughput
+
+# Import other SANCdpd modules
+import conf
+import logger as lg
+import dbops
+import metrics
+import operational.bagit as bagit
+import operational.bagval as bagval
+
+
+###############################################################################
+# Global (for this module) constants
+###############################################################################
+
+# Default address of the scanner daemon
+DEFAULT_ADDRESS = "localhost:3310"
+
+# Default number of concurrent connections to the scanner daemon
+DEFAULT_CONNECTIONS = 4
+
+# Seconds to wait for the scanner daemon before giving up
+SOCKET_TIMEOUT = 600
+
+# Size of the chunks of a file sent with INSTREAM
+STREAM_CHUNK = 256 * 1024
+
+# Upper limits on the size of one unit of work in "instream" mode
+CHUNK_MAX_FILES = 64
+CHUNK_MAX_BYTES = 64 * 1024 * 1024
+
+# Number of units of work to keep queued per connection
+UNITS_PER_CONNECTION = 4
+
+# Number of bag_event rows to insert per transaction
+EVENT_BATCH_SIZE = 500
+
+
+###############################################################################
+# function: _connect
+###############################################################################
+def _connect(address):
+    """
+    Opens a socket to the scanner daemon at address ("host:port" or the path
+    of a Unix socket).
+    """
+    if ":" in address and not os.path.isabs(address):
+        host, port = address.rsplit(":", 1)
+        sock = socket.create_connection((host, int(port)), SOCKET_TIMEOUT)
+        # Send each small command and chunk at once, without waiting for
+        # acknowledgment of the last one
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(SOCKET_TIMEOUT)
+        sock.connect(address)
+    return sock
+
+
+###############################################################################
+# function: _parse_reply
+###############################################################################
+def _parse_reply(reply):
+    """
+    Parses one clamd reply line, like "stream: OK", "/path: Sig FOUND", or
+    "/path: Some problem. ERROR".
+    Returns a triple (subject, status, detail), where status is "OK",
+    "FOUND", or "ERROR".
+    """
+    subject, _, rest = reply.rpartition(": ")
+    if rest == "OK":
+        return subject, "OK", None
+    if rest.endswith(" FOUND"):
+        return subject, "FOUND", rest[:-len(" FOUND")]
+    return subject, "ERROR", rest
+
+
+###############################################################################
+# class: _Session
+###############################################################################
+class _Session:
+    """
+    A clamd session (IDSESSION) on one connection, used by one thread to
+    scan many files with INSTREAM.
+    """
+
+    def __init__(self, address):
+        self.sock = _connect(address)
+        self.buf = b""
+        self.reqid = 0
+        self.sock.sendall(b"zIDSESSION\0")
+
+    def reply(self):
+        while b"\0" not in self.buf:
+            data = self.sock.recv(65536)
+            if not data:
+                raise Exception("Scanner closed the connection.")
+            self.buf += data
+        line, self.buf = self.buf.split(b"\0", 1)
+        line = line.decode("utf-8", "replace")
+        reqid, _, reply = line.partition(": ")
+        if reqid != str(self.reqid):
+            raise Exception("Unexpected reply from scanner: " + line)
+        return reply
+
+    def instream(self, fp):
+        self.reqid += 1
+        self.sock.sendall(b"zINSTREAM\0")
+        while True:
+            block = fp.read(STREAM_CHUNK)
+            if not block:
+                break
+            self.sock.sendall(struct.pack("!L", len(block)) + block)
+        self.sock.sendall(struct.pack("!L", 0))
+        return _parse_reply(self.reply())
+
+    def close(self):
+        try:
+            self.sock.sendall(b"zEND\0")
+        except OSError:
+            pass
+        self.sock.close()
+
+
+###############################################################################
+# function: _command
+###############################################################################
+def _command(address, command):
+    """
+    Sends one command (outside a session) to the scanner daemon.
+    Returns the list of reply lines, read until the daemon closes the
+    connection.
+    """
+    sock = _connect(address)
+    try:
+        sock.sendall(b"z" + command.encode("utf-8") + b"\0")
+        data = b""
+        while True:
+            block = sock.recv(65536)
+            if not block:
+                break
+            data += block
+    finally:
+        sock.close()
+    return [line.decode("utf-8", "replace")
+            for line in data.split(b"\0") if line]
+
+
+###############################################################################
+# function: _scan_files
+###############################################################################
+@metrics.timed("scan_files")
+def _scan_files(local, address, bag_id, chunk):
+    """
+    Runs in a worker thread.  Scans a chunk of (relpath, abspath) pairs with
+    INSTREAM, on this thread's session (opened on first use).
+    Returns a pair:  the bag_id, and a list of (relpath, status, detail).
+    """
+    results = []
+    for relpath, abspath in chunk:
+        try:
+            fp = open(abspath, "rb")
+        except OSError as e:
+            results.append((relpath, "ERROR", e.strerror))
+            continue
+        try:
+            if local.session is None:
+                local.session = _Session(address)
+                local.sessions.append(local.session)
+            subject, status, detail = local.session.instream(fp)
+        except Exception as e:
+            # The session may be unusable; the next file starts a new one
+            if local.session is not None:
+                local.session.close()
+                local.session = None
+            status, detail = "ERROR", str(e)
+        finally:
+            fp.close()
+        results.append((relpath, status, detail))
+    return bag_id, results
+
+
+###############################################################################
+# function: _multiscan_bag
+###############################################################################
+@metrics.timed("scan_bag")
+def _multiscan_bag(address, bag_id, bagdir):
+    """
+    Runs in a worker thread.  Scans the payload directory of a bag with
+    MULTISCAN.
+    Returns a pair:  the bag_id, and a list of (relpath, status, detail) for
+    each file reported (or for the payload directory, if none was).
+    """
+    payload = os.path.join(bagdir, bagit.PAYLOAD_DIR)
+    results = []
+    try:
+        replies = _command(address, "MULTISCAN " + payload)
+    except Exception as e:
+        return bag_id, [(bagit.PAYLOAD_DIR, "ERROR", str(e))]
+    for reply in replies:
+        subject, status, detail = _parse_reply(reply)
+        relpath = os.path.relpath(subject, bagdir).replace(os.sep, "/")
+        results.append((relpath, status, detail))
+    return bag_id, results
+
+
+###############################################################################
+# function: _quarantined
+###############################################################################
+def _quarantined(cur, bag_ids):
+    """
+    Returns the set of bag IDs, among bag_ids, that are in quarantine:  that
+    have a QRNTN event later than their latest UNQRN event.
+    """
+    qstr = """SELECT bag_id,
+                     max(CASE WHEN event_type_code = 'QRNTN'
+                              THEN bag_event_id END),
+                     max(CASE WHEN event_type_code = 'UNQRN'
+                              THEN bag_event_id END)
+              FROM bag_event
+              WHERE event_type_code IN ('QRNTN', 'UNQRN')
+                AND bag_id IN (SELECT value FROM json_each(?))
+              GROUP BY bag_id"""
+    found = set()
+    for bag_id, qid, uid in cur.execute(qstr, (json.dumps(list(bag_ids)),)):
+        if qid is not None and (uid is None or qid > uid):
+            found.add(bag_id)
+    return found
+
+
+###############################################################################
+# function: scan_bags
+###############################################################################
+def scan_bags(storage_id=None, bag_ids=None, mode=None, connections=None):
+    """
+    Scans the payloads of bags for viruses, and records one VRSSC event per
+    bag, with QRNTN and UNQRN events as needed.
+    Either storage_id or bag_ids (a list) may be given, to limit the bags
+    scanned.  The mode ("instream" or "multiscan") and the number of
+    connections default to the config file settings.
+    Returns a dictionary summarizing the run.
+    """
+    address = conf.fconf.get("clamd_address", DEFAULT_ADDRESS)
+    if mode is None:
+        mode = conf.fconf.get("scan_mode", "instream")
+    if mode not in ("instream", "multiscan"):
+        raise Exception("Unknown scan mode: " + str(mode))
+    if connections is None:
+        connections = conf.fconf.get("scan_connections", DEFAULT_CONNECTIONS)
+    connections = int(connections)
+
+    # Check that the scanner is there, and record its version
+    version = _command(address, "VERSION")
+    if not version:
+        raise Exception("No reply from scanner at " + address)
+    tools = version[0] + " (" + mode + ", " + str(connections) + \
+        " connections)"
+
+    cur = dbops.connect().cursor()
+    bags = bagval.select_bags(cur, storage_id, bag_ids)
+    quarantined = _quarantined(cur, [b[0] for b in bags])
+    agents = dbops.agent_ids()
+    cur.close()
+
+    lg.log("scan_bags: Scanning " + str(len(bags)) + " bags with " + tools +
+           " at " + address + ".")
+
+    summary = {"bags": len(bags), "NVIR": 0, "VIR": 0, "ERR": 0,
+               "files": 0, "bytes": 0, "quarantined": 0, "released": 0,
+               "bag_event_ids": []}
+    states = {}
+    rows = []
+    started = time.monotonic()
+
+    def flush_events():
+        if rows:
+            with dbops.transaction() as tcur:
+                ids = dbops.insert_bag_events(tcur, rows)
+            summary["bag_event_ids"].extend(ids)
+            del rows[:]
+
+    def event(bag_id, code, outcome, start_time, details, outcome_details):
+        rows.append({"bag_id": bag_id, "event_type_code": code,
+                     "person_agent_id": agents[0],
+                     "software_agent_id": agents[1],
+                     "start_time": start_time,
+                     "end_time": dbops.timestamp(),
+                     "event_details": details,
+                     "tools_used": tools,
+                     "outcome_code": outcome,
+                     "outcome_details": outcome_details})
+
+    def finish(bag_id):
+        state = states.pop(bag_id)
+        if state["found"]:
+            outcome = "VIR"
+            details = state["found"] + state["errors"]
+        elif state["errors"]:
+            outcome = "ERR"
+            details = state["errors"]
+        else:
+            outcome = "NVIR"
+            details = []
+        summary[outcome] += 1
+        summary["files"] += state["files"]
+        summary["bytes"] += state["bytes"]
+        outcome_details = "; ".join(details)[:2500] or None
+        event(bag_id, "VRSSC", outcome, state["start_time"],
+              "Scanned " + (str(state["files"]) + " payload files (" +
+                            str(state["bytes"]) + " bytes)"
+                            if mode == "instream" else "payload directory") +
+              " for viruses.", outcome_details)
+        if outcome == "VIR" and bag_id not in quarantined:
+            event(bag_id, "QRNTN", "SUCC", None,
+                  "Bag entered quarantine after virus scan.",
+                  outcome_details)
+            summary["quarantined"] += 1
+        elif outcome == "NVIR" and bag_id in quarantined:
+            event(bag_id, "UNQRN", "SUCC", None,
+                  "Bag exited quarantine after clean virus scan.", None)
+            summary["released"] += 1
+        lg.log("scan_bags: Bag " + str(bag_id) + " " + outcome)
+        if len(rows) >= EVENT_BATCH_SIZE:
+            flush_events()
+
+    def collect(bag_id, results):
+        state = states[bag_id]
+        for relpath, status, detail in results:
+            if status == "FOUND":
+                state["found"].append(detail + " in " + relpath)
+            elif status == "ERROR":
+                state["errors"].append("cannot scan " + relpath + ": " +
+                                       str(detail))
+        state["units"] -= 1
+        if state["units"] == 0:
+            finish(bag_id)
+
+    local = threading.local()
+    sessions = []
+
+    def init_thread():
+        local.session = None
+        local.sessions = sessions
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=connections, initializer=init_thread) as pool:
+        pending = set()
+        for bag_id, bagdir in bags:
+            state = {"start_time": dbops.timestamp(), "found": [],
+                     "errors": [], "files": 0, "bytes": 0, "units": 0}
+            states[bag_id] = state
+            try:
+                if not os.path.isdir(os.path.join(bagdir, bagit.PAYLOAD_DIR)):
+                    raise Exception("Payload directory not found in " +
+                                    bagdir)
+                if mode == "multiscan":
+                    units = [pool.submit(_multiscan_bag, address, bag_id,
+                                         bagdir)]
+                else:
+                    units = []
+                    chunk = []
+                    chunkbytes = 0
+                    for relpath, size in sorted(
+                            bagit.walk_payload(bagdir).items()):
+                        chunk.append((relpath, os.path.join(bagdir, relpath)))
+                        chunkbytes += size
+                        state["files"] += 1
+                        state["bytes"] += size
+                        if (len(chunk) >= CHUNK_MAX_FILES or
+                                chunkbytes >= CHUNK_MAX_BYTES):
+                            units.append(pool.submit(_scan_files, local,
+                                                     address, bag_id, chunk))
+                            chunk = []
+                            chunkbytes = 0
+                    if chunk:
+                        units.append(pool.submit(_scan_files, local, address,
+                                                 bag_id, chunk))
+            except Exception as e:
+                state["errors"].append(str(e))
+                units = []
+            state["units"] = len(units)
+            pending.update(units)
+            if not units:
+                finish(bag_id)
+
+            # Collect finished work, waiting if too much is queued
+            while pending:
+                done, _ = concurrent.futures.wait(
+                    pending, timeout=0 if len(pending) < connections *
+                    UNITS_PER_CONNECTION else None,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                if not done:
+                    break
+                for fut in done:
+                    pending.discard(fut)
+                    collect(*fut.result())
+
+        for fut in concurrent.futures.as_completed(pending):
+            collect(*fut.result())
+
+    for session in sessions:
+        session.close()
+    flush_events()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    summary["seconds"] = round(elapsed, 3)
+    summary["bytes_per_sec"] = round(summary["bytes"] / elapsed)
+    summary["files_per_sec"] = round(summary["files"] / elapsed, 1)
+
+    lg.log("scan_bags: Done. " + str(summary["NVIR"]) + " clean, " +
+           str(summary["VIR"]) + " with viruses, " + str(summary["ERR"]) +
+           " errors.  " + str(summary["quarantined"]) + " quarantined, " +
+           str(summary["released"]) + " released.")
+
+    return summary
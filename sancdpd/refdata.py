@@ -0,0 +1,306 @@
+"""
+This module keeps an in-memory cache of the SANCdpd reference tables:
+    `event_type`
+    `event_type_outcome`
+    `agent`
+    `storage`
+
+The cache lets bulk operations check codes and look up agents and storage
+locations in memory, with dictionary lookups, instead of querying the
+database for every row.  Event types and their outcomes are loaded with a
+single join.
+
+The cache is loaded on first use.  After that, it is checked for staleness at
+most once every CHECK_INTERVAL seconds.  The check reads the versions of the
+reference tables from the table_version table, which triggers raise on every
+insert, delete, or update of those tables (see schema.REFDATA_VERSIONED),
+and the tables are reloaded only if a version differs from the one taken at
+the last load.  This sees changes made by any connection, including this
+process's own, and changes that leave the size of a table the same.  Code
+that changes the reference tables may still call invalidate() afterward, to
+see the change at once rather than after CHECK_INTERVAL seconds.
+
+This module contains the following functions:
+    load() :  Load (or reload) the cache from the database
+    refresh() :  Reload the cache if the reference tables have changed
+    invalidate() :  Force a reload on the next lookup
+    event_type() :  Look up an event type by code
+    event_types() :  List all event types
+    outcomes() :  List the valid outcomes for an event type
+    is_valid_outcome() :  Check an (event type, outcome) pair
+    agent_by_code() :  Look up an agent by agent_code
+    agent_by_id() :  Look up an agent by agent_id
+    agents() :  List all agents
+    storage() :  Look up a storage location by storage_id
+"""
+
+# Import modules from the Python standard library
+import sqlite3 as sq         # for recognizing an older schema
+import time                  # for rate-limiting staleness checks
+
+# Import other SANCdpd modules
+import logger as lg
+import dbops
+
+
+###############################################################################
+# Global (for this module) data structures
+###############################################################################
+
+# Minimum number of seconds between checks of the table versions
+CHECK_INTERVAL = 1.0
+
+# Event types, keyed by event_type_code.
+# Each value is an ordered triple as follows:
+#    (event_type_code, event_name, event_category_code)
+_etypes = {}
+
+# Valid outcomes, keyed by (event_type_code, outcome_code).
+# Each value is the outcome_name.
+_outcomes = {}
+
+# Lists of valid outcomes, keyed by event_type_code.
+# Each outcome is represented as an ordered pair as follows:
+#    (outcome_code, outcome_name)
+_outcomes_by_type = {}
+
+# Agents, keyed by agent_id and by agent_code.
+# Each value is a dictionary of the agent's columns.
+_agents_by_id = {}
+_agents_by_code = {}
+
+# Storage locations, keyed by storage_id.
+# Each value is a dictionary of the storage location's columns.
+_storage = {}
+
+# State of the cache
+_loaded = False
+_versions = None
+_last_check = 0.0
+
+# Query returning the versions of the reference tables.  Versions only
+# increase, so their sum changes whenever any of the tables changes.
+VERSION_QUERY = """
+    SELECT sum(version) FROM table_version
+    WHERE table_name IN ('event_type', 'event_type_outcome', 'agent',
+                         'storage')"""
+
+
+###############################################################################
+# function: _read_versions
+###############################################################################
+def _read_versions(con):
+    """
+    Returns the sum of the versions of the reference tables, or None if the
+    database has no table_version table yet (before schema version 9, as
+    while the schema is being migrated).
+    """
+    try:
+        return con.execute(VERSION_QUERY).fetchone()[0]
+    except sq.OperationalError:
+        return None
+
+
+###############################################################################
+# function: load
+###############################################################################
+def load():
+    """
+    Loads all reference tables into the cache, replacing its contents.
+    """
+    global _loaded, _versions, _last_check
+
+    cur = dbops.connect().cursor()
+
+    # Read the versions first, so that a change made while loading is seen
+    # by the next check
+    _versions = _read_versions(cur)
+
+    # Event types and outcomes, in one join
+    qstr = """SELECT et.event_type_code, et.event_name,
+                     et.event_category_code,
+                     o.outcome_code, o.outcome_name
+              FROM event_type et
+              LEFT JOIN event_type_outcome o
+                ON o.event_type_code = et.event_type_code
+              ORDER BY et.rowid, o.rowid"""
+    _etypes.clear()
+    _outcomes.clear()
+    _outcomes_by_type.clear()
+    for code, name, category, ocode, oname in cur.execute(qstr):
+        _etypes[code] = (code, name, category)
+        olist = _outcomes_by_type.setdefault(code, [])
+        if ocode is not None:
+            _outcomes[(code, ocode)] = oname
+            olist.append((ocode, oname))
+
+    # Agents
+    qstr = "SELECT * FROM agent"
+    cur.execute(qstr)
+    cols = [d[0] for d in cur.description]
+    _agents_by_id.clear()
+    _agents_by_code.clear()
+    for row in cur:
+        agent = dict(zip(cols, row))
+        _agents_by_id[agent["agent_id"]] = agent
+        if agent["agent_code"] is not None:
+            _agents_by_code[agent["agent_code"]] = agent
+
+    # Storage locations
+    qstr = "SELECT * FROM storage"
+    cur.execute(qstr)
+    cols = [d[0] for d in cur.description]
+    _storage.clear()
+    for row in cur:
+        loc = dict(zip(cols, row))
+        _storage[loc["storage_id"]] = loc
+
+    cur.close()
+    _loaded = True
+    _last_check = time.monotonic()
+
+    lg.log("refdata: Loaded " + str(len(_etypes)) + " event types, " +
+           str(len(_outcomes)) + " outcomes, " + str(len(_agents_by_id)) +
+           " agents, " + str(len(_storage)) + " storage locations.")
+
+
+###############################################################################
+# function: refresh
+###############################################################################
+def refresh():
+    """
+    Loads the cache if it has not been loaded, or reloads it if the
+    reference tables have changed since the last load.
+    """
+    global _last_check
+
+    if not _loaded:
+        load()
+        return
+
+    _last_check = time.monotonic()
+    versions = _read_versions(dbops.connect())
+    if versions is None or versions != _versions:
+        load()
+
+
+###############################################################################
+# function: invalidate
+###############################################################################
+def invalidate():
+    """
+    Marks the cache as stale, so that the next lookup reloads it.
+    """
+    global _loaded
+    _loaded = False
+
+
+###############################################################################
+# function: _ensure
+###############################################################################
+def _ensure():
+    """
+    Makes sure the cache is loaded and has been checked for staleness in
+    the last CHECK_INTERVAL seconds.
+    """
+    if not _loaded or time.monotonic() - _last_check > CHECK_INTERVAL:
+        refresh()
+
+
+###############################################################################
+# function: event_type
+###############################################################################
+def event_type(code):
+    """
+    Returns the (event_type_code, event_name, event_category_code) triple for
+    an event type code, or None if there is no such event type.
+    """
+    _ensure()
+    return _etypes.get(code)
+
+
+
+###############################################################################
+# function: event_types
+###############################################################################
+def event_types():
+    """
+    Returns the list of (event_type_code, event_name, event_category_code)
+    triples for all event types.
+    """
+    _ensure()
+    return list(_etypes.values())
+
+
+
+###############################################################################
+# function: outcomes
+###############################################################################
+def outcomes(code):
+    """
+    Returns the list of (outcome_code, outcome_name) pairs valid for an event
+    type code.
+    """
+    _ensure()
+    return list(_outcomes_by_type.get(code, []))
+
+
+
+###############################################################################
+# function: is_valid_outcome
+###############################################################################
+def is_valid_outcome(code, outcome_code):
+    """
+    Returns True if outcome_code is a valid outcome for the event type code.
+    """
+    _ensure()
+    return (code, outcome_code) in _outcomes
+
+
+
+###############################################################################
+# function: agent_by_code
+###############################################################################
+def agent_by_code(agent_code):
+    """
+    Returns a dictionary of the columns of the agent with agent_code, or None.
+    """
+    _ensure()
+    return _agents_by_code.get(agent_code)
+
+
+
+###############################################################################
+# function: agent_by_id
+###############################################################################
+def agent_by_id(agent_id):
+    """
+    Returns a dictionary of the columns of the agent with agent_id, or None.
+    """
+    _ensure()
+    return _agents_by_id.get(agent_id)
+
+
+
+###############################################################################
+# function: agents
+###############################################################################
+def agents():
+    """
+    Returns a list of dictionaries of the columns of all agents.
+    """
+    _ensure()
+    return list(_agents_by_id.values())
+
+
+
+###############################################################################
+# function: storage
+###############################################################################
+def storage(storage_id):
+    """
+    Returns a dictionary of the columns of the storage location with
+    storage_id, or None.
+    """
+    _ensure()
+    return _storage.get(storage_id)
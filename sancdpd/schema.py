@@ -0,0 +1,739 @@
+"""
+This module manages the version of the SANCdpd database schema, and checks
+that the core queries of SANCdpd use the indexes they were designed for.
+
+The schema version is stored in the database with PRAGMA user_version.
+A database created with the scripts in sql_ddl has the current version.
+A database created before versioning has version 0.  Older databases are
+brought up to date by migrate(), which applies each pending migration in
+MIGRATIONS in its own transaction, and sets the version at the end of each.
+Foreign key enforcement is off while migrations run, so that a migration
+can rebuild a table that other tables refer to; each migration checks the
+foreign keys of the whole database before it commits.
+
+When the schema changes, add a migration to the end of MIGRATIONS, make the
+same change in sql_ddl/create_tables.sql (including the user_version pragma
+at the end of that file) or, for views, in sql_ddl/create_views.sql, and
+update SCHEMA_VERSION.
+
+The query plan checks run EXPLAIN QUERY PLAN for each query in PLAN_CHECKS
+and confirm that the plan uses the expected index.  This catches changes
+(to the schema or to the queries) that would turn an index search into a
+full table scan on tables with millions of rows.
+
+This module contains the following functions:
+    version() :  Returns the schema version of the database
+    migrate() :  Applies pending migrations
+    check_version() :  Raises an exception if the schema version is wrong
+    check_query_plans() :  Checks that core queries use their indexes
+"""
+
+# Import other SANCdpd modules
+import logger as lg
+import dbops
+import operational.bagit as bagit
+import operational.lineage as lineage
+
+
+###############################################################################
+# Global (for this module) data structures
+###############################################################################
+
+# The schema version this software expects
+SCHEMA_VERSION = 10
+
+# Definition of the bag table from schema version 5 on:  the tagmanifest
+# contents are no longer UNIQUE, and the canonical digest of the
+# tagmanifest is stored (with a UNIQUE index) instead
+BAG_TABLE_V5 = """CREATE TABLE bag_new (
+    bag_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    bag_family_id INTEGER NOT NULL,
+    storage_id INTEGER NOT NULL,
+    preservation_path VARCHAR(100) NOT NULL,
+    preservation_bag_name VARCHAR(50) NOT NULL,
+    SANC_container_id VARCHAR(50) NOT NULL,
+    original_bag_name VARCHAR(255) NOT NULL,
+    records_collection_id INTEGER NOT NULL,
+    item_id INTEGER NOT NULL,
+    still_exists BOOLEAN NOT NULL,
+    born_digital BOOLEAN NOT NULL,
+    preservation_level_code VARCHAR(5),
+    preservation_level_explanation VARCHAR(2500),
+    processing_status_code VARCHAR(5) NOT NULL,
+    processing_notes VARCHAR(500),
+    path_records_status VARCHAR(5) NOT NULL,
+    path_collection_type VARCHAR(5) NOT NULL,
+    path_records_group VARCHAR(20) NOT NULL,
+    path_series_no VARCHAR(20),
+    path_item_no VARCHAR(20),
+    path_accession_no VARCHAR(20) NOT NULL,
+    path_accession_no_suffix VARCHAR(4),
+    tagmanifest_filename VARCHAR(50),
+    tagmanifest_contents VARCHAR(5000),
+    tagmanifest_digest VARCHAR(64),
+    "bag-info_contents" VARCHAR(5000) NOT NULL,
+    "bag-info_Bagging-Date" VARCHAR(50),
+    "bag-info_digitalContentStructure" VARCHAR(100),
+    "bag-info_digitalOriginality" VARCHAR(100),
+    payload_files INTEGER NOT NULL,
+    payload_bytes BIGINT NOT NULL,
+    total_files INTEGER,
+    total_bytes BIGINT,
+    general_notes VARCHAR(2500),
+    FOREIGN KEY (bag_family_id)
+        REFERENCES bag_family (bag_family_id),
+    FOREIGN KEY (storage_id)
+        REFERENCES storage (storage_id),
+    FOREIGN KEY (records_collection_id)
+        REFERENCES records_collection (records_collection_id),
+    FOREIGN KEY (item_id)
+        REFERENCES item (item_id)
+)"""
+
+# Full-text search (schema version 7 on):  FTS5 tables whose content is
+# read from the bag and bag_event tables, and triggers that keep them in
+# sync.  Rows that existed when the tables were added are indexed by
+# operational.search.backfill_search(), which records its progress in the
+# search_backfill table.  Until a row has been backfilled, the triggers
+# leave it alone (FTS5 must be told the exact old values to delete a row
+# from its index).
+SEARCH_TABLES = [
+    """CREATE TABLE IF NOT EXISTS search_backfill (
+        table_name VARCHAR(50) PRIMARY KEY,
+        last_rowid INTEGER NOT NULL,
+        max_rowid INTEGER NOT NULL,
+        updated_time DATETIME NOT NULL
+    )""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS bag_fts USING fts5(
+        "bag-info_contents", general_notes, processing_notes,
+        content='bag', content_rowid='bag_id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS bag_event_fts USING fts5(
+        event_details,
+        content='bag_event', content_rowid='bag_event_id',
+        tokenize='unicode61 remove_diacritics 2'
+    )"""
+    ]
+
+# Triggers for each FTS5 table, built from (FTS5 table, content table,
+# rowid column, indexed columns)
+SEARCH_INDEXES = [
+    ("bag_fts", "bag", "bag_id",
+        ['"bag-info_contents"', "general_notes", "processing_notes"]),
+    ("bag_event_fts", "bag_event", "bag_event_id", ["event_details"])
+    ]
+
+
+# Capacity summaries (schema version 8 on):  the number of bags, files, and
+# bytes for each storage location, records collection, processing status,
+# and still_exists value, kept current by triggers on the bag table, so
+# that storage reports need not aggregate the whole bag table.  The views
+# roll the summaries up for the bags that still exist.
+CAPACITY_TABLES = [
+    """CREATE TABLE IF NOT EXISTS bag_capacity (
+        storage_id INTEGER NOT NULL,
+        records_collection_id INTEGER NOT NULL,
+        processing_status_code VARCHAR(5) NOT NULL,
+        still_exists BOOLEAN NOT NULL,
+        bags INTEGER NOT NULL,
+        payload_files INTEGER NOT NULL,
+        payload_bytes BIGINT NOT NULL,
+        total_files INTEGER NOT NULL,
+        total_bytes BIGINT NOT NULL,
+        PRIMARY KEY (storage_id, records_collection_id,
+                     processing_status_code, still_exists)
+    )"""
+    ]
+
+# Key columns of bag_capacity, and the expression for each on a bag row
+# named {0} (still_exists is stored as 0 or 1)
+CAPACITY_KEYS = [
+    ("storage_id", "{0}.storage_id"),
+    ("records_collection_id", "{0}.records_collection_id"),
+    ("processing_status_code", "{0}.processing_status_code"),
+    ("still_exists", "CASE WHEN {0}.still_exists THEN 1 ELSE 0 END")
+    ]
+
+# Summed columns of bag_capacity, and the expression for each on a bag row
+# named {0}
+CAPACITY_SUMS = [
+    ("bags", "1"),
+    ("payload_files", "{0}.payload_files"),
+    ("payload_bytes", "{0}.payload_bytes"),
+    ("total_files", "coalesce({0}.total_files, 0)"),
+    ("total_bytes", "coalesce({0}.total_bytes, 0)")
+    ]
+
+# Query computing the capacity summaries from the bag table itself, with
+# the columns of bag_capacity in order
+CAPACITY_QUERY = (
+    "SELECT " +
+    ", ".join(e.format("b") + " AS " + c for c, e in CAPACITY_KEYS) + ", " +
+    ", ".join("sum(" + e.format("b") + ") AS " + c
+              for c, e in CAPACITY_SUMS) +
+    " FROM bag b GROUP BY " +
+    ", ".join(str(i + 1) for i in range(len(CAPACITY_KEYS))))
+
+# Views of the capacity summaries
+CAPACITY_VIEWS = [
+    """CREATE VIEW IF NOT EXISTS storage_capacity AS
+    SELECT s.storage_id, s.storage_name, s.path_root, s.in_use,
+           coalesce(sum(c.bags), 0) AS bags,
+           coalesce(sum(c.payload_files), 0) AS payload_files,
+           coalesce(sum(c.payload_bytes), 0) AS payload_bytes,
+           coalesce(sum(c.total_files), 0) AS total_files,
+           coalesce(sum(c.total_bytes), 0) AS total_bytes
+    FROM storage s
+    LEFT JOIN bag_capacity c
+      ON c.storage_id = s.storage_id AND c.still_exists = 1
+    GROUP BY s.storage_id""",
+    """CREATE VIEW IF NOT EXISTS collection_capacity AS
+    SELECT rc.records_collection_id, rc.SANC_bib_record_id,
+           rc.records_collection_desc,
+           sum(c.bags) AS bags,
+           sum(c.payload_files) AS payload_files,
+           sum(c.payload_bytes) AS payload_bytes,
+           sum(c.total_files) AS total_files,
+           sum(c.total_bytes) AS total_bytes
+    FROM bag_capacity c
+    JOIN records_collection rc
+      ON rc.records_collection_id = c.records_collection_id
+    WHERE c.still_exists = 1
+    GROUP BY rc.records_collection_id""",
+    """CREATE VIEW IF NOT EXISTS processing_status_capacity AS
+    SELECT c.processing_status_code,
+           sum(c.bags) AS bags,
+           sum(c.payload_files) AS payload_files,
+           sum(c.payload_bytes) AS payload_bytes,
+           sum(c.total_files) AS total_files,
+           sum(c.total_bytes) AS total_bytes
+    FROM bag_capacity c
+    WHERE c.still_exists = 1
+    GROUP BY c.processing_status_code"""
+    ]
+
+
+
+# Table versions (schema version 9 on):  a version number for each table
+# whose contents SANCdpd caches in memory, raised by triggers whenever a row
+# of the table is inserted, deleted, or updated, so that a cache can tell
+# that a table has changed without reading it
+VERSION_TABLES = [
+    """CREATE TABLE IF NOT EXISTS table_version (
+        table_name VARCHAR(50) PRIMARY KEY,
+        version INTEGER NOT NULL
+    )"""
+    ]
+
+# Reference tables cached by the refdata module, each with the columns
+# whose updates change its version (None for any column)
+REFDATA_VERSIONED = [
+    ("event_type", None),
+    ("event_type_outcome", None),
+    ("agent", None),
+    ("storage", None)
+    ]
+
+# Tables read into the in-memory lineage index of the lineage module (from
+# schema version 10 on), each with the columns whose updates change its
+# version
+LINEAGE_VERSIONED = [
+    ("bag_has_parent_bag", None),
+    ("bag", ["bag_id", "bag_family_id"])
+    ]
+
+
+###############################################################################
+# function: _capacity_triggers
+###############################################################################
+def _capacity_triggers():
+    """
+    Returns the CREATE TRIGGER statements that keep bag_capacity current as
+    bags are inserted, updated, and deleted.
+    """
+    keys = ", ".join(c for c, e in CAPACITY_KEYS)
+    sums = ", ".join(c for c, e in CAPACITY_SUMS)
+
+    def add(ref):
+        return ("INSERT INTO bag_capacity (" + keys + ", " + sums + ") " +
+                "VALUES (" +
+                ", ".join(e.format(ref) for c, e in CAPACITY_KEYS) + ", " +
+                ", ".join(e.format(ref) for c, e in CAPACITY_SUMS) + ") " +
+                "ON CONFLICT (" + keys + ") DO UPDATE SET " +
+                ", ".join(c + " = " + c + " + excluded." + c
+                          for c, e in CAPACITY_SUMS) + ";")
+
+    def remove(ref):
+        where = " AND ".join(c + " = " + e.format(ref)
+                             for c, e in CAPACITY_KEYS)
+        return ("UPDATE bag_capacity SET " +
+                ", ".join(c + " = " + c + " - " + e.format(ref)
+                          for c, e in CAPACITY_SUMS) +
+                " WHERE " + where + "; " +
+                "DELETE FROM bag_capacity WHERE " + where + " AND bags = 0;")
+
+    cols = [c for c, e in CAPACITY_KEYS] + \
+        [c for c, e in CAPACITY_SUMS if c != "bags"]
+    changed = " OR ".join("old." + c + " IS NOT new." + c for c in cols)
+    return [
+        "CREATE TRIGGER IF NOT EXISTS bag_capacity_insert " +
+        "AFTER INSERT ON bag BEGIN " + add("new") + " END",
+        "CREATE TRIGGER IF NOT EXISTS bag_capacity_delete " +
+        "AFTER DELETE ON bag BEGIN " + remove("old") + " END",
+        "CREATE TRIGGER IF NOT EXISTS bag_capacity_update " +
+        "AFTER UPDATE OF " + ", ".join(cols) + " ON bag WHEN " + changed +
+        " BEGIN " + remove("old") + " " + add("new") + " END"
+        ]
+
+
+###############################################################################
+# function: _version_triggers
+###############################################################################
+def _version_triggers(versioned):
+    """
+    Returns the statements that add a row to table_version for each table
+    in versioned (a list of (table, columns) pairs), and the CREATE TRIGGER
+    statements that raise its version when the table changes.
+    """
+    statements = []
+    for table, cols in versioned:
+        bump = ("BEGIN UPDATE table_version SET version = version + 1 " +
+                "WHERE table_name = '" + table + "'; END")
+        statements.append("INSERT OR IGNORE INTO table_version " +
+                          "(table_name, version) VALUES ('" + table +
+                          "', 0)")
+        statements.append("CREATE TRIGGER IF NOT EXISTS " + table +
+                          "_version_insert AFTER INSERT ON " + table +
+                          " " + bump)
+        statements.append("CREATE TRIGGER IF NOT EXISTS " + table +
+                          "_version_delete AFTER DELETE ON " + table +
+                          " " + bump)
+        statements.append("CREATE TRIGGER IF NOT EXISTS " + table +
+                          "_version_update AFTER UPDATE " +
+                          ("OF " + ", ".join(cols) + " " if cols else "") +
+                          "ON " + table + " " + bump)
+    return statements
+
+
+###############################################################################
+# function: _search_triggers
+###############################################################################
+def _search_triggers():
+    """
+    Returns the CREATE TRIGGER statements that keep the FTS5 tables in
+    SEARCH_INDEXES in sync with their content tables.
+    """
+    triggers = []
+    for fts, table, rowid, cols in SEARCH_INDEXES:
+        collist = ", ".join(cols)
+
+        def values(ref):
+            return ref + "." + rowid + ", " + ", ".join(ref + "." + c
+                                                       for c in cols)
+
+        def indexed(ref):
+            return ("NOT EXISTS (SELECT 1 FROM search_backfill " +
+                    "WHERE table_name = '" + table + "' AND " +
+                    ref + "." + rowid + " > last_rowid AND " +
+                    ref + "." + rowid + " <= max_rowid)")
+
+        insert = ("INSERT INTO " + fts + " (rowid, " + collist + ") " +
+                  "VALUES (" + values("new") + ");")
+        delete = ("INSERT INTO " + fts + " (" + fts + ", rowid, " + collist +
+                  ") VALUES ('delete', " + values("old") + ");")
+        triggers.append("CREATE TRIGGER IF NOT EXISTS " + fts + "_insert " +
+                        "AFTER INSERT ON " + table + " WHEN " +
+                        indexed("new") + " BEGIN " + insert + " END")
+        triggers.append("CREATE TRIGGER IF NOT EXISTS " + fts + "_delete " +
+                        "AFTER DELETE ON " + table + " WHEN " +
+                        indexed("old") + " BEGIN " + delete + " END")
+        triggers.append("CREATE TRIGGER IF NOT EXISTS " + fts + "_update " +
+                        "AFTER UPDATE OF " + collist + " ON " + table +
+                        " WHEN " + indexed("old") + " BEGIN " + delete +
+                        " " + insert + " END")
+    return triggers
+
+
+###############################################################################
+# function: _start_search_backfill
+###############################################################################
+def _start_search_backfill(cur):
+    """
+    Migration step.  Records, for each table indexed for full-text search,
+    the highest rowid that existed when the index was added.  Rows up to
+    that one are left for operational.search.backfill_search(); later rows
+    are indexed by the triggers.
+    """
+    now = dbops.timestamp()
+    for fts, table, rowid, cols in SEARCH_INDEXES:
+        top = cur.execute("SELECT max(" + rowid + ") FROM " + table
+                          ).fetchone()[0]
+        cur.execute("""INSERT OR REPLACE INTO search_backfill
+                         (table_name, last_rowid, max_rowid, updated_time)
+                       VALUES (?, 0, ?, ?)""", (table, top or 0, now))
+
+
+###############################################################################
+# function: _rebuild_bag_table
+###############################################################################
+def _rebuild_bag_table(cur):
+    """
+    Migration step.  Rebuilds the bag table with the definition in
+    BAG_TABLE_V5, keeping every row, the AUTOINCREMENT sequence, and the
+    indexes and triggers on the table.  (SQLite cannot drop a UNIQUE
+    constraint in place.)
+    """
+    cols = [r[1] for r in cur.execute("PRAGMA table_info(bag)")]
+    collist = ", ".join('"' + c + '"' for c in cols)
+    seq = cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'bag'"
+                      ).fetchone()
+    indexes = cur.execute("""SELECT sql FROM sqlite_master
+                             WHERE type IN ('index', 'trigger')
+                               AND tbl_name = 'bag'
+                               AND sql IS NOT NULL""").fetchall()
+
+    cur.execute(BAG_TABLE_V5)
+    cur.execute("INSERT INTO bag_new (" + collist + ") SELECT " + collist +
+                " FROM bag")
+    cur.execute("DROP TABLE bag")
+    cur.execute("ALTER TABLE bag_new RENAME TO bag")
+    if seq is not None:
+        cur.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'bag'",
+                    (seq[0],))
+    for (sql,) in indexes:
+        cur.execute(sql)
+
+
+###############################################################################
+# function: _fill_tagmanifest_digests
+###############################################################################
+def _fill_tagmanifest_digests(cur):
+    """
+    Migration step.  Computes tagmanifest_digest for every bag that has
+    tagmanifest_contents.
+    Tagmanifests that differ only in line order, line endings, or spacing
+    have the same digest, which the UNIQUE index on tagmanifest_digest does
+    not allow.  Such a bag is a copy of an earlier bag, so only the bag with
+    the lowest bag_id gets the digest; the later ones are left NULL, and
+    are logged as warnings.
+    """
+    rows = cur.execute("""SELECT bag_id, tagmanifest_contents FROM bag
+                          WHERE tagmanifest_contents IS NOT NULL
+                          ORDER BY bag_id""").fetchall()
+    first = {}
+    updates = []
+    for bag_id, text in rows:
+        digest = bagit.manifest_digest(text)
+        if digest in first:
+            lg.log("migrate: Bag " + str(bag_id) + " has the same " +
+                   "tagmanifest as bag " + str(first[digest]) + "; its " +
+                   "tagmanifest_digest is left empty.", "WARNING")
+            continue
+        first[digest] = bag_id
+        updates.append((digest, bag_id))
+    cur.executemany("UPDATE bag SET tagmanifest_digest = ? WHERE bag_id = ?",
+                    updates)
+
+
+# List of migrations.  Each migration is a 3-tuple:
+#    - the schema version after the migration
+#    - a description
+#    - a list of steps, each an SQL statement or a function that takes a
+#      cursor (for changes that SQL alone cannot make)
+# Statements should be safe to run on a database that already has some of
+# the changes (hence IF NOT EXISTS), since databases created before schema
+# versioning may have been partly updated by hand.
+MIGRATIONS = [
+(1, "Fixity cache, registration checkpoints, and lineage indexes", [
+    """CREATE TABLE IF NOT EXISTS fixity_cache (
+        bag_id INTEGER NOT NULL,
+        relative_path VARCHAR(1000) NOT NULL,
+        file_size BIGINT NOT NULL,
+        mtime_ns BIGINT NOT NULL,
+        inode BIGINT NOT NULL,
+        algorithm VARCHAR(10) NOT NULL,
+        digest VARCHAR(128) NOT NULL,
+        verified_time DATETIME NOT NULL,
+        PRIMARY KEY (bag_id, relative_path),
+        FOREIGN KEY (bag_id)
+            REFERENCES bag (bag_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS registration_checkpoint (
+        storage_id INTEGER PRIMARY KEY,
+        last_bag_path VARCHAR(255) NOT NULL,
+        updated_time DATETIME NOT NULL,
+        FOREIGN KEY (storage_id)
+            REFERENCES storage (storage_id)
+    )""",
+    """CREATE INDEX IF NOT EXISTS idx_bag_has_parent_bag_parent
+        ON bag_has_parent_bag (parent_bag_id, child_bag_id)""",
+    """CREATE INDEX IF NOT EXISTS idx_bag_family
+        ON bag (bag_family_id)"""
+    ]),
+(2, "Secondary indexes for core queries", [
+    """CREATE INDEX IF NOT EXISTS idx_bag_event_bag
+        ON bag_event (bag_id, end_time)""",
+    """CREATE INDEX IF NOT EXISTS idx_bag_event_type_time
+        ON bag_event (event_type_code, end_time)""",
+    """CREATE INDEX IF NOT EXISTS idx_bag_storage
+        ON bag (storage_id)""",
+    """CREATE INDEX IF NOT EXISTS idx_bag_container
+        ON bag (SANC_container_id)""",
+    """CREATE INDEX IF NOT EXISTS idx_bag_from_accession_accession
+        ON bag_from_accession (accession_id)""",
+    """CREATE INDEX IF NOT EXISTS idx_storage_event_storage
+        ON storage_event (storage_id, end_time)"""
+    ]),
+(3, "Backup checkpoints", [
+    """CREATE TABLE IF NOT EXISTS backup_checkpoint (
+        storage_id INTEGER NOT NULL,
+        bag_id INTEGER NOT NULL,
+        run_start_time DATETIME NOT NULL,
+        completed_time DATETIME NOT NULL,
+        PRIMARY KEY (storage_id, bag_id),
+        FOREIGN KEY (storage_id)
+            REFERENCES storage (storage_id),
+        FOREIGN KEY (bag_id)
+            REFERENCES bag (bag_id)
+    )"""
+    ]),
+(4, "Access copy task state", [
+    """CREATE TABLE IF NOT EXISTS access_task (
+        bag_id INTEGER NOT NULL,
+        source_path VARCHAR(1000) NOT NULL,
+        source_digest VARCHAR(140) NOT NULL,
+        converter VARCHAR(100) NOT NULL,
+        converter_version VARCHAR(255) NOT NULL,
+        output_path VARCHAR(1000) NOT NULL,
+        status VARCHAR(10) NOT NULL,
+        message VARCHAR(500),
+        updated_time DATETIME NOT NULL,
+        PRIMARY KEY (bag_id, source_path),
+        FOREIGN KEY (bag_id)
+            REFERENCES bag (bag_id),
+        CHECK (status IN ('pending', 'done', 'failed'))
+    )"""
+    ]),
+(5, "Indexed tagmanifest digests instead of UNIQUE tagmanifest contents", [
+    _rebuild_bag_table,
+    _fill_tagmanifest_digests,
+    """CREATE UNIQUE INDEX IF NOT EXISTS idx_bag_tagmanifest_digest
+        ON bag (tagmanifest_digest)"""
+    ]),
+(6, "Job queue", [
+    """CREATE TABLE IF NOT EXISTS job (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        procname VARCHAR(50) NOT NULL,
+        arguments VARCHAR(2500) NOT NULL,
+        status VARCHAR(10) NOT NULL,
+        priority INTEGER NOT NULL,
+        attempts INTEGER NOT NULL,
+        max_attempts INTEGER NOT NULL,
+        run_after_time DATETIME NOT NULL,
+        enqueued_time DATETIME NOT NULL,
+        started_time DATETIME,
+        finished_time DATETIME,
+        worker VARCHAR(100),
+        lease_expires_time DATETIME,
+        heartbeat_time DATETIME,
+        checkpoint VARCHAR(5000),
+        result VARCHAR(5000),
+        error VARCHAR(2500),
+        CHECK (status IN ('queued', 'running', 'done', 'failed',
+                          'cancelled'))
+    )""",
+    """CREATE TABLE IF NOT EXISTS job_bag_event (
+        job_id INTEGER NOT NULL,
+        bag_event_id INTEGER NOT NULL,
+        PRIMARY KEY (job_id, bag_event_id),
+        FOREIGN KEY (job_id)
+            REFERENCES job (job_id),
+        FOREIGN KEY (bag_event_id)
+            REFERENCES bag_event (bag_event_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS job_storage_event (
+        job_id INTEGER NOT NULL,
+        storage_event_id INTEGER NOT NULL,
+        PRIMARY KEY (job_id, storage_event_id),
+        FOREIGN KEY (job_id)
+            REFERENCES job (job_id),
+        FOREIGN KEY (storage_event_id)
+            REFERENCES storage_event (storage_event_id)
+    )""",
+    """CREATE INDEX IF NOT EXISTS idx_job_status
+        ON job (status, priority, job_id)"""
+    ]),
+(7, "Full-text search of bag-info, notes, and event details",
+    SEARCH_TABLES + [_start_search_backfill] + _search_triggers()),
+(8, "Capacity summaries of bags by storage, collection, and status",
+    CAPACITY_TABLES + [
+    "DELETE FROM bag_capacity",
+    "INSERT INTO bag_capacity " + CAPACITY_QUERY
+    ] + _capacity_triggers() + CAPACITY_VIEWS),
+(9, "Versions of the cached reference tables",
+    VERSION_TABLES + _version_triggers(REFDATA_VERSIONED)),
+(10, "Versions of the tables in the lineage index",
+    _version_triggers(LINEAGE_VERSIONED))
+]
+
+# List of query plan checks.  Each check is a 4-tuple:
+#    - a name for the query
+#    - the query
+#    - the query parameters
+#    - the name of the index that the plan must use
+PLAN_CHECKS = [
+("events of a bag",
+    """SELECT * FROM bag_event WHERE bag_id = ? ORDER BY end_time""",
+    (1,), "idx_bag_event_bag"),
+("events of a type in a date range",
+    """SELECT * FROM bag_event
+       WHERE event_type_code = ? AND end_time BETWEEN ? AND ?""",
+    ("BGVAL", "2022-01-01", "2023-01-01"), "idx_bag_event_type_time"),
+("bags in a storage location",
+    """SELECT b.bag_id, s.path_root,
+              b.preservation_path, b.preservation_bag_name
+       FROM bag b
+       JOIN storage s ON s.storage_id = b.storage_id
+       WHERE b.still_exists AND b.storage_id = ?
+       ORDER BY b.bag_id""",
+    (1,), "idx_bag_storage"),
+("bags in a family",
+    """SELECT bag_id FROM bag WHERE bag_family_id = ?""",
+    (1,), "idx_bag_family"),
+("bags with a container ID",
+    """SELECT bag_id FROM bag WHERE SANC_container_id = ?""",
+    ("X",), "idx_bag_container"),
+("bags from an accession",
+    """SELECT bag_id FROM bag_from_accession WHERE accession_id = ?""",
+    (1,), "idx_bag_from_accession_accession"),
+("events of a storage location",
+    """SELECT * FROM storage_event WHERE storage_id = ?
+       ORDER BY end_time""",
+    (1,), "idx_storage_event_storage"),
+("descendants of a bag",
+    lineage.CTE_QUERIES["descendants"],
+    ("[1]",), "idx_bag_has_parent_bag_parent"),
+("ancestors of a bag",
+    lineage.CTE_QUERIES["ancestors"],
+    ("[1]",), "sqlite_autoindex_bag_has_parent_bag_1"),
+("fixity cache of a bag",
+    """SELECT relative_path, file_size, mtime_ns, inode,
+              algorithm, digest, verified_time
+       FROM fixity_cache
+       WHERE bag_id = ?""",
+    (1,), "sqlite_autoindex_fixity_cache_1"),
+("bags with a tagmanifest digest",
+    """SELECT bag_id FROM bag WHERE tagmanifest_digest = ?""",
+    ("0" * 64,), "idx_bag_tagmanifest_digest"),
+("queued jobs",
+    """SELECT job_id FROM job
+       WHERE status = 'queued' AND run_after_time <= ?
+       ORDER BY priority DESC, job_id""",
+    ("2022-01-01T00:00:00",), "idx_job_status")
+]
+
+
+###############################################################################
+# function: version
+###############################################################################
+def version():
+    """
+    Returns the schema version of the database (its PRAGMA user_version).
+    """
+    return dbops.connect().execute("PRAGMA user_version").fetchone()[0]
+
+
+###############################################################################
+# function: check_version
+###############################################################################
+def check_version():
+    """
+    Raises an exception if the database schema version is not the version
+    this software expects.
+    """
+    v = version()
+    if v < SCHEMA_VERSION:
+        raise Exception("Database schema version " + str(v) +
+                        " is older than version " + str(SCHEMA_VERSION) +
+                        ".  Run: python3 sancdpd schema migrate")
+    if v > SCHEMA_VERSION:
+        raise Exception("Database schema version " + str(v) +
+                        " is newer than this software (version " +
+                        str(SCHEMA_VERSION) + ").  Update SANCdpd.")
+
+
+###############################################################################
+# function: migrate
+###############################################################################
+def migrate():
+    """
+    Applies every migration newer than the database's schema version, in
+    order, each in its own transaction.
+    Returns a dictionary with the versions before and after, and the list of
+    migrations applied.
+    """
+    before = version()
+    applied = []
+    con = dbops.connect()
+
+    # These pragmas have no effect inside a transaction, so they are set
+    # around all the migrations rather than in each one
+    fkeys = con.execute("PRAGMA foreign_keys").fetchone()[0]
+    con.execute("PRAGMA foreign_keys = OFF")
+    con.execute("PRAGMA legacy_alter_table = ON")
+    try:
+        for v, description, steps in MIGRATIONS:
+            if v <= version():
+                continue
+            lg.log("migrate: Applying schema migration " + str(v) + ": " +
+                   description)
+            with dbops.transaction() as cur:
+                for step in steps:
+                    if callable(step):
+                        step(cur)
+                    else:
+                        cur.execute(step)
+                bad = cur.execute("PRAGMA foreign_key_check").fetchall()
+                if bad:
+                    raise Exception("Schema migration " + str(v) +
+                                    " would break " + str(len(bad)) +
+                                    " foreign key references, first in " +
+                                    "table " + bad[0][0] + ".")
+                cur.execute("PRAGMA user_version = " + str(v))
+            applied.append(str(v) + ": " + description)
+    finally:
+        con.execute("PRAGMA legacy_alter_table = OFF")
+        con.execute("PRAGMA foreign_keys = " + str(fkeys))
+
+    # Refresh the query planner's statistics for the new indexes
+    if applied:
+        con.execute("PRAGMA optimize")
+
+    return {"version_before": before, "version_after": version(),
+            "applied": applied}
+
+
+###############################################################################
+# function: check_query_plans
+###############################################################################
+def check_query_plans():
+    """
+    Runs EXPLAIN QUERY PLAN for each query in PLAN_CHECKS, and checks that
+    the plan uses the expected index.
+    Returns a dictionary with the number of checks passed, and a list of the
+    checks that failed, each with the plan SQLite chose.
+    """
+    con = dbops.connect()
+    result = {"passed": 0, "failed": []}
+    for name, query, params, index in PLAN_CHECKS:
+        plan = [row[3] for row in
+                con.execute("EXPLAIN QUERY PLAN " + query, params)]
+        if any((" INDEX " + index + " ") in (step + " ") for step in plan):
+            result["passed"] += 1
+        else:
+            result["failed"].append({"query": name, "expected": index,
+                                     "plan": plan})
+            lg.log("check_query_plans: '" + name + "' does not use " +
+                   index + ": " + " / ".join(plan), "WARNING")
+    return result
@@ -7,7 +7,11 @@ for the SANCdpd database.
 The target DBMS for this database is SQLite.  However, these data definition
 statements are compatible with MySQL with only minor changes.  In particular:
   - Replace all instanced of "AUTOINCREMENT" with "AUTO_INCREMENT".
-  - Remove the UNIQUE constraint on bag.tagmanifest_contents.
+  - Tagmanifests are kept unique by the unique index
+    idx_bag_tagmanifest_digest on bag.tagmanifest_digest (a SHA-256 hex
+    digest), not by a constraint on the long tagmanifest_contents column.
+    The index needs no change:  like SQLite, MySQL allows any number of
+    NULL digests in a unique index.
 *****************************************************************************/
 
 -- Tell the SQLite engine to enable foreign keys for the following statements
@@ -70,7 +74,8 @@ CREATE TABLE bag (
     path_accession_no VARCHAR(20) NOT NULL,
     path_accession_no_suffix VARCHAR(4),
     tagmanifest_filename VARCHAR(50),
-    tagmanifest_contents VARCHAR(5000) UNIQUE,
+    tagmanifest_contents VARCHAR(5000),
+    tagmanifest_digest VARCHAR(64),
     "bag-info_contents" VARCHAR(5000) NOT NULL,
     "bag-info_Bagging-Date" VARCHAR(50),
     "bag-info_digitalContentStructure" VARCHAR(100),
@@ -202,6 +207,428 @@ CREATE TABLE storage_event_by_agent (
     FOREIGN KEY (agent_id)
         REFERENCES agent (agent_id)
 );
+CREATE TABLE fixity_cache (
+    bag_id INTEGER NOT NULL,
+    relative_path VARCHAR(1000) NOT NULL,
+    file_size BIGINT NOT NULL,
+    mtime_ns BIGINT NOT NULL,
+    inode BIGINT NOT NULL,
+    algorithm VARCHAR(10) NOT NULL,
+    digest VARCHAR(128) NOT NULL,
+    verified_time DATETIME NOT NULL,
+    PRIMARY KEY (bag_id, relative_path),
+    FOREIGN KEY (bag_id)
+        REFERENCES bag (bag_id)
+);
+CREATE TABLE registration_checkpoint (
+    storage_id INTEGER PRIMARY KEY,
+    last_bag_path VARCHAR(255) NOT NULL,
+    updated_time DATETIME NOT NULL,
+    FOREIGN KEY (storage_id)
+        REFERENCES storage (storage_id)
+);
+CREATE TABLE backup_checkpoint (
+    storage_id INTEGER NOT NULL,
+    bag_id INTEGER NOT NULL,
+    run_start_time DATETIME NOT NULL,
+    completed_time DATETIME NOT NULL,
+    PRIMARY KEY (storage_id, bag_id),
+    FOREIGN KEY (storage_id)
+        REFERENCES storage (storage_id),
+    FOREIGN KEY (bag_id)
+        REFERENCES bag (bag_id)
+);
+CREATE TABLE access_task (
+    bag_id INTEGER NOT NULL,
+    source_path VARCHAR(1000) NOT NULL,
+    source_digest VARCHAR(140) NOT NULL,
+    converter VARCHAR(100) NOT NULL,
+    converter_version VARCHAR(255) NOT NULL,
+    output_path VARCHAR(1000) NOT NULL,
+    status VARCHAR(10) NOT NULL,
+    message VARCHAR(500),
+    updated_time DATETIME NOT NULL,
+    PRIMARY KEY (bag_id, source_path),
+    FOREIGN KEY (bag_id)
+        REFERENCES bag (bag_id),
+    CHECK (status IN ('pending', 'done', 'failed'))
+);
+CREATE TABLE job (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    procname VARCHAR(50) NOT NULL,
+    arguments VARCHAR(2500) NOT NULL,
+    status VARCHAR(10) NOT NULL,
+    priority INTEGER NOT NULL,
+    attempts INTEGER NOT NULL,
+    max_attempts INTEGER NOT NULL,
+    run_after_time DATETIME NOT NULL,
+    enqueued_time DATETIME NOT NULL,
+    started_time DATETIME,
+    finished_time DATETIME,
+    worker VARCHAR(100),
+    lease_expires_time DATETIME,
+    heartbeat_time DATETIME,
+    checkpoint VARCHAR(5000),
+    result VARCHAR(5000),
+    error VARCHAR(2500),
+    CHECK (status IN ('queued', 'running', 'done', 'failed', 'cancelled'))
+);
+CREATE TABLE job_bag_event (
+    job_id INTEGER NOT NULL,
+    bag_event_id INTEGER NOT NULL,
+    PRIMARY KEY (job_id, bag_event_id),
+    FOREIGN KEY (job_id)
+        REFERENCES job (job_id),
+    FOREIGN KEY (bag_event_id)
+        REFERENCES bag_event (bag_event_id)
+);
+CREATE TABLE job_storage_event (
+    job_id INTEGER NOT NULL,
+    storage_event_id INTEGER NOT NULL,
+    PRIMARY KEY (job_id, storage_event_id),
+    FOREIGN KEY (job_id)
+        REFERENCES job (job_id),
+    FOREIGN KEY (storage_event_id)
+        REFERENCES storage_event (storage_event_id)
+);
+CREATE TABLE search_backfill (
+    table_name VARCHAR(50) PRIMARY KEY,
+    last_rowid INTEGER NOT NULL,
+    max_rowid INTEGER NOT NULL,
+    updated_time DATETIME NOT NULL
+);
+CREATE TABLE bag_capacity (
+    storage_id INTEGER NOT NULL,
+    records_collection_id INTEGER NOT NULL,
+    processing_status_code VARCHAR(5) NOT NULL,
+    still_exists BOOLEAN NOT NULL,
+    bags INTEGER NOT NULL,
+    payload_files INTEGER NOT NULL,
+    payload_bytes BIGINT NOT NULL,
+    total_files INTEGER NOT NULL,
+    total_bytes BIGINT NOT NULL,
+    PRIMARY KEY (storage_id, records_collection_id,
+                 processing_status_code, still_exists)
+);
+CREATE TABLE table_version (
+    table_name VARCHAR(50) PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+
+
+
+-- Full-text search tables (external content, read from bag and bag_event)
+CREATE VIRTUAL TABLE bag_fts USING fts5(
+    "bag-info_contents", general_notes, processing_notes,
+    content='bag', content_rowid='bag_id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE VIRTUAL TABLE bag_event_fts USING fts5(
+    event_details,
+    content='bag_event', content_rowid='bag_event_id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+
+
+
+-- Secondary indexes
+CREATE INDEX idx_bag_has_parent_bag_parent
+    ON bag_has_parent_bag (parent_bag_id, child_bag_id);
+CREATE INDEX idx_bag_family
+    ON bag (bag_family_id);
+CREATE INDEX idx_bag_event_bag
+    ON bag_event (bag_id, end_time);
+CREATE INDEX idx_bag_event_type_time
+    ON bag_event (event_type_code, end_time);
+CREATE INDEX idx_bag_storage
+    ON bag (storage_id);
+CREATE INDEX idx_bag_container
+    ON bag (SANC_container_id);
+CREATE INDEX idx_bag_from_accession_accession
+    ON bag_from_accession (accession_id);
+CREATE INDEX idx_storage_event_storage
+    ON storage_event (storage_id, end_time);
+CREATE UNIQUE INDEX idx_bag_tagmanifest_digest
+    ON bag (tagmanifest_digest);
+CREATE INDEX idx_job_status
+    ON job (status, priority, job_id);
+
+-- Triggers keeping the full-text search tables in sync (rows not yet
+-- indexed by a backfill are skipped; see sancdpd/operational/search.py)
+CREATE TRIGGER bag_fts_insert AFTER INSERT ON bag
+WHEN NOT EXISTS (SELECT 1 FROM search_backfill
+                 WHERE table_name = 'bag'
+                   AND new.bag_id > last_rowid
+                   AND new.bag_id <= max_rowid)
+BEGIN
+    INSERT INTO bag_fts
+        (rowid, "bag-info_contents", general_notes, processing_notes)
+    VALUES (new.bag_id,
+            new."bag-info_contents",
+            new.general_notes,
+            new.processing_notes);
+END;
+CREATE TRIGGER bag_fts_delete AFTER DELETE ON bag
+WHEN NOT EXISTS (SELECT 1 FROM search_backfill
+                 WHERE table_name = 'bag'
+                   AND old.bag_id > last_rowid
+                   AND old.bag_id <= max_rowid)
+BEGIN
+    INSERT INTO bag_fts
+        (bag_fts, rowid, "bag-info_contents", general_notes, processing_notes)
+    VALUES ('delete', old.bag_id,
+            old."bag-info_contents",
+            old.general_notes,
+            old.processing_notes);
+END;
+CREATE TRIGGER bag_fts_update
+    AFTER UPDATE OF "bag-info_contents", general_notes, processing_notes
+    ON bag
+WHEN NOT EXISTS (SELECT 1 FROM search_backfill
+                 WHERE table_name = 'bag'
+                   AND old.bag_id > last_rowid
+                   AND old.bag_id <= max_rowid)
+BEGIN
+    INSERT INTO bag_fts
+        (bag_fts, rowid, "bag-info_contents", general_notes, processing_notes)
+    VALUES ('delete', old.bag_id,
+            old."bag-info_contents",
+            old.general_notes,
+            old.processing_notes);
+    INSERT INTO bag_fts
+        (rowid, "bag-info_contents", general_notes, processing_notes)
+    VALUES (new.bag_id,
+            new."bag-info_contents",
+            new.general_notes,
+            new.processing_notes);
+END;
+CREATE TRIGGER bag_event_fts_insert AFTER INSERT ON bag_event
+WHEN NOT EXISTS (SELECT 1 FROM search_backfill
+                 WHERE table_name = 'bag_event'
+                   AND new.bag_event_id > last_rowid
+                   AND new.bag_event_id <= max_rowid)
+BEGIN
+    INSERT INTO bag_event_fts (rowid, event_details)
+    VALUES (new.bag_event_id,
+            new.event_details);
+END;
+CREATE TRIGGER bag_event_fts_delete AFTER DELETE ON bag_event
+WHEN NOT EXISTS (SELECT 1 FROM search_backfill
+                 WHERE table_name = 'bag_event'
+                   AND old.bag_event_id > last_rowid
+                   AND old.bag_event_id <= max_rowid)
+BEGIN
+    INSERT INTO bag_event_fts (bag_event_fts, rowid, event_details)
+    VALUES ('delete', old.bag_event_id,
+            old.event_details);
+END;
+CREATE TRIGGER bag_event_fts_update
+    AFTER UPDATE OF event_details ON bag_event
+WHEN NOT EXISTS (SELECT 1 FROM search_backfill
+                 WHERE table_name = 'bag_event'
+                   AND old.bag_event_id > last_rowid
+                   AND old.bag_event_id <= max_rowid)
+BEGIN
+    INSERT INTO bag_event_fts (bag_event_fts, rowid, event_details)
+    VALUES ('delete', old.bag_event_id,
+            old.event_details);
+    INSERT INTO bag_event_fts (rowid, event_details)
+    VALUES (new.bag_event_id,
+            new.event_details);
+END;
+
+
+
+-- Triggers keeping the capacity summaries in bag_capacity current (see
+-- sancdpd/schema.py and sancdpd/operational/capacity.py)
+CREATE TRIGGER bag_capacity_insert AFTER INSERT ON bag
+BEGIN
+    INSERT INTO bag_capacity
+        (storage_id, records_collection_id, processing_status_code,
+         still_exists, bags, payload_files, payload_bytes,
+         total_files, total_bytes)
+    VALUES (new.storage_id, new.records_collection_id,
+            new.processing_status_code,
+            CASE WHEN new.still_exists THEN 1 ELSE 0 END,
+            1, new.payload_files, new.payload_bytes,
+            coalesce(new.total_files, 0), coalesce(new.total_bytes, 0))
+    ON CONFLICT (storage_id, records_collection_id,
+                 processing_status_code, still_exists)
+    DO UPDATE SET bags = bags + excluded.bags,
+                  payload_files = payload_files + excluded.payload_files,
+                  payload_bytes = payload_bytes + excluded.payload_bytes,
+                  total_files = total_files + excluded.total_files,
+                  total_bytes = total_bytes + excluded.total_bytes;
+END;
+CREATE TRIGGER bag_capacity_delete AFTER DELETE ON bag
+BEGIN
+    UPDATE bag_capacity
+    SET bags = bags - 1,
+        payload_files = payload_files - old.payload_files,
+        payload_bytes = payload_bytes - old.payload_bytes,
+        total_files = total_files - coalesce(old.total_files, 0),
+        total_bytes = total_bytes - coalesce(old.total_bytes, 0)
+    WHERE storage_id = old.storage_id
+      AND records_collection_id = old.records_collection_id
+      AND processing_status_code = old.processing_status_code
+      AND still_exists = CASE WHEN old.still_exists THEN 1 ELSE 0 END;
+    DELETE FROM bag_capacity
+    WHERE storage_id = old.storage_id
+      AND records_collection_id = old.records_collection_id
+      AND processing_status_code = old.processing_status_code
+      AND still_exists = CASE WHEN old.still_exists THEN 1 ELSE 0 END
+      AND bags = 0;
+END;
+CREATE TRIGGER bag_capacity_update
+    AFTER UPDATE OF storage_id, records_collection_id, processing_status_code,
+                    still_exists, payload_files, payload_bytes,
+                    total_files, total_bytes ON bag
+WHEN old.storage_id IS NOT new.storage_id
+  OR old.records_collection_id IS NOT new.records_collection_id
+  OR old.processing_status_code IS NOT new.processing_status_code
+  OR old.still_exists IS NOT new.still_exists
+  OR old.payload_files IS NOT new.payload_files
+  OR old.payload_bytes IS NOT new.payload_bytes
+  OR old.total_files IS NOT new.total_files
+  OR old.total_bytes IS NOT new.total_bytes
+BEGIN
+    UPDATE bag_capacity
+    SET bags = bags - 1,
+        payload_files = payload_files - old.payload_files,
+        payload_bytes = payload_bytes - old.payload_bytes,
+        total_files = total_files - coalesce(old.total_files, 0),
+        total_bytes = total_bytes - coalesce(old.total_bytes, 0)
+    WHERE storage_id = old.storage_id
+      AND records_collection_id = old.records_collection_id
+      AND processing_status_code = old.processing_status_code
+      AND still_exists = CASE WHEN old.still_exists THEN 1 ELSE 0 END;
+    DELETE FROM bag_capacity
+    WHERE storage_id = old.storage_id
+      AND records_collection_id = old.records_collection_id
+      AND processing_status_code = old.processing_status_code
+      AND still_exists = CASE WHEN old.still_exists THEN 1 ELSE 0 END
+      AND bags = 0;
+    INSERT INTO bag_capacity
+        (storage_id, records_collection_id, processing_status_code,
+         still_exists, bags, payload_files, payload_bytes,
+         total_files, total_bytes)
+    VALUES (new.storage_id, new.records_collection_id,
+            new.processing_status_code,
+            CASE WHEN new.still_exists THEN 1 ELSE 0 END,
+            1, new.payload_files, new.payload_bytes,
+            coalesce(new.total_files, 0), coalesce(new.total_bytes, 0))
+    ON CONFLICT (storage_id, records_collection_id,
+                 processing_status_code, still_exists)
+    DO UPDATE SET bags = bags + excluded.bags,
+                  payload_files = payload_files + excluded.payload_files,
+                  payload_bytes = payload_bytes + excluded.payload_bytes,
+                  total_files = total_files + excluded.total_files,
+                  total_bytes = total_bytes + excluded.total_bytes;
+END;
+
+
+
+-- Versions of the reference tables cached by sancdpd/refdata.py and of the
+-- tables in the lineage index of sancdpd/operational/lineage.py, raised by
+-- triggers whenever the tables change
+INSERT INTO table_version (table_name, version)
+VALUES ('event_type', 0), ('event_type_outcome', 0), ('agent', 0),
+       ('storage', 0), ('bag_has_parent_bag', 0), ('bag', 0);
+CREATE TRIGGER event_type_version_insert AFTER INSERT ON event_type
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'event_type';
+END;
+CREATE TRIGGER event_type_version_delete AFTER DELETE ON event_type
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'event_type';
+END;
+CREATE TRIGGER event_type_version_update AFTER UPDATE ON event_type
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'event_type';
+END;
+CREATE TRIGGER event_type_outcome_version_insert AFTER INSERT ON event_type_outcome
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'event_type_outcome';
+END;
+CREATE TRIGGER event_type_outcome_version_delete AFTER DELETE ON event_type_outcome
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'event_type_outcome';
+END;
+CREATE TRIGGER event_type_outcome_version_update AFTER UPDATE ON event_type_outcome
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'event_type_outcome';
+END;
+CREATE TRIGGER agent_version_insert AFTER INSERT ON agent
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'agent';
+END;
+CREATE TRIGGER agent_version_delete AFTER DELETE ON agent
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'agent';
+END;
+CREATE TRIGGER agent_version_update AFTER UPDATE ON agent
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'agent';
+END;
+CREATE TRIGGER storage_version_insert AFTER INSERT ON storage
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'storage';
+END;
+CREATE TRIGGER storage_version_delete AFTER DELETE ON storage
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'storage';
+END;
+CREATE TRIGGER storage_version_update AFTER UPDATE ON storage
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'storage';
+END;
+CREATE TRIGGER bag_has_parent_bag_version_insert AFTER INSERT ON bag_has_parent_bag
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'bag_has_parent_bag';
+END;
+CREATE TRIGGER bag_has_parent_bag_version_delete AFTER DELETE ON bag_has_parent_bag
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'bag_has_parent_bag';
+END;
+CREATE TRIGGER bag_has_parent_bag_version_update AFTER UPDATE ON bag_has_parent_bag
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'bag_has_parent_bag';
+END;
+CREATE TRIGGER bag_version_insert AFTER INSERT ON bag
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'bag';
+END;
+CREATE TRIGGER bag_version_delete AFTER DELETE ON bag
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'bag';
+END;
+CREATE TRIGGER bag_version_update AFTER UPDATE OF bag_id, bag_family_id ON bag
+BEGIN
+    UPDATE table_version SET version = version + 1
+    WHERE table_name = 'bag';
+END;
+
+
+
+-- Schema version (see sancdpd/schema.py)
+PRAGMA user_version = 10;
 
 
 
@@ -0,0 +1,52 @@
+/*****************************************************************************
+create_views.sql
+
+This file consists of SQL data definition statements to create the views
+for the SANCdpd database.  Run it after create_tables.sql.
+
+The capacity views roll up the summaries in the bag_capacity table (kept
+current by triggers on the bag table) for the bags that still exist, so
+that storage reports need not aggregate the whole bag table.
+*****************************************************************************/
+
+
+
+-- Capacity of each storage location (locations without bags show zeros)
+CREATE VIEW storage_capacity AS
+SELECT s.storage_id, s.storage_name, s.path_root, s.in_use,
+       coalesce(sum(c.bags), 0) AS bags,
+       coalesce(sum(c.payload_files), 0) AS payload_files,
+       coalesce(sum(c.payload_bytes), 0) AS payload_bytes,
+       coalesce(sum(c.total_files), 0) AS total_files,
+       coalesce(sum(c.total_bytes), 0) AS total_bytes
+FROM storage s
+LEFT JOIN bag_capacity c
+  ON c.storage_id = s.storage_id AND c.still_exists = 1
+GROUP BY s.storage_id;
+
+-- Capacity of each records collection with bags
+CREATE VIEW collection_capacity AS
+SELECT rc.records_collection_id, rc.SANC_bib_record_id,
+       rc.records_collection_desc,
+       sum(c.bags) AS bags,
+       sum(c.payload_files) AS payload_files,
+       sum(c.payload_bytes) AS payload_bytes,
+       sum(c.total_files) AS total_files,
+       sum(c.total_bytes) AS total_bytes
+FROM bag_capacity c
+JOIN records_collection rc
+  ON rc.records_collection_id = c.records_collection_id
+WHERE c.still_exists = 1
+GROUP BY rc.records_collection_id;
+
+-- Capacity of the bags with each processing status
+CREATE VIEW processing_status_capacity AS
+SELECT c.processing_status_code,
+       sum(c.bags) AS bags,
+       sum(c.payload_files) AS payload_files,
+       sum(c.payload_bytes) AS payload_bytes,
+       sum(c.total_files) AS total_files,
+       sum(c.total_bytes) AS total_bytes
+FROM bag_capacity c
+WHERE c.still_exists = 1
+GROUP BY c.processing_status_code;
@@ -0,0 +1,146 @@
+"""
+Shared fixtures for the SANCdpd tests.
+
+The SANCdpd modules import each other by their plain names (e.g., "import
+conf"), so the sancdpd directory is put on the module search path here, as
+__main__.py does for "python3 -m sancdpd".
+
+The db fixture creates a new database with the scripts in sql_ddl and the
+example agents, writes a config file for it (with logging off), and runs
+the CLI startup on it, so that tests call SANCdpd functions just as a
+command would.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "sancdpd"))
+
+import cli
+import dbops
+import refdata
+
+# Scripts that create a current database, in the order they are run
+DDL_SCRIPTS = [os.path.join(ROOT, "sql_ddl", "create_tables.sql"),
+               os.path.join(ROOT, "sql_ddl", "create_views.sql"),
+               os.path.join(ROOT, "sql_ddl", "insert_event_types.sql"),
+               os.path.join(ROOT, "setup_resources",
+                            "insert_agents_EXAMPLE.sql")]
+
+# The tables of a database created before schema versioning
+V0_TABLES = os.path.join(ROOT, "tests", "data", "create_tables_v0.sql")
+
+
+def run_scripts(dbfile, scripts):
+    """
+    Runs SQL scripts, in order, on the database file dbfile.
+    """
+    con = sqlite3.connect(dbfile)
+    # The scripts commit statement by statement; a test database need not
+    # survive a crash
+    con.execute("PRAGMA synchronous = OFF")
+    for path in scripts:
+        with open(path, encoding="utf-8") as fp:
+            con.executescript(fp.read())
+    con.close()
+
+
+def make_bag(bagdir, files, algs=("sha256",), info=None):
+    """
+    Writes a BagIt bag at bagdir with a payload of files (a dictionary of
+    relative paths under data/ and their contents as bytes), manifests and
+    tagmanifests for each algorithm in algs, and a bag-info.txt with the
+    labels in info plus a Payload-Oxum.  Returns bagdir.
+    """
+    def digest(alg, data):
+        return hashlib.new(alg, data).hexdigest()
+
+    os.makedirs(bagdir)
+    for relpath, data in files.items():
+        path = os.path.join(bagdir, "data", relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fp:
+            fp.write(data)
+
+    tags = {"bagit.txt": b"BagIt-Version: 1.0\n"
+                         b"Tag-File-Character-Encoding: UTF-8\n"}
+    labels = dict(info or {})
+    labels["Payload-Oxum"] = (str(sum(len(d) for d in files.values())) +
+                              "." + str(len(files)))
+    tags["bag-info.txt"] = "".join(k + ": " + v + "\n"
+                                   for k, v in labels.items()).encode()
+    for alg in algs:
+        tags["manifest-" + alg + ".txt"] = "".join(
+            digest(alg, data) + "  data/" + relpath + "\n"
+            for relpath, data in sorted(files.items())).encode()
+    for alg in algs:
+        with open(os.path.join(bagdir, "tagmanifest-" + alg + ".txt"),
+                  "wb") as fp:
+            fp.write("".join(digest(alg, data) + " " + name + "\n"
+                             for name, data in sorted(tags.items()))
+                     .encode())
+    for name, data in tags.items():
+        with open(os.path.join(bagdir, name), "wb") as fp:
+            fp.write(data)
+    return bagdir
+
+
+@pytest.fixture
+def start(tmp_path, monkeypatch):
+    """
+    Returns a function that writes a config file for a database file, and
+    runs the CLI startup with it.  Connections and cached reference data are
+    dropped afterward, so that each test starts afresh.
+    """
+    def starter(dbfile, check_schema=True):
+        config = tmp_path / "SANCdpd_config.json"
+        config.write_text(json.dumps({
+            "person_agent_code": "OCK",
+            "logging": False,
+            "logdir": str(tmp_path),
+            "dbfile": str(dbfile),
+            "access_path_root": str(tmp_path / "access")}))
+        monkeypatch.setenv("SANCDPD_CONFIG", str(config))
+        dbops.close()
+        refdata.invalidate()
+        cli.startup(quiet=True, check_schema=check_schema)
+        return dbfile
+
+    yield starter
+    dbops.close()
+    refdata.invalidate()
+
+
+@pytest.fixture
+def db(tmp_path, start):
+    """
+    Creates a current SANCdpd database with the sql_ddl scripts and the
+    example agents, and starts SANCdpd with it.  Returns the database path.
+    """
+    dbfile = tmp_path / "SANCdpd_test.db"
+    run_scripts(dbfile, DDL_SCRIPTS)
+    return start(dbfile)
+
+
+@pytest.fixture
+def storage(db, tmp_path):
+    """
+    Adds a storage location in a new directory, and returns a tuple of its
+    storage_id and its path_root.
+    """
+    root = tmp_path / "storage"
+    root.mkdir()
+    with dbops.transaction() as cur:
+        cur.execute("""INSERT INTO storage (storage_name, path_root,
+                                            in_use)
+                       VALUES ('test storage', ?, 1)""",
+                    (str(root) + os.sep,))
+        storage_id = cur.lastrowid
+    refdata.invalidate()
+    return storage_id, str(root) + os.sep
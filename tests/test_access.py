@@ -0,0 +1,38 @@
+"""
+Tests of access copy creation.
+"""
+
+import os
+
+import conf
+import operational.access as access
+import operational.bagmgmt as bagmgmt
+
+from conftest import make_bag
+
+
+def test_colliding_output_names(storage, tmp_path, monkeypatch):
+    storage_id, root = storage
+    make_bag(root + "PROC/STATE/DNCR/ACC1/bag1",
+             {"scan.tif": b"tif", "scan.jp2": b"jp2", "scan.jpg": b"jpg",
+              "other.tif": b"other"})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    to_jpg = {"command": "copy", "output_ext": "jpg", "version": "1"}
+    monkeypatch.setitem(conf.fconf, "access_converters", {
+        "tif": to_jpg, "jp2": to_jpg,
+        "jpg": {"command": "copy", "version": "1"}})
+    os.mkdir(conf.fconf["access_path_root"])
+
+    summary = access.create_access_copies(storage_id=storage_id, workers=2)
+    assert (summary["created"], summary["failed"]) == (4, 0)
+    accessdir = os.path.join(conf.fconf["access_path_root"],
+                             "PROC/STATE/DNCR/ACC1/bag1")
+    copies = {}
+    for name in os.listdir(accessdir):
+        with open(os.path.join(accessdir, name), "rb") as fp:
+            copies[name] = fp.read()
+    assert copies == {"scan.tif.jpg": b"tif", "scan.jp2.jpg": b"jp2",
+                      "scan.jpg": b"jpg", "other.jpg": b"other"}
+
+    summary = access.create_access_copies(storage_id=storage_id, workers=2)
+    assert (summary["created"], summary["current"]) == (0, 4)
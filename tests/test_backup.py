@@ -0,0 +1,56 @@
+"""
+Tests of backup replication and its checkpoints.
+"""
+
+import os
+
+import dbops
+import refdata
+import operational.backup as backup
+import operational.bagmgmt as bagmgmt
+
+from conftest import make_bag
+
+
+def replica_storage(tmp_path):
+    root = tmp_path / "replica"
+    root.mkdir()
+    with dbops.transaction() as cur:
+        cur.execute("""INSERT INTO storage (storage_name, path_root, in_use)
+                       VALUES ('replica', ?, 1)""", (str(root) + os.sep,))
+        storage_id = cur.lastrowid
+    refdata.invalidate()
+    return storage_id, str(root) + os.sep
+
+
+def checkpoint(replica_id):
+    return [r[0] for r in dbops.connect().execute(
+        """SELECT bag_id FROM backup_checkpoint WHERE storage_id = ?
+           ORDER BY bag_id""", (replica_id,))]
+
+
+def test_filtered_run_ignores_other_checkpoints(storage, tmp_path):
+    storage_id, root = storage
+    for name in ("bag1", "bag2"):
+        make_bag(root + "PROC/STATE/DNCR/ACC1/" + name,
+                 {"a.txt": name.encode()})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    replica_id, replica_root = replica_storage(tmp_path)
+
+    # An interrupted run for bag 1 left its checkpoint
+    with dbops.transaction() as cur:
+        cur.execute("""INSERT INTO backup_checkpoint
+                         (storage_id, bag_id, run_start_time, completed_time)
+                       VALUES (?, 1, '2026-01-01T00:00:00',
+                               '2026-01-01T00:00:01')""", (replica_id,))
+
+    summary = backup.backup_storage(storage_id, replica_id, bag_ids=[2])
+    assert (summary["bags"], summary["resumed"], summary["updated"]) == \
+        (1, 0, 1)
+    assert os.path.isdir(replica_root + "PROC/STATE/DNCR/ACC1/bag2")
+    assert checkpoint(replica_id) == [1]
+
+    summary = backup.backup_storage(storage_id, replica_id)
+    assert (summary["bags"], summary["resumed"], summary["unchanged"]) == \
+        (2, 1, 1)
+    assert checkpoint(replica_id) == []
@@ -0,0 +1,132 @@
+"""
+Tests of reading and registering bags.
+"""
+
+import os
+import shutil
+
+import dbops
+import operational.bagit as bagit
+import operational.bagmgmt as bagmgmt
+import operational.inventory as inventory
+
+from conftest import make_bag
+
+
+def test_read_bag(tmp_path):
+    root = str(tmp_path) + os.sep
+    make_bag(root + "PROC/STATE/DNCR/ACC1/bag1", {"a.txt": b"alpha"},
+             info={"SANC-Container-ID": "C1"})
+    rec = bagmgmt.read_bag(root, "PROC/STATE/DNCR/ACC1/bag1",
+                           bagmgmt.DEFAULT_PATH_LAYOUT)
+    assert rec["preservation_path"] == "PROC/STATE/DNCR/ACC1/"
+    assert rec["preservation_bag_name"] == "bag1"
+    assert rec["path_accession_no"] == "ACC1"
+    assert rec["SANC_container_id"] == "C1"
+    assert (rec["payload_bytes"], rec["payload_files"]) == (5, 1)
+    assert rec["tagmanifest_filename"] == "tagmanifest-sha256.txt"
+
+
+def test_read_bag_at_root(tmp_path):
+    root = str(tmp_path) + os.sep
+    make_bag(root + "bag1", {"a.txt": b"alpha"})
+    rec = bagmgmt.read_bag(root, "bag1", bagmgmt.DEFAULT_PATH_LAYOUT)
+    assert rec["preservation_path"] == ""
+    assert rec["preservation_bag_name"] == "bag1"
+    assert bagit.bag_dir(root, rec["preservation_path"],
+                         rec["preservation_bag_name"]) == root + "bag1"
+
+
+def test_register_storage_skips_known_bags(storage):
+    storage_id, root = storage
+    make_bag(root + "PROC/STATE/DNCR/ACC1/bag1", {"a.txt": b"alpha"})
+    first = bagmgmt.register_storage(storage_id, bib_record_id="B1",
+                                     item_no="1")
+    assert first["registered"] == 1
+    again = bagmgmt.register_storage(storage_id, bib_record_id="B1",
+                                     item_no="1", restart=True)
+    assert (again["registered"], again["skipped"]) == (0, 1)
+
+
+def test_bag_moved_to_root(storage):
+    storage_id, root = storage
+    make_bag(root + "PROC/STATE/DNCR/ACC1/bag1", {"a.txt": b"alpha"})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    os.rename(root + "PROC/STATE/DNCR/ACC1/bag1", root + "bag1")
+
+    summary = inventory.reconcile_inventory(storage_id, update=True)
+    assert [b["path"] for b in summary["moved"]] == ["bag1"]
+    path, name = dbops.connect().execute(
+        """SELECT preservation_path, preservation_bag_name
+           FROM bag""").fetchone()
+    assert path == ""
+    assert bagit.bag_dir(root, path, name) == root + "bag1"
+
+    summary = inventory.reconcile_inventory(storage_id)
+    assert summary["present"] == 1
+    assert summary["missing"] == summary["unexpected"] == []
+
+
+def test_inventory_skips_unreadable_subtrees(storage, monkeypatch):
+    storage_id, root = storage
+    make_bag(root + "PROC/STATE/DNCR/ACC1/bag1", {"a.txt": b"alpha"})
+    make_bag(root + "PROC/STATE/DNCR/ACC2/bag2", {"a.txt": b"beta"})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    shutil.rmtree(root + "PROC/STATE/DNCR/ACC1/bag1")
+    os.makedirs(root + "PROC/STATE/DNCR/ACC3")
+    os.rename(root + "PROC/STATE/DNCR/ACC2/bag2",
+              root + "PROC/STATE/DNCR/ACC3/bag2")
+
+    unreadable = root + "PROC/STATE/DNCR/ACC2"
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if os.path.normpath(path) == os.path.normpath(unreadable):
+            raise PermissionError(13, "Permission denied", path)
+        return scandir(path)
+    monkeypatch.setattr(os, "scandir", failing_scandir)
+
+    summary = inventory.reconcile_inventory(storage_id, update=True,
+                                            threads=2)
+    assert [b["path"] for b in summary["skipped"]] == ["PROC/STATE/DNCR/ACC2"]
+    assert [b["path"] for b in summary["missing"]] == [
+        "PROC/STATE/DNCR/ACC1/bag1"]
+    assert summary["moved"] == []
+    assert [b["path"] for b in summary["unexpected"]] == [
+        "PROC/STATE/DNCR/ACC3/bag2"]
+    assert summary["updated"] == 1
+    rows = dbops.connect().execute(
+        """SELECT preservation_path, still_exists FROM bag
+           WHERE preservation_bag_name = 'bag2'""").fetchall()
+    assert rows == [("PROC/STATE/DNCR/ACC2/", 1)]
+
+
+def test_register_new_bag_before_previous_last_path(storage):
+    storage_id, root = storage
+    make_bag(root + "PROC/STATE/DNCR/ACC5/bag5", {"a.txt": b"five"})
+    first = bagmgmt.register_storage(storage_id, bib_record_id="B1",
+                                     item_no="1")
+    assert first["registered"] == 1
+    assert dbops.connect().execute(
+        "SELECT count(*) FROM registration_checkpoint").fetchone()[0] == 0
+
+    make_bag(root + "PROC/STATE/DNCR/ACC1/bag1", {"a.txt": b"one"})
+    second = bagmgmt.register_storage(storage_id, bib_record_id="B1",
+                                      item_no="1")
+    assert (second["registered"], second["skipped"]) == (1, 1)
+
+
+def test_register_born_digital_values(storage):
+    storage_id, root = storage
+    values = {"born": "Born digital", "digitized": "Digitized",
+              "negated": "not born digital", "other": "Digitized (not "
+              "born-digital)"}
+    for name, value in values.items():
+        make_bag(root + "PROC/STATE/DNCR/ACC1/" + name,
+                 {"a.txt": name.encode()},
+                 info={"digitalOriginality": value})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1",
+                             born_digital=False)
+    rows = dict(dbops.connect().execute(
+        "SELECT preservation_bag_name, born_digital FROM bag"))
+    assert rows == {"born": 1, "digitized": 0, "negated": 0, "other": 0}
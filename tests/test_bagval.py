@@ -0,0 +1,78 @@
+"""
+Tests of reading manifests and planning the validation of a bag.
+"""
+
+import os
+
+import dbops
+import operational.bagit as bagit
+import operational.bagmgmt as bagmgmt
+import operational.bagval as bagval
+
+from conftest import make_bag
+
+
+def test_read_manifest_keeps_spaces_in_names(tmp_path):
+    path = tmp_path / "manifest-md5.txt"
+    path.write_bytes(b"0123abcd  data/report .pdf\r\n"
+                     b"4567ABCD *data/ trailing space \n"
+                     b"\n")
+    assert bagit.read_manifest(str(path)) == {
+        "data/report .pdf": "0123abcd",
+        "data/ trailing space ": "4567abcd"}
+
+
+def test_plan_bag(tmp_path):
+    bagdir = make_bag(str(tmp_path / "bag"),
+                      {"a.txt": b"alpha", "sub/b.txt": b"beta"},
+                      algs=("md5", "sha256"))
+    expected, problems, chunks = bagval._plan_bag(bagdir)
+    assert problems == []
+    assert set(expected["data/a.txt"]) == {"md5", "sha256"}
+    assert "tagmanifest-md5.txt" not in expected
+    assert "manifest-sha256.txt" in expected
+
+
+def test_plan_bag_unsupported_algorithm(tmp_path):
+    bagdir = make_bag(str(tmp_path / "bag"), {"a.txt": b"alpha"})
+    with open(os.path.join(bagdir, "manifest-blake3.txt"), "w") as fp:
+        fp.write("00ff  data/a.txt\n00ff  data/gone.txt\n")
+    with open(os.path.join(bagdir, "tagmanifest-blake3.txt"), "w") as fp:
+        fp.write("00ff  bagit.txt\n")
+
+    expected, problems, chunks = bagval._plan_bag(bagdir)
+    assert "unsupported manifest algorithm: blake3" in problems
+    assert "unsupported tagmanifest algorithm: blake3" in problems
+    assert "missing from payload: data/gone.txt" in problems
+    assert expected["data/a.txt"] == {
+        "sha256": bagit.read_manifest(
+            os.path.join(bagdir, "manifest-sha256.txt"))["data/a.txt"]}
+
+
+def test_plan_bag_only_unsupported_algorithm(tmp_path):
+    bagdir = make_bag(str(tmp_path / "bag"), {"a.txt": b"alpha"})
+    os.rename(os.path.join(bagdir, "manifest-sha256.txt"),
+              os.path.join(bagdir, "manifest-blake3.txt"))
+    expected, problems, chunks = bagval._plan_bag(bagdir)
+    assert "unsupported manifest algorithm: blake3" in problems
+    assert not any(p.startswith("not in manifest") for p in problems)
+    assert "data/a.txt" not in expected
+
+
+def test_validate_bags_with_unsupported_algorithm(storage):
+    storage_id, root = storage
+    good = make_bag(root + "PROC/STATE/DNCR/ACC1/good", {"a.txt": b"alpha"})
+    odd = make_bag(root + "PROC/STATE/DNCR/ACC1/odd", {"a.txt": b"beta"})
+    with open(os.path.join(odd, "manifest-blake3.txt"), "w") as fp:
+        fp.write("00ff  data/a.txt\n")
+    registered = bagmgmt.register_storage(storage_id, bib_record_id="B1",
+                                          item_no="1")
+    assert registered["registered"] == 2
+
+    summary = bagval.validate_bags(storage_id=storage_id, workers=1)
+    assert (summary["VAL"], summary["NVAL"], summary["ERR"]) == (1, 1, 0)
+    details = dbops.connect().execute(
+        """SELECT b.preservation_bag_name, e.outcome_code
+           FROM bag_event e JOIN bag b ON b.bag_id = e.bag_id
+           WHERE e.event_type_code = 'BGVAL'""").fetchall()
+    assert sorted(details) == [("good", "VAL"), ("odd", "NVAL")]
@@ -0,0 +1,50 @@
+"""
+Tests of the trigger-maintained capacity summaries.
+"""
+
+import os
+
+import dbops
+import operational.bagmgmt as bagmgmt
+import operational.capacity as capacity
+
+from conftest import make_bag
+
+
+def update(qstr, args=()):
+    with dbops.transaction() as cur:
+        cur.execute(qstr, args)
+    assert capacity.verify_capacity()["drift"] == []
+
+
+def test_capacity_follows_bag_changes(storage, tmp_path):
+    storage_id, root = storage
+    for name in ("bag1", "bag2", "bag3"):
+        make_bag(root + "PROC/STATE/DNCR/ACC1/" + name,
+                 {"a.txt": name.encode() * 10, "b.txt": b"b"})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    assert capacity.verify_capacity()["drift"] == []
+    [row] = capacity.list_storage()
+    assert (row["bags"], row["payload_bytes"]) == (3, 3 * 41)
+
+    with dbops.transaction() as cur:
+        cur.execute("""INSERT INTO storage (storage_name, path_root, in_use)
+                       VALUES ('other', ?, 1)""",
+                    (str(tmp_path / "other") + os.sep,))
+        other = cur.lastrowid
+    update("UPDATE bag SET still_exists = 0 WHERE bag_id = 1")
+    update("UPDATE bag SET storage_id = ? WHERE bag_id = 2", (other,))
+    update("UPDATE bag SET processing_status_code = 'PROC' WHERE bag_id = 3")
+    with dbops.transaction() as cur:
+        cur.execute("DELETE FROM bag_event WHERE bag_id = 3")
+        cur.execute("DELETE FROM bag_from_accession WHERE bag_id = 3")
+    update("DELETE FROM bag WHERE bag_id = 3")
+    assert [(r["storage_id"], r["bags"]) for r in capacity.list_storage()] \
+        == [(storage_id, 0), (other, 1)]
+
+    # Summaries changed behind the triggers' backs are found and rebuilt
+    with dbops.transaction() as cur:
+        cur.execute("UPDATE bag_capacity SET bags = bags + 5")
+    result = capacity.verify_capacity(repair=True)
+    assert result["drift"] and result["rebuilt"]
+    assert capacity.verify_capacity()["drift"] == []
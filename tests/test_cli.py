@@ -0,0 +1,71 @@
+"""
+Tests of the CLI definitions and of running commands.
+"""
+
+import json
+
+import cli
+import schema
+
+from conftest import V0_TABLES, DDL_SCRIPTS, run_scripts
+
+
+def configure(tmp_path, monkeypatch, dbfile):
+    """
+    Writes a config file for dbfile (with logging off), for cli.main() to
+    read.
+    """
+    config = tmp_path / "SANCdpd_config.json"
+    config.write_text(json.dumps({
+        "person_agent_code": "OCK",
+        "logging": False,
+        "logdir": str(tmp_path),
+        "dbfile": str(dbfile),
+        "access_path_root": str(tmp_path / "access")}))
+    monkeypatch.setenv("SANCDPD_CONFIG", str(config))
+
+
+def test_commands_name_procedures():
+    for command, procname, text in cli.cmddefs:
+        assert procname in cli.procdefs, command
+
+
+def test_new_ingest_registers_storage():
+    main = dict((key, target) for key, text, kind, target
+                in cli.menudefs["main"][1:])
+    assert main["n"] == "register_storage"
+    assert main["n"] in cli.procdefs
+
+
+def test_bench_generate_without_database(tmp_path, monkeypatch):
+    configure(tmp_path, monkeypatch, tmp_path / "absent.db")
+    status = cli.main(["bench", "generate", "--path-root",
+                       str(tmp_path / "synth"), "--bags", "2",
+                       "--events", "10", "--file-bytes", "100"])
+    assert status == 0
+    assert (tmp_path / "synth.db").exists()
+    assert not (tmp_path / "absent.db").exists()
+
+
+def test_startup_failure_is_status_3(tmp_path, monkeypatch, capsys):
+    configure(tmp_path, monkeypatch, tmp_path / "absent.db")
+    assert cli.main(["--json", "agents", "list"]) == 3
+    line = json.loads(capsys.readouterr().out)
+    assert line["command"] == "show_agents"
+    assert line["status"] == 3
+    assert "Database file not found" in line["error"]
+
+
+def test_batch_migrates_then_runs(tmp_path, monkeypatch, capsys):
+    old = tmp_path / "SANCdpd_v0.db"
+    run_scripts(old, [V0_TABLES] + DDL_SCRIPTS[2:])
+    configure(tmp_path, monkeypatch, old)
+    batch = tmp_path / "batch.txt"
+    batch.write_text("agents list\nschema migrate\nagents list\n")
+
+    assert cli.main(["--json", "--batch", str(batch)]) == 3
+    lines = [json.loads(l) for l in capsys.readouterr().out.splitlines()]
+    assert [(l["command"], l["status"]) for l in lines] == [
+        ("show_agents", 3), ("migrate_schema", 0), ("show_agents", 0)]
+    assert "older than version" in lines[0]["error"]
+    assert lines[1]["result"]["version_after"] == schema.SCHEMA_VERSION
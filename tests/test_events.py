@@ -0,0 +1,50 @@
+"""
+Tests of recording events from a file.
+"""
+
+import io
+import json
+
+import dbops
+import refdata
+import operational.bagmgmt as bagmgmt
+import operational.events as events
+
+from conftest import make_bag
+
+
+def test_record_events_checks_agent_roles(storage, tmp_path):
+    storage_id, root = storage
+    make_bag(root + "PROC/STATE/DNCR/ACC1/bag1", {"a.txt": b"alpha"})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    bag_id = dbops.connect().execute("SELECT bag_id FROM bag").fetchone()[0]
+    person = refdata.agent_by_code("OCK")["agent_id"]
+    software = [a["agent_id"] for a in refdata.agents()
+                if a["agent_type_code"] == "SOFTW"][0]
+
+    path = tmp_path / "scans.csv"
+    path.write_text(
+        "bag_id,person_agent_id,software_agent_code,software_agent_id\n" +
+        str(bag_id) + "," + str(person) + ",," + str(software) + "\n" +
+        str(bag_id) + "," + str(software) + ",,\n" +
+        str(bag_id) + ",,OCK,\n")
+
+    summary = events.record_events(str(path), event_type_code="VRSSC",
+                                   outcome_code="NVIR")
+    assert summary["recorded"] == 1
+    assert [e["row"] for e in summary["errors"]] == [2, 3]
+    assert "not a PERSN (person) agent" in summary["errors"][0]["error"]
+    assert "not a SOFTW (software) agent" in summary["errors"][1]["error"]
+
+
+def test_read_json_array_in_pieces(monkeypatch):
+    monkeypatch.setattr(events, "READ_CHARS", 5)
+    rows = [{"bag_id": n, "event_details": "x" * n} for n in range(1, 50)]
+    text = " [" + ", ".join(json.dumps(r) for r in rows) + ", 7 ]"
+    read = list(events.read_event_rows(io.StringIO(text)))
+    assert read[:-1] == list(enumerate(rows, 1))
+    assert read[-1] == (50, "Not a JSON object")
+
+    read = list(events.read_event_rows(io.StringIO('[{"bag_id": 1} {}]')))
+    assert read[0] == (1, {"bag_id": 1})
+    assert read[1][1].startswith("Invalid JSON")
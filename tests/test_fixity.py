@@ -0,0 +1,57 @@
+"""
+Tests of comparing the tagmanifests on disk with the database.
+"""
+
+import os
+
+import dbops
+import operational.bagmgmt as bagmgmt
+import operational.fixity as fixity
+
+from conftest import make_bag
+
+
+def test_compare_tagmanifests_missing_and_changed(storage):
+    storage_id, root = storage
+    bags = {}
+    for name in ("same", "gone", "edited"):
+        bags[name] = make_bag(root + "PROC/STATE/DNCR/ACC1/" + name,
+                              {"a.txt": name.encode()})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+
+    os.remove(os.path.join(bags["gone"], "tagmanifest-sha256.txt"))
+    with open(os.path.join(bags["edited"], "tagmanifest-sha256.txt"),
+              "a") as fp:
+        fp.write("00ff extra.txt\n")
+
+    summary = fixity.compare_tagmanifests(storage_id, record_events=True)
+    assert summary["bags"] == 3
+    assert summary["same"] == 1
+    assert [e["error"] for e in summary["errors"]] == ["tagmanifest missing"]
+    assert [c["added"] for c in summary["changed"]] == [["extra.txt"]]
+    outcomes = dbops.connect().execute(
+        """SELECT b.preservation_bag_name, e.outcome_code
+           FROM bag_event e JOIN bag b ON b.bag_id = e.bag_id
+           WHERE e.event_type_code = 'TGCMP'""").fetchall()
+    assert sorted(outcomes) == [("edited", "NSAM"), ("gone", "ERR"),
+                                ("same", "SAME")]
+
+
+def test_audit_reports_unreadable_files_with_mismatches(storage):
+    storage_id, root = storage
+    bagdir = make_bag(root + "PROC/STATE/DNCR/ACC1/bag1",
+                      {"a.txt": b"alpha", "b.txt": b"beta"})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    with open(os.path.join(bagdir, "data", "a.txt"), "wb") as fp:
+        fp.write(b"changed")
+    # A directory where a file should be can be listed, but not read
+    os.remove(os.path.join(bagdir, "data", "b.txt"))
+    os.mkdir(os.path.join(bagdir, "data", "b.txt"))
+
+    fixity.audit_bags(storage_id=storage_id, mode="full", workers=1)
+    outcome, details = dbops.connect().execute(
+        """SELECT outcome_code, outcome_details FROM bag_event
+           WHERE event_type_code = 'TGCMP'""").fetchone()
+    assert outcome == "NSAM"
+    assert "sha256 mismatch: data/a.txt" in details
+    assert "cannot read data/b.txt" in details
@@ -0,0 +1,24 @@
+"""
+Tests of hashing files.
+"""
+
+import hashlib
+
+import pytest
+
+import operational.hashing as hashing
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_hash_files_unknown_algorithm(tmp_path, threads):
+    files = []
+    for name in ("a.txt", "b.txt", "c.txt"):
+        path = tmp_path / name
+        path.write_bytes(name.encode())
+        files.append((str(path), ["sha256"]))
+    files[1] = (files[1][0], ["sha256", "blake3"])
+
+    results = hashing.hash_files(files, threads=threads)
+    assert [r[2] is None for r in results] == [True, False, True]
+    assert "blake3" in results[1][2]
+    assert results[2][0] == {"sha256": hashlib.sha256(b"c.txt").hexdigest()}
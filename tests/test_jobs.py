@@ -0,0 +1,119 @@
+"""
+Tests of the job queue:  retries, chunk checkpoints, and cancelling.
+"""
+
+import threading
+
+import pytest
+
+import conf
+import dbops
+import jobs
+import operational.bagmgmt as bagmgmt
+import operational.bagval as bagval
+
+from conftest import make_bag
+
+
+def register(storage, names):
+    storage_id, root = storage
+    for name in names:
+        make_bag(root + "PROC/STATE/DNCR/ACC1/" + name,
+                 {"a.txt": name.encode() * 10})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    return storage_id
+
+
+def make_due(job_id):
+    """
+    Lets a job queued for a retry run now.
+    """
+    with dbops.transaction() as cur:
+        cur.execute("""UPDATE job SET run_after_time = '2000-01-01T00:00:00'
+                       WHERE job_id = ?""", (job_id,))
+
+
+def test_job_retries_then_fails(db):
+    job_id = jobs.enqueue("verify_capacity", max_attempts=2)["job_id"]
+
+    job = jobs.claim("w1")
+    assert (job["job_id"], job["attempts"]) == (job_id, 1)
+    assert jobs._finish(job, "w1", error="disk error") == "queued"
+    # The retry waits for its delay
+    assert jobs.claim("w1") is None
+
+    make_due(job_id)
+    job = jobs.claim("w2")
+    assert job["attempts"] == 2
+    assert jobs._finish(job, "w2", error="disk error") == "failed"
+    job = jobs.show_job(job_id)
+    assert (job["status"], job["error"]) == ("failed", "disk error")
+    assert job["finished_time"] is not None
+    assert jobs.claim("w1") is None
+
+
+def test_lease_running_out_on_last_attempt_fails(db):
+    job_id = jobs.enqueue("verify_capacity", max_attempts=1)["job_id"]
+    jobs.claim("w1")
+    with dbops.transaction() as cur:
+        cur.execute("""UPDATE job
+                       SET lease_expires_time = '2000-01-01T00:00:00'
+                       WHERE job_id = ?""", (job_id,))
+    assert jobs.claim("w2") is None
+    job = jobs.show_job(job_id)
+    assert job["status"] == "failed"
+    assert "w1" in job["error"]
+
+
+def test_chunked_job_resumes_from_checkpoint(storage, monkeypatch):
+    storage_id = register(storage, ["bag1", "bag2", "bag3"])
+    monkeypatch.setitem(conf.fconf, "job_chunk_bags", 1)
+    real = bagval.validate_bags
+    chunks = []
+
+    def validate(**kwargs):
+        chunks.append(kwargs["bag_ids"])
+        if kwargs["bag_ids"] == [2] and len(chunks) == 2:
+            raise Exception("disk error")
+        return real(**kwargs)
+
+    monkeypatch.setattr(bagval, "validate_bags", validate)
+    job_id = jobs.enqueue("validate_bags", {"storage_id": storage_id,
+                                            "workers": 1})["job_id"]
+
+    assert jobs.run_job(jobs.claim("w1"), "w1") == "queued"
+    job = jobs.show_job(job_id)
+    assert job["checkpoint"]["last_bag_id"] == 1
+    assert job["checkpoint"]["result"]["VAL"] == 1
+
+    make_due(job_id)
+    assert jobs.run_job(jobs.claim("w2"), "w2") == "done"
+    assert chunks == [[1], [2], [2], [3]]
+    job = jobs.show_job(job_id)
+    assert (job["result"]["bags"], job["result"]["VAL"]) == (3, 3)
+    assert len(job["bag_event_ids"]) == 3
+
+
+def test_cancelled_chunked_job_stops_at_next_chunk(storage, monkeypatch):
+    storage_id = register(storage, ["bag1", "bag2", "bag3"])
+    monkeypatch.setitem(conf.fconf, "job_chunk_bags", 1)
+    job_id = jobs.enqueue("validate_bags", {"storage_id": storage_id,
+                                            "workers": 1})["job_id"]
+    job = jobs.claim("w1")
+    chunks = []
+
+    def validate(**kwargs):
+        chunks.append(kwargs["bag_ids"])
+        jobs.cancel_job(job_id)
+        return bagval.validate_bags(**kwargs)
+
+    with pytest.raises(jobs.LeaseLost):
+        jobs._run_chunked(job, validate, {"storage_id": storage_id,
+                                          "workers": 1},
+                          "w1", threading.Event())
+    assert chunks == [[1]]
+    job = jobs.show_job(job_id)
+    assert (job["status"], job["checkpoint"]) == ("cancelled", None)
+    # The worker records nothing for the cancelled job
+    assert jobs._finish(job, "w1", result={"bags": 1}) is None
+    assert jobs.show_job(job_id)["status"] == "cancelled"
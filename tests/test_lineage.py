@@ -0,0 +1,65 @@
+"""
+Tests of lineage lookups and the in-memory lineage index.
+"""
+
+import dbops
+import operational.bagmgmt as bagmgmt
+import operational.lineage as lineage
+
+from conftest import make_bag
+
+
+def register(storage, names):
+    storage_id, root = storage
+    for name in names:
+        make_bag(root + "PROC/STATE/DNCR/ACC1/" + name,
+                 {"a.txt": name.encode()})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    return dict((name, bag_id) for bag_id, name in dbops.connect().execute(
+        "SELECT bag_id, preservation_bag_name FROM bag"))
+
+
+def link(child, parent):
+    with dbops.transaction() as cur:
+        cur.execute("""INSERT INTO bag_has_parent_bag
+                         (child_bag_id, parent_bag_id) VALUES (?, ?)""",
+                    (child, parent))
+
+
+def test_index_follows_lineage_changes(storage, monkeypatch):
+    lineage.clear_index()
+    bags = register(storage, ["p", "c", "g"])
+    link(bags["c"], bags["p"])
+    assert lineage.descendants(bags["p"], "index") == {bags["c"]}
+    assert lineage.descendants(bags["p"], "cte") == {bags["c"]}
+
+    link(bags["g"], bags["c"])
+    assert lineage.descendants(bags["p"], "index") == {bags["c"], bags["g"]}
+    assert lineage.ancestors(bags["g"], "index") == {bags["c"], bags["p"]}
+
+    with dbops.transaction() as cur:
+        cur.execute("UPDATE bag SET bag_family_id = ? WHERE bag_id = ?",
+                    (bags["p"], bags["c"]))
+    assert lineage.family(bags["p"], "index") == {bags["p"], bags["c"]}
+    lineage.clear_index()
+
+
+def test_other_writes_keep_index(storage, monkeypatch):
+    lineage.clear_index()
+    bags = register(storage, ["p", "c"])
+    link(bags["c"], bags["p"])
+    lineage.load_index()
+
+    def reload():
+        raise AssertionError("index reloaded")
+    monkeypatch.setattr(lineage, "load_index", reload)
+    with dbops.transaction() as cur:
+        agents = dbops.agent_ids()
+        dbops.insert_bag_events(cur, [{
+            "bag_id": bags["p"], "event_type_code": "BGVAL",
+            "person_agent_id": agents[0], "software_agent_id": agents[1],
+            "end_time": dbops.timestamp(), "outcome_code": "VAL"}])
+        cur.execute("UPDATE bag SET general_notes = 'checked'")
+    assert lineage.descendants(bags["p"], "index") == {bags["c"]}
+    monkeypatch.undo()
+    lineage.clear_index()
@@ -0,0 +1,60 @@
+"""
+Tests of the session logger.
+"""
+
+import json
+import os
+
+import conf
+import logger as lg
+
+
+def test_forked_child_keeps_jsonl_format(tmp_path, monkeypatch):
+    monkeypatch.setattr(conf, "fconf", {"logging": True,
+                                        "logdir": str(tmp_path) + os.sep,
+                                        "log_format": "jsonl"})
+    lg.begin(quiet=True)
+    try:
+        lg.log("from the parent")
+        pid = os.fork()
+        if pid == 0:
+            try:
+                lg.log("from the child", "WARNING")
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        lg.flush()
+    finally:
+        lg.end()
+
+    with open(lg.logfilename) as fp:
+        records = [json.loads(line) for line in fp]
+    msgs = [(r["level"], r["msg"]) for r in records]
+    assert ("INFO", "from the parent") in msgs
+    assert ("WARNING", "from the child") in msgs
+
+
+def test_forked_child_opens_the_logfile_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(conf, "fconf", {"logging": True,
+                                        "logdir": str(tmp_path) + os.sep})
+    lg.begin(quiet=True)
+    try:
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                lg.log("child line 1")
+                fp = lg._child_fp
+                for n in range(2, 101):
+                    lg.log("child line " + str(n))
+                ok = fp is not None and lg._child_fp is fp
+            finally:
+                os._exit(0 if ok else 1)
+        assert os.waitpid(pid, 0)[1] == 0
+        lg.flush()
+    finally:
+        lg.end()
+
+    with open(lg.logfilename) as fp:
+        lines = [line for line in fp if "child line" in line]
+    assert len(lines) == 100
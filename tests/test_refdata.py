@@ -0,0 +1,40 @@
+"""
+Tests of the reference data cache.
+"""
+
+import sqlite3
+
+import dbops
+import refdata
+
+
+def test_same_length_update_by_other_connection(db):
+    assert refdata.agent_by_code("OCK")["agent_name"] == "Owen King"
+    con = sqlite3.connect(db)
+    con.execute("UPDATE agent SET agent_name = 'Owen Kong' "
+                "WHERE agent_code = 'OCK'")
+    con.commit()
+    con.close()
+    refdata.refresh()
+    assert refdata.agent_by_code("OCK")["agent_name"] == "Owen Kong"
+
+
+def test_update_by_own_connection(db):
+    assert refdata.storage(1) is None
+    with dbops.transaction() as cur:
+        cur.execute("""INSERT INTO storage (storage_name, path_root, in_use)
+                       VALUES ('s1', '/a/', 1)""")
+    refdata.refresh()
+    assert refdata.storage(1)["path_root"] == "/a/"
+    with dbops.transaction() as cur:
+        cur.execute("UPDATE storage SET path_root = '/b/'")
+    refdata.refresh()
+    assert refdata.storage(1)["path_root"] == "/b/"
+
+
+def test_unchanged_tables_are_not_reloaded(db, monkeypatch):
+    refdata.refresh()
+    with dbops.transaction() as cur:
+        cur.execute("UPDATE bag_family SET bag_family_id = bag_family_id")
+    monkeypatch.setattr(refdata, "load", lambda: 1 / 0)
+    refdata.refresh()
@@ -0,0 +1,52 @@
+"""
+Tests of exporting bag event reports.
+"""
+
+import xml.etree.ElementTree as ET
+
+import dbops
+import operational.bagmgmt as bagmgmt
+import operational.reports as reports
+
+from conftest import make_bag
+
+PREMIS = "{" + reports.PREMIS_NS + "}"
+
+
+def scan_event(bag_id):
+    agents = dbops.agent_ids()
+    with dbops.transaction() as cur:
+        dbops.insert_bag_events(cur, [{
+            "bag_id": bag_id, "event_type_code": "VRSSC",
+            "person_agent_id": agents[0], "software_agent_id": agents[1],
+            "end_time": dbops.timestamp(), "outcome_code": "NVIR"}])
+
+
+def test_premis_passes_share_a_snapshot(storage, tmp_path, monkeypatch):
+    storage_id, root = storage
+    for name in ("bag1", "bag2"):
+        make_bag(root + "PROC/STATE/DNCR/ACC1/" + name,
+                 {"a.txt": name.encode()})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    scan_event(1)
+
+    # An event recorded between the object pass and the event pass
+    events = reports._events
+
+    def late_events(where, args, agent_ids):
+        scan_event(2)
+        return events(where, args, agent_ids)
+    monkeypatch.setattr(reports, "_events", late_events)
+
+    output = str(tmp_path / "scans.xml")
+    summary = reports.export_events(output, event_type_code="VRSSC",
+                                    progress=False)
+    assert summary["events"] == 1
+    doc = ET.parse(output).getroot()
+    objects = [o.findtext(PREMIS + "objectIdentifier/" + PREMIS +
+                          "objectIdentifierValue")
+               for o in doc.iter(PREMIS + "object")]
+    linked = [e.findtext(PREMIS + "linkingObjectIdentifier/" + PREMIS +
+                         "linkingObjectIdentifierValue")
+              for e in doc.iter(PREMIS + "event")]
+    assert objects == linked == ["1"]
@@ -0,0 +1,93 @@
+"""
+Tests of the schema version, migrations, and query plan checks.
+"""
+
+import sqlite3
+
+import dbops
+import schema
+
+from conftest import V0_TABLES, DDL_SCRIPTS, run_scripts
+
+
+def objects(dbfile):
+    """
+    Returns the names of the tables, indexes, triggers, and views of a
+    database.
+    """
+    con = sqlite3.connect(dbfile)
+    names = set(con.execute("""SELECT type, name FROM sqlite_master
+                               WHERE name NOT LIKE 'sqlite_%'"""))
+    con.close()
+    return names
+
+
+def test_new_database_is_current(db):
+    assert schema.version() == schema.SCHEMA_VERSION
+    schema.check_version()
+
+
+def test_new_database_query_plans(db):
+    result = schema.check_query_plans()
+    assert result["failed"] == []
+    assert result["passed"] == len(schema.PLAN_CHECKS)
+
+
+def test_migrate_from_v0(tmp_path, start, db):
+    old = tmp_path / "SANCdpd_v0.db"
+    run_scripts(old, [V0_TABLES] + DDL_SCRIPTS[2:])
+    start(old, check_schema=False)
+    assert schema.version() == 0
+
+    result = schema.migrate()
+    assert result["version_before"] == 0
+    assert result["version_after"] == schema.SCHEMA_VERSION
+    assert len(result["applied"]) == len(schema.MIGRATIONS)
+    assert schema.check_query_plans()["failed"] == []
+
+    # A migrated database has the same tables, indexes, triggers, and views
+    # as one created with sql_ddl, except the views of create_views.sql
+    dbops.close()
+    assert objects(db) - objects(old) <= set(
+        ("view", n) for t, n in objects(db) if t == "view")
+    assert schema.migrate()["applied"] == []
+
+
+def test_migrate_duplicate_tagmanifests(tmp_path, start):
+    old = tmp_path / "SANCdpd_v0.db"
+    run_scripts(old, [V0_TABLES] + DDL_SCRIPTS[2:])
+    con = sqlite3.connect(old)
+    con.executescript("""
+        INSERT INTO records_collection (SANC_bib_record_id) VALUES ('B1');
+        INSERT INTO item (SANC_item_no) VALUES ('1');
+        INSERT INTO storage (path_root, storage_name, in_use)
+            VALUES ('/storage/', 'test storage', 1);
+        INSERT INTO bag_family DEFAULT VALUES;
+        INSERT INTO bag_family DEFAULT VALUES;""")
+    # The same tagmanifest, with its lines in a different order
+    for bag_id, text in ((1, "aa a.txt\nbb b.txt\n"),
+                         (2, "bb b.txt\naa a.txt\n")):
+        con.execute("""INSERT INTO bag (bag_id, bag_family_id, storage_id,
+                           preservation_path, preservation_bag_name,
+                           SANC_container_id, original_bag_name,
+                           records_collection_id, item_id, still_exists,
+                           born_digital, processing_status_code,
+                           path_records_status, path_collection_type,
+                           path_records_group, path_accession_no,
+                           "bag-info_contents", payload_files,
+                           payload_bytes, tagmanifest_contents)
+                       VALUES (?, ?, 1, 'PROC/STATE/DNCR/ACC1/', ?, ?, ?,
+                               1, 1, 1, 1, 'PROC', 'PROC', 'STATE', 'DNCR',
+                               'ACC1', '', 1, 1, ?)""",
+                    (bag_id, bag_id, "bag" + str(bag_id),
+                     "bag" + str(bag_id), "bag" + str(bag_id), text))
+    con.commit()
+    con.close()
+    start(old, check_schema=False)
+
+    assert schema.migrate()["version_after"] == schema.SCHEMA_VERSION
+    digests = dbops.connect().execute(
+        "SELECT bag_id, tagmanifest_digest FROM bag ORDER BY bag_id")
+    (first, digest), (second, duplicate) = digests.fetchall()
+    assert digest is not None
+    assert duplicate is None
@@ -0,0 +1,115 @@
+"""
+Tests of the full-text search index, its triggers, and its backfill.
+"""
+
+import sqlite3
+
+import dbops
+import schema
+import operational.search as search
+
+from conftest import V0_TABLES, DDL_SCRIPTS, run_scripts
+
+
+def indexed(fts, term):
+    """
+    Returns the rowids that the index fts itself holds for term, whether
+    or not the rows they came from still exist.
+    """
+    qstr = "SELECT rowid FROM " + fts + " WHERE " + fts + " MATCH ?"
+    return sorted(r[0] for r in dbops.connect().execute(qstr, (term,)))
+
+
+def check_index():
+    """
+    Checks that each search index matches the rows of its table.
+    """
+    with dbops.transaction() as cur:
+        for fts, table, rowid, cols in schema.SEARCH_INDEXES:
+            cur.execute("INSERT INTO " + fts + " (" + fts + ", rank) " +
+                        "VALUES ('integrity-check', 1)")
+
+
+def bag_ids(query):
+    return [r["bag_id"] for r in search.search_bags(query)["results"]]
+
+
+def test_search_backfill_and_triggers(tmp_path, start):
+    old = tmp_path / "SANCdpd_v0.db"
+    run_scripts(old, [V0_TABLES] + DDL_SCRIPTS[2:])
+    con = sqlite3.connect(old)
+    con.executescript("""
+        INSERT INTO records_collection (SANC_bib_record_id) VALUES ('B1');
+        INSERT INTO item (SANC_item_no) VALUES ('1');
+        INSERT INTO storage (path_root, storage_name, in_use)
+            VALUES ('/storage/', 'test storage', 1);""")
+    for bag_id, info in ((1, "Source-Organization: Water Board"),
+                         (2, "Source-Organization: Forestry Office"),
+                         (3, "Source-Organization: Ports Authority")):
+        con.execute("INSERT INTO bag_family DEFAULT VALUES")
+        con.execute("""INSERT INTO bag (bag_id, bag_family_id, storage_id,
+                           preservation_path, preservation_bag_name,
+                           SANC_container_id, original_bag_name,
+                           records_collection_id, item_id, still_exists,
+                           born_digital, processing_status_code,
+                           path_records_status, path_collection_type,
+                           path_records_group, path_accession_no,
+                           "bag-info_contents", payload_files,
+                           payload_bytes, tagmanifest_contents)
+                       VALUES (?, ?, 1, 'PROC/STATE/DNCR/ACC1/', ?, ?, ?,
+                               1, 1, 1, 1, 'PROC', 'PROC', 'STATE', 'DNCR',
+                               'ACC1', ?, 1, 1, ?)""",
+                    (bag_id, bag_id, "bag" + str(bag_id),
+                     "bag" + str(bag_id), "bag" + str(bag_id), info,
+                     "aa a" + str(bag_id) + ".txt\n"))
+    con.execute("""INSERT INTO bag_event (bag_id, event_type_code,
+                       software_agent_id, end_time, event_details,
+                       outcome_code)
+                   VALUES (2, 'QRNTN', 1, '2024-01-01 00:00:00',
+                           'Held for mould remediation', 'SUCC')""")
+    con.commit()
+    con.close()
+    start(old, check_schema=False)
+    schema.migrate()
+
+    # Rows from before the migration are not searchable until backfilled
+    assert search.search_bags("water")["total"] == 0
+    assert search.search_events("mould")["total"] == 0
+    # A row updated while waiting to be backfilled is left to the backfill
+    with dbops.transaction() as cur:
+        cur.execute("""UPDATE bag SET general_notes = 'flooded basement'
+                       WHERE bag_id = 3""")
+    assert indexed("bag_fts", "flooded") == []
+
+    summary = search.backfill_search(batch_size=1)
+    assert (summary["bag"], summary["bag_event"]) == (3, 1)
+    assert bag_ids("water") == [1]
+    assert bag_ids("flooded") == [3]
+    assert search.search_events("mould")["results"][0]["bag_id"] == 2
+    assert search.backfill_search()["bag"] == 0
+    check_index()
+
+    # An interrupted backfill resumes after the last row it indexed
+    with dbops.transaction() as cur:
+        cur.execute("INSERT INTO bag_fts (bag_fts) VALUES ('delete-all')")
+        cur.execute("""UPDATE search_backfill SET last_rowid = 1
+                       WHERE table_name = 'bag'""")
+    assert search.backfill_search(batch_size=1)["bag"] == 2
+    assert bag_ids("forestry") == [2]
+    assert bag_ids("water") == []
+    assert search.backfill_search(restart=True)["bag"] == 3
+    assert bag_ids("water") == [1]
+    check_index()
+
+    # Once indexed, rows are kept current by the triggers
+    with dbops.transaction() as cur:
+        cur.execute("""UPDATE bag
+                       SET "bag-info_contents" = 'Source-Organization: Mint'
+                       WHERE bag_id = 1""")
+        cur.execute("DELETE FROM bag_event WHERE bag_id = 2")
+        cur.execute("DELETE FROM bag WHERE bag_id = 2")
+    assert bag_ids("mint") == [1]
+    assert indexed("bag_fts", "water") == []
+    assert indexed("bag_fts", "forestry") == []
+    assert indexed("bag_event_fts", "mould") == []
+    check_index()
@@ -0,0 +1,32 @@
+"""
+Tests of splitting and merging bags.
+"""
+
+import errno
+
+import pytest
+
+import dbops
+import operational.bagmgmt as bagmgmt
+import operational.splitmerge as splitmerge
+import operational.stormig as stormig
+
+from conftest import make_bag
+
+
+def unsupported(src, dst):
+    raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+
+def test_split_unsupported_single_method(storage, monkeypatch):
+    storage_id, root = storage
+    make_bag(root + "PROC/STATE/DNCR/ACC1/bag1",
+             {"box1/a.txt": b"alpha", "box2/b.txt": b"beta"})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    monkeypatch.setattr(stormig, "_reflink", unsupported)
+
+    with pytest.raises(Exception, match="Copy method reflink is not "
+                       "supported on this filesystem"):
+        splitmerge.split_bag(1, paths="box1", method="reflink")
+    assert dbops.connect().execute("SELECT count(*) FROM bag"
+                                   ).fetchone()[0] == 1
@@ -0,0 +1,60 @@
+"""
+Tests of storage migration.
+"""
+
+import errno
+import os
+
+import dbops
+import refdata
+import operational.bagmgmt as bagmgmt
+import operational.stormig as stormig
+
+from conftest import make_bag
+
+
+def unsupported(src, dst):
+    raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+
+def target_storage(tmp_path):
+    root = tmp_path / "target"
+    root.mkdir()
+    with dbops.transaction() as cur:
+        cur.execute("""INSERT INTO storage (storage_name, path_root, in_use)
+                       VALUES ('target', ?, 1)""", (str(root) + os.sep,))
+        storage_id = cur.lastrowid
+    refdata.invalidate()
+    return storage_id, str(root) + os.sep
+
+
+def test_migrate_storage(storage, tmp_path):
+    storage_id, root = storage
+    make_bag(root + "PROC/STATE/DNCR/ACC1/bag1", {"a.txt": b"alpha"})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    target_id, target_root = target_storage(tmp_path)
+
+    summary = stormig.migrate_storage(storage_id, target_id, method="copy")
+    assert (summary["migrated"], summary["errors"]) == (1, 0)
+    assert os.path.isfile(target_root + "PROC/STATE/DNCR/ACC1/bag1/bagit.txt")
+    assert dbops.connect().execute("SELECT storage_id FROM bag"
+                                   ).fetchone()[0] == target_id
+
+
+def test_unsupported_single_method(storage, tmp_path, monkeypatch):
+    storage_id, root = storage
+    make_bag(root + "PROC/STATE/DNCR/ACC1/bag1", {"a.txt": b"alpha"})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+    target_id, target_root = target_storage(tmp_path)
+    monkeypatch.setattr(stormig, "_reflink", unsupported)
+
+    summary = stormig.migrate_storage(storage_id, target_id,
+                                      method="reflink")
+    assert (summary["migrated"], summary["errors"]) == (0, 1)
+    outcome, details = dbops.connect().execute(
+        """SELECT outcome_code, outcome_details FROM storage_event
+           WHERE event_type_code = 'STMIG'""").fetchone()
+    assert outcome == "ERR"
+    assert ("Copy method reflink is not supported on this filesystem "
+            "(Operation not supported)") in details
+    assert not os.path.exists(target_root + "PROC/STATE/DNCR/ACC1/bag1")
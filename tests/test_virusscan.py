@@ -0,0 +1,72 @@
+"""
+Tests of virus scanning, with the stand-in scanner of the scanstub module.
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+import conf
+import dbops
+import operational.bagmgmt as bagmgmt
+import operational.scanstub as scanstub
+import operational.virusscan as virusscan
+
+from conftest import make_bag
+
+
+@pytest.fixture
+def scanner(tmp_path, monkeypatch):
+    """
+    Serves the stand-in scanner on a Unix socket in a thread, and points
+    the config file's clamd_address at it.
+    """
+    address = str(tmp_path / "clamd.sock")
+    threading.Thread(target=scanstub.serve, args=(address,),
+                     daemon=True).start()
+    for _ in range(100):
+        if os.path.exists(address):
+            break
+        time.sleep(0.05)
+    monkeypatch.setitem(conf.fconf, "clamd_address", address)
+    return address
+
+
+def events(event_type_code):
+    return dbops.connect().execute(
+        """SELECT b.preservation_bag_name, e.outcome_code
+           FROM bag_event e JOIN bag b ON b.bag_id = e.bag_id
+           WHERE e.event_type_code = ?
+           ORDER BY e.bag_event_id""", (event_type_code,)).fetchall()
+
+
+@pytest.mark.parametrize("mode", ["instream", "multiscan"])
+def test_scan_quarantine_and_release(storage, scanner, mode):
+    storage_id, root = storage
+    infected = make_bag(root + "PROC/STATE/DNCR/ACC1/infected",
+                        {"a.txt": b"alpha", "b.com": scanstub.EICAR})
+    make_bag(root + "PROC/STATE/DNCR/ACC1/clean", {"a.txt": b"beta"})
+    bagmgmt.register_storage(storage_id, bib_record_id="B1", item_no="1")
+
+    summary = virusscan.scan_bags(storage_id=storage_id, mode=mode,
+                                  connections=2)
+    assert (summary["NVIR"], summary["VIR"], summary["ERR"]) == (1, 1, 0)
+    assert sorted(events("VRSSC")) == [("clean", "NVIR"),
+                                       ("infected", "VIR")]
+    assert [name for name, outcome in events("QRNTN")] == ["infected"]
+
+    # A second scan does not quarantine the bag again
+    virusscan.scan_bags(storage_id=storage_id, mode=mode, connections=2)
+    assert [name for name, outcome in events("QRNTN")] == ["infected"]
+    assert events("UNQRN") == []
+
+    # Once the file is cleaned, the bag is released
+    with open(os.path.join(infected, "data", "b.com"), "wb") as fp:
+        fp.write(b"clean now")
+    summary = virusscan.scan_bags(storage_id=storage_id, mode=mode,
+                                  connections=2)
+    assert (summary["NVIR"], summary["VIR"], summary["ERR"]) == (2, 0, 0)
+    assert [name for name, outcome in events("UNQRN")] == ["infected"]
+    assert [name for name, outcome in events("QRNTN")] == ["infected"]